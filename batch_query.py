@@ -0,0 +1,250 @@
+"""
+批量问答 (batch_query.py)
+功能: 离线批量回答 JSONL 中的问题 (评测集 / 报表生成)，不经过 HTTP
+  - 检索按批进行: 一批问题的 query 向量一次前向，Pro 模式一批的 (问题, 子块) 对合成一次 Rerank
+  - LLM 调用走有上限的异步池 (--concurrency)，检索下一批与等待上一批的回答同时进行
+  - 每答完一题立即追加一行到输出 JSONL (含各阶段耗时)，中断后再次运行跳过已完成的问题
+  - 批量问答不做意图路由，所有问题都检索知识库
+输入: 每行一个 JSON，{"question": "...", "id": 可选, "filters": 可选 (同 /api/chat)}，也可以是纯字符串；没有 id 时用行号
+输出: 每行 {"id", "question", "status": ok / no_context / error, "answer", "think", "sources", "timings", "error"}
+用法: python batch_query.py questions.jsonl answers.jsonl [--kb default] [--mode flash|pro] [--concurrency 4]
+      [--batch-size 16] [--multi-query off|local|llm] [--no-llm] [--quiet]
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+from kb_manager import KnowledgeBaseManager, DEFAULT_KB
+from stream_parser import ThinkParser
+
+STATUS_OK = "ok"
+STATUS_NO_CONTEXT = "no_context"
+STATUS_ERROR = "error"
+DONE_STATUSES = (STATUS_OK, STATUS_NO_CONTEXT)  # 续跑时跳过；失败的问题会重新回答
+
+
+def log(message):
+    """进度信息写 stderr (--quiet 时 stdout 上的检索日志被丢弃)"""
+    print(message, file=sys.stderr, flush=True)
+
+
+# ============================================================
+# 输入 / 输出
+# ============================================================
+
+def read_questions(path):
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            if isinstance(item, str):
+                item = {"question": item}
+            item.setdefault("id", line_no)
+            items.append(item)
+    return items
+
+
+def completed_ids(path):
+    """输出文件中已完成的问题 id (中断时写了一半的最后一行忽略)"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("status") in DONE_STATUSES:
+                done.add(str(record["id"]))
+    return done
+
+
+class ResultWriter:
+    """逐行追加并立即落盘，进程被杀也只丢正在写的那一行"""
+
+    def __init__(self, path):
+        self._f = open(path, "a", encoding="utf-8")
+        self.counts = {STATUS_OK: 0, STATUS_NO_CONTEXT: 0, STATUS_ERROR: 0}
+        self.timings = []
+
+    def write(self, record):
+        self._f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self.counts[record["status"]] += 1
+        self.timings.append(record["timings"])
+
+    def close(self):
+        self._f.close()
+
+
+# ============================================================
+# 检索 (按批) → LLM (有上限的异步池)
+# ============================================================
+
+def prepare_batch(rag, items, mode, multi_query):
+    """一批问题的检索 + Prompt 组装 (在工作线程中执行)，返回每题的 (messages, sources, 耗时) 或错误"""
+    questions = [item["question"] for item in items]
+    start = time.perf_counter()
+    retrieved = rag.retrieve_many(questions, mode=mode, filters=[item.get("filters") for item in items],
+                                  multi_query=multi_query)
+    batch_ms = (time.perf_counter() - start) * 1000
+    # 批内合并的编码 / Rerank 耗时按题数均摊，逐题检索的耗时单独记
+    search_total = sum(r[1] for r in retrieved if not isinstance(r, Exception))
+    shared_ms = max(0.0, batch_ms - search_total) / len(items)
+
+    prepared = []
+    for item, result in zip(items, retrieved):
+        if isinstance(result, Exception):
+            prepared.append({"error": f"检索失败: {result}"})
+            continue
+        ids, search_ms = result
+        timings = {"batch_shared_ms": round(shared_ms, 2), "search_ms": round(search_ms, 2)}
+        if not len(ids):
+            prepared.append({"messages": None, "sources": [], "timings": timings})
+            continue
+        start = time.perf_counter()
+        messages, docs = rag.build_answer_messages(item["question"], ids)
+        timings["prompt_ms"] = round((time.perf_counter() - start) * 1000, 2)
+        sources = [{
+            "source": os.path.basename(d.metadata.get("source", "unknown")),
+            "page": d.metadata.get("page", 0) + 1,
+            "chunk_id": d.metadata.get("chunk_id"),
+        } for d in docs]
+        prepared.append({"messages": messages, "sources": sources, "timings": timings})
+    return prepared
+
+
+async def answer(rag, item, prepared, slots, llm_pool, writer, use_llm):
+    """一个问题的 LLM 调用 (占用并发池的一个名额) 与结果写出"""
+    record = {"id": item["id"], "question": item["question"], "status": STATUS_OK,
+              "answer": None, "think": None, "sources": prepared.get("sources", []),
+              "timings": prepared.get("timings", {}), "error": prepared.get("error")}
+    if record["error"]:
+        record["status"] = STATUS_ERROR
+    elif prepared["messages"] is None:
+        record["status"] = STATUS_NO_CONTEXT
+    elif use_llm:
+        queued_at = time.perf_counter()
+        async with slots:
+            start = time.perf_counter()
+            try:
+                content = await asyncio.get_running_loop().run_in_executor(llm_pool, rag.complete, prepared["messages"])
+                parser = ThinkParser()
+                parser.feed(content)
+                parser.flush()
+                record["answer"], record["think"] = parser.content, parser.thought.strip() or None
+            except Exception as e:
+                record["status"], record["error"] = STATUS_ERROR, f"LLM 调用失败: {e}"
+            record["timings"]["llm_wait_ms"] = round((start - queued_at) * 1000, 2)
+            record["timings"]["llm_ms"] = round((time.perf_counter() - start) * 1000, 2)
+    timings = record["timings"]
+    timings["total_ms"] = round(sum(v for k, v in timings.items() if k != "llm_wait_ms"), 2)  # 不含排队等待
+    writer.write(record)
+
+
+async def run(args):
+    items = read_questions(args.input)
+    done = completed_ids(args.output)
+    todo = [item for item in items if str(item["id"]) not in done]
+    log(f"📋 共 {len(items)} 个问题，已完成 {len(items) - len(todo)} 个，本次回答 {len(todo)} 个")
+    if not todo:
+        return 0
+
+    manager = KnowledgeBaseManager()
+    rag = await asyncio.to_thread(manager.get, args.kb)
+    writer = ResultWriter(args.output)
+    llm_pool = ThreadPoolExecutor(max_workers=args.concurrency, thread_name_prefix="batch-llm")
+    slots = asyncio.Semaphore(args.concurrency)
+    in_flight = set()
+    failures = []  # answer() 本身抛出的异常 (如结果写盘失败)，这些问题没有写出
+    started = time.perf_counter()
+    try:
+        for offset in range(0, len(todo), args.batch_size):
+            # 背压: 已检索完、还在等 LLM 的问题过多时先等一部分答完，再检索下一批
+            while len(in_flight) >= args.concurrency * 2 + args.batch_size:
+                done, in_flight = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                failures += task_errors(done)
+            batch = todo[offset:offset + args.batch_size]
+            prepared = await asyncio.to_thread(prepare_batch, rag, batch, args.mode, args.multi_query)
+            for item, p in zip(batch, prepared):
+                in_flight.add(asyncio.create_task(answer(rag, item, p, slots, llm_pool, writer, not args.no_llm)))
+            finished = sum(writer.counts.values())
+            log(f"   -> 已检索 {offset + len(batch)}/{len(todo)} 个，已写出 {finished} 个")
+        if in_flight:
+            done, in_flight = await asyncio.wait(in_flight)
+            failures += task_errors(done)
+    finally:
+        for task in in_flight:
+            task.cancel()
+        writer.close()
+        llm_pool.shutdown(wait=False, cancel_futures=True)
+        manager.close()
+
+    report(writer, time.perf_counter() - started)
+    if failures:
+        log(f"❌ {len(failures)} 个问题的结果未能写出 (再次运行会重新回答): {failures[0]!r}")
+        return 1
+    return 0
+
+
+def task_errors(tasks):
+    """已结束的任务中抛出的异常 (取出后不会再有 "Task exception was never retrieved")"""
+    return [task.exception() for task in tasks if task.exception() is not None]
+
+
+def report(writer, elapsed_s):
+    n = sum(writer.counts.values())
+    log(f"\n   {'='*60}")
+    log(f"   📊 批量问答完成: {n} 个问题，耗时 {elapsed_s:.1f}s ({n / max(elapsed_s, 1e-9):.2f} 题/秒)")
+    log(f"   {'='*60}")
+    log(f"   │ 成功 {writer.counts[STATUS_OK]} | 无参考资料 {writer.counts[STATUS_NO_CONTEXT]} | "
+        f"失败 {writer.counts[STATUS_ERROR]} (再次运行会重试失败的问题)")
+    for key in ("search_ms", "batch_shared_ms", "prompt_ms", "llm_wait_ms", "llm_ms", "total_ms"):
+        values = [t[key] for t in writer.timings if key in t]
+        if values:
+            log(f"   │ {key:<16} p50 {np.median(values):9.1f}ms | p95 {np.percentile(values, 95):9.1f}ms")
+    log(f"   {'='*60}\n")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="离线批量问答: JSONL 问题 → JSONL 回答 (可中断续跑)")
+    parser.add_argument("input", help="问题文件 (JSONL)")
+    parser.add_argument("output", help="回答文件 (JSONL，追加写入；已完成的问题再次运行时跳过)")
+    parser.add_argument("--kb", default=DEFAULT_KB, help="知识库名称")
+    parser.add_argument("--mode", default="flash", choices=["flash", "pro"], help="检索模式")
+    parser.add_argument("--concurrency", type=int, default=4, help="同时进行的 LLM 调用数")
+    parser.add_argument("--batch-size", type=int, default=16, help="每批检索 / Rerank 的问题数")
+    parser.add_argument("--multi-query", default=None, choices=["off", "local", "llm"], help="多查询检索模式")
+    parser.add_argument("--no-llm", action="store_true", help="只检索，不调用 LLM (评测召回用)")
+    parser.add_argument("--quiet", action="store_true", help="不输出逐题的检索日志")
+    args = parser.parse_args()
+    args.concurrency = max(1, args.concurrency)
+    args.batch_size = max(1, args.batch_size)
+    return args
+
+
+def main():
+    args = parse_args()
+    with contextlib.ExitStack() as stack:
+        if args.quiet:
+            stack.enter_context(contextlib.redirect_stdout(stack.enter_context(open(os.devnull, "w"))))
+        return asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
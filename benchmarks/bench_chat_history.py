@@ -0,0 +1,88 @@
+"""
+聊天记录库压缩压测 (bench_chat_history.py)
+对比: 旧格式 (每条回答整段存参考来源 JSON、思考过程明文、全文索引存全文) vs compact_history 之后 (来源去重引用 + 思考过程 zlib + contentless 全文索引 + 增量回收)
+方法: 在临时目录构造合成库，会话数 × 每会话轮数，参考来源从固定的片段池中抽取 (同一知识库的高频片段反复被引用)
+      统计库大小、按会话加载全部消息的平均耗时、全文检索耗时
+用法: python benchmarks/bench_chat_history.py [会话数] [每会话轮数]
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+
+TMP_DIR = tempfile.mkdtemp(prefix="bench_chat_")
+os.environ["RAG_CHAT_DB"] = os.path.join(TMP_DIR, "chat_history.db")
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+
+import database as db
+from chat_maintenance import compact_history, measure_latency
+
+PHRASES = ["报销流程需要提交发票原件", "差旅费用按照标准执行", "审批人为部门负责人", "年假天数与工龄相关",
+           "The reimbursement policy applies to all staff", "加班需提前在系统中申请"]
+POOL_SIZE = 300
+SOURCES_PER_ANSWER = 5
+
+
+def text(rng, n_chars):
+    parts = []
+    while sum(map(len, parts)) < n_chars:
+        parts.append(rng.choice(PHRASES))
+    return "，".join(parts)
+
+
+def build(n_sessions, turns):
+    """直接按旧格式写入 (绕过 add_message)"""
+    rng = random.Random(0)
+    pool = [{"source": f"doc_{i % 40}.pdf", "page": i % 25 + 1, "chunk_id": i, "content": text(rng, 400)}
+            for i in range(POOL_SIZE)]
+    conn = db.get_db_connection()
+    # 旧版全文索引 (存一份分词后的全文)
+    conn.execute('DROP TABLE messages_fts')
+    conn.execute("CREATE VIRTUAL TABLE messages_fts USING fts5(content, thought, tokenize = 'unicode61')")
+    conn.execute("INSERT INTO messages_fts(messages_fts, rank) VALUES('rank', 'bm25(1.0, 0.4)')")
+    db._create_message_index_triggers(conn, contentless=False)
+    for _ in range(n_sessions):
+        sid = db.create_session(title="压测会话")
+        for _ in range(turns):
+            conn.execute('INSERT INTO messages (session_id, role, content) VALUES (?, ?, ?)',
+                         (sid, "user", text(rng, 30)))
+            sources = rng.sample(pool, SOURCES_PER_ANSWER)
+            conn.execute('INSERT INTO messages (session_id, role, content, thought, sources) VALUES (?, ?, ?, ?, ?)',
+                         (sid, "assistant", text(rng, 300), text(rng, 1500), json.dumps(sources, ensure_ascii=False)))
+        conn.commit()
+    conn.close()
+
+
+def search_ms(repeat=20):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        db.search_messages("报销 发票")
+    return (time.perf_counter() - t0) * 1000 / repeat
+
+
+def main():
+    n_sessions = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    turns = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    build(n_sessions, turns)
+    print(f"\n   {'='*72}")
+    print(f"   📊 聊天记录库压缩 ({n_sessions} 个会话 × {turns} 轮，来源片段池 {POOL_SIZE})")
+    print(f"   {'='*72}")
+    before_file = os.path.getsize(db.DB_PATH)
+    before_load, before_search = measure_latency(), search_ms()
+    _, report = compact_history(offline=True)
+    after_file = os.path.getsize(db.DB_PATH)
+    after_load, after_search = measure_latency(), search_ms()
+    print(f"   │ 库文件大小:     {before_file / 1024 / 1024:8.2f}MB -> {after_file / 1024 / 1024:8.2f}MB "
+          f"(x{before_file / after_file:.1f})")
+    print(f"   │ 会话消息加载:   {before_load:8.2f}ms -> {after_load:8.2f}ms")
+    print(f"   │ 全文检索:       {before_search:8.2f}ms -> {after_search:8.2f}ms")
+    print(f"   │ 转换消息: {report['converted_messages']} 条 | 清理来源片段: {report['pruned_source_chunks']} 条")
+    print(f"   {'='*72}\n")
+    print(f"   (临时库: {db.DB_PATH})")
+
+
+if __name__ == "__main__":
+    main()
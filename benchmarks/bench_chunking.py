@@ -0,0 +1,133 @@
+"""
+切分策略压测 (bench_chunking.py)
+对比: 旧做法 (所有格式同一套字符切分: 父块 800 字无重叠，子块 200 字重叠 50) vs 按类型自适应切分 (chunking.py)
+方法: 合成 Markdown (多级标题 + 表格)、CSV (一行一条记录)、中文 / 英文纯文本，按类型统计父块数、子块数、
+      子块平均 token 数，并用入库的 Embedding 模型实际计算全部子块，统计各类型的 embedding 耗时
+用法: python benchmarks/bench_chunking.py [每种类型的文件数]
+"""
+
+import os
+import sys
+import time
+import random
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+os.environ["HF_HUB_OFFLINE"] = "1"
+
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_huggingface import HuggingFaceEmbeddings
+
+from context_builder import estimate_tokens
+from ingest import iter_split, chunker_for
+
+ZH_SENTENCES = ["报销流程需要提交发票原件。", "差旅费用按照公司标准执行，超标部分自理。", "审批人为部门负责人，金额较大时需分管领导复核。",
+                "年假天数与工龄相关，满一年后按月折算。", "加班需提前在系统中申请，事后补录无效。"]
+EN_SENTENCES = ["The reimbursement policy applies to all full-time staff. ", "Travel expenses follow the standard rates. ",
+                "Approvals are handled by the department head. ", "Overtime must be requested in advance. "]
+
+
+def paragraph(rng, sentences, n):
+    return "".join(rng.choice(sentences) for _ in range(n))
+
+
+def make_markdown(rng, i):
+    parts = [f"# 员工手册 {i}\n"]
+    for chapter in range(6):
+        parts.append(f"## 第 {chapter + 1} 章\n")
+        for section in range(rng.randint(1, 4)):
+            parts.append(f"### {chapter + 1}.{section + 1} 条款\n")
+            parts.append(paragraph(rng, ZH_SENTENCES, rng.randint(1, 12)) + "\n")
+        if chapter % 2 == 0:
+            rows = "\n".join(f"| 城市{r} | {300 + r} 元 | {80 + r} 元 |" for r in range(rng.randint(5, 40)))
+            parts.append("| 城市 | 住宿标准 | 餐补 |\n|---|---|---|\n" + rows + "\n")
+    return [Document(page_content="\n".join(parts), metadata={"source": f"handbook_{i}.md"})]
+
+
+def make_csv(rng, i):
+    return [Document(page_content=f"工号: {i:03d}{row:04d}\n姓名: 员工{row}\n部门: {rng.choice(['财务部', '人事部', '研发部'])}\n"
+                                  f"备注: {paragraph(rng, ZH_SENTENCES, rng.randint(0, 2))}",
+                     metadata={"source": f"staff_{i}.csv", "row": row}) for row in range(300)]
+
+
+def make_text(rng, i, sentences, suffix):
+    text = "\n\n".join(paragraph(rng, sentences, rng.randint(3, 30)) for _ in range(40))
+    return [Document(page_content=text, metadata={"source": f"notes_{i}_{suffix}.txt"})]
+
+
+def legacy_split(documents):
+    """旧做法: 所有格式同一套字符切分，返回 {类型: (父块数, [子块文本])}"""
+    parent_splitter = RecursiveCharacterTextSplitter(chunk_size=800, chunk_overlap=0)
+    child_splitter = RecursiveCharacterTextSplitter(chunk_size=200, chunk_overlap=50)
+    result = {}
+    for document in documents:
+        kind = kind_of(document.metadata["source"])
+        entry = result.setdefault(kind, [0, []])
+        for parent in parent_splitter.split_documents([document]):
+            entry[0] += 1
+            entry[1].extend(child_splitter.split_text(parent.page_content))
+    return result
+
+
+def adaptive_split(documents):
+    result = {}
+    for _, _, children in iter_split(documents):
+        kind = kind_of(children[0][0].metadata["source"]) if children else None
+        if kind is None:
+            continue
+        entry = result.setdefault(kind, [0, []])
+        entry[0] += 1
+        entry[1].extend(doc.page_content for doc, _ in children)
+    return result
+
+
+def kind_of(source):
+    if source.endswith(".txt"):
+        return "txt (英文)" if "_en" in source else "txt (中文)"
+    return os.path.splitext(source)[1][1:] + f" ({chunker_for(source).name})"
+
+
+def embed_seconds(model, texts, batch=256):
+    t0 = time.perf_counter()
+    for start in range(0, len(texts), batch):
+        model.embed_documents(texts[start:start + batch])
+    return time.perf_counter() - t0
+
+
+def main():
+    n_files = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    rng = random.Random(0)
+    documents = []
+    for i in range(n_files):
+        documents += make_markdown(rng, i)
+        documents += make_csv(rng, i)
+        documents += make_text(rng, i, ZH_SENTENCES, "zh")
+        documents += make_text(rng, i, EN_SENTENCES, "en")
+
+    model = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2", model_kwargs={"device": "cpu"})
+    model.embed_documents(["warmup"])
+    legacy, adaptive = legacy_split(documents), adaptive_split(documents)
+
+    print(f"\n   {'='*96}")
+    print(f"   📊 切分策略对比 (每种类型 {n_files} 个文件)")
+    print(f"   {'='*96}")
+    print(f"   │ {'类型':<16}{'父块 旧→新':>14}{'子块 旧→新':>16}{'子块平均 token 旧→新':>24}{'embedding 旧→新':>22}")
+    totals = [0, 0, 0.0, 0.0]
+    for kind in sorted(adaptive):
+        old_parents, old_children = legacy.get(kind, (0, []))
+        new_parents, new_children = adaptive[kind]
+        old_s, new_s = embed_seconds(model, old_children), embed_seconds(model, new_children)
+        old_avg = sum(map(estimate_tokens, old_children)) / max(1, len(old_children))
+        new_avg = sum(map(estimate_tokens, new_children)) / max(1, len(new_children))
+        print(f"   │ {kind:<16}{old_parents:>7} → {new_parents:<5}{len(old_children):>8} → {len(new_children):<6}"
+              f"{old_avg:>12.0f} → {new_avg:<8.0f}{old_s:>12.2f}s → {new_s:.2f}s")
+        totals[0] += len(old_children)
+        totals[1] += len(new_children)
+        totals[2] += old_s
+        totals[3] += new_s
+    print(f"   │ {'合计':<16}{'':>14}{totals[0]:>8} → {totals[1]:<6}{'':>22}{totals[2]:>12.2f}s → {totals[3]:.2f}s")
+    print(f"   {'='*96}\n")
+
+
+if __name__ == "__main__":
+    main()
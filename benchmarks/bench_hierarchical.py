@@ -0,0 +1,122 @@
+"""
+分层检索压测 (bench_hierarchical.py)
+对比: 平铺检索 (向量 + BM25 对全部子块打分) vs 分层检索 (父块层路由 → 只对候选子块打分)，两者都经 RRF 融合
+方法: 合成语料，每个父块有自己的主题向量与关键词，子块 = 父块向量 + 噪声；查询取自随机子块 (向量加噪声 + 两个关键词)
+      在不同语料规模下统计单次检索延迟、分层结果与平铺结果的 Top-K 重合率、命中查询来源子块的比例
+用法: python benchmarks/bench_hierarchical.py [查询次数] [k] [每父块子块数]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+
+from chunk_store import ChunkStore
+from bm25_index import BM25Index
+from fusion import weighted_rrf
+from vector_store import MatrixVectorStore, write_matrix_index
+from hierarchical_index import ParentIndex, HIER_PARENTS
+
+DIM = 384
+SCALES = [10_000, 50_000, 200_000]
+VOCAB = 5000
+COMMON_WORDS = [f"w{i}" for i in range(50)]
+
+
+def build(n_children, per_parent, rng, db_dir):
+    n_parents = n_children // per_parent
+    parent_vectors = rng.normal(size=(n_parents, DIM)).astype(np.float32)
+    parent_words = rng.integers(0, VOCAB, size=(n_parents, 4))
+    chroma_ids, texts, metadatas, vectors, parent_map = [], [], [], [], {}
+    for p in range(n_parents):
+        pid = f"p{p}"
+        parent_map[pid] = pid
+        for c in range(per_parent):
+            chunk_id = p * per_parent + c
+            words = [f"k{w}" for w in parent_words[p][rng.permutation(4)[:3]]] + list(rng.choice(COMMON_WORDS, 20))
+            texts.append(" ".join(words))
+            metadatas.append({"source": f"doc{p % 200}.md", "parent_id": pid, "chunk_id": chunk_id})
+            chroma_ids.append(str(chunk_id))
+            vectors.append(parent_vectors[p] + rng.normal(scale=0.8, size=DIM))
+    vectors = np.asarray(vectors, dtype=np.float32)
+    write_matrix_index(db_dir, [m["chunk_id"] for m in metadatas], vectors)
+
+    store = ChunkStore(chroma_ids, texts, metadatas, parent_map)
+    vector_store = MatrixVectorStore(db_dir)
+    vector_store.align(store.chunk_ids)
+    tokenize = lambda batch: [t.split() for t in batch]
+    bm25 = BM25Index(tokenize(texts))
+    t0 = time.perf_counter()
+    parent_index = ParentIndex(store, vector_store.vectors, tokenize)
+    build_s = time.perf_counter() - t0
+    return store, vector_store, bm25, parent_index, vectors, parent_words, build_s
+
+
+def bm25_top(bm25, store, tokens, k, rows=None):
+    if rows is None:
+        rows = np.arange(len(bm25), dtype=np.int64)
+        scores = bm25.get_scores(tokens)
+    else:
+        scores = bm25.get_batch_scores(tokens, rows)
+    k = min(k, len(scores))
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top])]
+    return store.chunk_ids[rows[top[scores[top] > 0]]]
+
+
+def search(store, vector_store, bm25, q, tokens, k, rows=None):
+    vector_ids = vector_store.search(q, k=min(k * 3, 20), rows=rows)
+    bm25_ids = bm25_top(bm25, store, tokens, min(k * 3, 20), rows=rows)
+    return weighted_rrf([vector_ids, bm25_ids], top_k=k)[0]
+
+
+def main():
+    n_queries = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    per_parent = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    print(f"\n   {'='*92}")
+    print(f"   🌲 平铺 vs 分层检索 ({n_queries} 次查询, k={k}, 每父块 {per_parent} 个子块, 每路路由 {HIER_PARENTS} 个父块)")
+    print(f"   {'='*92}")
+    for n_children in SCALES:
+        rng = np.random.default_rng(0)
+        db_dir = tempfile.mkdtemp(prefix="bench_hier_")
+        try:
+            store, vector_store, bm25, parent_index, vectors, parent_words, build_s = build(n_children, per_parent, rng, db_dir)
+            targets = rng.integers(0, n_children, size=n_queries)
+            flat_ms, hier_ms, overlap, flat_hits, hier_hits, candidates = [], [], [], 0, 0, []
+            for target in targets:
+                q = vectors[target] + rng.normal(scale=0.5, size=DIM).astype(np.float32)
+                tokens = [f"k{w}" for w in parent_words[target // per_parent][:2]] + list(rng.choice(COMMON_WORDS, 3))
+
+                t0 = time.perf_counter()
+                flat = search(store, vector_store, bm25, q, tokens, k)
+                flat_ms.append((time.perf_counter() - t0) * 1000)
+
+                t0 = time.perf_counter()
+                rows, _ = parent_index.route(q, tokens, HIER_PARENTS)
+                hier = search(store, vector_store, bm25, q, tokens, k, rows=rows)
+                hier_ms.append((time.perf_counter() - t0) * 1000)
+
+                candidates.append(len(rows))
+                overlap.append(len(np.intersect1d(flat, hier)) / max(1, len(flat)))
+                flat_hits += int(target in flat)
+                hier_hits += int(target in hier)
+
+            flat_p50, hier_p50 = np.median(flat_ms), np.median(hier_ms)
+            print(f"   │ 子块 {n_children:>7} | 平铺 p50 {flat_p50:7.2f}ms | 分层 p50 {hier_p50:7.2f}ms (x{flat_p50 / hier_p50:.1f}) | "
+                  f"候选 {np.mean(candidates):6.0f} 个")
+            print(f"   │ {'':13}| Top-{k} 与平铺重合 {np.mean(overlap) * 100:5.1f}% | 命中来源子块 平铺 {flat_hits / n_queries * 100:5.1f}% "
+                  f"/ 分层 {hier_hits / n_queries * 100:5.1f}% | 父块层构建 {build_s:.1f}s")
+        finally:
+            shutil.rmtree(db_dir, ignore_errors=True)
+    print(f"   {'='*92}\n")
+
+
+if __name__ == "__main__":
+    main()
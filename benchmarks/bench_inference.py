@@ -0,0 +1,93 @@
+"""
+推理服务压测 (bench_inference.py)
+对比: 每个请求各自调用 embed_query / CrossEncoder.predict  vs  经 InferenceService 微批处理
+用法: python benchmarks/bench_inference.py [并发数] [每线程请求数]
+"""
+
+import os
+import sys
+import time
+import threading
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+os.environ["HF_HUB_OFFLINE"] = "1"
+
+from langchain_huggingface import HuggingFaceEmbeddings
+from sentence_transformers import CrossEncoder
+
+from inference_service import InferenceService
+from resources import RERANK_MODEL_PATH
+
+QUESTIONS = [
+    "合同的违约责任是什么？",
+    "How is the parent-child chunking strategy implemented?",
+    "报销流程需要哪些材料",
+    "What does the reranker do in pro mode?",
+]
+DOCS = ["这是一段用于重排序测试的文档内容，长度大约与子块相当。" * 4] * 20
+
+
+def run_concurrent(fn, concurrency, per_thread):
+    """并发执行 fn，返回 (总耗时秒, 单次延迟列表 ms)"""
+    latencies = []
+    lock = threading.Lock()
+
+    def worker(tid):
+        for i in range(per_thread):
+            q = QUESTIONS[(tid + i) % len(QUESTIONS)]
+            t0 = time.perf_counter()
+            fn(q)
+            with lock:
+                latencies.append((time.perf_counter() - t0) * 1000)
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, latencies
+
+
+def report(name, elapsed, latencies):
+    latencies.sort()
+    p50 = latencies[len(latencies) // 2]
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(f"   │ {name:<22} 吞吐: {len(latencies) / elapsed:7.1f} req/s | p50: {p50:7.2f}ms | p95: {p95:7.2f}ms")
+
+
+def main():
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    per_thread = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    embedding_model = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2", model_kwargs={"device": "cpu"})
+    try:
+        reranker = CrossEncoder(RERANK_MODEL_PATH, device="cpu")
+    except Exception as e:
+        print(f"⚠️ Rerank 模型加载失败，跳过 rerank 压测: {e}")
+        reranker = None
+
+    service = InferenceService(embedding_model, reranker)
+    embedding_model.embed_query("warmup")
+
+    print(f"\n   {'='*60}")
+    print(f"   ⚡ 推理服务压测 (并发 {concurrency} × 每线程 {per_thread} 次)")
+    print(f"   {'='*60}")
+
+    for c in (1, concurrency):
+        print(f"   │ --- 并发 {c} ---")
+        report("embed (直接调用)", *run_concurrent(embedding_model.embed_query, c, per_thread))
+        report("embed (微批处理)", *run_concurrent(service.embed_query, c, per_thread))
+        if reranker is not None:
+            report("rerank (直接调用)", *run_concurrent(
+                lambda q: reranker.predict([(q, d) for d in DOCS]), c, per_thread))
+            report("rerank (微批处理)", *run_concurrent(
+                lambda q: service.rerank(q, DOCS), c, per_thread))
+
+    print(f"   │ 批处理统计: {service.stats()}")
+    print(f"   {'='*60}\n")
+    service.close()
+
+
+if __name__ == "__main__":
+    main()
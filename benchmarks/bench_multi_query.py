@@ -0,0 +1,134 @@
+"""
+多查询检索压测 (bench_multi_query.py)
+对比: 单查询 (原问题一次编码 + 两路检索) vs 多查询 (本地改写 → 合批编码 → 逐个检索 / 线程池并发检索)
+方法: 编码用入库的 Embedding 模型实际计算 (逐条 vs 一次前向)；检索用合成语料 (中文词表随机组句 + 随机单位向量)，
+      统计各阶段耗时与多查询相对单查询多出的延迟
+用法: python benchmarks/bench_multi_query.py [查询次数] [语料子块数]
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+os.environ["HF_HUB_OFFLINE"] = "1"
+
+from langchain_huggingface import HuggingFaceEmbeddings
+
+from tokenizer import tokenize
+from bm25_index import BM25Index
+from fusion import weighted_rrf
+from vector_store import MatrixVectorStore, write_matrix_index
+from query_expansion import local_variants, search_pool, MULTI_QUERY_WEIGHT
+
+DIM = 384
+QUESTIONS = ["报销流程需要哪些材料", "年假怎么算", "出差住宿标准是多少？", "请问加班费如何申请", "合同的违约责任是什么？"]
+SYNONYMS = {"报销": ["报账", "费用报销"], "年假": ["带薪年休假"], "出差": ["差旅"], "加班费": ["加班工资"], "违约": ["毁约"]}
+VOCAB = ["报销", "报账", "发票", "流程", "材料", "年假", "带薪年休假", "工龄", "出差", "差旅", "住宿", "标准", "城市",
+         "加班", "加班费", "加班工资", "申请", "审批", "合同", "违约", "责任", "赔偿", "部门", "员工", "系统", "提交"]
+
+
+def build(n_chunks, rng, db_dir):
+    texts = ["".join(rng.choice(VOCAB, 12)) for _ in range(n_chunks)]
+    vectors = rng.normal(size=(n_chunks, DIM)).astype(np.float32)
+    chunk_ids = np.arange(n_chunks, dtype=np.int64)
+    write_matrix_index(db_dir, chunk_ids, vectors)
+    vector_store = MatrixVectorStore(db_dir)
+    vector_store.align(chunk_ids)
+    return chunk_ids, vector_store, BM25Index([tokenize(t) for t in texts])
+
+
+def search(chunk_ids, vector_store, bm25, query, query_vector, k=5):
+    vector_k = min(k * 3, 20)
+    vector_ids = vector_store.search(query_vector, k=vector_k)
+    scores = bm25.get_scores(tokenize(query))
+    top = np.argpartition(-scores, vector_k - 1)[:vector_k]
+    top = top[np.argsort(-scores[top])]
+    return vector_ids, chunk_ids[top[scores[top] > 0]]
+
+
+def fuse(results, k=5):
+    ranked, weights = [], []
+    for i, (vector_ids, bm25_ids) in enumerate(results):
+        ranked += [vector_ids, bm25_ids]
+        weights += [1.0 if i == 0 else MULTI_QUERY_WEIGHT] * 2
+    return weighted_rrf(ranked, weights=weights, top_k=k)[0]
+
+
+def main():
+    n_queries = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    n_chunks = int(sys.argv[2]) if len(sys.argv) > 2 else 50_000
+    rng = np.random.default_rng(0)
+
+    model = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2", model_kwargs={"device": "cpu"})
+    model.embed_documents(["warmup"])
+    db_dir = tempfile.mkdtemp(prefix="bench_multi_query_")
+    try:
+        chunk_ids, vector_store, bm25 = build(n_chunks, rng, db_dir)
+        timings = {key: [] for key in ("expand", "embed_single", "embed_each", "embed_batch",
+                                       "search_single", "search_sequential", "search_parallel")}
+        n_variants = []
+        for i in range(n_queries):
+            question = QUESTIONS[i % len(QUESTIONS)]
+
+            t0 = time.perf_counter()
+            queries = [question] + local_variants(question, synonyms=SYNONYMS)
+            timings["expand"].append(time.perf_counter() - t0)
+            n_variants.append(len(queries) - 1)
+
+            t0 = time.perf_counter()
+            model.embed_query(question)
+            timings["embed_single"].append(time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            for q in queries:
+                model.embed_documents([q])
+            timings["embed_each"].append(time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            model.embed_documents(queries)
+            timings["embed_batch"].append(time.perf_counter() - t0)
+
+            query_vectors = rng.normal(size=(len(queries), DIM)).astype(np.float32)
+
+            t0 = time.perf_counter()
+            search(chunk_ids, vector_store, bm25, question, query_vectors[0])
+            timings["search_single"].append(time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            sequential = fuse([search(chunk_ids, vector_store, bm25, q, v) for q, v in zip(queries, query_vectors)])
+            timings["search_sequential"].append(time.perf_counter() - t0)
+
+            t0 = time.perf_counter()
+            futures = [search_pool().submit(search, chunk_ids, vector_store, bm25, q, v)
+                       for q, v in zip(queries, query_vectors)]
+            parallel = fuse([f.result() for f in futures])
+            timings["search_parallel"].append(time.perf_counter() - t0)
+            assert np.array_equal(sequential, parallel)
+
+        ms = {key: np.median(values) * 1000 for key, values in timings.items()}
+        single = ms["embed_single"] + ms["search_single"]
+        naive = ms["expand"] + ms["embed_each"] + ms["search_sequential"]
+        multi = ms["expand"] + ms["embed_batch"] + ms["search_parallel"]
+
+        print(f"\n   {'='*80}")
+        print(f"   🔀 单查询 vs 多查询检索 ({n_queries} 次查询, 语料 {n_chunks} 个子块, 平均改写 {np.mean(n_variants):.1f} 个)")
+        print(f"   {'='*80}")
+        print(f"   │ 本地改写 p50          {ms['expand']:8.2f}ms")
+        print(f"   │ 编码 p50: 单条 {ms['embed_single']:.2f}ms | 逐条 {ms['embed_each']:.2f}ms | 合批一次前向 {ms['embed_batch']:.2f}ms")
+        print(f"   │ 检索 p50: 单查询 {ms['search_single']:.2f}ms | 逐个 {ms['search_sequential']:.2f}ms | "
+              f"并发 {ms['search_parallel']:.2f}ms")
+        print(f"   │ 合计 p50: 单查询 {single:.2f}ms | 多查询 (逐条编码 + 逐个检索) {naive:.2f}ms | "
+              f"多查询 (合批 + 并发) {multi:.2f}ms")
+        print(f"   │ ⏱ 多查询相对单查询额外耗时: {multi - single:+.2f}ms (逐个执行时 {naive - single:+.2f}ms)")
+        print(f"   {'='*80}\n")
+    finally:
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
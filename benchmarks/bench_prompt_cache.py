@@ -0,0 +1,163 @@
+"""
+Prompt 前缀缓存压测 (bench_prompt_cache.py)
+对比: 旧的消息拼接 (文件列表写在路由 system prompt 里 / 历史按条数滑动)  vs  稳定前缀拼接 (+ 路由与回答分槽位)
+方法: 本地起一个 llama.cpp 兼容的桩服务，按槽位记住上一次的 Prompt，
+      每次请求只对与缓存不同的后缀计 prefill token (与 llama.cpp 的 cache_prompt 行为一致)，返回 timings.prompt_n / cache_n
+用法: python benchmarks/bench_prompt_cache.py [对话轮数]
+"""
+
+import os
+import sys
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import requests
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+
+from context_builder import (
+    ContextBuilder, TokenCounter, PREFILL_TOKENS_PER_SEC, ROUTER_SYSTEM_PROMPT, ANSWER_SYSTEM_PROMPT,
+    router_messages, answer_messages,
+)
+
+COUNTER = TokenCounter()
+FILES = ["员工手册.pdf", "报销制度.docx", "产品说明.md"]
+PASSAGE = "报销需要提交发票原件、审批单和付款凭证，金额超过五千元需部门负责人签字。" * 6
+ANSWER = "根据参考资料，报销需要准备发票原件、审批单和付款凭证。" * 3
+
+
+# ============================================================
+# llama.cpp 兼容桩服务
+# ============================================================
+
+def render(messages):
+    """近似的 chat template：按消息顺序拼接成一个字符串"""
+    return "".join(f"<|{m['role']}|>\n{m['content']}\n" for m in messages)
+
+
+class StubState:
+    def __init__(self):
+        self.slots = {}  # id_slot → 上一次的 Prompt 文本
+        self.lock = threading.Lock()
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            prompt = render(body["messages"])
+            slot = body.get("id_slot", 0)
+            with state.lock:
+                cached = state.slots.get(slot, "") if body.get("cache_prompt") else ""
+                common = 0
+                for a, b in zip(cached, prompt):
+                    if a != b:
+                        break
+                    common += 1
+                state.slots[slot] = prompt
+            cache_n = COUNTER.count(prompt[:common])
+            prompt_n = COUNTER.count(prompt) - cache_n
+            is_router = "intent routing" in body["messages"][0]["content"]
+            result = {
+                "choices": [{"message": {"role": "assistant", "content": "SEARCH" if is_router else ANSWER}}],
+                "timings": {"prompt_n": prompt_n, "cache_n": cache_n},
+            }
+            data = json.dumps(result, ensure_ascii=False).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    return Handler
+
+
+# ============================================================
+# 两种消息拼接方式
+# ============================================================
+
+def legacy_router(files, question):
+    """改造前: 文件列表嵌在 system prompt 中间"""
+    kb_context = f"\nThe knowledge base currently contains: [{', '.join(sorted(files))}]. "
+    first_line, _, instructions = ROUTER_SYSTEM_PROMPT.partition("\n")
+    instructions = instructions.partition("\n")[2]  # 去掉新版说明文件列表位置的那一行
+    system_prompt = f"{first_line}\n{kb_context}\n{instructions}"
+    return [{"role": "system", "content": system_prompt}, {"role": "user", "content": question}]
+
+
+def legacy_answer(history, question, context_text):
+    """改造前: 最近 6 条历史 (每轮滑动一次)"""
+    return answer_messages(ANSWER_SYSTEM_PROMPT, history[-6:], question, context_text)
+
+
+def stable_answer(builder, history, question, context_text):
+    return answer_messages(ANSWER_SYSTEM_PROMPT, builder.build_history(history), question, context_text)
+
+
+def run_conversation(url, turns, stable, split_slots):
+    """模拟多轮对话 (每轮一次路由 + 一次回答，第 turns/2 轮时上传一个新文件)，返回 (prefill token 列表, 命中缓存 token 列表)"""
+    builder = ContextBuilder(counter=COUNTER, history_budget=600)
+    files = list(FILES)
+    history = []
+    prefill, cached = [], []
+    for turn in range(turns):
+        if turn == turns // 2:
+            files.append("新上传的合同.pdf")
+        question = f"第 {turn + 1} 个问题: 报销流程里第 {turn + 1} 步要注意什么？"
+        context_text = f"片段1: {PASSAGE}\n\n"
+
+        router = router_messages(files, question) if stable else legacy_router(files, question)
+        answer = (stable_answer(builder, history, question, context_text) if stable
+                  else legacy_answer(history, question, context_text))
+
+        turn_prefill = turn_cached = 0
+        for messages, slot in ((router, 1), (answer, 0)):
+            payload = {"messages": messages, "cache_prompt": True}
+            if split_slots:
+                payload["id_slot"] = slot
+            timings = requests.post(url, json=payload, proxies={"http": None}).json()["timings"]
+            turn_prefill += timings["prompt_n"]
+            turn_cached += timings["cache_n"]
+        prefill.append(turn_prefill)
+        cached.append(turn_cached)
+
+        history += [{"role": "user", "content": question}, {"role": "assistant", "content": ANSWER}]
+    return prefill, cached
+
+
+def main():
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_handler(StubState()))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/v1/chat/completions"
+
+    kind = "精确" if COUNTER.exact else "估算"
+    print(f"\n   {'='*72}")
+    print(f"   📊 Prompt 前缀缓存对比 ({turns} 轮对话，token 计数: {kind}，prefill 按 {PREFILL_TOKENS_PER_SEC:.0f} tok/s 估算)")
+    print(f"   {'='*72}")
+    results = {}
+    for name, stable, split_slots in (
+        ("旧拼接 (单槽位)", False, False),
+        ("稳定前缀 (单槽位)", True, False),
+        ("稳定前缀 + 分槽位", True, True),
+    ):
+        server.RequestHandlerClass = make_handler(StubState())  # 每种方式从空缓存开始
+        prefill, cached = run_conversation(url, turns, stable, split_slots)
+        total = sum(prefill) + sum(cached)
+        results[name] = prefill
+        print(f"   │ {name:<16} prefill: {sum(prefill):6d} tok | 每轮: {sum(prefill) / turns:7.1f} tok | "
+              f"缓存命中率: {sum(cached) / total * 100:5.1f}% | 估算 prefill: {sum(prefill) / PREFILL_TOKENS_PER_SEC:6.2f}s")
+
+    print("   │ 每轮 prefill token (旧 → 稳定前缀 + 分槽位):")
+    for turn, (old, new) in enumerate(zip(results["旧拼接 (单槽位)"], results["稳定前缀 + 分槽位"])):
+        print(f"   │   #{turn + 1:<3} {old:6d} → {new:6d}  (节省 {(old - new) / PREFILL_TOKENS_PER_SEC * 1000:6.0f}ms)")
+    print(f"   {'='*72}\n")
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+量化索引评估 (bench_quantization.py)
+以 matrix 后端 (float32 精确检索) 为基准，测量 int8 / binary 量化后端的
+recall@20、每条子块常驻内存、单次查询延迟
+前提: 已运行过 ingest (data/chroma_db 下存在 matrix_index)
+用法: python benchmarks/bench_quantization.py [查询次数]
+"""
+
+import os
+import sys
+import time
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+
+from rag_core02 import DB_DIR
+from vector_store import MatrixVectorStore, QuantizedVectorStore
+
+K = 20
+RECALL_TOLERANCE = 0.05  # 相对 float32 精确检索允许的 recall@20 损失
+
+
+def main():
+    n_queries = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    exact = MatrixVectorStore(DB_DIR)
+    n_chunks, dim = exact.matrix.shape
+    if n_chunks == 0:
+        print("⚠️ 数据库为空，请先构建知识库")
+        return
+
+    # 以库内向量加噪声作为查询 (无需加载 embedding 模型)
+    rng = np.random.default_rng(42)
+    rows = rng.choice(n_chunks, size=min(n_queries, n_chunks), replace=False)
+    queries = np.asarray(exact.matrix[rows], dtype=np.float32)
+    queries += rng.normal(scale=0.02, size=queries.shape).astype(np.float32)
+    truth = [set(exact._top_k(q, K).tolist()) for q in queries]
+
+    print(f"\n   {'='*64}")
+    print(f"   🗜️ 量化索引评估 ({n_chunks} 个子块 × {dim} 维, {len(queries)} 次查询)")
+    print(f"   {'='*64}")
+    print(f"   │ float32  每块: {exact.matrix.itemsize * dim:5d} B | recall@{K}: 1.0000 (基准)")
+
+    for mode in ("int8", "binary"):
+        store = QuantizedVectorStore(DB_DIR, mode=mode)
+        recalls, latencies = [], []
+        for q, expected in zip(queries, truth):
+            t0 = time.perf_counter()
+            got = store._top_k(q, K)
+            latencies.append((time.perf_counter() - t0) * 1000)
+            recalls.append(len(expected & set(got.tolist())) / len(expected))
+
+        recall = float(np.mean(recalls))
+        per_chunk = store.memory_bytes() / n_chunks
+        status = "🟢" if recall >= 1 - RECALL_TOLERANCE else "🔴 超出容差"
+        print(f"   │ {mode:<8} 每块: {per_chunk:5.0f} B | recall@{K}: {recall:.4f} {status} "
+              f"| p50: {sorted(latencies)[len(latencies) // 2]:.3f}ms")
+
+    print(f"   {'='*64}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+流式输出 CPU 压测 (bench_stream.py)
+对比: 旧的逐 token 处理 (每个 token 重扫整段 buffer + 一行 NDJSON + sleep(0))
+      vs  增量 <think> 状态机 + 按时间 / 字数合帧 (ndjson / sse / binary)
+方法: 构造 LM Studio 风格的 SSE 行 (先思考后正文)，在事件循环里跑完整条流，统计进程 CPU 时间 / token
+      token 到达时间按 RAG_BENCH_TPS (默认 30 tok/s) 模拟，用于按时间合帧
+用法: python benchmarks/bench_stream.py [token 数 ...]
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+
+from stream_parser import ThinkParser, FrameCoalescer, parse_llm_line, encode_frame_batch, STREAM_FORMATS
+
+TOKENS_PER_SEC = float(os.environ.get("RAG_BENCH_TPS", "30"))
+WORDS = ["根据", "参考", "资料", "，", "报销", "需要", "提交", "发票", "原件", "。", " the", " answer", "\n"]
+
+
+def make_stream(n_tokens):
+    """前 40% 为思考，其余为正文，返回 SSE 字节行列表"""
+    tokens = ["<think>"] + [WORDS[i % len(WORDS)] for i in range(n_tokens)]
+    tokens.insert(int(n_tokens * 0.4), "</think>")
+    lines = [b"data: " + json.dumps({"choices": [{"delta": {"content": t}}]}, ensure_ascii=False).encode("utf-8")
+             for t in tokens]
+    return lines + [b"data: [DONE]"]
+
+
+async def legacy(lines):
+    """改造前 chat_endpoint 的逐 token 循环，返回帧数与最后一次解析出的 (思考, 正文)"""
+    raw_buffer = ""
+    full_thought, full_content = "", ""
+    frames = 0
+    for item in lines:
+        decoded_line = item.decode('utf-8')
+        if decoded_line.startswith("data: "):
+            json_str = decoded_line[6:]
+            if json_str.strip() == "[DONE]":
+                break
+            json_data = json.loads(json_str)
+            content = json_data['choices'][0]['delta'].get('content', '')
+            if content:
+                raw_buffer += content
+                if "</think>" in raw_buffer:
+                    parts = raw_buffer.split("</think>", 1)
+                    full_thought = parts[0].replace("<think>", "")
+                    full_content = parts[1]
+                elif "<think>" in raw_buffer:
+                    full_thought = raw_buffer.replace("<think>", "")
+                    full_content = ""
+                else:
+                    full_thought = ""
+                    full_content = raw_buffer
+                _ = json.dumps({"type": "content", "data": content}, ensure_ascii=False) + "\n"
+                frames += 1
+                await asyncio.sleep(0)
+    return frames, full_thought, full_content
+
+
+async def coalesced(lines, fmt):
+    """改造后: 解析 (生产环境在读流线程里) + 合帧 + 编码"""
+    parser = ThinkParser()
+    coalescer = FrameCoalescer()
+    frames = 0
+    for i, line in enumerate(lines):
+        delta = parse_llm_line(line)
+        if delta is None:
+            break
+        batch = []
+        for kind, text in parser.feed(delta):
+            batch += coalescer.add(kind, text, now=i / TOKENS_PER_SEC)
+        if batch:
+            encode_frame_batch(fmt, batch)
+            frames += len(batch)
+            await asyncio.sleep(0)
+    batch = parser.flush()
+    batch = [f for kind, text in batch for f in coalescer.add(kind, text)] + coalescer.flush()
+    if batch:
+        encode_frame_batch(fmt, batch)
+        frames += len(batch)
+    return frames
+
+
+def measure(coro_fn, lines, repeat=3):
+    best, result = None, None
+    for _ in range(repeat):
+        t0 = time.process_time()
+        result = asyncio.run(coro_fn(lines))
+        cpu = time.process_time() - t0
+        best = cpu if best is None else min(best, cpu)
+    return best, result
+
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [1000, 4000, 16000]
+    print(f"\n   {'='*72}")
+    print(f"   📊 流式输出 CPU 对比 (token 到达速度按 {TOKENS_PER_SEC:.0f} tok/s 模拟)")
+    print(f"   {'='*72}")
+    for n in sizes:
+        lines = make_stream(n)
+        base, (base_frames, _, _) = measure(legacy, lines)
+        print(f"   │ {n:6d} tokens  旧逐 token      CPU: {base * 1000:8.1f}ms | {base / n * 1e6:7.2f} µs/token | 帧数: {base_frames}")
+        for fmt in STREAM_FORMATS:
+            cpu, frames = measure(lambda l, f=fmt: coalesced(l, f), lines)
+            print(f"   │ {'':14} 合帧 {fmt:<10} CPU: {cpu * 1000:8.1f}ms | {cpu / n * 1e6:7.2f} µs/token | "
+                  f"帧数: {frames} (x{base / cpu:.1f})")
+    print(f"   {'='*72}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+向量后端对比 (bench_vector_backend.py)
+对比 chroma / matrix / hnsw 三种后端的单次查询延迟与常驻内存
+前提: 已运行过 ingest (data/chroma_db 下存在 matrix_index)
+用法: python benchmarks/bench_vector_backend.py [查询次数] [k]
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+os.environ["HF_HUB_OFFLINE"] = "1"
+os.environ["CHROMA_ANONYMIZED_TELEMETRY"] = "False"
+
+from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_chroma import Chroma
+
+from rag_core02 import DB_DIR
+from vector_store import ChromaVectorStore, MatrixVectorStore, HnswVectorStore, hnswlib
+
+
+def main():
+    n_queries = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else 15
+
+    embedding_model = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2", model_kwargs={"device": "cpu"})
+    vector_db = Chroma(persist_directory=DB_DIR, embedding_function=embedding_model)
+
+    # 用库内子块文本的前 30 字作为查询，预先算好向量，只测检索本身
+    sample = vector_db.get(include=["documents"], limit=n_queries)["documents"]
+    if not sample:
+        print("⚠️ 数据库为空，请先构建知识库")
+        return
+    query_vectors = embedding_model.embed_documents([d[:30] for d in sample])
+
+    factories = [("chroma", lambda: ChromaVectorStore(vector_db)), ("matrix", lambda: MatrixVectorStore(DB_DIR))]
+    if hnswlib is not None:
+        factories.append(("hnsw", lambda: HnswVectorStore(DB_DIR)))
+
+    print(f"\n   {'='*60}")
+    print(f"   📦 向量后端对比 ({len(query_vectors)} 次查询, k={k})")
+    print(f"   {'='*60}")
+
+    for name, factory in factories:
+        tracemalloc.start()
+        store = factory()
+        load_mem = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        store.search(query_vectors[0], k)  # 预热
+        latencies = []
+        for q in query_vectors:
+            t0 = time.perf_counter()
+            store.search(q, k)
+            latencies.append((time.perf_counter() - t0) * 1000)
+        latencies.sort()
+
+        p50 = latencies[len(latencies) // 2]
+        p95 = latencies[max(int(len(latencies) * 0.95) - 1, 0)]
+        mem_mb = (load_mem + store.memory_bytes()) / 1024 / 1024
+        print(f"   │ {name:<8} p50: {p50:7.3f}ms | p95: {p95:7.3f}ms | 常驻内存: {mem_mb:7.2f} MB")
+
+    print(f"   {'='*60}\n")
+
+
+if __name__ == "__main__":
+    main()
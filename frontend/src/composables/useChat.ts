@@ -31,16 +31,10 @@ export function useChat() {
     // [修改] 发送消息增加 sessionId 参数
     const sendMessage = async (question: string, mode: string, sessionId: string | null) => {
 
-        // 1. 准备历史 payload (给 AI 看的，只包含 role 和 content)
-        const historyPayload = messages.value.map(msg => ({
-            role: msg.role,
-            content: msg.content || ""
-        }))
-
-        // 2. UI 添加用户消息
+        // 1. UI 添加用户消息 (历史由后端按 sessionId 从数据库读取，无需再随请求发送)
         messages.value.push({ role: 'user', content: question })
 
-        // 3. UI 添加 AI 占位
+        // 2. UI 添加 AI 占位
         const aiMessage = ref<ChatMessage>({
             role: 'assistant',
             content: '',
@@ -56,7 +50,6 @@ export function useChat() {
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({
                     question: question,
-                    history: historyPayload,
                     mode: mode,
                     session_id: sessionId // <--- [关键] 告诉后端存到哪个会话里
                 })
@@ -68,7 +61,6 @@ export function useChat() {
             const reader = response.body.getReader()
             const decoder = new TextDecoder()
 
-            let rawBuffer = ''  // [修复] 累积全部原始输出，避免标签跨 chunk
             let buffer = ''     // NDJSON 行拼接缓冲
 
             while (true) {
@@ -87,24 +79,13 @@ export function useChat() {
 
                         if (json.type === 'intent') aiMessage.value.intent = json.data
                         else if (json.type === 'sources') aiMessage.value.sources = json.data
-                        else if (json.type === 'content') {
-                            const text = json.data
-                            // [修复] 累积到 rawBuffer，通过全局状态判断标签
-                            rawBuffer += text
-
-                            if (rawBuffer.includes('</think>')) {
-                                // 标签已闭合：提取思考和正文
-                                const parts = rawBuffer.split('</think>')
-                                aiMessage.value.thought = parts[0].replace('<think>', '')
-                                aiMessage.value.content = parts.slice(1).join('')
-                            } else if (rawBuffer.includes('<think>')) {
-                                // 标签未闭合：全部是思考内容
-                                aiMessage.value.thought = rawBuffer.replace('<think>', '')
-                                aiMessage.value.content = ''
-                            } else {
-                                // 无标签：全部是正文
-                                aiMessage.value.content = rawBuffer
-                            }
+                        // 后端已拆分思考与正文并合并成帧，这里只需追加
+                        else if (json.type === 'thought') aiMessage.value.thought = (aiMessage.value.thought || '') + json.data
+                        else if (json.type === 'content') aiMessage.value.content += json.data
+                        else if (json.type === 'reclassify') {
+                            // 模型省略了开头的 <think>：已收到的“正文”其实是思考
+                            aiMessage.value.thought = (aiMessage.value.thought || '') + aiMessage.value.content
+                            aiMessage.value.content = ''
                         }
                         else if (json.type === 'error') aiMessage.value.content += `\n[Error: ${json.data}]`
                     } catch (e) { }
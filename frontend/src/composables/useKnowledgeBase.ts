@@ -71,13 +71,27 @@ export function useKnowledgeBase() {
         }
     }
 
+    // 等待后台任务结束 (重置等耗时操作在后端异步执行，接口立即返回 job_id)
+    const waitForJob = async (jobId: string) => {
+        while (true) {
+            await new Promise(resolve => setTimeout(resolve, 1000))
+            const res = await fetch(`/api/jobs/${jobId}`)
+            if (!res.ok) throw new Error('任务状态查询失败')
+            const job = await res.json()
+            if (job.status === 'done' || job.status === 'failed') return job
+        }
+    }
+
     const resetDb = async () => {
         // 二次确认通常在 UI 层做，这里直接执行逻辑
         isRebuilding.value = true
         try {
             const res = await fetch('/api/reset', { method: 'POST' })
             if (res.ok) {
-                message.success("已恢复出厂设置")
+                const data = await res.json()
+                const job = data.job_id ? await waitForJob(data.job_id) : { status: 'done' }
+                if (job.status === 'done') message.success("已恢复出厂设置")
+                else message.error("重置失败: " + job.message)
                 await fetchFiles() // 刷新，两个列表都应该变空
             } else {
                 message.error("重置失败")
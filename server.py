@@ -1,27 +1,36 @@
 """
 FastAPI 后端服务 (server.py)
-功能: 会话管理 / 流式聊天 / 文件管理 / 知识库重建
+功能: 会话管理 / 流式聊天 (历史由服务端按会话维护) / 文件管理 (上传即增量入库) / 知识库重建
+说明: 文件 I/O 与索引维护都不在事件循环上执行 (file-io 线程池 / maintenance 后台任务)，重置期间聊天流不受影响
 """
 
 import os
 import sys
-import json
-import shutil
 import asyncio
+import hashlib
 import threading
+import time
 from datetime import datetime
 from typing import List, Optional
 
 from fastapi import FastAPI, UploadFile, File
 from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, field_validator
 from starlette.concurrency import run_in_threadpool
 
 sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
 
-from rag_core02 import RAGSystem
-from ingest import create_vector_db, reset_vector_db
+from kb_manager import KnowledgeBaseManager, DEFAULT_KB
+from file_registry import STATUS_PENDING, STATUS_INDEXED, STATUS_FAILED, ACTIVE_STATUSES
+from conversation_memory import ConversationMemory
+from retrieval_filter import RetrievalFilter
+from background import run_io, JobManager, LoopLagMonitor
+from chat_maintenance import compact_history, run_scheduled_maintenance, CHAT_MAINTENANCE_HOURS
+from query_expansion import STATS as MULTI_QUERY_STATS
+from stream_parser import (
+    ThinkParser, FrameCoalescer, parse_llm_line, encode_frame, encode_frame_batch, STREAM_FORMATS, MEDIA_TYPES,
+)
 import database as db
 
 # ============================================================
@@ -31,16 +40,13 @@ import database as db
 os.environ["CHROMA_ANONYMIZED_TELEMETRY"] = "False"
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
-DOCS_DIR = os.path.join(CURRENT_DIR, "data/docs")
-if not os.path.exists(DOCS_DIR):
-    os.makedirs(DOCS_DIR)
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 上传文件按 1MB 分块写盘
 
 # ============================================================
 # 初始化
 # ============================================================
 
 app = FastAPI(title="Local RAG API", version="1.0")
-db.init_db()
 
 app.add_middleware(
     CORSMiddleware,
@@ -50,14 +56,107 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-rag_system = RAGSystem()
+# 多知识库: 共享模型，按需加载，LRU 淘汰 (default 知识库即原来的 data/docs + data/chroma_db)
+# 在 startup 中创建: 分词进程池以 spawn 方式启动，子进程会重新导入本模块，模块顶层不能建库 / 加载模型
+kb_manager: Optional[KnowledgeBaseManager] = None
+
+# 对话记忆: 按 session_id 从数据库取历史 (热点会话 LRU 缓存 + 滚动摘要)，客户端只需发送本轮问题
+memory = ConversationMemory()
+
+# 上传文件的增量入库队列: (知识库, 文件名)，由单个后台任务依次送入 maintenance 线程处理
+ingest_queue: Optional[asyncio.Queue] = None
+
+# 重置 / 删除等索引维护的后台任务，以及事件循环延迟监控
+jobs = JobManager()
+loop_monitor = LoopLagMonitor()
+
+
+async def ingest_worker():
+    while True:
+        kb, filename = await ingest_queue.get()
+        try:
+            await jobs.run(kb_manager.ingest_file, kb, filename)
+        except Exception as e:
+            print(f"Ingest Worker Error: {e}")
+        finally:
+            ingest_queue.task_done()
+
+
+def chat_maintenance():
+    """定时维护聊天记录库，归档的会话同时清出对话记忆"""
+    success, report = run_scheduled_maintenance()
+    for session_id in report["archived_sessions"]:
+        memory.forget(session_id)
+    return success, report
+
+
+async def chat_maintenance_scheduler():
+    while True:
+        await asyncio.sleep(CHAT_MAINTENANCE_HOURS * 3600)
+        jobs.submit("chat-maintenance", None, chat_maintenance)
+
+
+def init_services():
+    """初始化聊天记录库，加载共享模型与 default 知识库"""
+    global kb_manager
+    db.init_db()
+    kb_manager = KnowledgeBaseManager()
+    kb_manager.create_kb(DEFAULT_KB)
+    kb_manager.get(DEFAULT_KB)
+
+
+@app.on_event("startup")
+async def start_background_tasks():
+    global ingest_queue
+    await run_in_threadpool(init_services)
+    ingest_queue = asyncio.Queue()
+    asyncio.create_task(ingest_worker())
+    asyncio.create_task(loop_monitor.run())
+    if CHAT_MAINTENANCE_HOURS > 0:
+        asyncio.create_task(chat_maintenance_scheduler())
+    # 上次被中断的全量重建从断点继续 (重建期间旧索引照常服务)
+    for kb in await run_io(kb_manager.interrupted_rebuilds):
+        jobs.submit("rebuild", kb, kb_manager.rebuild_kb, kb)
+
+
+@app.on_event("shutdown")
+async def release_resources():
+    """退出时关闭常驻知识库并释放 Chroma 句柄 (不留给进程回收，避免下次启动时索引文件仍被占用)"""
+    if kb_manager is not None:
+        await run_in_threadpool(kb_manager.close)
 
 
 class ChatRequest(BaseModel):
     question: str
-    history: List[dict] = []
+    history: List[dict] = []        # 兼容旧客户端: 仅在没有 session_id 时使用，有会话时历史由服务端维护
     mode: str = "flash"
     session_id: Optional[str] = None
+    filters: Optional[dict] = None  # 检索范围: sources / page_min / page_max / ingested_after / ingested_before
+    kb: Optional[str] = None        # 知识库名称，不传则使用会话绑定的知识库，再退回 default
+    stream_format: str = "ndjson"   # 分帧格式: ndjson / sse / binary
+    multi_query: Optional[str] = None  # 多查询检索: off / local / llm，不传则用服务端默认 (RAG_MULTI_QUERY)
+
+    @field_validator("filters")
+    @classmethod
+    def check_filters(cls, value):
+        """过滤条件在开始流式输出之前校验，非法时直接返回 422，而不是在流中途报错"""
+        try:
+            RetrievalFilter.from_dict(value)
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"非法的检索过滤条件: {e}")
+        return value
+
+
+def resolve_kb(kb=None, session_id=None):
+    """确定本次请求使用的知识库: 显式指定 > 会话绑定 > default"""
+    if not kb and session_id:
+        kb = db.get_session_kb(session_id)
+    return kb or DEFAULT_KB
+
+
+def kb_error(e):
+    status = 404 if isinstance(e, KeyError) else 400
+    return JSONResponse(status_code=status, content={"status": "error", "message": str(e).strip("'")})
 
 
 # ============================================================
@@ -71,16 +170,20 @@ async def get_sessions():
 
 
 @app.post("/api/sessions")
-async def create_new_session():
-    """创建一个新会话"""
-    session_id = db.create_session(title="新对话")
-    return {"id": session_id, "title": "新对话", "created_at": datetime.now().isoformat()}
+async def create_new_session(payload: Optional[dict] = None):
+    """创建一个新会话 (Payload 可选: {"kb": "知识库名称"})"""
+    kb = (payload or {}).get("kb")
+    if kb and not kb_manager.exists(kb):
+        return kb_error(KeyError(f"知识库不存在: {kb}"))
+    session_id = db.create_session(title="新对话", kb=kb)
+    return {"id": session_id, "title": "新对话", "kb": kb, "created_at": datetime.now().isoformat()}
 
 
 @app.delete("/api/sessions/{session_id}")
 async def delete_session(session_id: str):
     """删除会话"""
     db.delete_session(session_id)
+    memory.forget(session_id)
     return {"status": "success"}
 
 
@@ -92,45 +195,74 @@ async def get_messages(session_id: str):
 
 @app.put("/api/sessions/{session_id}")
 async def update_session(session_id: str, payload: dict):
-    """更新标题 (Payload: {"title": "..."})"""
+    """更新标题 / 绑定知识库 (Payload: {"title": "...", "kb": "..."})"""
     new_title = payload.get("title")
     if new_title:
         db.update_session_title(session_id, new_title)
+    kb = payload.get("kb")
+    if kb:
+        if not kb_manager.exists(kb):
+            return kb_error(KeyError(f"知识库不存在: {kb}"))
+        db.update_session_kb(session_id, kb)
     return {"status": "success"}
 
 
+@app.get("/api/search/messages")
+async def search_messages(q: str, page: int = 1, page_size: int = 20,
+                          session_id: Optional[str] = None, role: Optional[str] = None):
+    """
+    全文检索聊天记录 (正文 + 思考过程，jieba 分词 + SQLite FTS5，BM25 排序)
+    返回 total / page / page_size / results，results 中 snippet 的命中词以 <mark> 标出
+    """
+    return await run_in_threadpool(db.search_messages, q, page=page, page_size=page_size,
+                                   session_id=session_id, role=role)
+
+
 # ============================================================
 # 2. 核心对话接口
 # ============================================================
 
 @app.post("/api/chat")
 async def chat_endpoint(request: ChatRequest):
-    # 保存用户消息到数据库
+    try:
+        kb = await run_in_threadpool(resolve_kb, request.kb, request.session_id)
+        rag_system = await run_in_threadpool(kb_manager.get, kb)
+    except (KeyError, ValueError) as e:
+        return kb_error(e)
+
+    # 有会话时从服务端记忆取历史 (必须在写入本轮问题之前取)，再保存用户消息到数据库
+    history = request.history
     if request.session_id:
-        db.add_message(
+        history = await run_in_threadpool(memory.history, request.session_id)
+        is_new = not history
+        # 写入会触发全文索引的分词 (jieba 首次使用时加载词典)，不在事件循环上执行
+        message_id = await run_in_threadpool(
+            db.add_message,
             session_id=request.session_id,
             role="user",
             content=request.question
         )
+        # 追加时可能折叠出滚动摘要并写库，同样放到线程池
+        await run_in_threadpool(memory.append, request.session_id, message_id, "user", request.question)
         # 新对话第一句自动重命名标题
-        if not request.history:
-            db.update_session_title(request.session_id, request.question[:20])
+        if is_new:
+            await run_in_threadpool(db.update_session_title, request.session_id, request.question[:20])
 
-    async def event_generator():
-        full_content = ""
-        full_thought = ""
+    fmt = request.stream_format if request.stream_format in STREAM_FORMATS else "ndjson"
 
+    async def event_generator():
         try:
             response, docs, intent = await run_in_threadpool(
                 rag_system.query,
                 question=request.question,
-                history=request.history,
-                mode=request.mode
+                history=history,
+                mode=request.mode,
+                filters=request.filters,
+                multi_query=request.multi_query
             )
 
             # 发送意图
-            yield json.dumps({"type": "intent", "data": intent}, ensure_ascii=False) + "\n"
-            await asyncio.sleep(0)
+            yield encode_frame(fmt, "intent", intent)
 
             # 发送参考资料
             serialized_docs = []
@@ -139,23 +271,33 @@ async def chat_endpoint(request: ChatRequest):
                     serialized_docs.append({
                         "source": os.path.basename(d.metadata.get("source", "unknown")),
                         "page": d.metadata.get("page", 0) + 1,
+                        "chunk_id": d.metadata.get("chunk_id"),
                         "content": d.page_content
                     })
-                yield json.dumps({"type": "sources", "data": serialized_docs}, ensure_ascii=False) + "\n"
-                await asyncio.sleep(0)
+                yield encode_frame(fmt, "sources", serialized_docs)
 
-            # 流式发送 LLM 输出
+            # 流式发送 LLM 输出: 后台线程解析 SSE 与 <think> 标签，事件循环只负责合并成帧
             if response:
-                raw_buffer = ""
+                parser = ThinkParser()
+                coalescer = FrameCoalescer()
                 queue = asyncio.Queue()
                 loop = asyncio.get_event_loop()
 
                 def _stream_reader():
-                    """后台线程读取同步流，通过 queue 桥接到异步 generator"""
+                    """后台线程读取同步流，解析出 (类型, 文本) 片段，通过 queue 桥接到异步 generator"""
                     try:
                         for line in response.iter_lines():
-                            if line:
-                                loop.call_soon_threadsafe(queue.put_nowait, line)
+                            if not line:
+                                continue
+                            delta = parse_llm_line(line)
+                            if delta is None:
+                                break
+                            segments = parser.feed(delta) if delta else None
+                            if segments:
+                                loop.call_soon_threadsafe(queue.put_nowait, segments)
+                        segments = parser.flush()
+                        if segments:
+                            loop.call_soon_threadsafe(queue.put_nowait, segments)
                     except Exception as e:
                         loop.call_soon_threadsafe(queue.put_nowait, e)
                     finally:
@@ -165,135 +307,309 @@ async def chat_endpoint(request: ChatRequest):
                 reader_thread.start()
 
                 while True:
-                    item = await queue.get()
+                    deadline = coalescer.deadline
+                    try:
+                        if deadline is None:
+                            item = await queue.get()
+                        else:
+                            item = await asyncio.wait_for(queue.get(), max(0.0, deadline - time.monotonic()))
+                    except asyncio.TimeoutError:
+                        # 到时间了还没有新 token，先把攒着的发出去
+                        for kind, text in coalescer.flush():
+                            yield encode_frame(fmt, kind, text)
+                        continue
+
                     if item is None:
                         break
                     if isinstance(item, Exception):
                         print(f"Stream Error: {item}")
                         break
+                    frames = []
+                    for kind, text in item:
+                        frames += coalescer.add(kind, text)
+                    if frames:
+                        yield encode_frame_batch(fmt, frames)
 
-                    decoded_line = item.decode('utf-8')
-                    if decoded_line.startswith("data: "):
-                        json_str = decoded_line[6:]
-                        if json_str.strip() == "[DONE]":
-                            break
-                        try:
-                            json_data = json.loads(json_str)
-                            content = json_data['choices'][0]['delta'].get('content', '')
-                            if content:
-                                raw_buffer += content
-
-                                # 通过全局 buffer 判断 <think> 标签状态
-                                if "</think>" in raw_buffer:
-                                    parts = raw_buffer.split("</think>", 1)
-                                    full_thought = parts[0].replace("<think>", "")
-                                    full_content = parts[1]
-                                elif "<think>" in raw_buffer:
-                                    full_thought = raw_buffer.replace("<think>", "")
-                                    full_content = ""
-                                else:
-                                    full_thought = ""
-                                    full_content = raw_buffer
-
-                                yield json.dumps({"type": "content", "data": content}, ensure_ascii=False) + "\n"
-                                await asyncio.sleep(0)
-                        except Exception:
-                            continue
+                frames = coalescer.flush()
+                if frames:
+                    yield encode_frame_batch(fmt, frames)
 
                 # 流式结束后保存 AI 回答
                 if request.session_id:
-                    clean_thought = full_thought.replace("<think>", "").replace("</think>", "")
-                    clean_content = full_content.replace("</think>", "").strip()
-                    db.add_message(
+                    thought, content = parser.thought, parser.content
+                    message_id = await run_in_threadpool(
+                        db.add_message,
                         session_id=request.session_id,
                         role="assistant",
-                        content=clean_content,
-                        thought=clean_thought if clean_thought else None,
+                        content=content,
+                        thought=thought if thought else None,
                         sources=serialized_docs if serialized_docs else None
                     )
+                    await run_in_threadpool(memory.append, request.session_id, message_id, "assistant", content)
             else:
-                yield json.dumps({"type": "error", "data": "LLM 未返回响应"}, ensure_ascii=False) + "\n"
+                yield encode_frame(fmt, "error", "LLM 未返回响应")
 
         except Exception as e:
             print(f"Server Error: {e}")
-            yield json.dumps({"type": "error", "data": str(e)}, ensure_ascii=False) + "\n"
+            yield encode_frame(fmt, "error", str(e))
 
     return StreamingResponse(
         event_generator(),
-        media_type="application/x-ndjson",
+        media_type=MEDIA_TYPES[fmt],
         headers={"Cache-Control": "no-cache", "Connection": "keep-alive", "X-Accel-Buffering": "no"}
     )
 
 
 # ============================================================
-# 3. 文件管理接口
+# 3. 知识库与文件管理接口 (均可通过 ?kb= 指定知识库，默认 default)
 # ============================================================
 
+@app.get("/api/kbs")
+async def list_kbs():
+    """知识库列表"""
+    stats = (await run_io(kb_manager.stats))["knowledge_bases"]
+    return [{"name": name, "resident": info["resident"]} for name, info in stats.items()]
+
+
+@app.post("/api/kbs")
+async def create_kb(payload: dict):
+    """新建知识库 (Payload: {"name": "..."})"""
+    name = payload.get("name", "")
+    try:
+        await run_io(kb_manager.create_kb, name)
+    except ValueError as e:
+        return kb_error(e)
+    return {"status": "success", "name": name}
+
+
 @app.get("/api/files")
-async def list_files():
-    if not os.path.exists(DOCS_DIR):
-        physical_files = set()
-    else:
-        physical_files = set(os.listdir(DOCS_DIR))
+async def list_files(kb: str = DEFAULT_KB):
+    """
+    文件列表: indexed / pending 两个列表 (兼容旧前端)，
+    files 为每个文件的详细状态 (pending / parsing / embedding / indexed / failed)
+    """
+    try:
+        docs_dir, _ = kb_manager.paths(kb)
+        rag_system = await run_in_threadpool(kb_manager.get, kb)
+    except (KeyError, ValueError) as e:
+        return kb_error(e)
+    physical_files = await run_io(list_docs, docs_dir)
     indexed_files_in_db = await run_in_threadpool(rag_system.get_indexed_files)
-    response_data = {"indexed": [], "pending": []}
-    for f in physical_files:
-        if f in indexed_files_in_db:
-            response_data["indexed"].append(f)
-        else:
-            response_data["pending"].append(f)
-    response_data["indexed"].sort()
-    response_data["pending"].sort()
+    registry = await run_io(kb_manager.registry, kb)  # 首次访问时从磁盘读入登记表
+    records = await run_io(registry.all)
+
+    response_data = {"indexed": [], "pending": [], "files": []}
+    for f in sorted(physical_files):
+        record = records.get(f, {})
+        status = record.get("status")
+        # 没有登记记录 (全量重建入库的文件) 时以索引内容为准
+        if status not in ACTIVE_STATUSES and status != STATUS_FAILED:
+            status = STATUS_INDEXED if f in indexed_files_in_db else STATUS_PENDING
+        response_data["indexed" if status == STATUS_INDEXED else "pending"].append(f)
+        response_data["files"].append({
+            "name": f,
+            "status": status,
+            "size": record.get("size"),
+            "sha256": record.get("sha256"),
+            "chunks": record.get("chunks"),
+            "peak_rss_mb": record.get("peak_rss_mb"),
+            "chunking": record.get("chunking"),
+            "error": record.get("error"),
+            "updated_at": record.get("updated_at"),
+        })
     return response_data
 
 
+def list_docs(docs_dir):
+    """文档目录下的文件名 (不含上传中的 .part 临时文件)"""
+    if not os.path.exists(docs_dir):
+        return set()
+    return {f for f in os.listdir(docs_dir) if not f.endswith(".part")}
+
+
+async def save_upload(file: UploadFile, file_path: str):
+    """分块读取上传流并写盘 (写盘放到 file-io 线程池，不阻塞事件循环)，边写边算 sha256"""
+    hasher = hashlib.sha256()
+    size = 0
+    tmp_path = file_path + ".part"
+    out = await run_io(open, tmp_path, "wb")
+
+    def _write(chunk):
+        hasher.update(chunk)
+        out.write(chunk)
+
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            await run_io(_write, chunk)
+    finally:
+        await run_io(out.close)
+    # 写完整后再改名，入库线程不会读到半个文件
+    await run_io(os.replace, tmp_path, file_path)
+    return hasher.hexdigest(), size
+
+
 @app.post("/api/upload")
-async def upload_files(files: List[UploadFile] = File(...)):
+async def upload_files(files: List[UploadFile] = File(...), kb: str = DEFAULT_KB):
+    """上传文件并加入增量入库队列 (内容未变的文件直接跳过)"""
+    try:
+        if not await run_io(kb_manager.exists, kb):
+            raise KeyError(f"知识库不存在: {kb}")
+        docs_dir, _ = await run_io(kb_manager.create_kb, kb)
+    except (KeyError, ValueError) as e:
+        return kb_error(e)
+    registry = await run_io(kb_manager.registry, kb)
     saved_files = []
+    queued_files = []
     for file in files:
-        file_path = os.path.join(DOCS_DIR, file.filename)
+        filename = os.path.basename(file.filename)
+        file_path = os.path.join(docs_dir, filename)
         try:
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            saved_files.append(file.filename)
+            sha256, size = await save_upload(file, file_path)
         except Exception as e:
-            return JSONResponse(status_code=500, content={"message": f"上传失败 {file.filename}: {str(e)}"})
-    return {"message": f"成功上传 {len(saved_files)} 个文件", "files": saved_files}
+            return JSONResponse(status_code=500, content={"message": f"上传失败 {filename}: {str(e)}"})
+        saved_files.append(filename)
+
+        previous = registry.get(filename)
+        if previous and previous.get("sha256") == sha256 and previous.get("status") == STATUS_INDEXED:
+            continue
+        await run_io(registry.update, filename, status=STATUS_PENDING, error=None, sha256=sha256, size=size)
+        await ingest_queue.put((kb, filename))
+        queued_files.append(filename)
+    return {
+        "message": f"成功上传 {len(saved_files)} 个文件，{len(queued_files)} 个已加入入库队列",
+        "files": saved_files,
+        "queued": queued_files,
+    }
+
+
+def resolve_file(kb, name):
+    """
+    校验知识库与文件名，返回 (docs_dir, 相对文档目录的路径)；子目录中的文件按相对路径指定 (如 "制度/报销.md")
+    绝对路径或 .. 跳出文档目录时抛 ValueError；文件既不在目录里也不在索引 / 登记表中时抛 KeyError
+    """
+    if not kb_manager.exists(kb):
+        raise KeyError(f"知识库不存在: {kb}")
+    docs_dir, _ = kb_manager.paths(kb)
+    filename = os.path.normpath(name.replace("\\", "/"))
+    if not name or os.path.isabs(name) or filename == "." or filename.split(os.sep)[0] == "..":
+        raise ValueError(f"非法的文件路径: {name}")
+    file_path = os.path.join(docs_dir, filename)
+    root = os.path.realpath(docs_dir)
+    if os.path.commonpath([root, os.path.realpath(file_path)]) != root:
+        raise ValueError(f"非法的文件路径: {name}")
+    rag = kb_manager.peek(kb)
+    known = (os.path.isfile(file_path)
+             or kb_manager.registry(kb).get(filename) is not None
+             or (rag is not None and rag.chunk_store.has_path(file_path)))
+    if not known:
+        raise KeyError(f"文件不存在: {filename}")
+    return docs_dir, filename
+
+
+@app.delete("/api/files/{name:path}")
+async def delete_file(name: str, kb: str = DEFAULT_KB):
+    """删除单个文件及其索引内容 (后台任务，只处理这一个文件，不重建、不重新加载模型)"""
+    try:
+        _, filename = await run_io(resolve_file, kb, name)
+    except (KeyError, ValueError) as e:
+        return kb_error(e)
+    job = jobs.submit("delete", kb, kb_manager.delete_file, kb, filename)
+    return JSONResponse(status_code=202, content={"status": "accepted", "job_id": job["id"], "job": job})
+
+
+@app.post("/api/files/{name:path}/reindex")
+async def reindex_file(name: str, kb: str = DEFAULT_KB):
+    """重新入库单个文件：替换它的子块，其它文件不受影响 (后台任务)"""
+    try:
+        docs_dir, filename = await run_io(resolve_file, kb, name)
+        if not await run_io(os.path.isfile, os.path.join(docs_dir, filename)):
+            raise KeyError(f"文件不存在: {filename}")
+    except (KeyError, ValueError) as e:
+        return kb_error(e)
+    job = jobs.submit("reindex", kb, kb_manager.reindex_file, kb, filename)
+    return JSONResponse(status_code=202, content={"status": "accepted", "job_id": job["id"], "job": job})
 
 
 @app.post("/api/rebuild")
-async def rebuild_db():
-    success, msg = await run_in_threadpool(create_vector_db)
+async def rebuild_db(kb: str = DEFAULT_KB):
+    """全量重建 (在 maintenance 线程中执行，与后台任务串行；等待完成后返回结果)"""
+    try:
+        if not await run_io(kb_manager.exists, kb):
+            raise KeyError(f"知识库不存在: {kb}")
+    except (KeyError, ValueError) as e:
+        return kb_error(e)
+    try:
+        success, msg = await jobs.run(kb_manager.rebuild_kb, kb)
+    except Exception as e:
+        return JSONResponse(status_code=500, content={"status": "error", "message": str(e)})
     if success:
-        global rag_system
-        rag_system = RAGSystem()
         return {"status": "success", "message": msg}
     else:
         return JSONResponse(status_code=500, content={"status": "error", "message": msg})
 
 
 @app.post("/api/reset")
-async def reset_db():
+async def reset_db(kb: str = DEFAULT_KB):
+    """清空文件和数据库 (后台任务，立即返回 job_id，通过 /api/jobs/{job_id} 查询进度)"""
     try:
-        if os.path.exists(DOCS_DIR):
-            for filename in os.listdir(DOCS_DIR):
-                file_path = os.path.join(DOCS_DIR, filename)
-                try:
-                    if os.path.isfile(file_path) or os.path.islink(file_path):
-                        os.unlink(file_path)
-                    elif os.path.isdir(file_path):
-                        shutil.rmtree(file_path)
-                except Exception as e:
-                    print(f"删除失败: {e}")
-        success, msg = await run_in_threadpool(reset_vector_db)
-        global rag_system
-        rag_system = RAGSystem()
-        if success:
-            return {"status": "success", "message": "已清空文件和数据库"}
-        else:
-            return JSONResponse(status_code=500, content={"status": "error", "message": msg})
-    except Exception as e:
-        return JSONResponse(status_code=500, content={"status": "error", "message": str(e)})
+        if not await run_io(kb_manager.exists, kb):
+            raise KeyError(f"知识库不存在: {kb}")
+        kb_manager.paths(kb)
+    except (KeyError, ValueError) as e:
+        return kb_error(e)
+    job = jobs.submit("reset", kb, kb_manager.reset_kb, kb)
+    return JSONResponse(status_code=202, content={"status": "accepted", "job_id": job["id"], "job": job})
+
+
+@app.get("/api/jobs")
+async def list_jobs():
+    """最近的后台任务 (最新的在前)"""
+    return jobs.list()
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """后台任务状态: queued / running / done / failed"""
+    job = jobs.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"status": "error", "message": f"任务不存在: {job_id}"})
+    return job
+
+
+@app.post("/api/maintenance/chat")
+async def compact_chat_history():
+    """
+    压缩聊天记录库 (后台任务，完成后任务 message 中为库大小 / 消息加载延迟的前后对比)
+    服务运行中不做完整 VACUUM；报告中 needs_offline_vacuum 为真时停服后执行 python src/chat_maintenance.py vacuum
+    """
+    job = jobs.submit("chat-compact", None, compact_history)
+    return JSONResponse(status_code=202, content={"status": "accepted", "job_id": job["id"], "job": job})
+
+
+# ============================================================
+# 4. 运行指标
+# ============================================================
+
+@app.get("/api/metrics")
+async def get_metrics():
+    """
+    推理服务微批处理统计 + 知识库常驻情况 (命中 / 加载耗时 / 淘汰) + Prompt token 统计 + 对话记忆 / 查询缓存
+    + 多查询检索耗时 + 事件循环延迟 (卡顿次数) + 后台任务状态
+    """
+    return {
+        "inference": kb_manager.inference.stats(),
+        "knowledge_bases": kb_manager.stats(),
+        "prompt": kb_manager.context_builder.stats(),
+        "memory": memory.stats(),
+        "query_cache": kb_manager.query_cache.stats(),
+        "multi_query": MULTI_QUERY_STATS.stats(),
+        "event_loop": loop_monitor.stats(),
+        "jobs": jobs.stats(),
+    }
 
 
 # ============================================================
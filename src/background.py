@@ -0,0 +1,149 @@
+"""
+后台执行与事件循环监控 (background.py)
+功能: 让文件系统操作与索引维护离开事件循环，聊天流不再被重置 / 大文件上传卡住
+  - run_io: 文件读写 / 列目录 / 删除等阻塞 I/O 放到专用的 file-io 线程池 (不占用聊天请求使用的默认线程池)
+  - JobManager: 重置 / 删除等耗时的索引维护作为后台任务串行执行，接口立即返回 job_id，可轮询状态
+  - LoopLagMonitor: 定时测量事件循环延迟 (实际唤醒时间 - 预期唤醒时间)，卡顿在 /api/metrics 中可见
+"""
+
+import os
+import time
+import uuid
+import asyncio
+import threading
+import functools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+IO_WORKERS = int(os.environ.get("RAG_IO_WORKERS", "4"))                         # 文件 I/O 线程数
+JOB_HISTORY = int(os.environ.get("RAG_JOB_HISTORY", "100"))                      # 保留最近多少个后台任务的状态
+LOOP_LAG_INTERVAL_MS = float(os.environ.get("RAG_LOOP_LAG_INTERVAL_MS", "100"))  # 事件循环延迟采样间隔
+LOOP_STALL_MS = float(os.environ.get("RAG_LOOP_STALL_MS", "100"))                # 延迟超过多少算一次卡顿
+LOOP_LAG_WINDOW = 600                                                            # 统计最近多少个采样
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+_io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="file-io")
+
+
+async def run_io(fn, *args, **kwargs):
+    """在 file-io 线程池中执行阻塞的文件操作"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_io_executor, functools.partial(fn, *args, **kwargs))
+
+
+# ============================================================
+# 后台任务
+# ============================================================
+
+class JobManager:
+    """索引维护任务在单个 maintenance 线程中依次执行 (与增量入库一样，同一时刻只有一个写索引的任务)"""
+
+    def __init__(self, max_workers=1, history=JOB_HISTORY):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="maintenance")
+        self._history = history
+        self._lock = threading.Lock()
+        self._jobs = OrderedDict()  # job_id → 状态记录，按提交顺序
+
+    def submit(self, kind, kb, fn, *args, **kwargs):
+        """
+        提交后台任务，立即返回任务记录
+        fn 返回 (success, message) 或任意结果；抛异常视为失败
+        """
+        job_id = uuid.uuid4().hex[:12]
+        job = {
+            "id": job_id, "kind": kind, "kb": kb, "status": JOB_QUEUED, "message": None,
+            "created_at": time.time(), "started_at": None, "finished_at": None,
+        }
+        with self._lock:
+            self._jobs[job_id] = job
+            while len(self._jobs) > self._history:
+                oldest = next(iter(self._jobs))
+                if self._jobs[oldest]["status"] in (JOB_QUEUED, JOB_RUNNING):
+                    break
+                self._jobs.pop(oldest)
+        self._executor.submit(self._run, job, fn, args, kwargs)
+        print(f" -> 后台任务已提交: {kind} [{kb}] ({job_id})")
+        return dict(job)
+
+    async def run(self, fn, *args, **kwargs):
+        """在 maintenance 线程中执行并等待结果 (需要同步返回结果、但必须与后台任务串行的维护操作)"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+
+    def _run(self, job, fn, args, kwargs):
+        self._update(job, status=JOB_RUNNING, started_at=time.time())
+        try:
+            result = fn(*args, **kwargs)
+            success, message = result if isinstance(result, tuple) else (True, result)
+            self._update(job, status=JOB_DONE if success else JOB_FAILED, message=message)
+        except Exception as e:
+            print(f"❌ 后台任务失败: {job['kind']} [{job['kb']}]: {e}")
+            self._update(job, status=JOB_FAILED, message=str(e))
+        finally:
+            self._update(job, finished_at=time.time())
+
+    def _update(self, job, **fields):
+        with self._lock:
+            job.update(fields)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def list(self):
+        with self._lock:
+            return [dict(job) for job in reversed(self._jobs.values())]
+
+    def stats(self):
+        with self._lock:
+            counts = {}
+            for job in self._jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+            return counts
+
+
+# ============================================================
+# 事件循环延迟
+# ============================================================
+
+class LoopLagMonitor:
+    def __init__(self, interval_ms=LOOP_LAG_INTERVAL_MS, stall_ms=LOOP_STALL_MS, window=LOOP_LAG_WINDOW):
+        self.interval = interval_ms / 1000
+        self.stall_ms = stall_ms
+        self._samples = deque(maxlen=window)
+        self._max_ms = 0.0
+        self._stalls = 0
+        self._last_stall_at = None
+
+    async def run(self):
+        """常驻协程：每隔 interval 醒来一次，醒得越晚说明事件循环被阻塞得越久"""
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag_ms = max(0.0, (time.perf_counter() - start - self.interval) * 1000)
+            self._samples.append(lag_ms)
+            self._max_ms = max(self._max_ms, lag_ms)
+            if lag_ms >= self.stall_ms:
+                self._stalls += 1
+                self._last_stall_at = time.time()
+                print(f"⚠️ 事件循环卡顿 {lag_ms:.0f}ms")
+
+    def stats(self):
+        samples = sorted(self._samples)
+        if not samples:
+            return {"samples": 0}
+        return {
+            "samples": len(samples),
+            "last_ms": round(self._samples[-1], 2),
+            "avg_ms": round(sum(samples) / len(samples), 2),
+            "p99_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))], 2),
+            "max_ms": round(self._max_ms, 2),
+            "stalls": self._stalls,
+            "stall_threshold_ms": self.stall_ms,
+            "last_stall_at": self._last_stall_at,
+        }
@@ -0,0 +1,154 @@
+"""
+BM25 倒排索引 (bm25_index.py)
+功能: 替代 rank_bm25.BM25Okapi 的可增量维护的 BM25 索引
+  - 文档槽位与 chunk_store 行号一一对应，只追加不移动
+  - 删除只打墓碑并修正 df / 总长度，倒排表里的死行打分时被掩掉，全量重建时压实
+  - 打分只遍历查询词的倒排表，开销与命中文档数成正比，而不是与语料总量成正比
+idf 与 BM25Okapi 一致: log((N - df + 0.5) / (df + 0.5))，为负 (超过半数文档含该词) 时取 epsilon × 全部词的平均 idf，
+平均 idf 在文档增删后的第一次打分时重新计算；查询中重复出现的词按次数累加。
+"""
+
+import math
+from collections import Counter
+
+import numpy as np
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_EPSILON = 0.25
+
+
+class BM25Index:
+    def __init__(self, corpus=(), k1=BM25_K1, b=BM25_B, epsilon=BM25_EPSILON):
+        """:param corpus: 分词后的文档列表，第 i 个文档占第 i 个槽位"""
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self._average_idf = None  # 负 idf 的兜底基数，增删文档后作废
+        self._postings = {}     # term → ([row, ...], [tf, ...])
+        self._arrays = {}       # term → (rows ndarray, tf ndarray)，按需从 _postings 生成
+        self._df = Counter()    # 只统计存活文档
+        self._terms = []        # 每个槽位的去重词表 (删除时回退 df 用)
+        self.doc_len = np.zeros(0, dtype=np.float32)
+        self.alive = np.zeros(0, dtype=bool)
+        self.total_len = 0
+        self.add(corpus)
+
+    @property
+    def corpus_size(self):
+        """存活文档数"""
+        return int(self.alive.sum())
+
+    def __len__(self):
+        """槽位总数 (含墓碑)"""
+        return len(self._terms)
+
+    # ============================================================
+    # 增量维护
+    # ============================================================
+
+    def add(self, corpus):
+        """在末尾追加文档，返回新文档的槽位号"""
+        corpus = list(corpus)
+        start = len(self._terms)
+        lengths = np.zeros(len(corpus), dtype=np.float32)
+        for offset, tokens in enumerate(corpus):
+            row = start + offset
+            counts = Counter(tokens)
+            for term, tf in counts.items():
+                rows, tfs = self._postings.setdefault(term, ([], []))
+                rows.append(row)
+                tfs.append(tf)
+                self._arrays.pop(term, None)
+            self._df.update(counts.keys())
+            self._terms.append(tuple(counts))
+            lengths[offset] = len(tokens)
+            self.total_len += len(tokens)
+        self.doc_len = np.concatenate([self.doc_len, lengths])
+        self.alive = np.concatenate([self.alive, np.ones(len(corpus), dtype=bool)])
+        self._average_idf = None
+        return np.arange(start, start + len(corpus), dtype=np.int64)
+
+    def remove(self, rows):
+        """删除指定槽位的文档 (打墓碑)"""
+        for row in np.asarray(rows, dtype=np.int64):
+            if not self.alive[row]:
+                continue
+            self.alive[row] = False
+            self._df.subtract(self._terms[row])
+            self.total_len -= int(self.doc_len[row])
+            self._terms[row] = ()
+            self._average_idf = None
+
+    # ============================================================
+    # 打分
+    # ============================================================
+
+    def _idf(self, df, n_docs):
+        """BM25Okapi 的 idf (负值替换为 epsilon × 平均 idf)"""
+        idf = math.log(n_docs - df + 0.5) - math.log(df + 0.5)
+        if idf >= 0:
+            return idf
+        if self._average_idf is None:
+            dfs = np.fromiter((v for v in self._df.values() if v > 0), dtype=np.float64)
+            self._average_idf = float(np.mean(np.log(n_docs - dfs + 0.5) - np.log(dfs + 0.5))) if len(dfs) else 0.0
+        return self.epsilon * self._average_idf
+
+    def _posting_arrays(self, term):
+        arrays = self._arrays.get(term)
+        if arrays is None:
+            rows, tfs = self._postings[term]
+            arrays = (np.asarray(rows, dtype=np.int64), np.asarray(tfs, dtype=np.float32))
+            self._arrays[term] = arrays
+        return arrays
+
+    def get_scores(self, query_tokens):
+        """对全部槽位打分 (墓碑为 0)，与 BM25Okapi.get_scores 用法一致"""
+        scores = np.zeros(len(self._terms), dtype=np.float32)
+        n_docs = self.corpus_size
+        if not n_docs:
+            return scores
+        avgdl = self.total_len / n_docs or 1.0
+        norm = self.k1 * (1 - self.b + self.b * self.doc_len / avgdl)
+
+        for term, qtf in Counter(query_tokens).items():
+            df = self._df.get(term, 0)
+            if df <= 0:
+                continue
+            idf = self._idf(df, n_docs) * qtf  # 查询中重复的词按出现次数计 (同 BM25Okapi)
+            rows, tf = self._posting_arrays(term)
+            scores[rows] += idf * tf * (self.k1 + 1) / (tf + norm[rows])
+
+        scores[~self.alive] = 0.0
+        return scores
+
+    def get_batch_scores(self, query_tokens, rows):
+        """
+        只对指定槽位打分 (过滤 / 分层检索)：倒排表在槽位中二分查找，
+        开销与查询词的倒排表长度和槽位数成正比，不为全部槽位分配分数数组
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        scores = np.zeros(len(rows), dtype=np.float32)
+        n_docs = self.corpus_size
+        if not n_docs or not len(rows):
+            return scores
+        avgdl = self.total_len / n_docs or 1.0
+        order = np.argsort(rows, kind="stable")
+        sorted_rows = rows[order]
+
+        for term, qtf in Counter(query_tokens).items():
+            df = self._df.get(term, 0)
+            if df <= 0:
+                continue
+            idf = self._idf(df, n_docs) * qtf
+            posting_rows, tf = self._posting_arrays(term)
+            pos = np.minimum(np.searchsorted(sorted_rows, posting_rows), len(sorted_rows) - 1)
+            hit = sorted_rows[pos] == posting_rows
+            if not hit.any():
+                continue
+            hit_rows, tf = posting_rows[hit], tf[hit]
+            norm = self.k1 * (1 - self.b + self.b * self.doc_len[hit_rows] / avgdl)
+            scores[order[pos[hit]]] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+        scores[~self.alive[rows]] = 0.0
+        return scores
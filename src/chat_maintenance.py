@@ -0,0 +1,243 @@
+"""
+聊天记录维护 (chat_maintenance.py)
+功能: 控制 chat_history.db 的体积，长期运行后会话列表 / 消息加载不再越来越慢
+  - 归档: 最后一条消息早于 RAG_CHAT_RETENTION_DAYS 天的会话导出为 chat_archive/<session_id>.json.gz 后从库中删除
+  - 压缩: 旧格式的消息 (参考来源整段存 JSON、长思考过程明文) 转为去重引用 + zlib 压缩，清理不再被引用的来源片段，
+          全文索引重建为 contentless (不再存一份分词后的全文)
+  - 回收: 定时 incremental_vacuum 把空闲页还给文件系统；旧库切换为 auto_vacuum=INCREMENTAL 需要一次完整 VACUUM，
+          VACUUM 期间整个库被独占，只在停服后手动执行: python src/chat_maintenance.py vacuum
+每次压缩返回库大小与消息加载延迟的前后对比
+"""
+
+import os
+import json
+import gzip
+import sys
+import time
+import sqlite3
+
+import database as db
+
+CHAT_RETENTION_DAYS = float(os.environ.get("RAG_CHAT_RETENTION_DAYS", "0"))          # 会话保留天数，0 表示不归档
+CHAT_ARCHIVE_DIR = os.environ.get("RAG_CHAT_ARCHIVE_DIR", "")                         # 归档目录，默认与数据库同目录的 chat_archive
+CHAT_VACUUM_PAGES = int(os.environ.get("RAG_CHAT_VACUUM_PAGES", "2000"))              # 每次增量回收最多多少页
+CHAT_MAINTENANCE_HOURS = float(os.environ.get("RAG_CHAT_MAINTENANCE_HOURS", "24"))    # 定时维护间隔，0 表示关闭
+LATENCY_SAMPLE_SESSIONS = 20                                                          # 测量消息加载延迟时抽样的会话数
+CONVERT_BATCH = 500
+
+
+def archive_dir():
+    return CHAT_ARCHIVE_DIR or os.path.join(os.path.dirname(os.path.abspath(db.DB_PATH)), "chat_archive")
+
+
+def db_size():
+    """数据库文件大小与空闲页占用 (字节)"""
+    conn = db.get_db_connection()
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    page_count = conn.execute('PRAGMA page_count').fetchone()[0]
+    freelist = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    conn.close()
+    return {"bytes": page_size * page_count, "free_bytes": page_size * freelist}
+
+
+def measure_latency(sample=LATENCY_SAMPLE_SESSIONS):
+    """最近活跃的若干会话，加载全部消息的平均耗时 (ms)"""
+    conn = db.get_db_connection()
+    rows = conn.execute('''
+        SELECT session_id FROM messages GROUP BY session_id ORDER BY MAX(id) DESC LIMIT ?
+    ''', (sample,)).fetchall()
+    conn.close()
+    if not rows:
+        return 0.0
+    t0 = time.perf_counter()
+    for r in rows:
+        db.get_session_messages(r['session_id'])
+    return round((time.perf_counter() - t0) * 1000 / len(rows), 3)
+
+
+# ============================================================
+# 归档
+# ============================================================
+
+def archive_old_sessions(days=CHAT_RETENTION_DAYS, target_dir=None):
+    """
+    归档并删除不活跃的会话 (以最后一条消息的时间为准，没有消息的按创建时间)
+    :return: 被归档的 session_id 列表
+    """
+    if days <= 0:
+        return []
+    target_dir = target_dir or archive_dir()
+    conn = db.get_db_connection()
+    rows = conn.execute('''
+        SELECT s.id FROM sessions s
+        LEFT JOIN messages m ON m.session_id = s.id
+        GROUP BY s.id
+        HAVING COALESCE(MAX(m.created_at), s.created_at) < datetime('now', ?)
+    ''', (f"-{days} days",)).fetchall()
+    conn.close()
+    if not rows:
+        return []
+
+    os.makedirs(target_dir, exist_ok=True)
+    archived = []
+    for r in rows:
+        session_id = r['id']
+        conn = db.get_db_connection()
+        session = conn.execute('SELECT * FROM sessions WHERE id = ?', (session_id,)).fetchone()
+        conn.close()
+        if session is None:
+            continue
+        record = {"session": dict(session), "messages": db.get_session_messages(session_id)}
+        path = os.path.join(target_dir, f"{session_id}.json.gz")
+        tmp_path = path + ".tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        # 归档文件落盘后才删除
+        db.delete_session(session_id)
+        archived.append(session_id)
+    print(f"🗄️ 已归档 {len(archived)} 个超过 {days:g} 天未活跃的会话 -> {target_dir}")
+    return archived
+
+
+def load_archived_session(session_id, target_dir=None):
+    """读取归档的会话: {"session": {...}, "messages": [...]}，不存在返回 None"""
+    path = os.path.join(target_dir or archive_dir(), f"{session_id}.json.gz")
+    if not os.path.exists(path):
+        return None
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# ============================================================
+# 压缩与回收
+# ============================================================
+
+def convert_legacy_messages():
+    """旧格式消息转为去重引用 + 压缩存储，返回转换的条数"""
+    conn = db.get_db_connection()
+    converted = 0
+    last_id = 0
+    while True:
+        rows = conn.execute('''
+            SELECT id, thought, sources FROM messages
+            WHERE id > ? AND (sources LIKE '[%' OR (thought_z IS NULL AND length(thought) >= ?))
+            ORDER BY id LIMIT ?
+        ''', (last_id, db.THOUGHT_COMPRESS_MIN or -1, CONVERT_BATCH)).fetchall()
+        if not rows:
+            break
+        for r in rows:
+            sources = r['sources']
+            if sources and sources.startswith('['):
+                try:
+                    sources = db._pack_sources(conn, json.loads(sources))
+                except ValueError:
+                    sources = None
+            thought, thought_z = db._pack_thought(r['thought'])
+            conn.execute('UPDATE messages SET thought = ?, thought_z = ?, sources = ? WHERE id = ?',
+                         (thought, thought_z, sources, r['id']))
+        conn.commit()
+        converted += len(rows)
+        last_id = rows[-1]['id']
+    conn.close()
+    return converted
+
+
+def prune_source_chunks():
+    """删除不再被任何消息引用的来源片段 (会话删除 / 归档后留下的)，返回删除条数"""
+    conn = db.get_db_connection()
+    cursor = conn.execute('''
+        DELETE FROM source_chunks WHERE id NOT IN (
+            SELECT refs.value FROM messages, json_each(messages.sources, '$.refs') AS refs
+            WHERE messages.sources LIKE '{%'
+        )
+    ''')
+    removed = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return removed
+
+
+def incremental_vacuum(pages=CHAT_VACUUM_PAGES):
+    """把最多 pages 个空闲页还给文件系统 (库尚未切换为增量回收模式时什么都不做)，返回回收的字节数"""
+    conn = db.get_db_connection()
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        conn.close()
+        return 0
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    before = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    # 逐页回收，execute 只会推进一步，需要用 executescript 跑完
+    conn.executescript(f'PRAGMA incremental_vacuum({int(pages)});')
+    after = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    conn.close()
+    return (before - after) * page_size
+
+
+def compact_history(offline=False):
+    """
+    完整压缩: 转换旧格式 → 清理来源片段 → 重建 / 合并全文索引 → 回收空间
+    在线执行 (服务运行中) 只做增量回收；尚未切换为 auto_vacuum=INCREMENTAL 的旧库在报告中标出 needs_offline_vacuum，
+    offline=True (停服后命令行执行) 时顺带做切换所需的完整 VACUUM
+    :return: (True, 前后对比报告)
+    """
+    before = {**db_size(), "load_ms": measure_latency()}
+    converted = convert_legacy_messages()
+    pruned = prune_source_chunks()
+    reindexed = db.rebuild_message_index()
+
+    conn = db.get_db_connection()
+    conn.execute("INSERT INTO messages_fts(messages_fts) VALUES('optimize')")
+    conn.commit()
+    incremental = conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+    conn.close()
+    full_vacuum = False
+    if not incremental and offline:
+        full_vacuum = vacuum_offline()
+    elif incremental:
+        incremental_vacuum(pages=1 << 30)
+
+    after = {**db_size(), "load_ms": measure_latency()}
+    report = {
+        "converted_messages": converted, "pruned_source_chunks": pruned, "reindexed": reindexed,
+        "full_vacuum": full_vacuum, "needs_offline_vacuum": not incremental and not full_vacuum,
+        "before": before, "after": after,
+    }
+    print(f"🧹 聊天记录压缩完成: {before['bytes'] / 1024:.0f}KB -> {after['bytes'] / 1024:.0f}KB, "
+          f"消息加载 {before['load_ms']}ms -> {after['load_ms']}ms (转换 {converted} 条, 清理来源片段 {pruned} 条)")
+    if report["needs_offline_vacuum"]:
+        print("   (空闲页需要一次完整 VACUUM 才能回收，请停服后执行: python src/chat_maintenance.py vacuum)")
+    return True, report
+
+
+def vacuum_offline():
+    """
+    切换为 auto_vacuum=INCREMENTAL 并执行一次完整 VACUUM (独占整个库，只在服务停止时调用)
+    仍有其它连接在用库时等待 busy timeout 后放弃，返回是否完成
+    """
+    conn = db.get_db_connection()
+    try:
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        return True
+    except sqlite3.OperationalError as e:
+        print(f"⚠️ VACUUM 未完成 (库仍被占用，请先停止服务): {e}")
+        return False
+    finally:
+        conn.close()
+
+
+def run_scheduled_maintenance():
+    """定时维护: 归档过期会话 → 清理来源片段 → 增量回收"""
+    archived = archive_old_sessions()
+    pruned = prune_source_chunks() if archived else 0
+    reclaimed = incremental_vacuum()
+    return True, {"archived_sessions": archived, "pruned_source_chunks": pruned, "reclaimed_bytes": reclaimed}
+
+
+if __name__ == '__main__':
+    # 停服后执行: python src/chat_maintenance.py [compact|vacuum]
+    command = sys.argv[1] if len(sys.argv) > 1 else "compact"
+    if command == "vacuum":
+        print("完整 VACUUM 完成。" if vacuum_offline() else "完整 VACUUM 未完成。")
+    else:
+        print(compact_history(offline=True)[1])
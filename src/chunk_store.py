@@ -0,0 +1,259 @@
+"""
+子块仓库 (chunk_store.py)
+功能: 以稳定整数 chunk_id 统一 Chroma / BM25 / 父文档映射三方的子块寻址
+  - chunk_id 在 ingest 时由 (来源文件相对文档根目录的路径, 父块序号, 子块序号) 哈希得到，与内容长度无关，重建后保持不变
+  - 行号 (row) 是进程内数组下标，BM25 语料、父块编码都按行对齐
+  - 只有最终命中的少量子块才构造 LangChain Document
+"""
+
+import os
+import hashlib
+import numpy as np
+from langchain_core.documents import Document
+
+from dedup import DUP_SEPARATOR
+
+
+def source_key(source, docs_dir=None):
+    """
+    来源文件在 chunk_id 中的键: 相对文档根目录的路径 (分隔符统一为 /)，不同子目录下的同名文件互不冲突
+    根目录下的文件即文件名本身；没有根目录 (直接传入的 Document) 时退回文件名
+    """
+    if docs_dir is None:
+        return os.path.basename(source)
+    return os.path.relpath(source, docs_dir).replace(os.sep, "/")
+
+
+def make_chunk_id(source, parent_seq, child_seq):
+    """
+    稳定的 63 位正整数 chunk_id (Chroma 的 id 为其十进制字符串)
+    :param source: 来源文件的键 (见 source_key)
+    """
+    key = f"{source}|{parent_seq}|{child_seq}".encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "big") >> 1
+
+
+class ChunkStore:
+    """
+    :param chroma_ids: Chroma 中的字符串 id 列表
+    :param texts: 子块文本列表
+    :param metadatas: 子块 metadata 列表
+    :param parent_map: parent_id → 父文档内容
+    """
+
+    def __init__(self, chroma_ids, texts, metadatas, parent_map):
+        self.parent_map = parent_map
+        self.texts = []
+        self.metadatas = []
+        self.chunk_ids = np.zeros(0, dtype=np.int64)
+        self.alive = np.zeros(0, dtype=bool)
+        self._row_by_chroma_id = {}
+        self.parent_keys = []
+        self._parent_code_by_key = {}
+        self.parent_codes = np.zeros(0, dtype=np.int64)
+        self._rows_by_source = {}
+        self._paths_by_source = {}
+        self._rows_by_path = {}   # 完整来源路径 → 该文件自己的行号 (增量删除 / 重新入库按路径，子目录下的同名文件互不影响)
+        self.pages = np.zeros(0, dtype=np.int64)
+        self.ingested_at = np.zeros(0, dtype=np.float64)
+        self.append(chroma_ids, texts, metadatas)
+
+    # ------------------------------------------------------------
+    # 增量维护 (单文件入库 / 删除)：行号只追加不移动，删除的行打墓碑
+    # ------------------------------------------------------------
+
+    def append(self, chroma_ids, texts, metadatas):
+        """在末尾追加子块，返回新行号数组 (与 BM25 槽位一一对应)"""
+        start = len(self.texts)
+        texts = list(texts)
+        metadatas = [m or {} for m in metadatas]
+        rows = np.arange(start, start + len(texts), dtype=np.int64)
+        self.texts.extend(texts)
+        self.metadatas.extend(metadatas)
+
+        # 旧库没有 chunk_id 时按行号兜底
+        new_ids = np.asarray([m.get("chunk_id", row) for row, m in zip(rows, metadatas)], dtype=np.int64)
+        self.chunk_ids = np.concatenate([self.chunk_ids, new_ids])
+        self.alive = np.concatenate([self.alive, np.ones(len(texts), dtype=bool)])
+        self._row_by_chroma_id.update((cid, int(row)) for row, cid in zip(rows, chroma_ids))
+
+        # 父块编码：parent_id 字符串 → 连续整数，-1 表示没有父块 (兼容旧数据)
+        parent_codes = np.full(len(texts), -1, dtype=np.int64)
+        for offset, meta in enumerate(metadatas):
+            pid = meta.get("parent_id")
+            if pid and pid in self.parent_map:
+                if pid not in self._parent_code_by_key:
+                    self._parent_code_by_key[pid] = len(self.parent_keys)
+                    self.parent_keys.append(pid)
+                parent_codes[offset] = self._parent_code_by_key[pid]
+        self.parent_codes = np.concatenate([self.parent_codes, parent_codes])
+
+        # 元数据列：按来源文件预计算行号表，页码 / 入库时间转为数组，供过滤检索直接做向量化掩码
+        rows_by_source, rows_by_path = {}, {}
+        for row, meta in zip(rows, metadatas):
+            path = meta.get("source", "")
+            name = os.path.basename(path)
+            rows_by_path.setdefault(path, []).append(row)
+            self._paths_by_source.setdefault(name, set()).add(path)
+            for source_name in self._source_names(meta):
+                rows_by_source.setdefault(source_name, []).append(row)
+        _extend_rows(self._rows_by_source, rows_by_source)
+        _extend_rows(self._rows_by_path, rows_by_path)
+        self.pages = np.concatenate([
+            self.pages, np.asarray([m.get("page", -1) for m in metadatas], dtype=np.int64)
+        ])
+        self.ingested_at = np.concatenate([
+            self.ingested_at, np.asarray([m.get("ingested_at", np.nan) for m in metadatas], dtype=np.float64)
+        ])
+
+        self._reindex_ids()
+        return rows
+
+    @staticmethod
+    def _source_names(meta):
+        """一行子块可按哪些文件名检索到: 自己的文件名 + 入库时合并进来的近似重复的来源文件名"""
+        name = os.path.basename(meta.get("source", ""))
+        return {name} | set(filter(None, meta.get("dup_sources", "").split(DUP_SEPARATOR)))
+
+    def remove_paths(self, paths):
+        """删除若干来源文件 (完整路径) 自己的全部子块，返回被删除的行号"""
+        parts = [self._rows_by_path.pop(p, np.array([], dtype=np.int64)) for p in paths]
+        rows = np.unique(np.concatenate(parts)) if parts else np.array([], dtype=np.int64)
+        rows = rows[self.alive[rows]]
+        for path in paths:
+            name = os.path.basename(path)
+            self._paths_by_source.get(name, set()).discard(path)
+            if not self._paths_by_source.get(name):
+                # 这个文件名下已没有任何文件: 其它文件中记着它的合并映射一并解除
+                self._paths_by_source.pop(name, None)
+                self._rows_by_source.pop(name, None)
+            elif name in self._rows_by_source:
+                self._rows_by_source[name] = np.setdiff1d(self._rows_by_source[name], rows)
+        self.alive[rows] = False
+        self.chunk_ids[rows] = -1
+        self.parent_codes[rows] = -1
+        for row in rows:
+            self.texts[row] = ""
+            self.metadatas[row] = {}
+        self._reindex_ids()
+        return rows
+
+    def update_metadatas(self, updated):
+        """
+        替换若干子块的 metadata (其它文件被删除 / 重新入库后，代表子块记录的近似重复有变化)
+        :param updated: Chroma id → 新 metadata；只调整按文件名的映射，子块文本 / 向量不变
+        """
+        for chroma_id, meta in updated.items():
+            row = self._row_by_chroma_id.get(chroma_id, -1)
+            if row < 0 or not self.alive[row]:
+                continue
+            old_names, new_names = self._source_names(self.metadatas[row]), self._source_names(meta)
+            for name in old_names - new_names:
+                if name in self._rows_by_source:
+                    self._rows_by_source[name] = self._rows_by_source[name][self._rows_by_source[name] != row]
+            _extend_rows(self._rows_by_source, {name: [row] for name in new_names - old_names})
+            self.metadatas[row] = meta
+
+    def _reindex_ids(self):
+        """chunk_id → row：排序后二分查找，整批向量化完成 (墓碑行不参与)"""
+        live = np.flatnonzero(self.alive)
+        order = np.argsort(self.chunk_ids[live], kind="stable")
+        self._sort_order = live[order]
+        self._sorted_ids = self.chunk_ids[self._sort_order]
+
+    def live_rows(self):
+        return np.flatnonzero(self.alive)
+
+    @property
+    def live_count(self):
+        return int(self.alive.sum())
+
+    def __len__(self):
+        """行数 (含墓碑)，存活子块数见 live_count"""
+        return len(self.texts)
+
+    # ------------------------------------------------------------
+    # id / row 转换
+    # ------------------------------------------------------------
+
+    def rows_for(self, chunk_ids):
+        """chunk_id 数组 → 行号数组 (不存在的 id 返回 -1)"""
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        if len(self._sorted_ids) == 0:
+            return np.full(len(chunk_ids), -1, dtype=np.int64)
+        pos = np.searchsorted(self._sorted_ids, chunk_ids)
+        pos = np.clip(pos, 0, len(self._sorted_ids) - 1)
+        found = self._sorted_ids[pos] == chunk_ids
+        return np.where(found, self._sort_order[pos], -1)
+
+    def ids_from_chroma(self, chroma_ids):
+        """Chroma 字符串 id → chunk_id 数组 (供 ChromaVectorStore 使用)"""
+        rows = [self._row_by_chroma_id.get(cid, -1) for cid in chroma_ids]
+        return np.asarray([self.chunk_ids[r] for r in rows if r >= 0 and self.alive[r]], dtype=np.int64)
+
+    # ------------------------------------------------------------
+    # 按来源文件
+    # ------------------------------------------------------------
+
+    def indexed_files(self):
+        return {name for name, rows in self._rows_by_source.items() if name and self.alive[rows].any()}
+
+    def rows_for_sources(self, names):
+        """多个来源文件的行号并集 (升序)"""
+        parts = [self._rows_by_source[n] for n in names if n in self._rows_by_source]
+        if not parts:
+            return np.array([], dtype=np.int64)
+        rows = np.unique(np.concatenate(parts))
+        return rows[self.alive[rows]]
+
+    def merged_chunk_ids(self, names):
+        """按这些文件名检索得到、但属于其它文件的子块 (入库时合并了它们的重复内容) 的 chunk_id"""
+        own = [self._rows_by_path[p] for p in self.source_paths(names) if p in self._rows_by_path]
+        rows = self.rows_for_sources(names)
+        if own:
+            rows = np.setdiff1d(rows, np.concatenate(own), assume_unique=True)
+        return [int(c) for c in self.chunk_ids[rows]]
+
+    def has_path(self, path):
+        """该来源文件 (完整路径) 是否还有子块在索引中"""
+        rows = self._rows_by_path.get(path)
+        return rows is not None and bool(self.alive[rows].any())
+
+    def source_paths(self, names):
+        """文件名 → metadata 中实际存储的 source 路径"""
+        return sorted(p for n in names for p in self._paths_by_source.get(n, ()))
+
+    # ------------------------------------------------------------
+    # 父块展开
+    # ------------------------------------------------------------
+
+    def parent_group_keys(self, rows):
+        """用于父块去重的整数键：有父块时为父块编码，否则为 -(row+1) (自成一组)"""
+        rows = np.asarray(rows, dtype=np.int64)
+        codes = self.parent_codes[rows]
+        return np.where(codes >= 0, codes, -(rows + 1))
+
+    def parent_content(self, row):
+        code = self.parent_codes[row]
+        if code >= 0:
+            return self.parent_map[self.parent_keys[code]]
+        # 兼容更早的数据：父内容直接存在 metadata 里
+        return self.metadatas[row].get("parent_content", self.texts[row])
+
+    # ------------------------------------------------------------
+    # Document 构造 (只对最终结果调用)
+    # ------------------------------------------------------------
+
+    def documents(self, chunk_ids):
+        rows = self.rows_for(chunk_ids)
+        return [
+            Document(page_content=self.texts[r], metadata=self.metadatas[r])
+            for r in rows if r >= 0
+        ]
+
+
+def _extend_rows(rows_by_key, new_rows_by_key):
+    """按键追加行号 (键 → 行号数组)"""
+    for key, new_rows in new_rows_by_key.items():
+        old_rows = rows_by_key.get(key, np.array([], dtype=np.int64))
+        rows_by_key[key] = np.concatenate([old_rows, np.asarray(new_rows, dtype=np.int64)])
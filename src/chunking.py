@@ -0,0 +1,298 @@
+"""
+自适应切分 (chunking.py)
+功能: 按文档类型选择父子切分策略，减少零碎 / 重复的子块 (子块越多，embedding 越慢、索引越大)
+  - recursive: 通用递归切分 (pdf / docx / txt)，按 token 长度计 (中文 1 字 ≈ 1 token，其它 4 字符 ≈ 1 token)，
+               中文句读也作为断点，不在句子中间硬切
+  - markdown:  按标题分节，相邻小节合并到父块预算内，跨父块的小节在续块开头补上标题路径；
+               表格整体保留，超长时按行分组并重复表头；代码块内的 # 不算标题
+  - csv:       一行一条记录，子块就是整行 (不切开、不重叠)，相邻行合并为父块
+  - 每种扩展名用哪种策略、尺寸多大在 ingest.LOADER_MAPPING 中配置
+统计每种策略的文件数、父块 / 子块数、子块平均 token 数与 embedding 耗时
+说明: 切分按估算的 token 数而不是本地 LLM tokenizer，模型缓存有没有 tokenizer 都切出同样的块 (chunk_id 与重建断点保持稳定)
+"""
+
+import os
+import re
+import json
+import itertools
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from context_builder import estimate_tokens
+
+CHUNK_PARENT_TOKENS = int(os.environ.get("RAG_CHUNK_PARENT_TOKENS", "800"))   # 父块大小 (给 LLM 看)
+CHUNK_CHILD_TOKENS = int(os.environ.get("RAG_CHUNK_CHILD_TOKENS", "200"))     # 子块大小 (embedding 检索)
+CHUNK_CHILD_OVERLAP = int(os.environ.get("RAG_CHUNK_CHILD_OVERLAP", "50"))    # 相邻子块重叠
+SEPARATORS = ["\n\n", "\n", "。", "！", "？", "；", ". ", "! ", "? ", "; ", "，", ", ", " ", ""]
+BLOCK_SEPARATOR = "\n\n"
+SECTION_PATH_SEPARATOR = " / "
+
+_HEADING = re.compile(r"^(#{1,6})\s+(.+?)\s*#*\s*$")
+_FENCE = re.compile(r"^\s*(```|~~~)")
+_TABLE_ROW = re.compile(r"^\s*\|")
+_TABLE_DIVIDER = re.compile(r"^\s*\|?\s*:?-{3,}")
+
+
+class RecursiveChunker:
+    """通用父子切分: 先按父块预算切，再把每个父块切成带重叠的子块"""
+
+    name = "recursive"
+
+    def __init__(self, parent_size=CHUNK_PARENT_TOKENS, child_size=CHUNK_CHILD_TOKENS,
+                 child_overlap=CHUNK_CHILD_OVERLAP, length="tokens"):
+        if length not in ("tokens", "chars"):
+            raise ValueError(f"未知的长度单位: {length}")
+        self.parent_size = parent_size
+        self.child_size = child_size
+        self.child_overlap = child_overlap
+        self.length = length
+        self.length_function = estimate_tokens if length == "tokens" else len
+        self.parent_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=parent_size, chunk_overlap=0, separators=SEPARATORS,
+            keep_separator="end", length_function=self.length_function
+        )
+        self.child_splitter = RecursiveCharacterTextSplitter(
+            chunk_size=child_size, chunk_overlap=child_overlap, separators=SEPARATORS,
+            keep_separator="end", length_function=self.length_function
+        )
+
+    def config(self):
+        return {"strategy": self.name, "parent_size": self.parent_size, "child_size": self.child_size,
+                "child_overlap": self.child_overlap, "length": self.length}
+
+    def split(self, documents):
+        """
+        :param documents: 同一个文件按顺序产出的 Document (逐页 / 逐块)
+        :return: 生成器，每个父块产出 (父块内容, metadata, [子块文本, ...])；子块都是父块内容的片段
+        """
+        for document in documents:
+            for parent_doc in self.parent_splitter.split_documents([document]):
+                yield parent_doc.page_content, parent_doc.metadata, self.child_splitter.split_text(parent_doc.page_content)
+
+
+class MarkdownChunker(RecursiveChunker):
+    """按标题 / 段落 / 表格分块后合并成父块，子块不跨表格边界"""
+
+    name = "markdown"
+
+    def _iter_blocks(self, documents):
+        """
+        逐行扫描，产出 (类型, 文本, 标题路径, metadata)，类型为 heading / text / table
+        标题路径跨 Document 保持 (大文件按块读取时，后面的块仍知道自己属于哪一节)
+        """
+        path = []          # [(级别, 标题)]
+        in_fence = False
+        for document in documents:
+            lines, kind = [], "text"
+            for line in document.page_content.splitlines():
+                if _FENCE.match(line):
+                    in_fence = not in_fence
+                heading = None if in_fence else _HEADING.match(line)
+                if heading:
+                    if lines:
+                        yield kind, "\n".join(lines), list(path), document.metadata
+                    lines, kind = [], "text"
+                    level = len(heading.group(1))
+                    while path and path[-1][0] >= level:
+                        path.pop()
+                    path.append((level, heading.group(2)))
+                    yield "heading", line.strip(), list(path), document.metadata
+                elif not line.strip() and not in_fence:
+                    if lines:
+                        yield kind, "\n".join(lines), list(path), document.metadata
+                    lines, kind = [], "text"
+                else:
+                    line_kind = "table" if not in_fence and _TABLE_ROW.match(line) else "text"
+                    if lines and line_kind != kind:
+                        yield kind, "\n".join(lines), list(path), document.metadata
+                        lines = []
+                    kind = line_kind
+                    lines.append(line)
+            if lines:
+                yield kind, "\n".join(lines), list(path), document.metadata
+
+    def _table_groups(self, table, size):
+        """超长表格按行分组，每组都带上表头 (表头 + 分隔行)"""
+        rows = table.split("\n")
+        header_len = 2 if len(rows) > 1 and _TABLE_DIVIDER.match(rows[1]) else 1
+        header, rows = rows[:header_len], rows[header_len:]
+        groups, group = [], []
+        for row in rows:
+            if group and self.length_function("\n".join(header + group + [row])) > size:
+                groups.append("\n".join(header + group))
+                group = []
+            group.append(row)
+        if group or not groups:
+            groups.append("\n".join(header + group))
+        return groups
+
+    def _fit(self, kind, text, size):
+        """超过 size 的块拆开 (表格按行分组，其它按递归切分)，返回 [(类型, 文本), ...]"""
+        if self.length_function(text) <= size:
+            return [(kind, text)]
+        if kind == "table":
+            return [(kind, t) for t in self._table_groups(text, size)]
+        return [(kind, t) for t in self.parent_splitter.split_text(text)]
+
+    def _children(self, blocks):
+        """相邻的标题 / 段落合并到子块预算内，表格单独成块；标题不单独成块，总与下面的段落 / 表格落在同一个子块"""
+        children, group, kinds = [], [], []
+
+        def flush(following=()):
+            leading = list(itertools.takewhile(lambda pair: pair[1] == "heading", zip(group, kinds)))
+            lead = BLOCK_SEPARATOR.join(text for text, _ in leading)
+            if len(leading) < len(group):
+                pieces = self.child_splitter.split_text(BLOCK_SEPARATOR.join(group))
+            else:
+                pieces = [lead] if lead else []
+            pieces += following
+            # 开头的标题被切成了单独一块时并入下一块 (父块中二者相邻，拼起来仍是父块的片段)
+            if len(pieces) > 1 and lead and pieces[0] == lead:
+                pieces[:2] = [lead + BLOCK_SEPARATOR + pieces[1]]
+            children.extend(pieces)
+            group.clear()
+            kinds.clear()
+
+        for kind, text in blocks:
+            if kind == "table":
+                flush([t for _, t in self._fit(kind, text, self.child_size)])
+                continue
+            if "text" in kinds and self.length_function(BLOCK_SEPARATOR.join(group + [text])) > self.child_size:
+                flush()
+            group.append(text)
+            kinds.append(kind)
+        flush()
+        return children
+
+    def split(self, documents):
+        blocks, metadata, size, section = [], None, 0, []
+
+        def emit():
+            content = BLOCK_SEPARATOR.join(text for _, text in blocks)
+            parent_metadata = dict(metadata)
+            if section:
+                parent_metadata["section"] = SECTION_PATH_SEPARATOR.join(title for _, title in section)
+            return content, parent_metadata, self._children(blocks)
+
+        for block_kind, block, path, doc_metadata in self._iter_blocks(documents):
+            for kind, text in self._fit(block_kind, block, self.parent_size):
+                tokens = self.length_function(text)
+                # 新的一节在父块已过半时另起父块，尽量不把一节拆到两个父块里
+                full = size + tokens > self.parent_size or (kind == "heading" and size > self.parent_size // 2)
+                if blocks and full:
+                    # 父块末尾的标题属于下一个父块 (会作为上级标题补在它开头)
+                    while blocks and blocks[-1][0] == "heading":
+                        blocks.pop()
+                    if blocks:
+                        yield emit()
+                    blocks, size = [], 0
+                if not blocks:
+                    metadata, section = doc_metadata, path
+                    # 父块开头补上所属的上级标题，脱离上文也知道属于哪一节
+                    ancestors = path[:-1] if kind == "heading" else path
+                    if ancestors:
+                        header = "\n".join("#" * level + " " + title for level, title in ancestors)
+                        blocks.append(("heading", header))
+                        size = self.length_function(header)
+                blocks.append((kind, text))
+                size += tokens
+        if blocks:
+            yield emit()
+
+
+class CsvRecordChunker(RecursiveChunker):
+    """CSV 每行 (CSVLoader 的一个 Document) 是一条记录: 整行一个子块，相邻行合并为父块"""
+
+    name = "csv"
+
+    def split(self, documents):
+        rows, metadata, size = [], None, 0
+        for document in documents:
+            row = document.page_content.strip()
+            if not row:
+                continue
+            tokens = self.length_function(row)
+            if rows and size + tokens > self.parent_size:
+                yield self._parent(rows, metadata)
+                rows, size = [], 0
+            if not rows:
+                metadata = document.metadata
+            rows.append(row)
+            size += tokens
+        if rows:
+            yield self._parent(rows, metadata)
+
+    def _parent(self, rows, metadata):
+        children = []
+        for row in rows:
+            # 超过子块预算的长记录才切开 (embedding 模型会截断过长的输入)
+            children.extend(self.child_splitter.split_text(row) if self.length_function(row) > self.child_size else [row])
+        return BLOCK_SEPARATOR.join(rows), metadata, children
+
+
+CHUNKERS = {
+    RecursiveChunker.name: RecursiveChunker,
+    MarkdownChunker.name: MarkdownChunker,
+    CsvRecordChunker.name: CsvRecordChunker,
+}
+
+
+def make_chunker(config=None):
+    """按配置创建切分器: {"strategy": "markdown", "parent_size": 800, ...}，未给出的尺寸用默认值"""
+    config = dict(config or {})
+    strategy = config.pop("strategy", RecursiveChunker.name)
+    if strategy not in CHUNKERS:
+        raise ValueError(f"未知的切分策略: {strategy} (可选: {', '.join(CHUNKERS)})")
+    return CHUNKERS[strategy](**config)
+
+
+def chunking_signature(chunkers):
+    """扩展名 → 生效的切分配置 (配置变化后旧的重建断点作废)"""
+    return json.dumps({ext: chunker.config() for ext, chunker in sorted(chunkers.items())}, sort_keys=True)
+
+
+class ChunkingStats:
+    """按策略统计切分结果与 embedding 耗时"""
+
+    def __init__(self):
+        self.strategies = {}
+
+    def _entry(self, name):
+        return self.strategies.setdefault(name, {
+            "files": 0, "parents": 0, "children": 0, "child_tokens": 0, "embedded": 0, "embed_seconds": 0.0,
+        })
+
+    def add_file(self, name):
+        self._entry(name)["files"] += 1
+
+    def add_parent(self, name, child_texts):
+        entry = self._entry(name)
+        entry["parents"] += 1
+        entry["children"] += len(child_texts)
+        entry["child_tokens"] += sum(map(estimate_tokens, child_texts))
+
+    def add_embed(self, name, count, seconds):
+        entry = self._entry(name)
+        entry["embedded"] += count
+        entry["embed_seconds"] += seconds
+
+    def report(self):
+        report = {}
+        for name, entry in sorted(self.strategies.items()):
+            report[name] = {
+                "files": entry["files"],
+                "parents": entry["parents"],
+                "children": entry["children"],
+                "avg_child_tokens": round(entry["child_tokens"] / entry["children"], 1) if entry["children"] else 0,
+                "embedded": entry["embedded"],
+                "embed_ms": round(entry["embed_seconds"] * 1000, 1),
+                "embed_ms_per_chunk": round(entry["embed_seconds"] * 1000 / entry["embedded"], 2) if entry["embedded"] else 0,
+            }
+        return report
+
+    def summary(self):
+        return "；".join(
+            f"{name}: {r['files']} 个文件 → 父块 {r['parents']} / 子块 {r['children']} (平均 {r['avg_child_tokens']} token)，"
+            f"embedding {r['embedded']} 个 {r['embed_ms'] / 1000:.1f}s"
+            for name, r in self.report().items()
+        )
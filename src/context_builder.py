@@ -0,0 +1,290 @@
+"""
+上下文组装 (context_builder.py)
+功能: 按 token 预算组装发给 LLM 的 Prompt
+  - 用本地 tokenizer 计数 (model_cache/llm_tokenizer，缺失时按字符估算)
+  - 参考资料按相关度依次填入预算，父块只保留命中子块所在的句子及其前后各 N 句
+  - 历史对话从最近一轮往前填入预算，放不下的早期轮次压缩成一条摘要
+  - 打印每次 Prompt 的 token 数；RAG_PROMPT_BASELINE=1 (调试 / 压测) 时再与“整段父块 + 最近 6 条历史”的旧做法对比，
+    估算节省的 prefill 时间 (基线 Prompt 要整段分词，线上默认不算)
+  - 消息顺序固定为 [固定 system] + [历史] + [本轮可变内容]，前缀逐字节稳定，LM Studio / llama.cpp 可复用 KV 缓存
+说明: 本地 14B 模型的首字延迟 (TTFT) 主要花在 prefill，Prompt 每少 1k token 就少一截等待。
+"""
+
+import os
+import re
+import math
+import threading
+
+try:
+    from transformers import AutoTokenizer
+except ImportError:
+    AutoTokenizer = None
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# ============================================================
+# 配置 (可通过环境变量覆盖)
+# ============================================================
+LLM_TOKENIZER_PATH = os.environ.get("RAG_LLM_TOKENIZER", os.path.join(CURRENT_DIR, "../model_cache/llm_tokenizer"))
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("RAG_CONTEXT_TOKENS", "2048"))       # 参考资料预算
+HISTORY_TOKEN_BUDGET = int(os.environ.get("RAG_HISTORY_TOKENS", "1024"))       # 历史对话预算
+SENTENCE_WINDOW = int(os.environ.get("RAG_SENTENCE_WINDOW", "1"))              # 命中子块前后各保留几句
+PREFILL_TOKENS_PER_SEC = float(os.environ.get("RAG_PREFILL_TPS", "400"))       # 本地模型 prefill 速度 (估算节省时间用)
+PROMPT_BASELINE = os.environ.get("RAG_PROMPT_BASELINE", "0") == "1"             # 每次 Prompt 都与旧拼接方式对比 (调试 / 压测)
+MESSAGE_OVERHEAD_TOKENS = 4       # 每条消息的角色标记等额外开销
+LEGACY_HISTORY_MESSAGES = 6       # 旧做法注入的历史条数 (对比基线)
+HISTORY_STRIDE = int(os.environ.get("RAG_HISTORY_STRIDE", "8"))  # 历史窗口起点按几条消息对齐 (起点不动，前缀才稳定)
+SUMMARY_SNIPPET_CHARS = 40        # 历史摘要中每条早期消息保留的字数
+SUMMARY_HEADER = "【早前对话摘要】\n"
+
+# ============================================================
+# 固定的 system prompt (逐字节不变，作为 KV 缓存可复用的前缀)
+# ============================================================
+ROUTER_SYSTEM_PROMPT = (
+    "You are an intent routing AI. Your task is to ONLY output 'SEARCH' or 'CHAT'. Skip thinking process.\n"
+    "The user message lists the files in the knowledge base, followed by the question.\n"
+    "INSTRUCTIONS:\n"
+    "1. Carefully compare the user's question with the provided filenames to see if they relate.\n"
+    "2. If related to ANY filename, output 'SEARCH'.\n"
+    "3. If question is a greeting, general coding, or unrelated, output 'CHAT'.\n\n"
+    "EXAMPLES:\n"
+    "User: '你好' -> Output: CHAT\n"
+    "User: '帮我写个Python脚本' -> Output: CHAT\n"
+    "User: '根据文档，xxx是什么？' -> Output: SEARCH\n"
+    "Now it's your turn. Output ONLY 'SEARCH' or 'CHAT'."
+)
+CHAT_SYSTEM_PROMPT = "你是一个乐于助人的 AI 助手。请直接回答用户的问题。"
+ANSWER_SYSTEM_PROMPT = "你是一个专业助手。请根据【参考资料】回答问题。如果不知道就说不知道。"
+EXPANSION_SYSTEM_PROMPT = (
+    "你是检索问题改写助手。把用户的问题改写成几种不同的说法 (换用同义词、补全省略的主语、拆出关键词)，"
+    "用于知识库检索。不要回答问题，不要解释，一行一个改写，不加序号。Skip thinking process."
+)
+
+
+def summary_line(content):
+    """早期用户提问在摘要中的一行 (只截取开头)"""
+    return f"- 用户曾问: {' '.join(content.split())[:SUMMARY_SNIPPET_CHARS]}\n"
+
+
+def summary_lines(messages):
+    """按时间顺序取出可进摘要的行：用户提问各一行，已有的摘要消息 (对话记忆的滚动摘要) 原样展开"""
+    lines = []
+    for m in messages:
+        content = m.get("content", "")
+        if m.get("role") == "user":
+            lines.append(summary_line(content))
+        elif m.get("role") == "system" and content.startswith(SUMMARY_HEADER):
+            lines.extend(content[len(SUMMARY_HEADER):].splitlines(keepends=True))
+    return lines
+
+
+def router_messages(indexed_files, question):
+    """意图路由消息：知识库文件列表随入库变化，放在 user 消息里而不是 system prompt 里"""
+    if indexed_files:
+        kb_context = f"The knowledge base currently contains: [{', '.join(sorted(indexed_files))}]."
+    else:
+        kb_context = "The knowledge base is currently empty."
+    return [
+        {"role": "system", "content": ROUTER_SYSTEM_PROMPT},
+        {"role": "user", "content": f"{kb_context}\nQuestion: {question}"},
+    ]
+
+
+def expansion_messages(question, n):
+    """多查询改写消息：要几个改写放在 user 消息里，system prompt 保持不变"""
+    return [
+        {"role": "system", "content": EXPANSION_SYSTEM_PROMPT},
+        {"role": "user", "content": f"请给出 {n} 个改写。\n问题: {question}"},
+    ]
+
+
+def answer_messages(system_prompt, history_messages, question, context_text=None):
+    """回答消息：固定 system → 历史 → 本轮 (参考资料 + 问题)，每轮变化的内容只出现在末尾"""
+    if context_text is not None:
+        question = f"【参考资料】:\n{context_text}\n\n【问题】:\n{question}"
+    return [{"role": "system", "content": system_prompt}, *history_messages, {"role": "user", "content": question}]
+
+
+_CJK = re.compile(r"[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]")
+_SENTENCE = re.compile(r"[^。！？!?；;\n]+[。！？!?；;\n]*|[。！？!?；;\n]+")
+
+
+def estimate_tokens(text):
+    """按字符估算 token 数: CJK 1 字 ≈ 1 token，其它 4 字符 ≈ 1 token"""
+    cjk = len(_CJK.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+class TokenCounter:
+    """LLM token 计数：优先用本地 tokenizer，缺失时按 CJK 1 字 ≈ 1 token、其它 4 字符 ≈ 1 token 估算"""
+
+    def __init__(self, path=LLM_TOKENIZER_PATH):
+        self._tokenizer = None
+        if AutoTokenizer is not None and os.path.isdir(path):
+            try:
+                self._tokenizer = AutoTokenizer.from_pretrained(path)
+                print(f" -> 已加载 LLM tokenizer: {path}")
+            except Exception as e:
+                print(f"⚠️ 加载 LLM tokenizer 失败，改为按字符估算: {e}")
+
+    @property
+    def exact(self):
+        return self._tokenizer is not None
+
+    def count(self, text):
+        if not text:
+            return 0
+        if self._tokenizer is not None:
+            return len(self._tokenizer.encode(text, add_special_tokens=False))
+        return estimate_tokens(text)
+
+    def count_messages(self, messages):
+        return sum(self.count(m.get("content", "")) + MESSAGE_OVERHEAD_TOKENS for m in messages)
+
+
+def split_sentences(text):
+    """返回 [(start, end), ...] 句子区间"""
+    return [m.span() for m in _SENTENCE.finditer(text)]
+
+
+class ContextBuilder:
+    """多个知识库可共享同一个实例 (tokenizer 只加载一次，指标汇总在一起)"""
+
+    def __init__(self, counter=None, context_budget=CONTEXT_TOKEN_BUDGET,
+                 history_budget=HISTORY_TOKEN_BUDGET, sentence_window=SENTENCE_WINDOW, compare_baseline=PROMPT_BASELINE):
+        self.counter = counter or TokenCounter()
+        self.context_budget = context_budget
+        self.history_budget = history_budget
+        self.sentence_window = sentence_window
+        self.compare_baseline = compare_baseline
+        self._lock = threading.Lock()
+        self._stats = {"prompts": 0, "prompt_tokens": 0, "compared": 0, "compared_prompt_tokens": 0,
+                       "baseline_tokens": 0}
+
+    # ============================================================
+    # 参考资料
+    # ============================================================
+
+    def trim_parent(self, parent, child):
+        """父块只保留与子块重叠的句子及前后 sentence_window 句；定位不到子块时返回整段父块"""
+        start = parent.find(child)
+        if start < 0:
+            start = parent.find(child[:30]) if len(child) >= 30 else -1
+        if start < 0:
+            return parent
+        end = start + len(child)
+
+        spans = split_sentences(parent)
+        hit = [i for i, (s, e) in enumerate(spans) if s < end and e > start]
+        if not hit:
+            return parent
+        lo = max(0, hit[0] - self.sentence_window)
+        hi = min(len(spans) - 1, hit[-1] + self.sentence_window)
+        return parent[spans[lo][0]:spans[hi][1]].strip()
+
+    def build_context(self, passages):
+        """
+        按相关度顺序把参考资料填入预算
+        :param passages: [(父块内容, 命中的子块内容), ...]，已按相关度降序
+        :return: (context_text, 实际使用的片段数)
+        """
+        parts = []
+        remaining = self.context_budget
+        for parent, child in passages:
+            snippet = self.trim_parent(parent, child)
+            block = f"片段{len(parts) + 1}: {snippet}\n\n"
+            tokens = self.counter.count(block)
+            if tokens > remaining:
+                if parts:
+                    break
+                # 第一条就超预算：按比例截断，至少保证有一条参考资料
+                block = block[:max(1, len(block) * remaining // tokens)] + "\n\n"
+                tokens = remaining
+            parts.append(block)
+            remaining -= tokens
+        return "".join(parts), len(parts)
+
+    # ============================================================
+    # 历史对话
+    # ============================================================
+
+    def build_history(self, history):
+        """
+        从最近一轮往前填入预算，放不下的早期消息压缩为一条摘要放在最前面
+        窗口起点向后对齐到 HISTORY_STRIDE 的整数倍、摘要使用固定预算：对话每多一轮起点和摘要都不变，
+        上一轮的 [system + 历史] 仍是这一轮的前缀，直到跨过对齐边界才整体前移一次
+        """
+        if not history:
+            return []
+        costs = [self.counter.count(m.get("content", "")) + MESSAGE_OVERHEAD_TOKENS for m in history]
+        if sum(costs) <= self.history_budget:
+            return list(history)
+
+        summary_budget = self.history_budget // 4
+        start, remaining = len(history), self.history_budget - summary_budget
+        while start > 0 and costs[start - 1] <= remaining:
+            start -= 1
+            remaining -= costs[start]
+        if HISTORY_STRIDE > 1:
+            aligned = -(-start // HISTORY_STRIDE) * HISTORY_STRIDE
+            if aligned < len(history):
+                start = aligned
+        kept = history[start:]
+
+        summary = self.summarize(history[:start], budget=summary_budget)
+        return ([{"role": "system", "content": summary}] if summary else []) + kept
+
+    def summarize(self, messages, budget):
+        """抽取式摘要 (不额外调用 LLM)：只保留早期的用户提问，每条截取开头，超出预算的更早提问丢弃"""
+        lines = []
+        used = self.counter.count(SUMMARY_HEADER) + MESSAGE_OVERHEAD_TOKENS
+        for line in reversed(summary_lines(messages)):
+            tokens = self.counter.count(line)
+            if used + tokens > budget:
+                break
+            lines.append(line)
+            used += tokens
+        if not lines:
+            return ""
+        return SUMMARY_HEADER + "".join(reversed(lines))
+
+    # ============================================================
+    # 统计
+    # ============================================================
+
+    def report(self, messages, baseline=None):
+        """
+        打印 Prompt token 数；开启基线对比时再与旧的拼接方式对比，估算节省的 prefill 时间
+        :param baseline: 返回旧拼接方式消息列表的函数，只在开启对比时调用 (不对比时连基线 Prompt 都不拼)
+        :return: (total, baseline_total)，未对比时 baseline_total 为 None
+        """
+        total = self.counter.count_messages(messages)
+        baseline_total = None
+        if self.compare_baseline and baseline is not None:
+            baseline_total = self.counter.count_messages(baseline())
+        with self._lock:
+            self._stats["prompts"] += 1
+            self._stats["prompt_tokens"] += total
+            if baseline_total is not None:
+                self._stats["compared"] += 1
+                self._stats["compared_prompt_tokens"] += total
+                self._stats["baseline_tokens"] += baseline_total
+
+        kind = "精确" if self.counter.exact else "估算"
+        if baseline_total is None:
+            print(f" -> Prompt tokens ({kind}): {total}")
+        else:
+            saved = baseline_total - total
+            print(f" -> Prompt tokens ({kind}): {total} | 旧拼接方式: {baseline_total} | "
+                  f"节省 {saved} (约 {saved / PREFILL_TOKENS_PER_SEC * 1000:.0f}ms prefill)")
+        return total, baseline_total
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+        saved = s["baseline_tokens"] - s.pop("compared_prompt_tokens")  # 只统计做过基线对比的 Prompt
+        s["avg_prompt_tokens"] = round(s["prompt_tokens"] / s["prompts"], 1) if s["prompts"] else 0.0
+        s["saved_tokens"] = saved
+        s["saved_prefill_ms_est"] = round(saved / PREFILL_TOKENS_PER_SEC * 1000, 1)
+        s["exact_tokenizer"] = self.counter.exact
+        return s
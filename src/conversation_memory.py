@@ -0,0 +1,113 @@
+"""
+服务端对话记忆 (conversation_memory.py)
+功能: /api/chat 按 session_id 从 SQLite 取历史，客户端只需发送本轮问题
+  - 热点会话缓存在内存中 (LRU)，冷会话首次访问时从数据库加载
+  - 每个会话只保留最近 N 条消息原文，更早的消息按批折叠进滚动摘要并写回 sessions 表
+  - 会话再长，每次请求取到的历史也只有 [摘要] + [最近 N 条]，请求开销恒定
+说明: 折叠按 MEMORY_FOLD_STRIDE 条一批进行，两次折叠之间摘要和历史前缀保持不变 (利于 LLM 复用 KV 缓存)
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+import database as db
+from context_builder import SUMMARY_HEADER, summary_lines
+
+# ============================================================
+# 配置 (可通过环境变量覆盖)
+# ============================================================
+MEMORY_MAX_SESSIONS = int(os.environ.get("RAG_MEMORY_SESSIONS", "64"))        # 内存中缓存的会话数
+MEMORY_RECENT_MESSAGES = int(os.environ.get("RAG_MEMORY_RECENT", "12"))       # 保留原文的最近消息条数
+MEMORY_FOLD_STRIDE = int(os.environ.get("RAG_MEMORY_FOLD_STRIDE", "8"))       # 超出多少条后折叠一批进摘要
+MEMORY_SUMMARY_LINES = int(os.environ.get("RAG_MEMORY_SUMMARY_LINES", "20"))  # 滚动摘要最多保留的行数
+
+
+class ConversationMemory:
+    """线程安全：流式回答结束时在后台线程中写入"""
+
+    def __init__(self, max_sessions=MEMORY_MAX_SESSIONS, recent_messages=MEMORY_RECENT_MESSAGES,
+                 fold_stride=MEMORY_FOLD_STRIDE, summary_lines_limit=MEMORY_SUMMARY_LINES):
+        self.max_sessions = max_sessions
+        self.recent_messages = recent_messages
+        self.fold_stride = max(1, fold_stride)
+        self.summary_lines_limit = summary_lines_limit
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()  # session_id → {"summary", "summary_upto", "recent": [{id, role, content}]}
+        self._stats = {"hits": 0, "loads": 0, "evictions": 0, "folds": 0}
+
+    # ============================================================
+    # 对外接口
+    # ============================================================
+
+    def history(self, session_id):
+        """返回喂给 RAGSystem.query 的历史：[滚动摘要 (system)] + 最近的消息原文"""
+        with self._lock:
+            state = self._get(session_id)
+            messages = [{"role": m["role"], "content": m["content"]} for m in state["recent"]]
+            if state["summary"]:
+                messages.insert(0, {"role": "system", "content": SUMMARY_HEADER + state["summary"]})
+            return messages
+
+    def append(self, session_id, message_id, role, content):
+        """记录一条已写入数据库的消息 (会话不在缓存中时不处理，下次访问会从数据库加载)"""
+        with self._lock:
+            state = self._sessions.get(session_id)
+            if state is None:
+                return
+            state["recent"].append({"id": message_id, "role": role, "content": content})
+            self._fold(session_id, state)
+
+    def forget(self, session_id):
+        """会话被删除时清掉缓存"""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["cached_sessions"] = len(self._sessions)
+            s["max_sessions"] = self.max_sessions
+            return s
+
+    # ============================================================
+    # 内部实现
+    # ============================================================
+
+    def _get(self, session_id):
+        """取会话状态 (LRU)，未缓存则从数据库加载 [摘要] + [摘要之后的消息]"""
+        state = self._sessions.get(session_id)
+        if state is not None:
+            self._sessions.move_to_end(session_id)
+            self._stats["hits"] += 1
+            return state
+
+        summary, summary_upto = db.get_session_summary(session_id)
+        state = {
+            "summary": summary,
+            "summary_upto": summary_upto,
+            "recent": db.get_messages_after(session_id, summary_upto),
+        }
+        self._stats["loads"] += 1
+        self._fold(session_id, state)
+
+        self._sessions[session_id] = state
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self._stats["evictions"] += 1
+        return state
+
+    def _fold(self, session_id, state):
+        """最近消息超出 recent_messages + fold_stride 时，把多出的部分折叠进滚动摘要并落库"""
+        recent = state["recent"]
+        if len(recent) <= self.recent_messages + self.fold_stride:
+            return
+        cut = len(recent) - self.recent_messages
+        folded, state["recent"] = recent[:cut], recent[cut:]
+
+        lines = state["summary"].splitlines(keepends=True) + summary_lines(folded)
+        state["summary"] = "".join(lines[-self.summary_lines_limit:])
+        state["summary_upto"] = folded[-1]["id"]
+        db.update_session_summary(session_id, state["summary"], state["summary_upto"])
+        self._stats["folds"] += 1
+        print(f" -> 会话 {session_id[:8]} 折叠 {len(folded)} 条早期消息进滚动摘要")
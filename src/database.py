@@ -1,20 +1,54 @@
 import sqlite3
 import json
 import os
+import re
+import html
+import zlib
 import uuid
+import hashlib
 from datetime import datetime
 
+from tokenizer import tokenize, tokenize_for_search
+
 # --- 配置 ---
 # 数据库文件存放在 data 目录下
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_PATH = os.path.join(CURRENT_DIR, "../data/chat_history.db")
+DB_PATH = os.environ.get("RAG_CHAT_DB", os.path.join(CURRENT_DIR, "../data/chat_history.db"))
+SEARCH_PAGE_SIZE_MAX = 100   # 全文检索每页最多条数
+SNIPPET_CHARS = 80           # 检索结果摘录的长度 (字符)
+THOUGHT_COMPRESS_MIN = int(os.environ.get("RAG_THOUGHT_COMPRESS_MIN", "1024"))  # 思考过程超过多少字压缩存储，0 表示不压缩
+BUSY_TIMEOUT_S = float(os.environ.get("RAG_CHAT_BUSY_TIMEOUT", "30"))  # 库被维护任务占用时，其它连接最多等待多少秒
+
+
+def _fts_tokens(text):
+    """FTS5 索引列的内容：jieba 细粒度分词后用空格连接 (SQLite 内置 tokenizer 不会切中文)"""
+    return " ".join(tokenize_for_search(text)) if text else ""
+
+
+def _fts_thought_tokens(thought, thought_z):
+    """思考过程的索引内容 (压缩存储的先解压)"""
+    return _fts_tokens(_unpack_thought(thought, thought_z))
+
+
+def _fts_pack(content, thought, thought_z):
+    """一条消息入索引时的分词结果 (正文 / 思考过程)，zlib 压缩后存入 message_tokens，删除时原样取回"""
+    return zlib.compress((_fts_tokens(content) + "\0" + _fts_thought_tokens(thought, thought_z)).encode("utf-8"), 6)
+
+
+def _fts_unpack(tokens_z, column):
+    return zlib.decompress(tokens_z).decode("utf-8").split("\0")[column] if tokens_z else ""
 
 
 def get_db_connection():
     """获取数据库连接"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT_S)
     # 这行代码让查询结果像字典一样可以通过列名访问 (row['id'])
     conn.row_factory = sqlite3.Row
+    # 全文索引的同步触发器调用这些函数分词，所有写 messages 的连接都必须注册
+    conn.create_function("fts_tokens", 1, _fts_tokens, deterministic=True)
+    conn.create_function("fts_thought_tokens", 2, _fts_thought_tokens, deterministic=True)
+    conn.create_function("fts_pack", 3, _fts_pack, deterministic=True)
+    conn.create_function("fts_unpack", 2, _fts_unpack, deterministic=True)
     return conn
 
 
@@ -22,6 +56,8 @@ def init_db():
     """初始化数据库表结构"""
     conn = get_db_connection()
     c = conn.cursor()
+    # 新建的库直接使用增量回收 (已有数据的库由 chat_maintenance.compact_history 切换)
+    c.execute('PRAGMA auto_vacuum = INCREMENTAL')
 
     # 1. 会话表 (Sessions)
     c.execute('''
@@ -48,20 +84,127 @@ def init_db():
         )
     ''')
 
+    # 3. 兼容旧库: 会话绑定的知识库 (多知识库支持后新增的列)
+    columns = [row['name'] for row in c.execute('PRAGMA table_info(sessions)').fetchall()]
+    if 'kb' not in columns:
+        c.execute('ALTER TABLE sessions ADD COLUMN kb TEXT')
+
+    # 4. 兼容旧库: 会话的滚动摘要 (summary_upto 为已折叠进摘要的最后一条消息 id)
+    if 'summary' not in columns:
+        c.execute('ALTER TABLE sessions ADD COLUMN summary TEXT')
+    if 'summary_upto' not in columns:
+        c.execute('ALTER TABLE sessions ADD COLUMN summary_upto INTEGER DEFAULT 0')
+
+    # 5. 存储压缩: 参考来源按内容去重存一份 (messages.sources 只存引用)，长思考过程 zlib 压缩存入 thought_z
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS source_chunks (
+            id TEXT PRIMARY KEY,
+            chunk_id INTEGER,
+            source TEXT,
+            page INTEGER,
+            content TEXT NOT NULL
+        )
+    ''')
+    message_columns = [row['name'] for row in c.execute('PRAGMA table_info(messages)').fetchall()]
+    if 'thought_z' not in message_columns:
+        c.execute('ALTER TABLE messages ADD COLUMN thought_z BLOB')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, id)')
+
+    # 6. 聊天记录全文索引 (FTS5)：正文与思考过程分词后存入，触发器与 messages 表保持同步
+    fts = c.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'").fetchone()
+    if not fts:
+        _create_message_index(c)
+    elif _FTS_CONTENTLESS in fts['sql'] and not _has_table(c, 'message_tokens'):
+        # 没有存分词结果的 contentless 索引: 删除时只能重新分词，词典变化后会删不干净，重建一次
+        print(" -> 全文索引缺少分词记录，正在重建...")
+        _create_message_index(c)
+    else:
+        _create_message_index_triggers(c, contentless=_FTS_CONTENTLESS in fts['sql'])
+
     conn.commit()
     conn.close()
     print(f"✅ 数据库初始化完成: {DB_PATH}")
 
 
+_FTS_CONTENTLESS = "content = ''"
+
+
+def _has_table(c, name):
+    return c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+def _create_message_index(c):
+    """
+    建立全文索引并补建已有消息 (旧库一次性)
+    contentless: 索引里不再存一份分词后的全文 (摘录从 messages 表取)；
+    删除需要提供入索引时的原分词结果，压缩存在 message_tokens 中，不在删除时重新分词 (词典 / 停用词可能已变)
+    """
+    c.execute('DROP TABLE IF EXISTS messages_fts')
+    c.execute('CREATE TABLE IF NOT EXISTS message_tokens (id INTEGER PRIMARY KEY, tokens_z BLOB)')
+    c.execute('DELETE FROM message_tokens')
+    c.execute(f"CREATE VIRTUAL TABLE messages_fts USING fts5(content, thought, {_FTS_CONTENTLESS}, tokenize = 'unicode61')")
+    # 排序: BM25，正文命中权重高于思考过程
+    c.execute("INSERT INTO messages_fts(messages_fts, rank) VALUES('rank', 'bm25(1.0, 0.4)')")
+    c.execute('INSERT INTO message_tokens(id, tokens_z) SELECT id, fts_pack(content, thought, thought_z) FROM messages')
+    c.execute('INSERT INTO messages_fts(rowid, content, thought) '
+              'SELECT id, fts_unpack(tokens_z, 0), fts_unpack(tokens_z, 1) FROM message_tokens')
+    _create_message_index_triggers(c, contentless=True)
+
+
+def _create_message_index_triggers(c, contentless):
+    """触发器每次按最新定义重建 (思考过程可能压缩存储；旧库的索引可能还不是 contentless)"""
+    if contentless:
+        remove_old = ("INSERT INTO messages_fts(messages_fts, rowid, content, thought) "
+                      "SELECT 'delete', id, fts_unpack(tokens_z, 0), fts_unpack(tokens_z, 1) "
+                      "FROM message_tokens WHERE id = old.id; "
+                      "DELETE FROM message_tokens WHERE id = old.id;")
+        insert_new = ("INSERT INTO message_tokens(id, tokens_z) "
+                      "VALUES (new.id, fts_pack(new.content, new.thought, new.thought_z)); "
+                      "INSERT INTO messages_fts(rowid, content, thought) "
+                      "SELECT id, fts_unpack(tokens_z, 0), fts_unpack(tokens_z, 1) FROM message_tokens WHERE id = new.id;")
+    else:
+        remove_old = "DELETE FROM messages_fts WHERE rowid = old.id;"
+        insert_new = ("INSERT INTO messages_fts(rowid, content, thought) "
+                      "VALUES (new.id, fts_tokens(new.content), fts_thought_tokens(new.thought, new.thought_z));")
+    c.executescript(f'''
+        DROP TRIGGER IF EXISTS messages_fts_insert;
+        DROP TRIGGER IF EXISTS messages_fts_delete;
+        DROP TRIGGER IF EXISTS messages_fts_update;
+        CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+            {insert_new}
+        END;
+        CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+            {remove_old}
+        END;
+        CREATE TRIGGER messages_fts_update AFTER UPDATE OF content, thought, thought_z ON messages BEGIN
+            {remove_old}
+            {insert_new}
+        END;
+    ''')
+
+
+def rebuild_message_index():
+    """旧库的全文索引重建为 contentless (chat_maintenance.compact_history 调用)，已是新格式返回 False"""
+    conn = get_db_connection()
+    fts = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'").fetchone()
+    if fts and _FTS_CONTENTLESS in fts['sql'] and _has_table(conn, 'message_tokens'):
+        conn.close()
+        return False
+    _create_message_index(conn)
+    conn.commit()
+    conn.close()
+    return True
+
+
 # ===========================
 # 会话管理 (Sessions)
 # ===========================
 
-def create_session(title="新对话"):
-    """创建一个新会话，返回 session_id"""
+def create_session(title="新对话", kb=None):
+    """创建一个新会话，返回 session_id (kb: 会话绑定的知识库名称)"""
     conn = get_db_connection()
     session_id = str(uuid.uuid4())
-    conn.execute('INSERT INTO sessions (id, title) VALUES (?, ?)', (session_id, title))
+    conn.execute('INSERT INTO sessions (id, title, kb) VALUES (?, ?, ?)', (session_id, title, kb))
     conn.commit()
     conn.close()
     return session_id
@@ -86,6 +229,22 @@ def delete_session(session_id):
     conn.close()
 
 
+def get_session_kb(session_id):
+    """获取会话绑定的知识库名称 (未绑定返回 None)"""
+    conn = get_db_connection()
+    row = conn.execute('SELECT kb FROM sessions WHERE id = ?', (session_id,)).fetchone()
+    conn.close()
+    return row['kb'] if row else None
+
+
+def update_session_kb(session_id, kb):
+    """更新会话绑定的知识库"""
+    conn = get_db_connection()
+    conn.execute('UPDATE sessions SET kb = ? WHERE id = ?', (kb, session_id))
+    conn.commit()
+    conn.close()
+
+
 def update_session_title(session_id, new_title):
     """更新会话标题"""
     conn = get_db_connection()
@@ -98,20 +257,91 @@ def update_session_title(session_id, new_title):
 # 消息管理 (Messages)
 # ===========================
 
+def source_chunk_id(doc):
+    """参考来源片段的去重键 (来源 + 页码 + 内容的哈希)"""
+    key = f"{doc.get('source', '')}\0{doc.get('page', '')}\0{doc.get('content', '')}"
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=12).hexdigest()
+
+
+def _pack_sources(conn, sources):
+    """参考来源写入去重表，返回 messages.sources 中存的引用 JSON: {"refs": [...]}"""
+    refs = []
+    for doc in sources:
+        ref = source_chunk_id(doc)
+        conn.execute(
+            'INSERT OR IGNORE INTO source_chunks (id, chunk_id, source, page, content) VALUES (?, ?, ?, ?, ?)',
+            (ref, doc.get('chunk_id'), doc.get('source'), doc.get('page'), doc.get('content', ''))
+        )
+        refs.append(ref)
+    return json.dumps({"refs": refs})
+
+
+def _pack_thought(thought):
+    """返回 (thought, thought_z)：超过阈值的长思考过程压缩存储"""
+    if thought and THOUGHT_COMPRESS_MIN and len(thought) >= THOUGHT_COMPRESS_MIN:
+        return None, zlib.compress(thought.encode("utf-8"), 6)
+    return thought, None
+
+
+def _unpack_thought(thought, thought_z):
+    if thought_z is not None:
+        return zlib.decompress(thought_z).decode("utf-8")
+    return thought
+
+
+def _resolve_sources(conn, rows):
+    """把一批消息的 sources 还原为 [{source, page, content}, ...] (兼容旧格式: 直接存的 JSON 列表)"""
+    parsed = {}
+    wanted = set()
+    for r in rows:
+        raw = r['sources']
+        if not raw:
+            continue
+        try:
+            value = json.loads(raw)
+        except ValueError:
+            value = []
+        parsed[r['id']] = value
+        if isinstance(value, dict):
+            wanted.update(value.get("refs", ()))
+
+    chunks = {}
+    wanted = sorted(wanted)
+    for start in range(0, len(wanted), 500):
+        batch = wanted[start:start + 500]
+        placeholders = ",".join("?" * len(batch))
+        for c in conn.execute(f'SELECT * FROM source_chunks WHERE id IN ({placeholders})', batch):
+            doc = {"source": c['source'], "page": c['page'], "content": c['content']}
+            if c['chunk_id'] is not None:
+                doc["chunk_id"] = c['chunk_id']
+            chunks[c['id']] = doc
+
+    resolved = {}
+    for message_id, value in parsed.items():
+        if isinstance(value, dict):
+            resolved[message_id] = [chunks[ref] for ref in value.get("refs", ()) if ref in chunks]
+        else:
+            resolved[message_id] = value if isinstance(value, list) else []
+    return resolved
+
+
 def add_message(session_id, role, content, thought=None, sources=None):
-    """添加一条消息"""
+    """添加一条消息，返回消息 id (参考来源去重存储，长思考过程压缩存储)"""
     conn = get_db_connection()
 
-    # 如果 sources 是对象/列表，转为 JSON 字符串存储
+    # 如果 sources 是对象/列表，内容写入去重表，消息里只存引用
     if sources and not isinstance(sources, str):
-        sources = json.dumps(sources, ensure_ascii=False)
+        sources = _pack_sources(conn, sources)
+    thought, thought_z = _pack_thought(thought)
 
-    conn.execute('''
-        INSERT INTO messages (session_id, role, content, thought, sources)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (session_id, role, content, thought, sources))
+    cursor = conn.execute('''
+        INSERT INTO messages (session_id, role, content, thought, sources, thought_z)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (session_id, role, content, thought, sources, thought_z))
+    message_id = cursor.lastrowid
     conn.commit()
     conn.close()
+    return message_id
 
 
 def get_session_messages(session_id):
@@ -122,21 +352,143 @@ def get_session_messages(session_id):
         WHERE session_id = ? 
         ORDER BY id ASC
     ''', (session_id,)).fetchall()
+
+    # 将 sources 从引用还原为对象，压缩的思考过程解压
+    sources = _resolve_sources(conn, messages)
     conn.close()
 
     result = []
     for msg in messages:
         m = dict(msg)
-        # 将 sources 从 JSON 字符串转回对象
+        m['thought'] = _unpack_thought(m['thought'], m.pop('thought_z'))
         if m['sources']:
-            try:
-                m['sources'] = json.loads(m['sources'])
-            except:
-                m['sources'] = []
+            m['sources'] = sources.get(m['id'], [])
         result.append(m)
     return result
 
 
+def get_messages_after(session_id, after_id=0):
+    """获取指定会话中 id 大于 after_id 的消息 (只取对话记忆需要的 id / role / content)"""
+    conn = get_db_connection()
+    rows = conn.execute('''
+        SELECT id, role, content FROM messages
+        WHERE session_id = ? AND id > ?
+        ORDER BY id ASC
+    ''', (session_id, after_id)).fetchall()
+    conn.close()
+    return [dict(r) for r in rows]
+
+
+# ===========================
+# 全文检索 (FTS5)
+# ===========================
+
+def _match_expression(query):
+    """问题 → FTS5 MATCH 表达式：分词后每个词作为一个短语，全部命中 (隐式 AND)"""
+    terms = []
+    for token in tokenize(query):
+        if token not in terms:
+            terms.append(token)
+    return terms, " ".join('"' + t.replace('"', '""') + '"' for t in terms)
+
+
+def _highlight(text, terms, width=SNIPPET_CHARS):
+    """在原文 (而不是分词后的索引列) 上截取第一个命中词附近的片段，命中词用 <mark> 包裹 (已做 HTML 转义)"""
+    if not text:
+        return ""
+    pattern = re.compile("|".join(re.escape(t) for t in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    first = pattern.search(text)
+    start = max(0, (first.start() if first else 0) - width // 3)
+    end = min(len(text), start + width)
+    parts, pos = [], start
+    for m in pattern.finditer(text, start, end):
+        parts.append(html.escape(text[pos:m.start()]))
+        parts.append(f"<mark>{html.escape(m.group())}</mark>")
+        pos = m.end()
+    parts.append(html.escape(text[pos:end]))
+    return ("…" if start > 0 else "") + "".join(parts) + ("…" if end < len(text) else "")
+
+
+def search_messages(query, page=1, page_size=20, session_id=None, role=None):
+    """
+    全文检索聊天记录 (正文 + 思考过程)，按 BM25 排序分页
+    :return: {"total", "page", "page_size", "results": [{id, session_id, session_title, role, created_at,
+              score, field, snippet}, ...]}，snippet 中命中词用 <mark> 标出
+    """
+    page = max(1, int(page))
+    page_size = min(max(1, int(page_size)), SEARCH_PAGE_SIZE_MAX)
+    terms, expression = _match_expression(query or "")
+    if not terms:
+        return {"total": 0, "page": page, "page_size": page_size, "results": []}
+
+    where = ["messages_fts MATCH ?"]
+    params = [expression]
+    if session_id:
+        where.append("m.session_id = ?")
+        params.append(session_id)
+    if role:
+        where.append("m.role = ?")
+        params.append(role)
+    where_sql = " AND ".join(where)
+
+    conn = get_db_connection()
+    total = conn.execute(f'''
+        SELECT COUNT(*) FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+        WHERE {where_sql}
+    ''', params).fetchone()[0]
+    rows = conn.execute(f'''
+        SELECT m.id, m.session_id, s.title AS session_title, m.role, m.content, m.thought, m.thought_z, m.created_at,
+               messages_fts.rank AS rank
+        FROM messages_fts
+        JOIN messages m ON m.id = messages_fts.rowid
+        LEFT JOIN sessions s ON s.id = m.session_id
+        WHERE {where_sql}
+        ORDER BY messages_fts.rank
+        LIMIT ? OFFSET ?
+    ''', params + [page_size, (page - 1) * page_size]).fetchall()
+    conn.close()
+
+    results = []
+    for r in rows:
+        texts = {"content": r['content'], "thought": _unpack_thought(r['thought'], r['thought_z'])}
+        # 摘录取命中词更多的一列 (正文优先)
+        hits = {f: sum(t in (text or "").lower() for t in terms) for f, text in texts.items()}
+        field = "thought" if hits["thought"] > hits["content"] else "content"
+        results.append({
+            "id": r['id'],
+            "session_id": r['session_id'],
+            "session_title": r['session_title'],
+            "role": r['role'],
+            "created_at": r['created_at'],
+            "score": round(-r['rank'], 4),  # FTS5 的 bm25 越小越相关，取反后越大越相关
+            "field": field,
+            "snippet": _highlight(texts[field], terms),
+        })
+    return {"total": total, "page": page, "page_size": page_size, "results": results}
+
+
+# ===========================
+# 对话记忆 (Rolling Summary)
+# ===========================
+
+def get_session_summary(session_id):
+    """获取会话的滚动摘要，返回 (summary, summary_upto)"""
+    conn = get_db_connection()
+    row = conn.execute('SELECT summary, summary_upto FROM sessions WHERE id = ?', (session_id,)).fetchone()
+    conn.close()
+    if not row:
+        return "", 0
+    return row['summary'] or "", row['summary_upto'] or 0
+
+
+def update_session_summary(session_id, summary, summary_upto):
+    """更新会话的滚动摘要"""
+    conn = get_db_connection()
+    conn.execute('UPDATE sessions SET summary = ?, summary_upto = ? WHERE id = ?', (summary, summary_upto, session_id))
+    conn.commit()
+    conn.close()
+
+
 # 模块被导入时自动检查初始化
 if not os.path.exists(DB_PATH):
     # 确保父目录存在
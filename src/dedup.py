@@ -0,0 +1,208 @@
+"""
+近似重复子块检测 (dedup.py)
+功能: 入库时用 MinHash + LSH 分桶找出近似重复的子块 (页眉页脚、免责声明、重复的 CSV 行、换名重传的同一文件)
+  - 字符 n-gram 分片 → 滚动哈希 → 乘移位 (multiply-shift) 哈希族得到 MinHash 签名，全部用 NumPy 向量化
+  - LSH 分桶只比较同桶候选，签名一致率 ≥ 阈值即视为重复
+  - 重复子块合并为一条 (保留最先出现的)，来源文件记入 dup_sources，避免重复 embedding 和重复命中
+  - 其它文件的重复子块的原始 metadata 记入 dup_refs (JSON)，代表子块所在的文件被删除 / 重新入库时，
+    据此把这部分内容交还给其它文件 (见 ingest._detach_source)，而不是随代表子块一起丢失
+  - 分桶可增量维护，流式入库时逐批去重 (只保留代表子块的签名与分桶，不保留全部文本)
+"""
+
+import os
+import json
+import numpy as np
+
+DEDUP_THRESHOLD = float(os.environ.get("RAG_DEDUP_THRESHOLD", "0.9"))  # 估计的 Jaccard 相似度 ≥ 阈值视为重复，0 表示关闭
+NUM_PERM = 64        # MinHash 签名长度
+LSH_BANDS = 16       # 分桶数 (每桶 NUM_PERM / LSH_BANDS 行)
+SHINGLE_SIZE = 5     # 字符 n-gram 长度 (中文按字切分效果好于按词)
+DUP_SEPARATOR = "|"  # Chroma metadata 只支持标量，多来源用分隔符拼成字符串
+
+_rng = np.random.default_rng(20240601)  # 固定种子：签名在不同进程 / 不同次入库之间可比
+_HASH_A = _rng.integers(1, 2 ** 63, size=NUM_PERM, dtype=np.uint64) | np.uint64(1)  # 乘移位哈希要求奇数
+_HASH_B = _rng.integers(0, 2 ** 63, size=NUM_PERM, dtype=np.uint64)
+_ROLL_POWERS = np.uint64(1000003) ** np.arange(SHINGLE_SIZE - 1, -1, -1, dtype=np.uint64)
+
+
+def _shingle_hashes(text):
+    """文本 → 去重后的 n-gram 哈希数组 (空白归一、英文小写)"""
+    text = " ".join(text.lower().split())
+    codes = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+    if len(codes) < SHINGLE_SIZE:
+        codes = np.concatenate([codes, np.zeros(SHINGLE_SIZE - len(codes), dtype=np.uint64)])
+    windows = np.lib.stride_tricks.sliding_window_view(codes, SHINGLE_SIZE)
+    return np.unique((windows * _ROLL_POWERS).sum(axis=1))
+
+
+def minhash_signatures(texts):
+    """返回 (len(texts), NUM_PERM) 的 uint32 MinHash 签名矩阵"""
+    signatures = np.empty((len(texts), NUM_PERM), dtype=np.uint32)
+    with np.errstate(over="ignore"):
+        for i, text in enumerate(texts):
+            x = _shingle_hashes(text)
+            # h(x) = (a·x + b) mod 2^64 的高 32 位，uint64 溢出即取模
+            hashed = (_HASH_A[:, None] * x[None, :] + _HASH_B[:, None]) >> np.uint64(32)
+            signatures[i] = hashed.min(axis=1)
+    return signatures
+
+
+class NearDuplicateIndex:
+    """
+    可增量的 LSH 分桶：文本可分批加入，只保留代表的签名与分桶 (流式入库时跨批次去重)
+    add(texts) 返回这批文本的代表的全局下标，rep[i] == 自身全局下标表示保留
+    """
+
+    def __init__(self, threshold=DEDUP_THRESHOLD):
+        self.threshold = threshold
+        self.count = 0
+        self._signatures = {}  # 代表的全局下标 → 签名
+        self._buckets = [dict() for _ in range(LSH_BANDS)]
+
+    def add(self, texts):
+        n = len(texts)
+        rep = np.arange(self.count, self.count + n, dtype=np.int64)
+        self.count += n
+        if not n or self.threshold <= 0:
+            return rep
+
+        signatures = minhash_signatures(texts)
+        rows_per_band = NUM_PERM // LSH_BANDS
+        for i in range(n):
+            signature = signatures[i]
+            keys = [signature[b * rows_per_band:(b + 1) * rows_per_band].tobytes() for b in range(LSH_BANDS)]
+            candidates = {j for bucket, key in zip(self._buckets, keys) for j in bucket.get(key, ())}
+            if candidates:
+                cands = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+                similarity = (np.stack([self._signatures[j] for j in cands]) == signature).mean(axis=1)
+                best = int(np.argmax(similarity))
+                if similarity[best] >= self.threshold:
+                    rep[i] = cands[best]
+                    continue
+            # 只有保留下来的代表进入分桶
+            own = int(rep[i])
+            self._signatures[own] = signature.copy()
+            for bucket, key in zip(self._buckets, keys):
+                bucket.setdefault(key, []).append(own)
+        return rep
+
+
+def find_near_duplicates(texts, threshold=DEDUP_THRESHOLD):
+    """
+    按出现顺序贪心归并近似重复文本
+    :return: 与 texts 等长的代表下标数组，rep[i] == i 表示保留，否则 i 是 rep[i] 的重复
+    """
+    return NearDuplicateIndex(threshold).add(texts)
+
+
+def dup_ref(metadata):
+    """被合并的重复子块的原始 metadata (source / page / parent_id / chunk_id ...)，交还内容时按它重建子块"""
+    return {k: v for k, v in metadata.items() if not k.startswith("dup_")}
+
+
+def load_dup_refs(metadata):
+    """代表子块记录的其它文件的重复子块 (旧库没有 dup_refs 时为空)"""
+    return json.loads(metadata.get("dup_refs") or "[]")
+
+
+def set_dup_refs(metadata, refs):
+    """
+    写入 dup_refs (按 chunk_id 去重)，并据此更新 dup_files (涉及几个其它文件，供按条件查询) 与 dup_sources
+    旧库中只有 dup_sources、没有对应记录的文件名保留不动
+    """
+    refs = list({ref.get("chunk_id"): ref for ref in refs}.values())
+    own_source = metadata.get("source", "")
+    ref_sources = {ref.get("source", "") for ref in refs} - {own_source}
+    if refs:
+        metadata["dup_refs"] = json.dumps(refs, ensure_ascii=False)
+    else:
+        metadata.pop("dup_refs", None)
+    metadata["dup_files"] = len(ref_sources)
+    names = set(filter(None, metadata.get("dup_sources", "").split(DUP_SEPARATOR)))
+    names |= {os.path.basename(s) for s in ref_sources}
+    if names:
+        metadata["dup_sources"] = DUP_SEPARATOR.join(sorted(names))
+    else:
+        metadata.pop("dup_sources", None)
+    return refs
+
+
+def drop_dup_source(metadata, source):
+    """移除代表子块中记录的某个文件的重复 (该文件被删除 / 重新入库，旧内容不应再被交还)，返回移除的条数"""
+    refs = load_dup_refs(metadata)
+    kept = [ref for ref in refs if ref.get("source") != source]
+    removed = len(refs) - len(kept)
+    if removed:
+        names = set(filter(None, metadata.get("dup_sources", "").split(DUP_SEPARATOR)))
+        names.discard(os.path.basename(source))
+        metadata["dup_sources"] = DUP_SEPARATOR.join(sorted(names))
+        metadata["dup_count"] = max(0, metadata.get("dup_count", 0) - removed)
+        set_dup_refs(metadata, kept)
+    return removed
+
+
+def merge_dup_metadata(metadata, count, sources, refs=()):
+    """把合并进来的重复子块计入代表子块的 metadata (dup_count 累加，dup_sources / dup_refs 取并集)"""
+    metadata["dup_count"] = metadata.get("dup_count", 0) + count
+    merged = set(filter(None, metadata.get("dup_sources", "").split(DUP_SEPARATOR))) | set(sources)
+    if merged:
+        metadata["dup_sources"] = DUP_SEPARATOR.join(sorted(merged))
+    if refs:
+        set_dup_refs(metadata, load_dup_refs(metadata) + list(refs))
+
+
+class DocumentDeduper:
+    """
+    分批合并近似重复的子块 (一次性入库只调用一次 filter，流式入库每批调用一次，跨批次去重)
+    代表子块所在的批次已经写入时，之后合并进来的重复计入 late_updates: id → (条数, 来源文件名集合, dup_refs)，由调用方最后补写
+    """
+
+    def __init__(self, threshold=DEDUP_THRESHOLD):
+        self.index = NearDuplicateIndex(threshold)
+        self.duplicates = 0
+        self.late_updates = {}
+        self._reps = {}  # 代表的全局下标 → (id, 来源文件路径)
+
+    def filter(self, docs, ids):
+        """
+        :param docs: 子文档列表 (LangChain Document)
+        :param ids: 与 docs 对应的 Chroma id 列表
+        :return: (保留的 docs, 保留的 ids)
+        被保留的代表子块 metadata 增加 dup_count (合并了几条)、dup_sources (其它来源文件名，用 | 分隔)
+        与 dup_refs (其它来源文件的重复子块的原始 metadata)
+        """
+        base = self.index.count
+        rep = self.index.add([d.page_content for d in docs])
+        kept_docs, kept_ids = [], []
+        merged = {}  # 本批内的代表下标 → [条数, 来源文件名集合, dup_refs]
+        for i, doc in enumerate(docs):
+            r = int(rep[i])
+            source = doc.metadata.get("source", "")
+            if r == base + i:
+                self._reps[r] = (ids[i], source)
+                kept_docs.append(doc)
+                kept_ids.append(ids[i])
+                continue
+            self.duplicates += 1
+            rep_id, rep_source = self._reps[r]
+            entry = (merged.setdefault(r, [0, set(), []]) if r >= base
+                     else self.late_updates.setdefault(rep_id, [0, set(), []]))
+            entry[0] += 1
+            # 子目录下的同名文件也是不同的文件，按完整路径比较
+            if source and source != rep_source:
+                entry[1].add(os.path.basename(source))
+                entry[2].append(dup_ref(doc.metadata))
+
+        for r, (count, sources, refs) in merged.items():
+            merge_dup_metadata(docs[r - base].metadata, count, sources, refs)
+        return kept_docs, kept_ids
+
+
+def dedup_documents(docs, ids, threshold=DEDUP_THRESHOLD):
+    """
+    合并近似重复的子块
+    :return: (保留的 docs, 保留的 ids, 被合并的子块数)
+    """
+    deduper = DocumentDeduper(threshold)
+    docs, ids = deduper.filter(docs, ids)
+    return docs, ids, deduper.duplicates
@@ -0,0 +1,71 @@
+"""
+文件登记表 (file_registry.py)
+功能: 记录每个上传文件的入库状态，持久化为 db_dir/file_registry.json
+  - 状态流转: pending → parsing → embedding → indexed / failed
+  - 上传时边写边算的 sha256 也记在这里，同一文件原样重传时可直接跳过重新入库
+"""
+
+import os
+import json
+import time
+import threading
+
+REGISTRY_FILE = "file_registry.json"
+
+STATUS_PENDING = "pending"
+STATUS_PARSING = "parsing"
+STATUS_EMBEDDING = "embedding"
+STATUS_INDEXED = "indexed"
+STATUS_FAILED = "failed"
+ACTIVE_STATUSES = (STATUS_PENDING, STATUS_PARSING, STATUS_EMBEDDING)
+
+
+class FileRegistry:
+    """线程安全：上传接口与后台入库线程会同时更新"""
+
+    def __init__(self, db_dir):
+        self.path = os.path.join(db_dir, REGISTRY_FILE)
+        self._lock = threading.Lock()
+        self._files = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._files = json.load(f)
+            except Exception as e:
+                print(f"⚠️ 加载文件登记表失败: {e}")
+
+    def get(self, name):
+        with self._lock:
+            record = self._files.get(name)
+            return dict(record) if record else None
+
+    def all(self):
+        with self._lock:
+            return {name: dict(record) for name, record in self._files.items()}
+
+    def update(self, name, **fields):
+        """更新一个文件的记录 (不存在则新建)，立即落盘"""
+        with self._lock:
+            record = self._files.setdefault(name, {"status": STATUS_PENDING, "error": None})
+            record.update(fields)
+            record["updated_at"] = time.time()
+            self._save()
+            return dict(record)
+
+    def remove(self, name):
+        with self._lock:
+            if self._files.pop(name, None) is not None:
+                self._save()
+
+    def clear(self):
+        """全量重建 / 重置后清空 (状态以新的索引为准)"""
+        with self._lock:
+            self._files = {}
+            self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self._files, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
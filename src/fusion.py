@@ -0,0 +1,53 @@
+"""
+结果融合 (fusion.py)
+功能: 基于整数 chunk_id 数组的 NumPy 向量化 RRF 融合与去重
+说明: 融合只处理 id 与名次，开销与子块文本长度无关
+"""
+
+import numpy as np
+
+RRF_K = 60
+
+
+def weighted_rrf(ranked_ids, weights=None, top_k=None, rrf_k=RRF_K):
+    """
+    加权 Reciprocal Rank Fusion: score(d) = Σ w_i / (rrf_k + rank_i(d) + 1)
+    :param ranked_ids: N 路检索结果，每路为按相关性降序排列的 chunk_id 数组
+    :param weights: 每路权重，默认全 1
+    :param top_k: 返回前多少个，None 表示全部
+    :return: (fused_ids, fused_scores)，按分数降序
+    """
+    lists = [np.asarray(ids, dtype=np.int64) for ids in ranked_ids]
+    lists = [ids for ids in lists if len(ids)]
+    if not lists:
+        return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+
+    if weights is None:
+        weights = [1.0] * len(ranked_ids)
+    weights = [w for ids, w in zip(ranked_ids, weights) if len(ids)]
+
+    all_ids = np.concatenate(lists)
+    ranks = np.concatenate([np.arange(len(ids)) for ids in lists])
+    w = np.repeat(np.asarray(weights, dtype=np.float64), [len(ids) for ids in lists])
+    contrib = w / (rrf_k + ranks + 1)
+
+    unique_ids, inverse = np.unique(all_ids, return_inverse=True)
+    scores = np.bincount(inverse, weights=contrib)
+
+    # 同分时按首次出现的位置排序，保证结果稳定
+    first_seen = np.full(len(unique_ids), len(all_ids), dtype=np.int64)
+    np.minimum.at(first_seen, inverse, np.arange(len(all_ids)))
+    order = np.lexsort((first_seen, -scores))
+    if top_k is not None:
+        order = order[:top_k]
+    return unique_ids[order], scores[order]
+
+
+def first_unique(keys):
+    """保持原有顺序的去重，返回每个键首次出现位置的布尔掩码"""
+    keys = np.asarray(keys)
+    mask = np.zeros(len(keys), dtype=bool)
+    if len(keys):
+        _, first_idx = np.unique(keys, return_index=True)
+        mask[first_idx] = True
+    return mask
@@ -0,0 +1,152 @@
+"""
+分层检索 (hierarchical_index.py)
+功能: 先在父块层路由，再只对路由到的父块下的子块打分，检索开销随 父块数 + 候选子块数 增长，而不是随子块总数
+  - 父块向量: 子块单位向量的均值 (质心)，不需要额外 embedding
+  - 父块 BM25: 父块下全部子块分词的拼接，一个父块占一个槽位
+  - 路由: 父块层向量 Top-P ∪ BM25 Top-P → 这些父块的子块行号 → 交给子块层的向量 / BM25 只在候选内打分
+  - 增量入库 / 删除时只重算受影响的父块 (质心从存活子块重新求均值，BM25 槽位替换)，不重建整层
+开启: RAG_RETRIEVAL_MODE=hierarchical；RAG_HIER_PARENTS 为每路路由的父块数 (召回与延迟的取舍)
+子块少于 RAG_HIER_MIN_CHUNKS 时全量检索本来就快，直接走平铺检索
+"""
+
+import os
+
+import numpy as np
+
+from bm25_index import BM25Index
+from vector_store import _top_k_indices
+
+RETRIEVAL_MODE = os.environ.get("RAG_RETRIEVAL_MODE", "flat")            # flat / hierarchical
+HIER_PARENTS = int(os.environ.get("RAG_HIER_PARENTS", "24"))              # 每路 (向量 / BM25) 路由的父块数
+HIER_MIN_CHUNKS = int(os.environ.get("RAG_HIER_MIN_CHUNKS", "2000"))      # 子块少于此数时不分层
+
+
+class ParentIndex:
+    """
+    父块层索引，按 chunk_store 的父块编码 (parent_codes) 寻址
+    :param vectors: chunk_id 数组 → (n, dim) 单位向量 (取不到的为全 0 行)
+    :param tokenize: 子块文本列表 → 分词列表 (走分词缓存)
+    向量维度取自第一次读到的子块向量
+    """
+
+    def __init__(self, chunk_store, vectors, tokenize):
+        self.chunk_store = chunk_store
+        self._vectors = vectors
+        self._tokenize = tokenize
+        self.centroids = np.zeros((0, 0), dtype=np.float32)
+        self.active = np.zeros(0, dtype=bool)               # 还有存活子块的父块
+        self.bm25 = BM25Index()
+        self._slot_of_code = np.zeros(0, dtype=np.int64)    # 父块编码 → BM25 槽位 (-1 表示没有)
+        self._code_of_slot = []
+        self._rows_of_code = []                             # 父块编码 → 子块行号 (只追加，存活与否查 chunk_store.alive)
+        self._row_code = np.zeros(0, dtype=np.int64)        # 子块行号 → 父块编码 (删除后 chunk_store 会清掉，这里保留)
+        self._orphans = []                                  # 没有父块的子块 (旧数据)，路由时总是保留
+        self.add_rows(chunk_store.live_rows())
+
+    @property
+    def parent_count(self):
+        return int(self.active.sum())
+
+    def memory_bytes(self):
+        return int(self.centroids.nbytes + self.bm25.corpus_size * 512 + self._row_code.nbytes * 2)
+
+    # ------------------------------------------------------------
+    # 增量维护
+    # ------------------------------------------------------------
+
+    def _grow(self):
+        n_codes = len(self.chunk_store.parent_keys)
+        extra = n_codes - len(self.active)
+        if extra <= 0:
+            return
+        self.centroids = np.concatenate([self.centroids, np.zeros((extra, self.centroids.shape[1]), dtype=np.float32)])
+        self.active = np.concatenate([self.active, np.zeros(extra, dtype=bool)])
+        self._slot_of_code = np.concatenate([self._slot_of_code, np.full(extra, -1, dtype=np.int64)])
+        self._rows_of_code.extend([] for _ in range(extra))
+
+    def add_rows(self, rows):
+        """chunk_store.append 之后调用：登记新子块并重算它们所属的父块"""
+        rows = np.asarray(rows, dtype=np.int64)
+        self._grow()
+        n_rows = len(self.chunk_store)
+        if len(self._row_code) < n_rows:
+            self._row_code = np.concatenate([self._row_code, np.full(n_rows - len(self._row_code), -1, dtype=np.int64)])
+        codes = self.chunk_store.parent_codes[rows]
+        self._row_code[rows] = codes
+        for row, code in zip(rows.tolist(), codes.tolist()):
+            if code >= 0:
+                self._rows_of_code[code].append(row)
+            else:
+                self._orphans.append(row)
+        self.refresh(np.unique(codes[codes >= 0]))
+
+    def remove_rows(self, rows):
+        """chunk_store.remove_paths 之后调用：重算被删子块原来所属的父块"""
+        rows = np.asarray(rows, dtype=np.int64)
+        rows = rows[rows < len(self._row_code)]
+        codes = self._row_code[rows]
+        self.refresh(np.unique(codes[codes >= 0]))
+
+    def refresh(self, codes):
+        """从存活子块重新计算这些父块的质心与 BM25 文档"""
+        if not len(codes):
+            return
+        alive = self.chunk_store.alive
+        live_rows = {int(c): [r for r in self._rows_of_code[c] if alive[r]] for c in codes}
+        all_rows = np.asarray([r for rows in live_rows.values() for r in rows], dtype=np.int64)
+        vectors = self._vectors(self.chunk_store.chunk_ids[all_rows]) if len(all_rows) else np.zeros((0, 0))
+        if len(vectors) and vectors.shape[1] != self.centroids.shape[1] and not self.centroids.any():
+            self.centroids = np.zeros((len(self.active), vectors.shape[1]), dtype=np.float32)
+        tokens = self._tokenize([self.chunk_store.texts[r] for r in all_rows])
+
+        stale_slots, new_docs, new_codes = [], [], []
+        offset = 0
+        for code, rows in live_rows.items():
+            n = len(rows)
+            if self._slot_of_code[code] >= 0:
+                stale_slots.append(self._slot_of_code[code])
+                self._slot_of_code[code] = -1
+            if not n:
+                self.active[code] = False
+                self.centroids[code] = 0
+                continue
+            if vectors.shape[1] == self.centroids.shape[1]:
+                centroid = np.asarray(vectors[offset:offset + n], dtype=np.float32).mean(axis=0)
+                self.centroids[code] = centroid / (np.linalg.norm(centroid) or 1.0)
+            self.active[code] = True
+            new_docs.append([t for doc in tokens[offset:offset + n] for t in doc])
+            new_codes.append(code)
+            offset += n
+        self.bm25.remove(stale_slots)
+        slots = self.bm25.add(new_docs)
+        self._code_of_slot.extend(new_codes)
+        self._slot_of_code[np.asarray(new_codes, dtype=np.int64)] = slots
+
+    # ------------------------------------------------------------
+    # 路由
+    # ------------------------------------------------------------
+
+    def route(self, query_vector, query_tokens, n_parents=HIER_PARENTS):
+        """
+        :return: (候选子块行号 (升序，仅存活), 路由到的父块编码)
+        """
+        if not self.active.any():
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        selected = [np.array([], dtype=np.int64)]
+        q = np.asarray(query_vector, dtype=np.float32)
+        if self.centroids.shape[1] == len(q):
+            scores = self.centroids @ (q / (np.linalg.norm(q) or 1.0))
+            scores[~self.active] = -np.inf
+            selected.append(_top_k_indices(scores, min(n_parents, self.parent_count)))
+        if query_tokens and self.bm25.corpus_size:
+            bm25_scores = self.bm25.get_scores(query_tokens)
+            top = _top_k_indices(bm25_scores, n_parents)
+            top = top[bm25_scores[top] > 0]
+            selected.append(np.asarray([self._code_of_slot[s] for s in top], dtype=np.int64))
+        codes = np.unique(np.concatenate(selected))
+
+        parts = [np.asarray(self._rows_of_code[c], dtype=np.int64) for c in codes]
+        if self._orphans:
+            parts.append(np.asarray(self._orphans, dtype=np.int64))
+        rows = np.unique(np.concatenate(parts)) if parts else np.array([], dtype=np.int64)
+        return rows[self.chunk_store.alive[rows]], codes
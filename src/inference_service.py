@@ -0,0 +1,260 @@
+"""
+推理服务 (inference_service.py)
+功能: 专用 CPU 推理工作线程 + 请求微批处理 (Micro-batching)
+说明: 并发请求各自的 query embedding / rerank pair 先进入队列，
+      工作线程在一个很小的时间窗内把它们攒成一批，只做一次前向计算，再把结果分发回各请求。
+      单用户时队列里只有自己，直接执行，不额外等待。
+"""
+
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+# ============================================================
+# 配置 (可通过环境变量覆盖)
+# ============================================================
+BATCH_WINDOW_MS = float(os.environ.get("RAG_BATCH_WINDOW_MS", "5"))     # 攒批时间窗 (毫秒)
+MAX_EMBED_BATCH = int(os.environ.get("RAG_MAX_EMBED_BATCH", "32"))      # 单批最多多少条 query
+MAX_RERANK_BATCH = int(os.environ.get("RAG_MAX_RERANK_BATCH", "128"))   # 单批最多多少个 (query, doc) 对
+INFERENCE_WORKERS = int(os.environ.get("RAG_INFERENCE_WORKERS", "1"))   # 每类任务的工作线程数
+MAX_QUEUE_SIZE = int(os.environ.get("RAG_INFERENCE_QUEUE", "256"))      # 队列上限 (满了 submit 会阻塞，形成背压)
+
+
+class _Request:
+    """一次提交：一组输入 + 一个 Future"""
+    __slots__ = ("items", "future", "enqueued_at")
+
+    def __init__(self, items):
+        self.items = items
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class MicroBatcher:
+    """
+    通用微批处理器
+    :param name: 名称 (日志/指标用)
+    :param batch_fn: 批量函数，输入 list，返回等长 list
+    :param max_batch: 单批最多条目数
+    :param window_ms: 有并发时的攒批时间窗
+    :param workers: 工作线程数
+    """
+
+    def __init__(self, name, batch_fn, max_batch, window_ms=BATCH_WINDOW_MS, workers=INFERENCE_WORKERS):
+        self.name = name
+        self._batch_fn = batch_fn
+        self._max_batch = max_batch
+        self._window = window_ms / 1000.0
+        self._queue = queue.Queue(maxsize=MAX_QUEUE_SIZE)
+        self._lock = threading.Lock()
+        self._pending = 0  # 已提交但尚未完成的请求数 (用于判断是否存在并发)
+        self._closed = False
+        self._stats = {"requests": 0, "items": 0, "batches": 0, "wait_ms": 0.0, "compute_ms": 0.0, "max_batch": 0}
+
+        self._threads = []
+        for i in range(max(1, workers)):
+            t = threading.Thread(target=self._worker_loop, name=f"{name}-worker-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, items):
+        """提交一组输入，返回 Future (结果为与 items 等长的 list)"""
+        req = _Request(list(items))
+        if not req.items:
+            req.future.set_result([])
+            return req.future
+        with self._lock:
+            if self._closed:
+                raise RuntimeError(f"推理服务 {self.name} 已关闭")
+            self._pending += 1
+        self._queue.put(req)
+        if self._closed:
+            # 与 close() 并发: 入队时工作线程可能已经退出，自己把还留在队列里的请求结束掉
+            self._fail_queued()
+        return req.future
+
+    def __call__(self, items):
+        """同步调用：提交并等待结果"""
+        return self.submit(items).result()
+
+    def close(self):
+        """停止接收新请求；队列中尚未被工作线程取走的请求直接以异常结束，不会有人永远等在 result() 上"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._fail_queued()
+        for _ in self._threads:
+            self._queue.put(None)
+
+    def _fail_queued(self):
+        """取出队列中全部未处理的请求并以异常结束 (关闭信号原样放回)"""
+        error = RuntimeError(f"推理服务 {self.name} 已关闭")
+        sentinels = 0
+        while True:
+            try:
+                req = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if req is None:
+                sentinels += 1
+                continue
+            req.future.set_exception(error)
+            with self._lock:
+                self._pending -= 1
+        for _ in range(sentinels):
+            self._queue.put(None)
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["pending"] = self._pending
+        batches = s["batches"] or 1
+        s["avg_batch_items"] = round(s["items"] / batches, 2)
+        s["avg_wait_ms"] = round(s["wait_ms"] / (s["requests"] or 1), 3)
+        s["avg_compute_ms"] = round(s["compute_ms"] / batches, 3)
+        s["wait_ms"] = round(s["wait_ms"], 3)
+        s["compute_ms"] = round(s["compute_ms"], 3)
+        return s
+
+    # ------------------------------------------------------------
+    # 工作线程
+    # ------------------------------------------------------------
+
+    def _collect_batch(self, first):
+        """以 first 为起点攒一批：先无等待地取走队列里已有的请求，有并发时再等一个时间窗"""
+        batch = [first]
+        size = len(first.items)
+        deadline = None
+
+        while size < self._max_batch:
+            try:
+                req = self._queue.get_nowait()
+            except queue.Empty:
+                with self._lock:
+                    concurrent = self._pending > len(batch)
+                if not concurrent or self._window <= 0:
+                    break
+                # 还有其它请求在途 (正在提交路上)，稍等一个时间窗
+                if deadline is None:
+                    deadline = time.perf_counter() + self._window
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    req = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            if req is None:
+                # 关闭信号放回去，让本批处理完后再退出
+                self._queue.put(None)
+                break
+            batch.append(req)
+            size += len(req.items)
+
+        return batch
+
+    def _worker_loop(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+
+            batch = self._collect_batch(first)
+            flat = [item for req in batch for item in req.items]
+
+            start = time.perf_counter()
+            try:
+                results = list(self._batch_fn(flat))
+                error = None
+            except Exception as e:
+                results, error = None, e
+            compute_ms = (time.perf_counter() - start) * 1000
+
+            offset = 0
+            for req in batch:
+                n = len(req.items)
+                if error is not None:
+                    req.future.set_exception(error)
+                else:
+                    req.future.set_result(results[offset:offset + n])
+                offset += n
+
+            with self._lock:
+                self._pending -= len(batch)
+                self._stats["requests"] += len(batch)
+                self._stats["items"] += len(flat)
+                self._stats["batches"] += 1
+                self._stats["compute_ms"] += compute_ms
+                self._stats["wait_ms"] += sum((start - req.enqueued_at) * 1000 for req in batch)
+                self._stats["max_batch"] = max(self._stats["max_batch"], len(flat))
+
+
+class InferenceService:
+    """
+    Embedding + Reranker 推理服务
+    - embed_query / embed_queries: 走 embedding 批处理器
+    - rerank: 走 reranker 批处理器 (多个请求的 pair 合并成一次 predict)
+    - rerank_many: 多个问题的 pair 作为一个请求提交 (批量问答)
+    """
+
+    def __init__(self, embedding_model, reranker=None):
+        self.embedding_model = embedding_model
+        self.reranker = reranker
+
+        self._embedder = MicroBatcher(
+            "embed", self._embed_batch, max_batch=MAX_EMBED_BATCH
+        )
+        self._reranker = None
+        if reranker is not None:
+            self._reranker = MicroBatcher(
+                "rerank", self._rerank_batch, max_batch=MAX_RERANK_BATCH
+            )
+
+    def _embed_batch(self, texts):
+        return self.embedding_model.embed_documents(texts)
+
+    def _rerank_batch(self, pairs):
+        return [float(s) for s in self.reranker.predict(pairs, batch_size=len(pairs))]
+
+    def embed_query(self, text):
+        """单条 query 向量化 (与其它并发请求合批)"""
+        return self._embedder([text])[0]
+
+    def embed_queries(self, texts):
+        """多条 query 向量化 (作为一个请求提交，一次前向)"""
+        return self._embedder(texts)
+
+    def rerank(self, query, texts):
+        """对 texts 计算与 query 的相关性分数，返回与 texts 等长的 list"""
+        if self._reranker is None:
+            raise RuntimeError("Reranker 未加载")
+        return self._reranker([(query, t) for t in texts])
+
+    def rerank_many(self, requests):
+        """
+        多个问题一起精排 (批量问答)：全部 (query, doc) 对作为一个请求提交，一次 predict
+        :param requests: [(query, texts), ...]
+        :return: 与 requests 等长的分数列表，每项与对应的 texts 等长
+        """
+        if self._reranker is None:
+            raise RuntimeError("Reranker 未加载")
+        scores = self._reranker([(query, t) for query, texts in requests for t in texts])
+        results, offset = [], 0
+        for _, texts in requests:
+            results.append(scores[offset:offset + len(texts)])
+            offset += len(texts)
+        return results
+
+    def close(self):
+        self._embedder.close()
+        if self._reranker is not None:
+            self._reranker.close()
+
+    def stats(self):
+        return {
+            "embed": self._embedder.stats(),
+            "rerank": self._reranker.stats() if self._reranker is not None else None,
+        }
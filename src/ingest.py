@@ -1,182 +1,751 @@
 import os
 import time
 import shutil
+import hashlib
+import itertools
+import threading
 from langchain_community.document_loaders import (
     PyPDFLoader,
     Docx2txtLoader,
     CSVLoader,
-    TextLoader
 )
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_chroma import Chroma
+from langchain_core.documents import Document
+
+from resources import shared_resources, COLLECTION_NAME
+from vector_store import (
+    MatrixIndexWriter, append_matrix_index, delete_from_matrix_index, has_matrix_index, remove_matrix_index
+)
+from tokenizer import TokenCache, text_hash, close_tokenize_pool
+from chunk_store import make_chunk_id, source_key
+from dedup import (
+    DocumentDeduper, merge_dup_metadata, load_dup_refs, set_dup_refs, drop_dup_source, DEDUP_THRESHOLD, DUP_SEPARATOR
+)
+from parent_store import ParentMapWriter, append_parent_changes, iter_journal
+from rebuild_checkpoint import RebuildCheckpoint, doc_manifest, staging_dir, has_interrupted_swap
+from chunking import ChunkingStats, make_chunker, chunking_signature
 
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))# 获取当前脚本所在的绝对路径，确保在任何地方运行都不会找不到文件
 DOCS_DIR = os.path.join(CURRENT_DIR, '../data/docs')# 数据的输入目录 
 DB_DIR = os.path.join(CURRENT_DIR, "../data/chroma_db")
+CHROMA_BATCH_SIZE = 1000  # 单文件增量写入 Chroma 时每批条数 (低于 Chroma 的单批上限)
+STAGING_COLLECTION = "langchain_rebuild"  # 全量重建写入的临时集合，完成后改名替换
+OLD_COLLECTION = "langchain_old"          # 切换期间旧的正式集合改成的名字，新集合就位后删除
+_swap_lock = threading.RLock()            # 重建线程的切换与加载时的补做切换互斥
+
+# 流式入库: 逐页解析 → 父子切分 → 按内存预算攒批 → embedding → 写入，写完一批才继续解析下一页 (生成器拉取即背压)
+# 预算只约束待写入的批 (文本 + 向量)，与文档大小无关；常驻的模型、全局去重签名等不计入
+INGEST_MEMORY_MB = float(os.environ.get("RAG_INGEST_MEMORY_MB", "128"))
+TEXT_BLOCK_CHARS = 64 * 1024       # txt / md 按块读取，块在空行处断开
+EMBEDDING_BYTES = 384 * 32         # 一条向量在 Python list 中的大约占用 (float 对象 + 指针)
+CHUNK_OVERHEAD_BYTES = 1024        # 一个子块的 Document + metadata 的大约占用
+
+
+class TextBlockLoader:
+    """流式读取大文本：攒够 block_chars 后在下一个空行处断开 (没有空行时到 4 倍大小强制断开)，每块一个 Document"""
+
+    def __init__(self, file_path, encoding="utf-8", block_chars=TEXT_BLOCK_CHARS):
+        self.file_path = file_path
+        self.encoding = encoding
+        self.block_chars = block_chars
+
+    def lazy_load(self):
+        lines, size = [], 0
+        with open(self.file_path, "r", encoding=self.encoding) as f:
+            for line in f:
+                lines.append(line)
+                size += len(line)
+                if (size >= self.block_chars and not line.strip()) or size >= self.block_chars * 4:
+                    yield Document(page_content="".join(lines), metadata={"source": self.file_path})
+                    lines, size = [], 0
+        if lines:
+            yield Document(page_content="".join(lines), metadata={"source": self.file_path})
+
+    def load(self):
+        return list(self.lazy_load())
+
+
+# 扩展名 → (加载器, 加载器参数, 切分配置)
+# 切分配置: strategy 为 recursive / markdown / csv (见 chunking.py)，可选 parent_size / child_size / child_overlap / length ("tokens" 或 "chars")
 LOADER_MAPPING = {
-    ".pdf": (PyPDFLoader, {}),
-    ".docx": (Docx2txtLoader, {}),
-    ".csv": (CSVLoader, {"encoding": "utf-8"}),
-    ".txt": (TextLoader, {"encoding": "utf-8"}),
-    ".md": (TextLoader, {"encoding": "utf-8"}),
+    ".pdf": (PyPDFLoader, {}, {"strategy": "recursive"}),           # 逐页
+    ".docx": (Docx2txtLoader, {}, {"strategy": "recursive"}),       # docx2txt 整篇提取为一个 Document (文本远小于原文件)
+    ".csv": (CSVLoader, {"encoding": "utf-8"}, {"strategy": "csv"}),  # 逐行，一行一条记录
+    ".txt": (TextBlockLoader, {"encoding": "utf-8"}, {"strategy": "recursive"}),
+    ".md": (TextBlockLoader, {"encoding": "utf-8"}, {"strategy": "markdown"}),
 }
+DEFAULT_CHUNKING = {"strategy": "recursive"}  # 不在映射中的来源 (直接传入的 Document)
 
-def load_documents(source_dir):
-    all_documents = []
-
-    for root, dirs, files in os.walk(source_dir):
-        for file in files:
-            file_path = os.path.join(root, file)
-            file_ext = os.path.splitext(file_path)[1].lower()
+_chunkers = {}
 
-            if file_ext in LOADER_MAPPING:
-                loader_class, loader_arge = LOADER_MAPPING[file_ext]
-                try:
-                    print(f"Loading:{file}...")
-                    loader = loader_class(file_path, **loader_arge)
-                    documents = loader.load()
-                    all_documents.extend(documents)
-                except Exception as e:
-                    print(f"❌ 加载文件失败 {file}: {e}")
 
-            else:
-                pass
+def chunker_for(source):
+    """按来源文件的扩展名取切分器 (每种扩展名只创建一次)"""
+    file_ext = os.path.splitext(source)[1].lower()
+    if file_ext not in _chunkers:
+        config = LOADER_MAPPING[file_ext][2] if file_ext in LOADER_MAPPING else DEFAULT_CHUNKING
+        _chunkers[file_ext] = make_chunker(config)
+    return _chunkers[file_ext]
 
-    return all_documents
-def create_vector_db():
 
-    documents = load_documents(DOCS_DIR)
+def _chunking_signature():
+    return chunking_signature({ext: chunker_for(ext) for ext in LOADER_MAPPING})
 
-    if not documents:
-        return False, "data/docs 文件夹为空，或没有支持的文档格式。"
 
-    print(f"   -> 共成功加载 {len(documents)} 个文档片段。")
+def iter_file(file_path):
+    """逐页 / 逐块加载单个文件，不支持的格式什么都不产出 (解析失败直接抛出异常)"""
+    file_ext = os.path.splitext(file_path)[1].lower()
+    if file_ext not in LOADER_MAPPING:
+        return
+    loader_class, loader_arge, _ = LOADER_MAPPING[file_ext]
+    print(f"Loading:{os.path.basename(file_path)}...")
+    loader = loader_class(file_path, **loader_arge)
+    yield from loader.lazy_load()
 
 
-    print("2. 正在切分文本...")
+def load_file(file_path):
+    """加载单个文件，不支持的格式返回空列表 (解析失败直接抛出异常)"""
+    return list(iter_file(file_path))
 
-    # A. 定义父切分器 (Parent Splitter) - 大块，用于给 AI 看
-    # 800 字左右通常包含一个完整的段落逻辑
-    parent_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=800,   # chunk_size=: 每块文本大约  个字符。太小了语义不全，太大了检索不准。
-        chunk_overlap=0  # chunk_overlap=: 相邻两块文本有  字重叠，防止关键信息刚好被切断。
-    )
 
-    # B. 定义子切分器 (Child Splitter) - 小块，用于生成向量检索
-    # 200 字左右语义最致密，检索最准
+def iter_documents(source_dir):
+    """依次流式加载目录下的所有文件，单个文件解析失败时跳过它剩下的部分"""
+    for root, dirs, files in os.walk(source_dir):
+        for file in files:
+            pages = 0
+            try:
+                for doc in iter_file(os.path.join(root, file)):
+                    pages += 1
+                    yield doc
+            except Exception as e:
+                print(f"❌ 加载文件失败 {file} (已读取 {pages} 页): {e}")
 
-    child_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=200,
-        chunk_overlap=50
-    )
 
-    print("2. 正在进行父子切分...")
+def load_documents(source_dir):
+    return list(iter_documents(source_dir))
 
-    # C. 执行切分流程
-    # 1. 先切出父文档
-    parent_docs = parent_splitter.split_documents(documents)
 
+def iter_split(documents, ingested_at=None, stats=None, docs_dir=None):
+    """
+    父子切分 (流式)：按来源文件的类型选切分策略 (见 chunking.py)，逐个输入文档切出父块，再把父块切成子块
+    父块给 AI 看 (默认 800 token 左右，通常包含一个完整的段落逻辑)；子块用于向量检索 (默认 200 token，语义最致密)
+    :param stats: ChunkingStats，按策略累计文件 / 父块 / 子块数
+    :param docs_dir: 文档根目录，chunk_id 按来源文件相对它的路径生成 (子目录下的同名文件不冲突)
+    :return: 生成器，每个父块产出 (parent_id, 父块内容, [(子文档, Chroma id), ...])
+    """
+    parent_seq_by_source = {}  # 每个来源文件内的父块序号，用于生成稳定的 chunk_id
+    if ingested_at is None:
+        ingested_at = int(time.time())  # 入库时间 (Unix 秒)，供按时间过滤检索
+
+    # 同一文件的文档 (PDF 的各页 / CSV 的各行) 连续产出，整组交给该类型的切分器
+    for source, file_docs in itertools.groupby(documents, key=lambda d: d.metadata.get("source", "")):
+        chunker = chunker_for(source)
+        if stats is not None:
+            stats.add_file(chunker.name)
+        for parent_content, metadata, child_texts in chunker.split(file_docs):
+            if stats is not None:
+                stats.add_parent(chunker.name, child_texts)
+            # 获取父文档原有的 metadata (比如 source, page)
+            base_metadata = metadata.copy()
+
+            # [修复] 用哈希生成轻量 parent_id，替代存储完整父内容
+            parent_id = hashlib.md5(parent_content.encode('utf-8')).hexdigest()[:12]
+
+            source = base_metadata.get("source", "")
+            parent_seq = parent_seq_by_source.get(source, 0)
+            parent_seq_by_source[source] = parent_seq + 1
+
+            children = []
+            for child_seq, child_text in enumerate(child_texts):
+                # [修复] 只存 parent_id (12字符) 替代存完整父内容 (800字)
+                # 大幅减少 metadata 体积，避免数据库膨胀
+                new_metadata = base_metadata.copy()
+                new_metadata["parent_id"] = parent_id
+                # 稳定整数 id：Chroma / BM25 / 父块映射统一用它寻址
+                chunk_id = make_chunk_id(source_key(source, docs_dir), parent_seq, child_seq)
+                new_metadata["chunk_id"] = chunk_id
+                new_metadata["ingested_at"] = ingested_at
+                children.append((Document(page_content=child_text, metadata=new_metadata), str(chunk_id)))
+            yield parent_id, parent_content, children
+
+
+def split_documents(documents, ingested_at=None):
+    """
+    父子切分 (一次性)
+    :return: (子文档列表, 与子文档一一对应的 Chroma id 列表, parent_id → 父文档内容)
+    """
+    print("2. 正在进行父子切分...")
     final_storage_docs = []  # 最终要存入数据库的文档列表（子文档）
+    final_storage_ids = []   # 与子文档一一对应的 Chroma id (chunk_id 的字符串形式)
     parent_map = {}  # parent_id -> parent_content 映射表
-
-    # 2. 遍历每个父文档，切分成子文档
-    from langchain_core.documents import Document   # 确保引入 Document 对象
-    import hashlib
-
-    for parent_doc in parent_docs:
-        # 获取父文档的内容
-        parent_content = parent_doc.page_content
-        # 获取父文档原有的 metadata (比如 source, page)
-        base_metadata = parent_doc.metadata.copy()
-
-        # [修复] 用哈希生成轻量 parent_id，替代存储完整父内容
-        parent_id = hashlib.md5(parent_content.encode('utf-8')).hexdigest()[:12]
+    for parent_id, parent_content, children in iter_split(documents, ingested_at):
         parent_map[parent_id] = parent_content
-
-        # 切分子文档
-        child_texts = child_splitter.split_text(parent_content)
-
-        for child_text in child_texts:
-            # [修复] 只存 parent_id (12字符) 替代存完整父内容 (800字)
-            # 大幅减少 metadata 体积，避免数据库膨胀
-            new_metadata = base_metadata.copy()
-            new_metadata["parent_id"] = parent_id
-
-            # 创建新的子文档对象
-            child_doc = Document(page_content=child_text, metadata=new_metadata)
+        for child_doc, chroma_id in children:
             final_storage_docs.append(child_doc)
+            final_storage_ids.append(chroma_id)
+
+    print(f"   -> 父文档数: {len(parent_map)} | 子文档数 (实际入库): {len(final_storage_docs)}")
+    return final_storage_docs, final_storage_ids, parent_map
 
-    print(f"   -> 父文档数: {len(parent_docs)} | 子文档数 (实际入库): {len(final_storage_docs)}")
 
-    # 使用 sentence-transformers 的经典模型 'all-MiniLM-L6-v2'
-    # 这个模型很小(约80MB)，速度快，效果好
+def iter_batches(split, memory_budget_mb=INGEST_MEMORY_MB):
+    """
+    把切分结果按内存预算攒成批：(子文档列表, Chroma id 列表, parent_id → 父块内容)
+    估算 = 子块文本 + 预计的向量占用 + 父块文本；批满即产出，调用方写完这一批才会拉取下一页
+    """
+    budget = memory_budget_mb * 1024 * 1024
+    docs, ids, parents, size = [], [], {}, 0
+    for parent_id, parent_content, children in split:
+        if parent_id not in parents:
+            parents[parent_id] = parent_content
+            size += len(parent_content) * 4
+        for child_doc, chroma_id in children:
+            docs.append(child_doc)
+            ids.append(chroma_id)
+            size += len(child_doc.page_content) * 4 + EMBEDDING_BYTES + CHUNK_OVERHEAD_BYTES
+        if size >= budget:
+            yield docs, ids, parents
+            docs, ids, parents, size = [], [], {}, 0
+    if docs or parents:
+        yield docs, ids, parents
+
+
+def _rss_bytes():
+    """当前进程的常驻内存 (Linux 读 /proc；其它平台退回历史峰值 ru_maxrss)"""
     try:
-        embedding_model = HuggingFaceEmbeddings(
-            model_name="all-MiniLM-L6-v2",
-            model_kwargs={"device": "cpu"}  # 强制用 CPU，避免和 LM Studio 抢显存
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        try:
+            import resource
+        except ImportError:
+            return 0
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+
+class RssMonitor:
+    """入库期间的常驻内存：每批 embedding 完 (向量尚未释放，接近这一批的峰值) 采样一次"""
+
+    def __init__(self):
+        self.start = self.peak = _rss_bytes()
+
+    def sample(self):
+        current = _rss_bytes()
+        self.peak = max(self.peak, current)
+        return current
+
+    def report(self):
+        return {"start_rss_mb": round(self.start / 1024 / 1024, 1), "peak_rss_mb": round(self.peak / 1024 / 1024, 1)}
+
+
+def _embed(embedding_model, texts, metadatas, stats=None):
+    """embedding 一批子块；传入 stats 时按切分策略分组计算，分别记录耗时"""
+    if stats is None:
+        return embedding_model.embed_documents(texts)
+    groups = {}
+    for i, metadata in enumerate(metadatas):
+        groups.setdefault(chunker_for(metadata.get("source", "")).name, []).append(i)
+    embeddings = [None] * len(texts)
+    for name, rows in groups.items():
+        start = time.perf_counter()
+        vectors = embedding_model.embed_documents([texts[i] for i in rows])
+        stats.add_embed(name, len(rows), time.perf_counter() - start)
+        for i, vector in zip(rows, vectors):
+            embeddings[i] = vector
+    return embeddings
+
+
+def _write_batch(collection, embedding_model, ids, texts, metadatas, stats=None):
+    """embedding 一批子块并写入 Chroma (向量已算好，直接写底层 collection，避免重复 embedding)，返回向量"""
+    embeddings = _embed(embedding_model, texts, metadatas, stats)
+    for start in range(0, len(ids), CHROMA_BATCH_SIZE):
+        end = start + CHROMA_BATCH_SIZE
+        collection.upsert(
+            ids=ids[start:end], embeddings=embeddings[start:end],
+            documents=texts[start:end], metadatas=metadatas[start:end]
         )
+    return embeddings
+
+
+def _apply_late_duplicates(collection, late_updates):
+    """代表子块所在的批次写入之后才合并进来的重复，补写到 Chroma 中的 metadata，返回更新后的 id → metadata"""
+    updated = {}
+    pending = sorted(late_updates)
+    for start in range(0, len(pending), CHROMA_BATCH_SIZE):
+        rows = collection.get(ids=pending[start:start + CHROMA_BATCH_SIZE], include=["metadatas"])
+        for chroma_id, metadata in zip(rows["ids"], rows["metadatas"]):
+            count, sources, refs = late_updates[chroma_id]
+            merge_dup_metadata(metadata, count, sources, refs)
+            updated[chroma_id] = metadata
+        if rows["ids"]:
+            collection.update(ids=rows["ids"], metadatas=[updated[i] for i in rows["ids"]])
+    return updated
+
+
+def _doc_files(docs_dir):
+    """文档目录下支持的文件 (相对路径，排序后顺序固定，断点按下标记录)"""
+    files = []
+    for root, dirs, names in os.walk(docs_dir):
+        for name in names:
+            if os.path.splitext(name)[1].lower() in LOADER_MAPPING:
+                files.append(os.path.relpath(os.path.join(root, name), docs_dir))
+    return sorted(files)
+
+
+def _iter_resumable_split(docs_dir, files, start_file, skip_children, ingested_at, position, stats=None):
+    """
+    从断点处继续逐个文件切分 (断点所在文件的前 skip_children 个子块已写入，跳过)
+    position 随产出更新为 [文件下标, 该文件已产出的子块数]；批总在父块边界结束，批产出时它就是这一批的断点
+    """
+    for index in range(start_file, len(files)):
+        skip = skip_children if index == start_file else 0
+        done = 0
+        try:
+            for item in iter_split(iter_file(os.path.join(docs_dir, files[index])), ingested_at, stats, docs_dir):
+                done += len(item[2])
+                if done <= skip:
+                    continue
+                position[:] = [index, done]
+                yield item
+        except Exception as e:
+            print(f"❌ 加载文件失败 {files[index]} (已切出 {done} 个子块): {e}")
+
+
+def _iter_collection(collection, include, where=None):
+    """分页读取整个集合 (或满足 where 条件的部分)"""
+    kwargs = {"where": where} if where else {}
+    offset = 0
+    while True:
+        rows = collection.get(include=include, limit=CHROMA_BATCH_SIZE, offset=offset, **kwargs)
+        if not rows["ids"]:
+            return
+        yield rows
+        offset += len(rows["ids"])
+
+
+def _commit_rebuild(resources, db_dir, checkpoint):
+    """
+    重建完成后切换为正式索引 (先持久标记 swapping，途中崩溃时加载 / 重建会从头重做这一步，每一步都可重做):
+      1. 矩阵索引 / 分词缓存从临时集合分批读回生成，父块日志流式写成基线
+      2. 正式集合改名为 OLD_COLLECTION，临时集合改名为正式集合，最后删除旧集合
+    任何时刻中断都至少有一个完整的集合: 正式集合，或 (改名之间) 旧集合 + 临时集合，补做切换时接着改名即可
+    """
+    with _swap_lock:
+        checkpoint.mark_swapping()
+        if STAGING_COLLECTION in resources.collection_names(db_dir):
+            _write_derived_indexes(resources.collection(db_dir, STAGING_COLLECTION), db_dir, checkpoint)
+            close_tokenize_pool()
+        _swap_collections(resources, db_dir)
+        checkpoint.discard()
+    print("   -> 新索引已切换为正式版本")
+
+
+def _write_derived_indexes(staging, db_dir, checkpoint):
+    """从临时集合生成矩阵索引、分词缓存与父块映射基线"""
+    matrix_writer = MatrixIndexWriter(db_dir)
+    token_cache = TokenCache(db_dir)
+    alive_tokens = set()
+    try:
+        for rows in _iter_collection(staging, ["embeddings", "documents", "metadatas"]):
+            matrix_writer.add([m["chunk_id"] for m in rows["metadatas"]], rows["embeddings"])
+            # 预先分词并持久化，服务端构建 BM25 时直接命中缓存 (大批量时进程池并行)
+            token_cache.tokenize_corpus(rows["documents"])
+            alive_tokens.update(text_hash(t) for t in rows["documents"])
+        # 同步写出进程内向量矩阵索引 (供 matrix / hnsw 检索后端使用)
+        index_dir = matrix_writer.commit()
+    except Exception:
+        matrix_writer.abort()
+        raise
+    if index_dir is not None:
+        print(f"   -> 向量矩阵索引已保存: {index_dir}")
+    token_cache.retain(alive_tokens)
+    token_cache.save()
+    print(f"   -> 分词缓存已保存: {len(token_cache.tokens)} 条")
+
+    # [修复] 将 parent_map 保存为 JSON，供检索时还原父文档内容 (同时清空增量变更日志)
+    parent_writer = ParentMapWriter(db_dir)
+    for entry in iter_journal(checkpoint.dir):
+        parent_writer.add(entry.get("add", {}))
+    parent_writer.commit()
+    print(f"   -> 父文档映射已保存: {parent_writer.count} 条")
+
+
+def _swap_collections(resources, db_dir):
+    """正式集合 → 旧集合，临时集合 → 正式集合，再删旧集合；从中断处接着做 (临时集合已不在说明改名已完成)"""
+    names = resources.collection_names(db_dir)
+    if STAGING_COLLECTION in names:
+        if COLLECTION_NAME in names:
+            resources.delete_collection(db_dir, OLD_COLLECTION)
+            resources.rename_collection(db_dir, COLLECTION_NAME, OLD_COLLECTION)
+        resources.rename_collection(db_dir, STAGING_COLLECTION, COLLECTION_NAME)
+    resources.delete_collection(db_dir, OLD_COLLECTION)
+
+
+def finish_interrupted_swap(db_dir, resources=None):
+    """
+    加载索引前调用: 上次全量重建停在切换途中 (如两次改名之间进程被杀) 时先把切换做完，返回是否补做了切换
+    重建线程正在切换时等它完成 (同一进程内)
+    """
+    if not has_interrupted_swap(db_dir):
+        return False
+    with _swap_lock:
+        checkpoint = RebuildCheckpoint.load(db_dir)
+        if checkpoint is None or not checkpoint.swapping:
+            return False  # 等锁期间重建线程已切换完成
+        print("🔁 上次全量重建切换到一半，继续切换...")
+        _commit_rebuild(resources or shared_resources(), db_dir, checkpoint)
+        return True
+
+
+def create_vector_db(docs_dir=DOCS_DIR, db_dir=DB_DIR, embedding_model=None, memory_budget_mb=INGEST_MEMORY_MB,
+                     resources=None):
+    """
+    全量构建知识库 (流式：按内存预算分批解析 / 切分 / embedding / 写入)
+    新索引写入临时集合并逐批记录断点，旧索引在重建期间照常服务，全部完成后才切换；
+    上次重建中断 (且文档与切分配置都没有变化) 时从断点继续，已写入的子块不再重新 embedding
+    :param docs_dir / db_dir: 文档目录与索引目录 (多知识库时每个库各自一套)
+    :param embedding_model: 复用已加载的 Embedding 模型，不传则取共享资源中的模型 (进程内只加载一次)
+    :param memory_budget_mb: 每批待写入子块的内存预算
+    :param resources: 共享资源管理器 (模型 + Chroma 句柄，见 resources.py)，默认进程级单例
+    """
+    rss = RssMonitor()
+    stats = ChunkingStats()
+    files = _doc_files(docs_dir)
+    manifest = doc_manifest(docs_dir, files)
+    chunking = _chunking_signature()
+    checkpoint = RebuildCheckpoint.load(db_dir)
+    if checkpoint is not None and not checkpoint.matches(manifest, chunking):
+        print("⚠️ 文档或切分配置已变化，丢弃上次中断的重建进度")
+        checkpoint.discard()
+        checkpoint = None
+    if not files and checkpoint is None:
+        return False, f"{os.path.basename(docs_dir)} 文件夹为空，或没有支持的文档格式。"
+
+    resources = resources or shared_resources()
+    try:
+        embedding_model = embedding_model or resources.embedding_model()
 
         print("正在连接数据库...")
-        vectordb = Chroma(
-            persist_directory=DB_DIR,
-            embedding_function=embedding_model
-        )
+        os.makedirs(db_dir, exist_ok=True)
+
+        if checkpoint is None:
+            # 上次留下的临时集合 (没有断点或文档已变化) 作废
+            resources.delete_collection(db_dir, STAGING_COLLECTION)
+            checkpoint = RebuildCheckpoint.start(db_dir, manifest, ingested_at=int(time.time()), chunking=chunking)
+        elif checkpoint.complete:
+            print("🔁 上次重建已写完但未切换完成，继续切换...")
+            _commit_rebuild(resources, db_dir, checkpoint)
+            return True, "上次中断的重建已完成切换。"
+        else:
+            state = checkpoint.state
+            print(f"🔁 从断点继续重建: 第 {state['file_index'] + 1}/{len(files)} 个文件，"
+                  f"已写入 {state['written']} 个子块 ({state['batches']} 批)")
+        state = checkpoint.state
+        collection = resources.collection(db_dir, STAGING_COLLECTION)
+
+        # 近似重复子块合并 (在 embedding 之前，重复内容不再计算向量；跨批次去重)
+        # 续建时先用已写入的子块恢复去重状态
+        deduper = DocumentDeduper()
+        if checkpoint.resumed:
+            for rows in _iter_collection(collection, ["documents", "metadatas"]):
+                deduper.filter([Document(page_content=t, metadata=m) for t, m in zip(rows["documents"], rows["metadatas"])],
+                               rows["ids"])
+            deduper.duplicates = state["duplicates"]
+        check_existing = checkpoint.resumed
+
+        position = [state["file_index"], state["children_done"]]
+        split = _iter_resumable_split(docs_dir, state["files"], state["file_index"], state["children_done"],
+                                      state["ingested_at"], position, stats)
+        print(f"正在流式写入新数据 (每批预算 {memory_budget_mb:g}MB)...")
+        for docs, ids, parent_map in iter_batches(split, memory_budget_mb):
+            n_split, recovered = len(docs), 0
+            if check_existing:
+                # 中断前的最后一批可能已经写入 Chroma 但没来得及记断点，已存在的子块跳过
+                # (这一批的重复合并会再记一次: dup_sources 取并集、dup_refs 按 chunk_id 去重不受影响，dup_count 可能偏大)
+                existing = set()
+                for start in range(0, len(ids), CHROMA_BATCH_SIZE):
+                    existing.update(collection.get(ids=ids[start:start + CHROMA_BATCH_SIZE], include=[])["ids"])
+                keep = [i for i, chroma_id in enumerate(ids) if chroma_id not in existing]
+                docs, ids = [docs[i] for i in keep], [ids[i] for i in keep]
+                recovered = len(existing)
+                check_existing = False
+            docs, ids = deduper.filter(docs, ids)
+            if ids:
+                _write_batch(collection, embedding_model, ids,
+                             [d.page_content for d in docs], [d.metadata for d in docs], stats)
+            _apply_late_duplicates(collection, deduper.late_updates)
+            deduper.late_updates.clear()
+            append_parent_changes(checkpoint.dir, add=parent_map, compact=False)
+            # 子块与父块都已落盘，推进断点
+            checkpoint.advance(position, chunks=n_split, written=len(ids) + recovered, duplicates=deduper.duplicates)
+            print(f"   -> 第 {state['batches']} 批: 子块 {len(ids)} 个 (累计写入 {state['written']} 个) | "
+                  f"RSS {rss.sample() / 1024 / 1024:.0f}MB")
+
+        if not state["written"]:
+            checkpoint.discard()
+            resources.delete_collection(db_dir, STAGING_COLLECTION)
+            return False, f"{os.path.basename(docs_dir)} 文件夹为空，或没有支持的文档格式。"
+        checkpoint.mark_complete()
+
+        total_chunks, dup_count = state["chunks"], state["duplicates"]
+        if dup_count:
+            print(f"   -> 近似重复子块 {dup_count}/{total_chunks} 个已合并 (阈值 {DEDUP_THRESHOLD})")
+        _commit_rebuild(resources, db_dir, checkpoint)
+
+        # 续建时只统计本次切分 / embedding 的部分
+        print(f"   -> 切分策略: {stats.summary()}")
+        report = rss.report()
+        return True, (f"成功！采用父子索引策略。生成 {state['written']} 个子向量片段"
+                      f" (切分 {total_chunks} 个，合并近似重复 {dup_count} 个，共 {state['batches']} 批)。"
+                      f"入库峰值内存 {report['peak_rss_mb']}MB (开始时 {report['start_rss_mb']}MB)。"
+                      f"切分策略 — {stats.summary()}。")
+    except Exception as e:
+        return False, f"向量库构建失败: {e} (已完成的批次已记录断点，再次重建将从断点继续)"
 
-        try:
-            print("正在清空旧数据...")
-            # 这里的逻辑是：删除整个集合，然后 LangChain 会在下面重新创建它
-            vectordb.delete_collection()
-        except Exception:
-            # 如果第一次运行，集合可能不存在，报错也没关系
-            pass
-
-        print("正在写入新数据...")
-        vectordb = Chroma.from_documents(
-            documents=final_storage_docs,
-            embedding=embedding_model,
-            persist_directory=DB_DIR
+def index_file(file_path, db_dir=DB_DIR, embedding_model=None, on_status=None, memory_budget_mb=INGEST_MEMORY_MB,
+               resources=None, docs_dir=DOCS_DIR):
+    """
+    增量索引单个文件 (上传后由后台队列触发)：只解析、向量化这一个文件，按内存预算分批 embedding / 写入
+    同名文件再次入库时先删掉它的旧子块，再写入新子块，其它文件不受影响
+    :param on_status: 状态回调，依次收到 "parsing" / "embedding"
+    :param docs_dir: 文件所在知识库的文档根目录 (chunk_id 按相对路径生成，与全量重建一致)
+    :return: dict，包含新子块的 chroma_ids / texts / metadatas、新增与不再被引用的父块，供常驻的 RAGSystem 原地更新；
+             以及入库期间的峰值内存 peak_rss_mb、切分策略统计 chunking
+    """
+    notify = on_status or (lambda status: None)
+    source_name = os.path.basename(file_path)
+    rss = RssMonitor()
+    stats = ChunkingStats()
+
+    notify("parsing")
+    batches = iter_batches(iter_split(iter_file(file_path), stats=stats, docs_dir=docs_dir), memory_budget_mb)
+    first = next(batches, None)
+    if first is None or not first[0]:
+        raise ValueError(f"{source_name} 没有可解析的内容，或不是支持的文档格式")
+
+    notify("embedding")
+    resources = resources or shared_resources()
+    embedding_model = embedding_model or resources.embedding_model()
+    collection = resources.collection(db_dir)
+
+    # 1. 删除该文件的旧子块 (其它文件合并进来的近似重复交还给它们自己)
+    detached = _detach_source(collection, file_path)
+    others = collection.count()
+
+    # 2. 向量矩阵索引: 旧行打墓碑，新行逐批追加
+    #    索引缺失 (或为旧格式) 而库里还有其它文件时不能只写这一个文件，留待全量重建
+    write_matrix = has_matrix_index(db_dir) or others == 0
+    if write_matrix:
+        _update_matrix_after_detach(db_dir, detached)
+    else:
+        print("⚠️ 向量矩阵索引缺失，本次只写入 Chroma，matrix 类后端需全量重建后生效")
+
+    # 3. 逐批写入新子块 (增量入库只在本文件内部去重，跨文件的重复在全量重建时合并)
+    deduper = DocumentDeduper()
+    chroma_ids, texts, metadatas, parent_map = [], [], [], {}
+    total_chunks = n_batches = 0
+    for docs, ids, parents in itertools.chain([first], batches):
+        n_batches += 1
+        total_chunks += len(docs)
+        parent_map.update(parents)
+        docs, ids = deduper.filter(docs, ids)
+        if not ids:
+            continue
+        batch_texts = [d.page_content for d in docs]
+        batch_metadatas = [d.metadata for d in docs]
+        embeddings = _write_batch(collection, embedding_model, ids, batch_texts, batch_metadatas, stats)
+        rss.sample()
+        if write_matrix:
+            append_matrix_index(db_dir, [m["chunk_id"] for m in batch_metadatas], embeddings)
+        del embeddings
+        chroma_ids += ids
+        texts += batch_texts
+        metadatas += batch_metadatas
+
+    if deduper.late_updates:
+        updated = _apply_late_duplicates(collection, deduper.late_updates)
+        for i, chroma_id in enumerate(chroma_ids):
+            if chroma_id in updated:
+                metadatas[i] = updated[chroma_id]
+    dup_count = deduper.duplicates
+
+    # 4. 父块: 追加新父块，旧版本中不再被任何子块引用的父块一并移除 (只写变更日志，不重写整个映射)
+    stale_parents = _unreferenced_parents(
+        collection, _parent_ids(detached["old_metadatas"]) - set(parent_map) - detached["ref_parents"]
+    )
+    append_parent_changes(db_dir, add=parent_map, remove=stale_parents)
+
+    report = rss.report()
+    print(f"   -> {source_name} 增量入库完成: 删除旧子块 {len(detached['old_ids'])} 个，"
+          f"新增 {len(texts)} 个 (切分 {total_chunks} 个，合并近似重复 {dup_count} 个，{n_batches} 批) | "
+          f"峰值内存 {report['peak_rss_mb']}MB | {stats.summary()}")
+    return {
+        "source": source_name,
+        "path": file_path,
+        "chroma_ids": chroma_ids,
+        "texts": texts,
+        "metadatas": metadatas,
+        "parent_map": parent_map,
+        "removed_parents": sorted(stale_parents),
+        "rehomed": {key: detached["rehomed"][key] for key in ("chroma_ids", "texts", "metadatas")},
+        "updated": detached["updated"],
+        "affected": detached["affected"],
+        "duplicates": dup_count,
+        "batches": n_batches,
+        "chunking": stats.report(),
+        **report,
+    }
+
+
+def remove_file(file_path, db_dir=DB_DIR, resources=None):
+    """
+    从索引中删除单个文件：Chroma 子块、矩阵索引行、不再被引用的父块，其它文件不受影响
+    开销与该文件的子块数成正比 (按 source 条件删除，父块引用按 parent_id 条件查询)
+    全量重建时合并进本文件子块的其它文件的近似重复内容交还给它们 (rehomed)，不随本文件一起丢失
+    :return: dict，包含 source / path / 删除的子块数 / 移除的父块 / rehomed / updated，以及 affected:
+        旧库 (合并时还没有记录 dup_refs) 中内容只保存在本文件子块里的其它文件 (需要重新入库才能找回那部分内容)
+    """
+    source_name = os.path.basename(file_path)
+    collection = (resources or shared_resources()).collection(db_dir)
+
+    detached = _detach_source(collection, file_path)
+    stale_parents = _unreferenced_parents(collection, _parent_ids(detached["old_metadatas"]) - detached["ref_parents"])
+    append_parent_changes(db_dir, remove=stale_parents)
+    if has_matrix_index(db_dir):
+        _update_matrix_after_detach(db_dir, detached)
+
+    print(f"   -> {source_name} 已从索引删除: 子块 {len(detached['old_ids'])} 个，父块 {len(stale_parents)} 个")
+    return {
+        "source": source_name,
+        "path": file_path,
+        "removed_chunks": len(detached["old_ids"]),
+        "removed_parents": sorted(stale_parents),
+        "rehomed": {key: detached["rehomed"][key] for key in ("chroma_ids", "texts", "metadatas")},
+        "updated": detached["updated"],
+        "affected": detached["affected"],
+    }
+
+
+def _detach_source(collection, file_path):
+    """
+    从 Chroma 删除一个来源文件的全部子块 (重新入库 / 删除文件共用)，并修复与其它文件共享的近似重复内容:
+      - 本文件的子块代表着其它文件的重复时，把内容交还给其中一个文件: 按 dup_refs 用它自己的 chunk_id / 父块 / 页码
+        重建子块 (文本与向量沿用代表子块，合并时已判定两者近似相同)，其余的重复记到这个新代表上
+      - 其它文件的代表子块中记录的本文件的重复一并移除，之后不会再把本文件的旧内容交还回来
+    交还的子块先写入、再删除旧子块，中途失败也不会丢内容
+    :return: dict
+        old_ids / old_metadatas: 删除的子块
+        rehomed: 交还给其它文件的子块 {chroma_ids, texts, metadatas, embeddings}
+        updated: 其它文件中 metadata 有变化的代表子块 {Chroma id: metadata}
+        affected: 旧库中合并进本文件子块、但没有 dup_refs 记录的其它文件名 (只能重新入库找回)
+        ref_parents: 新代表上记录的重复子块的父块 (没有子块直接引用，清理父块时保留)
+    """
+    old = collection.get(where={"source": file_path}, include=["metadatas"])
+    old_metadatas = [m or {} for m in old["metadatas"]]
+    own_name = os.path.basename(file_path)
+    rehomed = {"chroma_ids": [], "texts": [], "metadatas": [], "embeddings": []}
+    affected, ref_parents = set(), set()
+
+    owners = [chroma_id for chroma_id, m in zip(old["ids"], old_metadatas) if m.get("dup_sources")]
+    for start in range(0, len(owners), CHROMA_BATCH_SIZE):
+        rows = collection.get(ids=owners[start:start + CHROMA_BATCH_SIZE],
+                              include=["documents", "embeddings", "metadatas"])
+        for text, embedding, metadata in zip(rows["documents"], rows["embeddings"], rows["metadatas"]):
+            refs = [ref for ref in load_dup_refs(metadata)
+                    if ref.get("source", file_path) != file_path and "chunk_id" in ref]
+            recorded = {os.path.basename(ref["source"]) for ref in refs}
+            affected.update(set(filter(None, metadata.get("dup_sources", "").split(DUP_SEPARATOR)))
+                            - recorded - {own_name})
+            if not refs:
+                continue
+            new_metadata = dict(refs[0])
+            new_metadata["dup_count"] = len(refs) - 1
+            remaining = set_dup_refs(new_metadata, [r for r in refs[1:] if r["source"] != new_metadata["source"]])
+            ref_parents.update(r["parent_id"] for r in remaining if r.get("parent_id"))
+            rehomed["chroma_ids"].append(str(new_metadata["chunk_id"]))
+            rehomed["texts"].append(text)
+            rehomed["metadatas"].append(new_metadata)
+            rehomed["embeddings"].append(list(embedding))
+
+    for start in range(0, len(rehomed["chroma_ids"]), CHROMA_BATCH_SIZE):
+        end = start + CHROMA_BATCH_SIZE
+        collection.upsert(
+            ids=rehomed["chroma_ids"][start:end], embeddings=rehomed["embeddings"][start:end],
+            documents=rehomed["texts"][start:end], metadatas=rehomed["metadatas"][start:end]
         )
 
-        # [修复] 将 parent_map 保存为 JSON，供检索时还原父文档内容
-        import json
-        parent_map_path = os.path.join(DB_DIR, "parent_map.json")
-        with open(parent_map_path, "w", encoding="utf-8") as f:
-            json.dump(parent_map, f, ensure_ascii=False)
-        print(f"   -> 父文档映射已保存: {len(parent_map)} 条")
-
-        return True, f"成功！采用父子索引策略。生成 {len(final_storage_docs)} 个子向量片段。"
-    except Exception as e:
-        return False, f"向量库构建失败: {e}"
-
-def reset_vector_db():
+    updated = {}
+    for rows in _iter_collection(collection, ["metadatas"], where={"dup_files": {"$gt": 0}}):
+        for chroma_id, metadata in zip(rows["ids"], rows["metadatas"]):
+            if metadata.get("source") != file_path and drop_dup_source(metadata, file_path):
+                updated[chroma_id] = metadata
+    pending = sorted(updated)
+    for start in range(0, len(pending), CHROMA_BATCH_SIZE):
+        batch = pending[start:start + CHROMA_BATCH_SIZE]
+        collection.update(ids=batch, metadatas=[updated[i] for i in batch])
+
+    if old["ids"]:
+        collection.delete(ids=old["ids"])
+    if rehomed["chroma_ids"]:
+        print(f"   -> 近似重复内容交还给其它文件: {len(rehomed['chroma_ids'])} 个子块 "
+              f"({', '.join(sorted({os.path.basename(m['source']) for m in rehomed['metadatas']}))})")
+    return {
+        "old_ids": old["ids"],
+        "old_metadatas": old_metadatas,
+        "rehomed": rehomed,
+        "updated": updated,
+        "affected": sorted(affected),
+        "ref_parents": ref_parents,
+    }
+
+
+def _update_matrix_after_detach(db_dir, detached):
+    """矩阵索引: 删除的子块打墓碑，交还给其它文件的子块追加 (向量沿用原代表子块)"""
+    delete_from_matrix_index(db_dir, [m["chunk_id"] for m in detached["old_metadatas"] if "chunk_id" in m])
+    rehomed = detached["rehomed"]
+    if rehomed["chroma_ids"]:
+        append_matrix_index(db_dir, [m["chunk_id"] for m in rehomed["metadatas"]], rehomed["embeddings"])
+
+
+def _parent_ids(metadatas):
+    return {m["parent_id"] for m in metadatas if m and m.get("parent_id")}
+
+
+def _unreferenced_parents(collection, parent_ids):
+    """在候选父块中找出已没有任何子块引用的 (父块按内容哈希，可能被其它文件共用)"""
+    if not parent_ids:
+        return set()
+    candidates = sorted(parent_ids)
+    referenced = set()
+    for start in range(0, len(candidates), CHROMA_BATCH_SIZE):
+        batch = candidates[start:start + CHROMA_BATCH_SIZE]
+        rows = collection.get(where={"parent_id": {"$in": batch}}, include=["metadatas"])
+        referenced.update(_parent_ids(rows["metadatas"]))
+    return set(candidates) - referenced
+
+
+def reset_vector_db(db_dir=DB_DIR, resources=None):
     """
         独立功能：清空向量数据库，但不重新构建。
         用于"清空所有"按钮。
+        删除集合经由共享资源管理器，检索端持有的句柄一并作废，不会与仍打开的旧句柄争用文件
     """
+    resources = resources or shared_resources()
     try:
-        # 1. 初始化 Embedding (连接数据库需要它)
-        embedding_model = HuggingFaceEmbeddings(
-            model_name="all-MiniLM-L6-v2",
-            model_kwargs={"device": "cpu"}
-        )
-
-        # 2. 连接到数据库
+        # 1. 连接到数据库
         print("正在连接数据库以进行重置...")
-        vectordb = Chroma(
-            persist_directory=DB_DIR,
-            embedding_function=embedding_model
-        )
 
-        # 3. 删除集合 (逻辑清空)
-        try:
-            vectordb.delete_collection()
+        # 2. 删除集合 (逻辑清空)，未完成的全量重建一并作废
+        remove_matrix_index(db_dir)
+        shutil.rmtree(staging_dir(db_dir), ignore_errors=True)
+        resources.delete_collection(db_dir, STAGING_COLLECTION)
+        resources.delete_collection(db_dir, OLD_COLLECTION)
+        if resources.delete_collection(db_dir, COLLECTION_NAME):
             print()
             print("数据库集合已删除。")
             return True, "数据库已重置为空。"
-        except  ValueError:
-            # 如果数据库本来就是空的，delete_collection 会报错，但这不算失败
-            return True, "数据库本来就是空的。"
+        # 如果数据库本来就是空的，没有集合可删，这不算失败
+        return True, "数据库本来就是空的。"
 
     except Exception as e:
         return False, f"重置数据库失败: {e}"
@@ -0,0 +1,354 @@
+"""
+多知识库管理 (kb_manager.py)
+功能: 按名称隔离的知识库 (独立的文档目录 / Chroma 集合 / BM25 / 父文档映射)
+  - 所有知识库共享同一份 Embedding、Reranker 模型与推理服务；模型与 Chroma 句柄由共享资源管理器持有，
+    入库 / 重建 / 重置与检索共用 (见 resources.py)
+  - 冷知识库按需加载，常驻总内存超出预算时按 LRU 淘汰
+  - 记录每个知识库的命中 / 加载次数 / 加载耗时 / 淘汰次数
+  - 上传的文件逐个增量入库，常驻的知识库原地更新索引；单个文件可单独删除 / 重新入库
+  - 全量重建 / 重置与增量入库互斥 (共用一把入库锁)，由后台线程调用
+  - 全量重建期间旧索引照常服务，完成后才切换；中断的重建在服务启动时从断点继续
+目录结构:
+  default 知识库沿用原有的 data/docs + data/chroma_db
+  其它知识库位于 data/kbs/<name>/docs + data/kbs/<name>/chroma_db
+"""
+
+import os
+import re
+import time
+import shutil
+import threading
+from collections import OrderedDict
+
+from rag_core02 import RAGSystem
+from resources import shared_resources
+from inference_service import InferenceService
+from context_builder import ContextBuilder
+from query_cache import QueryCache
+from tokenizer import close_tokenize_pool
+from ingest import index_file, remove_file, create_vector_db, reset_vector_db
+from file_registry import FileRegistry, STATUS_PENDING, STATUS_INDEXED, STATUS_FAILED
+from rebuild_checkpoint import has_interrupted_rebuild
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(CURRENT_DIR, "../data")
+KB_ROOT = os.path.join(DATA_DIR, "kbs")
+DEFAULT_KB = "default"
+
+KB_MEMORY_BUDGET_MB = int(os.environ.get("RAG_KB_MEMORY_BUDGET_MB", "2048"))  # 常驻知识库的总内存预算
+KB_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_\-]{1,64}$")
+
+
+class KnowledgeBaseManager:
+    def __init__(self, memory_budget_mb=KB_MEMORY_BUDGET_MB, resources=None):
+        print("正在加载共享模型 (所有知识库共用)...")
+        self.resources = resources or shared_resources()
+        self.embedding_model = self.resources.embedding_model()
+        self.reranker = self.resources.reranker()
+        self.inference = InferenceService(self.embedding_model, self.reranker)
+        self.context_builder = ContextBuilder()
+        self.query_cache = QueryCache()  # 键中含全局唯一的索引代数，各知识库共用一个缓存不会串
+
+        self.memory_budget = memory_budget_mb * 1024 * 1024
+        self._resident = OrderedDict()  # name → RAGSystem，按最近使用排序 (末尾最新)
+        self._lock = threading.RLock()
+        self._load_locks = {}           # 每个知识库一把加载锁，避免并发请求重复加载
+        self._metrics = {}
+        self._registries = {}           # name → FileRegistry
+        self._ingest_lock = threading.Lock()  # 增量入库串行执行 (同一时刻只有一个写 Chroma / 矩阵索引的线程)
+
+    # ============================================================
+    # 目录与命名
+    # ============================================================
+
+    @staticmethod
+    def validate_name(name):
+        if not name or not KB_NAME_PATTERN.match(name):
+            raise ValueError(f"非法的知识库名称: {name!r} (仅允许字母、数字、下划线、短横线)")
+        return name
+
+    def paths(self, name):
+        """返回 (docs_dir, db_dir)"""
+        self.validate_name(name)
+        if name == DEFAULT_KB:
+            return os.path.join(DATA_DIR, "docs"), os.path.join(DATA_DIR, "chroma_db")
+        return os.path.join(KB_ROOT, name, "docs"), os.path.join(KB_ROOT, name, "chroma_db")
+
+    def list_kbs(self):
+        names = {DEFAULT_KB}
+        if os.path.exists(KB_ROOT):
+            names.update(n for n in os.listdir(KB_ROOT)
+                         if KB_NAME_PATTERN.match(n) and os.path.isdir(os.path.join(KB_ROOT, n)))
+        return sorted(names)
+
+    def exists(self, name):
+        return name in self.list_kbs()
+
+    def create_kb(self, name):
+        docs_dir, db_dir = self.paths(name)
+        os.makedirs(docs_dir, exist_ok=True)
+        os.makedirs(db_dir, exist_ok=True)
+        return docs_dir, db_dir
+
+    # ============================================================
+    # 按需加载 + LRU 淘汰
+    # ============================================================
+
+    def _metric(self, name):
+        return self._metrics.setdefault(name, {
+            "hits": 0, "loads": 0, "load_ms_total": 0.0, "last_load_ms": 0.0,
+            "evictions": 0, "memory_bytes": 0,
+        })
+
+    def get(self, name=DEFAULT_KB):
+        """获取知识库的 RAGSystem，未常驻时加载 (加载后按内存预算淘汰最久未用的知识库)"""
+        name = name or DEFAULT_KB
+        self.validate_name(name)
+
+        with self._lock:
+            rag = self._resident.get(name)
+            if rag is not None:
+                self._resident.move_to_end(name)
+                self._metric(name)["hits"] += 1
+                return rag
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+
+        with load_lock:
+            # 等锁期间可能已被其它请求加载
+            with self._lock:
+                rag = self._resident.get(name)
+                if rag is not None:
+                    self._resident.move_to_end(name)
+                    self._metric(name)["hits"] += 1
+                    return rag
+
+            if not self.exists(name):
+                raise KeyError(f"知识库不存在: {name}")
+            _, db_dir = self.create_kb(name)
+
+            start = time.perf_counter()
+            rag = RAGSystem(db_dir=db_dir, embedding_model=self.embedding_model, inference=self.inference,
+                            context_builder=self.context_builder, query_cache=self.query_cache,
+                            resources=self.resources)
+            load_ms = (time.perf_counter() - start) * 1000
+
+            with self._lock:
+                m = self._metric(name)
+                m["loads"] += 1
+                m["load_ms_total"] += load_ms
+                m["last_load_ms"] = round(load_ms, 1)
+                m["memory_bytes"] = rag.memory_bytes()
+                self._resident[name] = rag
+                self._evict_over_budget(keep=name)
+            print(f" -> 知识库 [{name}] 已加载，耗时 {load_ms:.0f}ms，估算内存 {m['memory_bytes'] / 1024 / 1024:.1f}MB")
+            return rag
+
+    def _evict_over_budget(self, keep):
+        """淘汰最久未用的知识库直到满足预算 (刚加载的 keep 不淘汰)"""
+        while self._resident_bytes() > self.memory_budget and len(self._resident) > 1:
+            victim = next(n for n in self._resident if n != keep)
+            rag = self._resident.pop(victim)
+            rag.close()
+            self.resources.release(rag.db_dir)  # 淘汰的知识库不再占用 Chroma 客户端，下次访问时重新打开
+            self._metric(victim)["evictions"] += 1
+            print(f" -> 内存超出预算，淘汰知识库 [{victim}]")
+
+    def _resident_bytes(self):
+        return sum(self._metrics[n]["memory_bytes"] for n in self._resident)
+
+    def peek(self, name):
+        """已常驻则返回 RAGSystem，否则返回 None (不触发加载，不计入命中)"""
+        with self._lock:
+            return self._resident.get(name)
+
+    def invalidate(self, name):
+        """知识库重建/重置后调用：丢弃常驻实例，下次访问重新加载"""
+        with self._lock:
+            rag = self._resident.pop(name, None)
+        if rag is not None:
+            rag.close()
+
+    # ============================================================
+    # 增量入库
+    # ============================================================
+
+    def registry(self, name):
+        with self._lock:
+            registry = self._registries.get(name)
+            if registry is None:
+                _, db_dir = self.paths(name)
+                registry = self._registries[name] = FileRegistry(db_dir)
+            return registry
+
+    def ingest_file(self, name, filename):
+        """
+        增量入库单个已上传的文件 (后台队列调用)，状态写入文件登记表
+        知识库已常驻时原地更新其索引；未常驻时下次加载自然读到新数据
+        filename 为相对文档目录的路径 (子目录中的文件带子目录)
+        """
+        changes = self._index_one(name, filename)
+        if changes is None:
+            return False
+        self._reingest_affected(name, changes["affected"], exclude=filename)
+        return True
+
+    def _index_one(self, name, filename):
+        """入库一个文件并更新常驻索引，返回 index_file 的变更 (失败时记录到登记表并返回 None)"""
+        docs_dir, db_dir = self.paths(name)
+        registry = self.registry(name)
+        with self._ingest_lock:
+            try:
+                changes = index_file(
+                    os.path.join(docs_dir, os.path.normpath(filename)), db_dir=db_dir,
+                    embedding_model=self.embedding_model,
+                    on_status=lambda status: registry.update(filename, status=status), resources=self.resources,
+                    docs_dir=docs_dir
+                )
+                rag = self.peek(name)
+                if rag is not None:
+                    rag.apply_file_changes(changes)
+                    with self._lock:
+                        self._metric(name)["memory_bytes"] = rag.memory_bytes()
+            except Exception as e:
+                print(f"❌ 增量入库失败 [{name}] {filename}: {e}")
+                registry.update(filename, status=STATUS_FAILED, error=str(e))
+                return None
+        registry.update(filename, status=STATUS_INDEXED, error=None, chunks=len(changes["texts"]),
+                        batches=changes["batches"], peak_rss_mb=changes["peak_rss_mb"], chunking=changes["chunking"])
+        return changes
+
+    def _reingest_affected(self, name, affected, exclude=None):
+        """
+        旧库 (没有合并记录) 中被合并进已删除子块的其它文件逐个重新入库，找回被合并的那部分内容
+        只处理仍在文档目录中的文件，不再继续追溯它们各自的 affected；返回重新入库的文件
+        """
+        docs_dir, _ = self.paths(name)
+        registry = self.registry(name)
+        done = []
+        for other in affected:
+            if other == exclude or not os.path.isfile(os.path.join(docs_dir, other)):
+                continue
+            registry.update(other, status=STATUS_PENDING, error=None)
+            self._index_one(name, other)
+            done.append(other)
+        return done
+
+    def reindex_file(self, name, filename):
+        """重新入库单个文件 (文件需仍在文档目录中)，返回 (success, message)"""
+        docs_dir, _ = self.paths(name)
+        if not os.path.isfile(os.path.join(docs_dir, os.path.normpath(filename))):
+            return False, f"文件不存在: {filename}"
+        self.registry(name).update(filename, status=STATUS_PENDING, error=None)
+        changes = self._index_one(name, filename)
+        if changes is None:
+            return False, self.registry(name).get(filename).get("error")
+        msg = f"{filename} 已重新入库"
+        if changes["rehomed"]["chroma_ids"]:
+            msg += f"，{len(changes['rehomed']['chroma_ids'])} 个合并的重复子块已交还给原文件"
+        affected = self._reingest_affected(name, changes["affected"], exclude=filename)
+        if affected:
+            msg += f"，并重新入库了共享内容的文件: {', '.join(affected)}"
+        return True, msg
+
+    def delete_file(self, name, filename):
+        """
+        删除单个文件：只移除它在 Chroma / 矩阵索引 / BM25 / 父块中的内容与登记记录，再删掉文档本身
+        全量重建时合并进本文件子块的其它文件的近似重复内容在删除时交还给它们 (见 ingest._detach_source)；
+        旧库没有合并记录时，这些文件随后各自重新入库 (找回被合并的那部分内容)
+        返回 (success, message)
+        """
+        docs_dir, db_dir = self.paths(name)
+        file_path = os.path.join(docs_dir, os.path.normpath(filename))
+        registry = self.registry(name)
+        with self._ingest_lock:
+            changes = remove_file(file_path, db_dir=db_dir, resources=self.resources)
+            rag = self.peek(name)
+            if rag is not None:
+                rag.apply_file_removal(changes)
+                with self._lock:
+                    self._metric(name)["memory_bytes"] = rag.memory_bytes()
+            registry.remove(filename)
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+        affected = self._reingest_affected(name, changes["affected"])
+        msg = f"已删除 {filename} ({changes['removed_chunks']} 个子块)"
+        if affected:
+            msg += f"，并重新入库了共享内容的文件: {', '.join(affected)}"
+        return True, msg
+
+    # ============================================================
+    # 全量重建 / 重置 (阻塞，由后台线程调用)
+    # ============================================================
+
+    def rebuild_kb(self, name):
+        """全量重建知识库索引并重新加载 (上次重建中断时从断点继续)，返回 (success, message)"""
+        docs_dir, db_dir = self.create_kb(name)
+        with self._ingest_lock:
+            rag = self.peek(name)
+            if rag is not None and rag.token_cache is not None:
+                # 增量入库新分的词先落盘供重建复用，切换后旧实例关闭时就不会再覆盖新的分词缓存
+                rag.token_cache.save()
+            success, msg = create_vector_db(docs_dir=docs_dir, db_dir=db_dir, embedding_model=self.embedding_model,
+                                            resources=self.resources)
+            if success:
+                self.registry(name).clear()
+                self.invalidate(name)
+        if success:
+            self.get(name)
+        return success, msg
+
+    def interrupted_rebuilds(self):
+        """留有未完成全量重建断点的知识库"""
+        return [name for name in self.list_kbs() if has_interrupted_rebuild(self.paths(name)[1])]
+
+    def reset_kb(self, name):
+        """清空知识库的文档与索引，返回 (success, message)"""
+        docs_dir, db_dir = self.paths(name)
+        with self._ingest_lock:
+            if os.path.exists(docs_dir):
+                for filename in os.listdir(docs_dir):
+                    file_path = os.path.join(docs_dir, filename)
+                    try:
+                        if os.path.isfile(file_path) or os.path.islink(file_path):
+                            os.unlink(file_path)
+                        elif os.path.isdir(file_path):
+                            shutil.rmtree(file_path)
+                    except Exception as e:
+                        print(f"删除失败: {e}")
+            success, msg = reset_vector_db(db_dir=db_dir, resources=self.resources)
+            self.registry(name).clear()
+            self.invalidate(name)
+        return success, ("已清空文件和数据库" if success else msg)
+
+    def close(self):
+        """进程退出时调用：关闭常驻知识库、推理线程与分词进程池，释放全部 Chroma 句柄"""
+        with self._lock:
+            residents = list(self._resident.values())
+            self._resident.clear()
+        for rag in residents:
+            rag.close()
+        self.inference.close()
+        close_tokenize_pool()
+        self.resources.close()
+
+    # ============================================================
+    # 指标
+    # ============================================================
+
+    def stats(self):
+        with self._lock:
+            kbs = {}
+            for name in self.list_kbs():
+                m = dict(self._metric(name))
+                m["resident"] = name in self._resident
+                load_ms_total = m.pop("load_ms_total")
+                m["avg_load_ms"] = round(load_ms_total / m["loads"], 1) if m["loads"] else 0.0
+                kbs[name] = m
+            return {
+                "memory_budget_bytes": self.memory_budget,
+                "resident_bytes": self._resident_bytes(),
+                "resident": list(self._resident.keys()),
+                "knowledge_bases": kbs,
+                "resources": self.resources.stats(),
+            }
@@ -0,0 +1,127 @@
+"""
+父块存储 (parent_store.py)
+功能: parent_id → 父块内容的持久化
+  - parent_map.json: 全量重建时整体写出的基线 (流式重建时边切分边写)
+  - parent_map.log:  增量入库 / 删除文件时追加的变更日志 (每行一个 JSON: {"add": {...}, "remove": [...]})
+    单文件的变更只追加这一个文件的父块，开销与文件大小成正比，不再重写整个 parent_map.json
+  - 加载时基线 + 按顺序重放日志；日志超过基线大小时合并回基线
+"""
+
+import os
+import json
+
+PARENT_MAP_FILE = "parent_map.json"
+PARENT_JOURNAL_FILE = "parent_map.log"
+
+
+def _read_base(db_dir):
+    path = os.path.join(db_dir, PARENT_MAP_FILE)
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def iter_journal(db_dir):
+    """按顺序逐条读取变更日志 (末尾写了一半的行忽略)"""
+    path = os.path.join(db_dir, PARENT_JOURNAL_FILE)
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                continue
+
+
+def _replay_journal(db_dir, parent_map):
+    """按顺序重放变更日志，返回重放的条数"""
+    count = 0
+    for entry in iter_journal(db_dir):
+        parent_map.update(entry.get("add", {}))
+        for pid in entry.get("remove", ()):
+            parent_map.pop(pid, None)
+        count += 1
+    return count
+
+
+def load_parent_map(db_dir):
+    """基线 + 变更日志 → 当前的 parent_id → 父块内容"""
+    parent_map = _read_base(db_dir)
+    _replay_journal(db_dir, parent_map)
+    return parent_map
+
+
+class ParentMapWriter:
+    """
+    边切分边写出基线 (流式全量重建时不在内存中攒整个映射)
+    写到临时文件，commit 时整体替换 parent_map.json 并清空变更日志；abort 丢弃
+    """
+
+    def __init__(self, db_dir):
+        self.db_dir = db_dir
+        self.path = os.path.join(db_dir, PARENT_MAP_FILE)
+        self._tmp_path = self.path + ".tmp"
+        os.makedirs(db_dir, exist_ok=True)
+        self._f = open(self._tmp_path, "w", encoding="utf-8")
+        self._f.write("{")
+        self._seen = set()  # parent_id 是内容哈希，不同文件的相同父块只写一次
+        self.count = 0
+
+    def add(self, parent_map):
+        for pid, content in parent_map.items():
+            if pid in self._seen:
+                continue
+            self._seen.add(pid)
+            self._f.write(("," if self.count else "") + json.dumps(pid) + ":" + json.dumps(content, ensure_ascii=False))
+            self.count += 1
+
+    def commit(self):
+        self._f.write("}")
+        self._f.close()
+        os.replace(self._tmp_path, self.path)
+        journal = os.path.join(self.db_dir, PARENT_JOURNAL_FILE)
+        if os.path.exists(journal):
+            os.remove(journal)
+
+    def abort(self):
+        self._f.close()
+        if os.path.exists(self._tmp_path):
+            os.remove(self._tmp_path)
+
+
+def write_parent_map(db_dir, parent_map):
+    """整体写出基线并清空变更日志 (全量重建 / 日志合并时调用)"""
+    writer = ParentMapWriter(db_dir)
+    writer.add(parent_map)
+    writer.commit()
+
+
+def append_parent_changes(db_dir, add=None, remove=(), compact=True):
+    """
+    追加一条变更 (新增的父块 / 不再被引用的父块)；日志比基线还大时合并回基线
+    :param compact: False 时只追加不合并 (全量重建的断点日志，切换时再流式写成基线)
+    """
+    add, remove = add or {}, sorted(remove)
+    if not add and not remove:
+        return
+    journal = os.path.join(db_dir, PARENT_JOURNAL_FILE)
+    line = json.dumps({"add": add, "remove": remove}, ensure_ascii=False) + "\n"
+    if os.path.exists(journal) and os.path.getsize(journal):
+        with open(journal, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                line = "\n" + line  # 上次写到一半就中断了，另起一行，不与残行粘在一起
+    with open(journal, "a", encoding="utf-8") as f:
+        f.write(line)
+        f.flush()
+        os.fsync(f.fileno())
+
+    if not compact:
+        return
+    base = os.path.join(db_dir, PARENT_MAP_FILE)
+    base_size = os.path.getsize(base) if os.path.exists(base) else 0
+    if os.path.getsize(journal) > max(base_size, 1024 * 1024):
+        write_parent_map(db_dir, load_parent_map(db_dir))
+        print(f"   -> 父块变更日志已合并回 {PARENT_MAP_FILE}")
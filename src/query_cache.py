@@ -0,0 +1,116 @@
+"""
+查询缓存 (query_cache.py)
+功能: 缓存重复查询的 query 向量与混合检索结果 (FAQ 式重复提问、前端“重新生成”)
+  - 结果缓存: (索引代数, 规范化问题, k, 过滤条件) → 融合后的 chunk_id 与 RRF 分数
+  - 向量缓存: 规范化问题 → query 向量 (与索引无关，索引更新后仍可复用)
+  - 两者均为有界 LRU + TTL，命中时跳过 MiniLM 编码、向量检索、jieba 分词与 BM25 打分
+失效: 每个 RAGSystem 实例加载时及每次增量入库后取一个全局递增的索引代数，旧代数的缓存项不会再被命中，
+      等 LRU / TTL 自然淘汰 (重建 / 重置 / 淘汰后重新加载的实例也会拿到新代数)
+"""
+
+import os
+import re
+import time
+import itertools
+import threading
+import unicodedata
+from collections import OrderedDict
+
+QUERY_CACHE_SIZE = int(os.environ.get("RAG_QUERY_CACHE_SIZE", "512"))             # 检索结果缓存条数，0 表示关闭
+QUERY_CACHE_TTL = float(os.environ.get("RAG_QUERY_CACHE_TTL", "600"))             # 检索结果缓存有效期 (秒)
+EMBEDDING_CACHE_SIZE = int(os.environ.get("RAG_EMBEDDING_CACHE_SIZE", "1024"))    # query 向量缓存条数
+EMBEDDING_CACHE_TTL = float(os.environ.get("RAG_EMBEDDING_CACHE_TTL", "3600"))
+
+_generations = itertools.count(1)
+_generation_lock = threading.Lock()
+_TRAILING_PUNCT = re.compile(r"[\s?？!！。.,，~～]+$")
+
+
+def next_generation():
+    """全局递增的索引代数 (不同知识库、不同实例之间也不会重复)"""
+    with _generation_lock:
+        return next(_generations)
+
+
+def normalize_query(query):
+    """规范化问题：全角转半角、英文小写、合并空白、去掉末尾标点"""
+    query = unicodedata.normalize("NFKC", query).lower()
+    query = " ".join(query.split())
+    return _TRAILING_PUNCT.sub("", query)
+
+
+class _LRU:
+    """有界 LRU + TTL，带命中统计 (调用方持锁)"""
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()  # key → (写入时间, value)
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    def get(self, key, now):
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if now - entry[0] > self.ttl:
+            del self._data[key]
+            self.expired += 1
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value, now):
+        if self.max_entries <= 0:
+            return
+        self._data[key] = (now, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data), "max_entries": self.max_entries,
+            "hits": self.hits, "misses": self.misses, "expired": self.expired, "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class QueryCache:
+    """线程安全，多个知识库可共享同一个实例 (键中的索引代数全局唯一)"""
+
+    def __init__(self, max_entries=QUERY_CACHE_SIZE, ttl=QUERY_CACHE_TTL,
+                 embedding_entries=EMBEDDING_CACHE_SIZE, embedding_ttl=EMBEDDING_CACHE_TTL):
+        self._lock = threading.Lock()
+        self._results = _LRU(max_entries, ttl)
+        self._embeddings = _LRU(embedding_entries, embedding_ttl)
+
+    def get_results(self, key):
+        """返回 (fused_ids, fused_scores) 或 None"""
+        with self._lock:
+            return self._results.get(key, time.monotonic())
+
+    def put_results(self, key, ids, scores):
+        ids.flags.writeable = False  # 缓存的数组会被多个请求共享，禁止原地修改
+        scores.flags.writeable = False
+        with self._lock:
+            self._results.put(key, (ids, scores), time.monotonic())
+
+    def get_embedding(self, normalized_query):
+        with self._lock:
+            return self._embeddings.get(normalized_query, time.monotonic())
+
+    def put_embedding(self, normalized_query, vector):
+        with self._lock:
+            self._embeddings.put(normalized_query, vector, time.monotonic())
+
+    def stats(self):
+        with self._lock:
+            return {"results": self._results.stats(), "embeddings": self._embeddings.stats()}
@@ -0,0 +1,171 @@
+"""
+多查询检索 (query_expansion.py)
+功能: 把一个简短 / 有歧义的问题扩写成几个改写问题，与原问题一起检索后 RRF 融合，提高召回
+  - local: 本地改写，不调 LLM —— jieba 关键词 (TF-IDF) 组成的关键词问题 + 同义词替换 (data/synonyms.txt)
+  - llm:   让 LLM 改写 (严格限制输出 token 数与超时)，失败时回退到 local
+  - 全部问题的 query 向量作为一个请求提交推理服务，一次前向；各问题的向量检索 + BM25 在线程池中并发执行
+  - 改写问题的 RRF 权重低于原问题，避免改写跑偏后盖过原问题的结果
+开启: RAG_MULTI_QUERY=local / llm (默认 off)；也可以按请求指定
+同义词表: 一行一组同义词，空格或逗号分隔，例如 "报销 报账 费用报销"
+"""
+
+import os
+import re
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import jieba.analyse
+
+from tokenizer import tokenize, init_jieba, STOPWORDS
+from query_cache import normalize_query
+
+# ============================================================
+# 配置 (可通过环境变量覆盖)
+# ============================================================
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+SYNONYMS_PATH = os.path.join(CURRENT_DIR, "../data/synonyms.txt")
+
+MULTI_QUERY_MODES = ("off", "local", "llm")
+MULTI_QUERY = os.environ.get("RAG_MULTI_QUERY", "off")                             # off / local / llm
+MULTI_QUERY_VARIANTS = int(os.environ.get("RAG_MULTI_QUERY_VARIANTS", "3"))        # 最多几个改写问题 (不含原问题)
+MULTI_QUERY_WEIGHT = float(os.environ.get("RAG_MULTI_QUERY_WEIGHT", "0.5"))        # 改写问题每路的 RRF 权重 (原问题为 1)
+MULTI_QUERY_LLM_TOKENS = int(os.environ.get("RAG_MULTI_QUERY_LLM_TOKENS", "96"))   # LLM 改写的输出 token 上限
+MULTI_QUERY_LLM_TIMEOUT = float(os.environ.get("RAG_MULTI_QUERY_LLM_TIMEOUT", "5"))  # LLM 改写超时 (秒)
+MULTI_QUERY_WORKERS = int(os.environ.get("RAG_MULTI_QUERY_WORKERS", "4"))          # 并发检索线程数 (所有知识库共用)
+MAX_VARIANT_CHARS = 100                                                             # 过长的 LLM 输出行不当作问题
+
+_LIST_MARKER = re.compile(r"^\s*(?:[-*•]|\d+[.、)）]|[（(]\d+[)）])\s*")
+
+
+def resolve_mode(mode):
+    """请求指定的模式优先，不认识的值当作 off"""
+    return mode if mode in MULTI_QUERY_MODES else "off"
+
+
+# ============================================================
+# 本地改写
+# ============================================================
+
+def _load_synonyms(path=SYNONYMS_PATH):
+    """词 → 同组的其它词 (按文件中的顺序)"""
+    synonyms = {}
+    if not os.path.exists(path):
+        return synonyms
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            group = [w for w in re.split(r"[\s,，]+", line.strip().lower()) if w]
+            for word in group:
+                synonyms.setdefault(word, []).extend(w for w in group if w != word)
+    return synonyms
+
+
+SYNONYMS = _load_synonyms()
+
+
+def keywords(query, top_k=6):
+    """问题的关键词 (TF-IDF 排序，去掉疑问词等停用词)；提取不到时退回分词结果"""
+    init_jieba()
+    tags = [t.lower() for t in jieba.analyse.extract_tags(query, topK=top_k) if t.lower() not in STOPWORDS]
+    return tags or tokenize(query)[:top_k]
+
+
+def local_variants(query, n=MULTI_QUERY_VARIANTS, synonyms=None):
+    """
+    本地改写 (毫秒级)，返回不超过 n 个与原问题不同的改写问题
+      1. 关键词问题: 去掉疑问词 / 虚词，只保留关键词，BM25 与向量都更聚焦
+      2. 同义词替换: 问题中出现同义词表里的词时，逐个换成同组的其它说法
+      3. 关键词 + 全部同义词: 一个词袋问题，覆盖文档里的不同叫法
+    """
+    synonyms = SYNONYMS if synonyms is None else synonyms
+    words = keywords(query)
+    candidates = [" ".join(words)]
+
+    lowered = query.lower()
+    hits = [(w, synonyms[w]) for w in dict.fromkeys(tokenize(query) + words) if w in synonyms]
+    for word, alternatives in hits:
+        candidates.extend(lowered.replace(word, alt) for alt in alternatives)
+    if hits:
+        candidates.append(" ".join(words + [alt for _, alternatives in hits for alt in alternatives]))
+    return dedupe_variants(query, candidates, n)
+
+
+def dedupe_variants(query, candidates, n):
+    """按规范化后的文本去重，去掉与原问题相同的和空的"""
+    seen = {normalize_query(query)}
+    variants = []
+    for candidate in candidates:
+        key = normalize_query(candidate)
+        if key and key not in seen:
+            seen.add(key)
+            variants.append(candidate.strip())
+        if len(variants) >= n:
+            break
+    return variants
+
+
+# ============================================================
+# LLM 改写
+# ============================================================
+
+def parse_llm_variants(text, query, n=MULTI_QUERY_VARIANTS):
+    """解析 LLM 输出: 去掉 <think> 段与列表序号，一行一个问题"""
+    if "</think>" in text:
+        text = text.split("</think>")[-1]
+    lines = [_LIST_MARKER.sub("", line).strip().strip("\"'“”") for line in text.splitlines()]
+    return dedupe_variants(query, [line for line in lines if 0 < len(line) <= MAX_VARIANT_CHARS], n)
+
+
+# ============================================================
+# 并发检索与统计
+# ============================================================
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def search_pool():
+    """多查询检索共用的线程池 (首次使用时创建)"""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=max(1, MULTI_QUERY_WORKERS), thread_name_prefix="multi-query")
+        return _pool
+
+
+class MultiQueryStats:
+    """多查询检索的累计耗时：改写 / 合批编码 / 并发检索，以及相对单查询 (原问题单路检索) 多出的耗时"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {"queries": 0, "variants": 0, "expand_ms": 0.0, "embed_ms": 0.0,
+                       "search_ms": 0.0, "single_search_ms": 0.0, "added_ms": 0.0, "llm_fallbacks": 0}
+
+    def record(self, variants, expand_ms, embed_ms, search_ms, single_search_ms, llm_fallback=False):
+        with self._lock:
+            s = self._stats
+            s["queries"] += 1
+            s["variants"] += variants
+            s["expand_ms"] += expand_ms
+            s["embed_ms"] += embed_ms
+            s["search_ms"] += search_ms
+            s["single_search_ms"] += single_search_ms
+            s["added_ms"] += expand_ms + search_ms - single_search_ms
+            s["llm_fallbacks"] += int(llm_fallback)
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+        n = s["queries"] or 1
+        result = {"queries": s["queries"], "llm_fallbacks": s["llm_fallbacks"],
+                  "avg_variants": round(s["variants"] / n, 2)}
+        for key in ("expand_ms", "embed_ms", "search_ms", "single_search_ms", "added_ms"):
+            result[f"avg_{key}"] = round(s[key] / n, 3)
+        return result
+
+
+STATS = MultiQueryStats()
+
+
+def elapsed_ms(start):
+    return (time.perf_counter() - start) * 1000
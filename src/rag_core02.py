@@ -6,31 +6,78 @@ RAG 核心引擎 (rag_core02.py)
 
 import os
 import re
-import json
+import time
+import threading
 import requests
-import jieba
-from rank_bm25 import BM25Okapi
+import numpy as np
 
 # 强制离线模式 (禁止 HuggingFace 联网下载)
 os.environ["HF_HUB_OFFLINE"] = "1"
 
-from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_chroma import Chroma
-from langchain_core.documents import Document
-from sentence_transformers import CrossEncoder
+from resources import shared_resources
+from inference_service import InferenceService
+from vector_store import load_vector_store, VECTOR_BACKEND
+from hierarchical_index import ParentIndex, RETRIEVAL_MODE, HIER_PARENTS, HIER_MIN_CHUNKS
+from tokenizer import TokenCache, tokenize, close_tokenize_pool
+from chunk_store import ChunkStore
+from bm25_index import BM25Index
+from fusion import weighted_rrf, first_unique
+from retrieval_filter import RetrievalFilter
+from query_cache import QueryCache, next_generation, normalize_query
+from query_expansion import (
+    MULTI_QUERY, MULTI_QUERY_VARIANTS, MULTI_QUERY_WEIGHT, MULTI_QUERY_LLM_TOKENS, MULTI_QUERY_LLM_TIMEOUT,
+    STATS as MULTI_QUERY_STATS, resolve_mode, local_variants, parse_llm_variants, search_pool, elapsed_ms
+)
+from parent_store import PARENT_MAP_FILE, load_parent_map
+from ingest import finish_interrupted_swap
+from context_builder import (
+    ContextBuilder, LEGACY_HISTORY_MESSAGES, CHAT_SYSTEM_PROMPT, ANSWER_SYSTEM_PROMPT,
+    router_messages, answer_messages, expansion_messages
+)
 
 # ============================================================
 # 路径配置
 # ============================================================
 CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_DIR = os.path.join(CURRENT_DIR, "../data/chroma_db")
-RERANK_MODEL_PATH = os.path.join(CURRENT_DIR, "../model_cache/bge-reranker-base")
-PARENT_MAP_PATH = os.path.join(DB_DIR, "parent_map.json")
+PARENT_MAP_PATH = os.path.join(DB_DIR, PARENT_MAP_FILE)
 
 # LM Studio API
 LLM_URL = "http://127.0.0.1:1234/v1/chat/completions"
 LLM_HEADERS = {"Content-Type": "application/json"}
 LLM_PROXIES = {"http": None, "https": None}  # 绕过系统代理
+# KV 缓存复用提示: cache_prompt 让 llama.cpp 复用与上次请求相同的前缀；
+# 指定槽位后路由与回答各占一个槽，路由请求不会挤掉回答对话的缓存 (LM Studio 会忽略不认识的字段)
+LLM_CACHE_PROMPT = os.environ.get("RAG_LLM_CACHE_PROMPT", "1") == "1"
+
+
+def _slot_from_env(name):
+    """读取槽位编号 (非负整数)；未设置或不合法时返回 None (不指定槽位)，启动时只解析一次"""
+    value = os.environ.get(name, "").strip()
+    if not value:
+        return None
+    if not value.isdigit():
+        print(f"⚠️ {name}={value!r} 不是合法的槽位编号 (应为非负整数)，已忽略")
+        return None
+    return int(value)
+
+
+LLM_ROUTER_SLOT = _slot_from_env("RAG_LLM_ROUTER_SLOT")
+LLM_ANSWER_SLOT = _slot_from_env("RAG_LLM_ANSWER_SLOT")
+LLM_COMPLETE_TIMEOUT = float(os.environ.get("RAG_LLM_COMPLETE_TIMEOUT", "300"))  # 非流式 (批量问答) 单次调用超时 (秒)
+
+# 混合检索各路 RRF 权重 (向量, BM25)
+RRF_WEIGHTS = [1.0, 1.0]
+
+
+def llm_cache_options(slot=None):
+    """请求体中的 KV 缓存提示字段"""
+    options = {}
+    if LLM_CACHE_PROMPT:
+        options["cache_prompt"] = True
+    if slot is not None:
+        options["id_slot"] = slot
+    return options
 
 
 class RAGSystem:
@@ -40,158 +87,269 @@ class RAGSystem:
     # 初始化
     # ============================================================
 
-    def __init__(self):
+    def __init__(self, vector_backend=VECTOR_BACKEND, db_dir=DB_DIR,
+                 embedding_model=None, reranker=None, inference=None, context_builder=None, query_cache=None,
+                 retrieval_mode=RETRIEVAL_MODE, multi_query=MULTI_QUERY, resources=None):
+        """
+        :param vector_backend: 向量检索后端 'chroma' / 'matrix' / 'hnsw' / 'int8' / 'binary' (见 vector_store.py)
+        :param retrieval_mode: 'flat' (全部子块打分) 或 'hierarchical' (先路由到父块，见 hierarchical_index.py)
+        :param multi_query: 默认的多查询模式 'off' / 'local' / 'llm' (见 query_expansion.py)，可按请求覆盖
+        :param db_dir: 知识库索引目录 (多知识库时每个库一个目录)
+        :param embedding_model / reranker / inference / context_builder / query_cache: 多个知识库共享的模型、
+            推理服务、Prompt 组装器与查询缓存，不传则取自共享资源 (模型) 或自行创建
+        :param resources: 共享资源管理器 (模型 + Chroma 句柄，见 resources.py)，默认进程级单例
+        """
         print("正在初始化 RAG 系统...")
+        self.db_dir = db_dir
+        self.multi_query = resolve_mode(multi_query)
 
-        # A. 向量 Embedding 模型
-        self.embedding_model = HuggingFaceEmbeddings(
-            model_name="all-MiniLM-L6-v2",
-            model_kwargs={"device": "cpu"}
-        )
+        self.resources = resources or shared_resources()
 
-        # B. 向量数据库
-        if not os.path.exists(DB_DIR):
-            raise FileNotFoundError(f"找不到数据库目录: {DB_DIR}")
-        self.vector_db = Chroma(
-            persist_directory=DB_DIR,
-            embedding_function=self.embedding_model
-        )
+        # A. 向量 Embedding 模型 (进程内共享，重建 / 重新加载时不再重复加载)
+        self.embedding_model = embedding_model or self.resources.embedding_model()
+
+        # B. 向量数据库 (Chroma 句柄由共享资源管理器持有，与入库共用同一个客户端)
+        if not os.path.exists(db_dir):
+            raise FileNotFoundError(f"找不到数据库目录: {db_dir}")
+        finish_interrupted_swap(db_dir, self.resources)  # 上次全量重建切换到一半时先补做完，再读正式集合
+        self.vector_db = self.resources.vector_db(db_dir)
 
         # C. Reranker 精排模型 (可选, 加载失败自动降级)
-        print(f" -> 正在加载 Rerank 模型 ({RERANK_MODEL_PATH})...")
-        try:
-            self.reranker = CrossEncoder(RERANK_MODEL_PATH, device="cpu")
-            print(" -> Rerank 模型加载成功！")
-        except Exception as e:
-            print(f"❌ Rerank 模型加载失败: {e}")
-            print("   (将自动降级为仅使用向量检索)")
-            self.reranker = None
+        if inference is not None:
+            self.reranker = inference.reranker
+        else:
+            self.reranker = reranker if reranker is not None else self.resources.reranker()
+
+        # C2. 推理服务 (embedding / rerank 请求微批处理，多个并发查询合并成一次前向)
+        self._owns_inference = inference is None
+        self.inference = inference or InferenceService(self.embedding_model, self.reranker)
 
-        # D. 父文档映射表 (parent_id → 父文档内容)
+        # C3. Prompt 组装 (按 token 预算填充参考资料与历史)
+        self.context_builder = context_builder or ContextBuilder()
+
+        # C4. 查询缓存 (query 向量 + 检索结果，按索引代数失效)
+        self.query_cache = query_cache or QueryCache()
+
+        # D. 父文档映射表 (parent_id → 父文档内容，基线 + 增量变更日志)
         self.parent_map = {}
-        if os.path.exists(PARENT_MAP_PATH):
-            try:
-                with open(PARENT_MAP_PATH, "r", encoding="utf-8") as f:
-                    self.parent_map = json.load(f)
+        try:
+            self.parent_map = load_parent_map(db_dir)
+            if self.parent_map:
                 print(f" -> 已加载父文档映射: {len(self.parent_map)} 条")
-            except Exception as e:
-                print(f"⚠️ 加载父文档映射失败: {e}")
+        except Exception as e:
+            print(f"⚠️ 加载父文档映射失败: {e}")
+
+        # E. 子块仓库 (chunk_id ↔ 行号 ↔ 父块，三路检索共用)
+        #    增量入库与检索互斥：更新子块仓库 / BM25 / 向量索引期间不做检索
+        self._index_lock = threading.RLock()
+        self.index_generation = next_generation()  # 索引每变一次换一个代数，旧的检索缓存随之失效
+        self._load_chunk_store()
+        self.vector_store = load_vector_store(
+            self.vector_db, db_dir, backend=vector_backend, resolve_ids=self.chunk_store.ids_from_chroma
+        )
+        self.vector_store.align(self.chunk_store.chunk_ids)
+        print(f" -> 向量检索后端: {self.vector_store.name}")
 
-        # E. BM25 索引 (混合检索)
+        # F. BM25 索引 (混合检索)
         self._build_bm25_index()
 
+        # G. 父块层索引 (分层检索：先路由到少量父块，只对它们的子块打分)
+        self.parent_index = None
+        if retrieval_mode == "hierarchical":
+            self._build_parent_index()
+        close_tokenize_pool()  # 全量分词只在加载时发生，不让空闲的分词子进程常驻
+
         print("✅ 系统初始化完成！")
 
+    def close(self):
+        """释放后台推理线程 (重建/重置时替换旧实例前调用；共享的推理服务与 Chroma 句柄由其所有者关闭)"""
+        if self._owns_inference:
+            self.inference.close()
+        # 增量入库新分的词在这里统一落盘，避免每个文件都重写整个分词缓存
+        if self.token_cache is not None:
+            self.token_cache.save()
+
+    def memory_bytes(self):
+        """估算本知识库的常驻内存 (子块/父块文本 + 向量索引 + BM25 倒排)，用于多知识库的内存预算"""
+        store = self.chunk_store
+        text_chars = sum(map(len, store.texts)) + sum(map(len, self.parent_map.values()))
+        vectors = self.vector_store.memory_bytes() or len(store) * 384 * 4
+        bm25 = self.bm25_index.corpus_size * 512
+        parents = self.parent_index.memory_bytes() if self.parent_index is not None else 0
+        return int(text_chars * 4 + vectors + bm25 + parents + store.chunk_ids.nbytes * 4)
+
     # ============================================================
     # 文件索引查询
     # ============================================================
 
     def get_indexed_files(self):
-        """查询 ChromaDB，返回当前数据库中所有唯一的 source 文件名"""
-        try:
-            data = self.vector_db.get(include=['metadatas'])
-            if not data or not data['metadatas']:
-                return set()
-
-            indexed_files = set()
-            for meta in data['metadatas']:
-                if meta and 'source' in meta:
-                    indexed_files.add(os.path.basename(meta['source']))
-            return indexed_files
-        except Exception as e:
-            print(f"❌ 获取索引文件列表失败: {e}")
-            return set()
+        """返回当前数据库中所有唯一的 source 文件名 (来自启动时加载的子块仓库，不再每次查询 ChromaDB)"""
+        return self.chunk_store.indexed_files()
 
     # ============================================================
     # BM25 混合检索
     # ============================================================
 
-    def _build_bm25_index(self):
-        """从 ChromaDB 中加载全部文档，用 jieba 分词后构建 BM25 索引"""
-        print(" -> 正在构建 BM25 索引...")
+    def _load_chunk_store(self):
+        """从 ChromaDB 中一次性加载全部子块，建立 chunk_id / 行号 / 父块的对应关系"""
         try:
             data = self.vector_db.get(include=['documents', 'metadatas'])
+        except Exception as e:
+            print(f"⚠️ 加载子块失败: {e}")
+            data = None
+        if not data or not data['documents']:
+            data = {"ids": [], "documents": [], "metadatas": []}
+        self.chunk_store = ChunkStore(data['ids'], data['documents'], data['metadatas'], self.parent_map)
+        print(f" -> 已加载子块: {len(self.chunk_store)} 个")
 
-            if not data or not data['documents']:
-                print("⚠️ 数据库为空，BM25 索引跳过")
-                self.bm25_index = None
-                self.bm25_docs = []
-                self.bm25_metadatas = []
-                self.bm25_corpus = []
-                return
-
-            self.bm25_docs = data['documents']
-            self.bm25_metadatas = data['metadatas']
-            self.bm25_corpus = [list(jieba.cut(doc)) for doc in self.bm25_docs]
-            self.bm25_index = BM25Okapi(self.bm25_corpus)
-            print(f" -> BM25 索引构建完成！共 {len(self.bm25_docs)} 个文档片段")
+    def _build_bm25_index(self):
+        """对子块分词 (优先命中持久化分词缓存) 后构建 BM25 索引，语料按 chunk_store 行号对齐"""
+        print(" -> 正在构建 BM25 索引...")
+        self.bm25_index = BM25Index()
+        self.token_cache = None
+        if not len(self.chunk_store):
+            print("⚠️ 数据库为空，BM25 索引跳过")
+            return
+        try:
+            self.token_cache = TokenCache(self.db_dir)
+            corpus = self.token_cache.tokenize_corpus(self.chunk_store.texts)
+            self.token_cache.save()
+            self.bm25_index = BM25Index(corpus)
+            print(f" -> BM25 索引构建完成！共 {len(corpus)} 个文档片段")
         except Exception as e:
             print(f"⚠️ BM25 索引构建失败: {e}")
-            self.bm25_index = None
-            self.bm25_docs = []
-            self.bm25_metadatas = []
-            self.bm25_corpus = []
-
-    def _bm25_search(self, query, k=10):
-        """BM25 关键词检索，返回 Top-K 的 (文档内容, metadata, 索引) 列表"""
-        if not self.bm25_index:
-            return []
+            self.bm25_index = BM25Index()
 
-        query_tokens = list(jieba.cut(query))
-        scores = self.bm25_index.get_scores(query_tokens)
-        top_indices = sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:k]
+    def _build_parent_index(self):
+        """父块质心取自子块向量 (matrix 类后端读 mmap，chroma 后端从库中读取)，父块 BM25 复用分词缓存"""
+        print(" -> 正在构建父块层索引 (分层检索)...")
+        if self.token_cache is None:
+            self.token_cache = TokenCache(self.db_dir)
+        try:
+            self.parent_index = ParentIndex(self.chunk_store, self.vector_store.vectors, self.token_cache.tokenize_corpus)
+            print(f" -> 父块层索引构建完成！共 {self.parent_index.parent_count} 个父块")
+        except Exception as e:
+            print(f"⚠️ 父块层索引构建失败，改为平铺检索: {e}")
+            self.parent_index = None
 
-        return [
-            (self.bm25_docs[idx], self.bm25_metadatas[idx], idx)
-            for idx in top_indices if scores[idx] > 0
-        ]
+    # ============================================================
+    # 增量入库 (单文件)
+    # ============================================================
 
-    def _hybrid_search(self, query, k=5):
+    def apply_file_changes(self, changes):
         """
-        混合检索：向量检索 + BM25 → RRF (Reciprocal Rank Fusion) 融合
-        返回 LangChain Document 对象列表
+        把 ingest.index_file 的结果原地应用到常驻索引，不重新加载模型、不重读整个 Chroma
+        同一来源文件的旧子块先打墓碑再追加新子块，重复应用结果不变
         """
-        RRF_K = 60
+        removed, added = self._apply_source_changes(
+            changes, changes["chroma_ids"], changes["texts"], changes["metadatas"]
+        )
+        print(f" -> 常驻索引已更新: {changes['source']} (-{len(removed)} / +{len(added)} 个子块)")
 
-        # 路径 1: 向量语义检索
-        vector_k = min(k * 3, 20)
-        vector_docs = self.vector_db.similarity_search(query, k=vector_k)
+    def apply_file_removal(self, changes):
+        """把 ingest.remove_file 的结果原地应用到常驻索引：该文件的子块打墓碑，移除不再被引用的父块"""
+        removed, added = self._apply_source_changes(changes, [], [], [])
+        print(f" -> 常驻索引已更新: 删除 {changes['source']} (-{len(removed)} 个子块)")
 
-        # 路径 2: BM25 关键词检索
-        bm25_results = self._bm25_search(query, k=vector_k)
-
-        # RRF 融合
-        rrf_scores = {}
-        doc_map = {}
-        vec_hashes = set()
-        bm25_hashes = set()
-
-        for rank, doc in enumerate(vector_docs):
-            h = hash(doc.page_content)
-            rrf_scores[h] = rrf_scores.get(h, 0) + 1.0 / (RRF_K + rank + 1)
-            doc_map[h] = doc
-            vec_hashes.add(h)
-
-        for rank, (content, metadata, _) in enumerate(bm25_results):
-            h = hash(content)
-            rrf_scores[h] = rrf_scores.get(h, 0) + 1.0 / (RRF_K + rank + 1)
-            bm25_hashes.add(h)
-            if h not in doc_map:
-                doc_map[h] = Document(page_content=content, metadata=metadata or {})
-
-        sorted_hashes = sorted(rrf_scores.keys(), key=lambda h: rrf_scores[h], reverse=True)[:k]
-        final_docs = [doc_map[h] for h in sorted_hashes]
+    def _apply_source_changes(self, changes, chroma_ids, texts, metadatas):
+        """
+        单个来源文件的变更: 按完整路径删除它的旧子块，追加新子块与交还给其它文件的子块 (rehomed)，
+        更新其它文件中记录的近似重复有变化的代表子块，返回 (删除的行号, 追加的行号)
+        """
+        rehomed = changes.get("rehomed") or {}
+        chroma_ids = list(chroma_ids) + rehomed.get("chroma_ids", [])
+        texts = list(texts) + rehomed.get("texts", [])
+        metadatas = list(metadatas) + rehomed.get("metadatas", [])
+        if self.token_cache is None:
+            self.token_cache = TokenCache(self.db_dir)
+        tokens = self.token_cache.tokenize_corpus(texts)
+
+        with self._index_lock:
+            self.parent_map.update(changes.get("parent_map", {}))
+            removed = self.chunk_store.remove_paths([changes["path"]])
+            self.bm25_index.remove(removed)
+            added = self.chunk_store.append(chroma_ids, texts, metadatas)
+            self.bm25_index.add(tokens)
+            self.chunk_store.update_metadatas(changes.get("updated", {}))
+            for pid in changes.get("removed_parents", ()):
+                self.parent_map.pop(pid, None)
+            self.vector_store.reload()
+            self.vector_store.align(self.chunk_store.chunk_ids)
+            if self.parent_index is not None:
+                self.parent_index.remove_rows(removed)
+                self.parent_index.add_rows(added)
+            self.index_generation = next_generation()
+        return removed, added
+
+    def _bm25_search(self, query, k=10, rows=None):
+        """
+        BM25 关键词检索，返回按分数降序排列的 chunk_id 数组 (只保留分数 > 0 的)
+        :param rows: 允许检索的行号 (过滤条件)，只对这些文档打分
+        """
+        if not self.bm25_index:
+            return np.array([], dtype=np.int64)
+
+        query_tokens = tokenize(query)
+        if not query_tokens or (rows is not None and not len(rows)):
+            return np.array([], dtype=np.int64)
+        if rows is None:
+            rows = np.arange(len(self.bm25_index), dtype=np.int64)
+            scores = self.bm25_index.get_scores(query_tokens)
+        else:
+            scores = self.bm25_index.get_batch_scores(query_tokens, rows)
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        top = top[scores[top] > 0]
+        return self.chunk_store.chunk_ids[rows[top]]
+
+    def _hybrid_search(self, query, k=5, filters=None):
+        """混合检索，返回 LangChain Document 对象列表 (只为最终结果构造)"""
+        return self.chunk_store.documents(self._hybrid_search_ids(query, k=k, filters=filters))
+
+    def _hybrid_search_ids(self, query, k=5, filters=None, multi_query=None):
+        """
+        混合检索：向量检索 + BM25 → 加权 RRF (Reciprocal Rank Fusion) 融合
+        融合在 chunk_id 数组上完成，返回按融合分数降序排列的 chunk_id 数组
+        :param filters: RetrievalFilter，同时下推到向量检索和 BM25
+        :param multi_query: 多查询模式，None 表示用实例默认值；开启时原问题 + 改写问题并发检索后一起融合
+        分层检索开启时先路由到少量父块，两路检索只在这些父块的子块内打分
+        相同问题 (规范化后) 在索引未变化时直接返回缓存的融合结果
+        """
+        multi_query = resolve_mode(self.multi_query if multi_query is None else multi_query)
+        normalized = normalize_query(query)
+        cache_key = (self.index_generation, normalized, k,
+                     filters.cache_key() if filters is not None else None, multi_query)
+        cached = self.query_cache.get_results(cache_key)
+        if cached is not None:
+            print(f" -> 检索缓存命中: {len(cached[0])} 条 (索引代数 {cache_key[0]})")
+            return cached[0]
+        if multi_query != "off":
+            return self._multi_query_search(query, k, filters, multi_query, cache_key)
+
+        query_vector = self._embed_queries([query])[0]
+
+        with self._index_lock:
+            generation = self.index_generation
+            rows, where = self._filter_scope(filters)
+            if rows is not None and not len(rows):
+                return np.array([], dtype=np.int64)
+            vector_ids, bm25_ids = self._search_paths(query, query_vector, rows, where, k)
+
+        # RRF 融合 (检索期间索引被更新过时，结果记在实际检索时的代数下)
+        fused_ids, fused_scores = weighted_rrf([vector_ids, bm25_ids], weights=RRF_WEIGHTS, top_k=k)
+        self.query_cache.put_results((generation,) + cache_key[1:], fused_ids, fused_scores)
 
         # ========== 检索质量指标 ==========
-        overlap = vec_hashes & bm25_hashes
-        all_unique = vec_hashes | bm25_hashes
-        overlap_rate = len(overlap) / len(all_unique) * 100 if all_unique else 0
-        top_rrf = [rrf_scores[h] for h in sorted_hashes]
+        overlap = np.intersect1d(vector_ids, bm25_ids)
+        all_unique = np.union1d(vector_ids, bm25_ids)
+        overlap_rate = len(overlap) / len(all_unique) * 100 if len(all_unique) else 0
+        top_rrf = fused_scores.tolist()
 
         print(f"\n   {'='*50}")
         print(f"   📊 检索质量报告")
         print(f"   {'='*50}")
-        print(f"   │ 向量检索: {len(vector_docs)}条  |  BM25检索: {len(bm25_results)}条")
+        print(f"   │ 向量检索: {len(vector_ids)}条  |  BM25检索: {len(bm25_ids)}条")
         print(f"   │ 去重后独立文档: {len(all_unique)}条  |  双路重合: {len(overlap)}条")
         print(f"   │ 🎯 双路重合率: {overlap_rate:.1f}%")
         if overlap_rate > 50:
@@ -206,7 +364,154 @@ class RAGSystem:
             print(f"   │   #{i+1}: {score:.5f} {bar}")
         print(f"   {'='*50}\n")
 
-        return final_docs
+        return fused_ids
+
+    def _embed_queries(self, queries):
+        """多条问题的 query 向量：先查向量缓存，未命中的作为一个请求提交推理服务 (一次前向)"""
+        keys = [normalize_query(q) for q in queries]
+        vectors = [self.query_cache.get_embedding(key) for key in keys]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            for i, vector in zip(missing, self.inference.embed_queries([queries[i] for i in missing])):
+                vectors[i] = vector
+                self.query_cache.put_embedding(keys[i], vector)
+        return vectors
+
+    def _filter_scope(self, filters):
+        """过滤条件 → (允许的行号, Chroma where 子句)，无过滤时为 (None, None) (调用方持 _index_lock)"""
+        if filters is None:
+            return None, None
+        rows = filters.allowed_rows(self.chunk_store)
+        print(f" -> 过滤条件命中 {len(rows)}/{self.chunk_store.live_count} 个子块")
+        return rows, filters.to_chroma_where(self.chunk_store)
+
+    def _search_paths(self, query, query_vector, rows, where, k):
+        """单个问题的两路检索 (分层路由 → 向量 + BM25)，返回 (vector_ids, bm25_ids)"""
+        vector_k = min(k * 3, 20)
+        rows, where = self._route_to_parents(query, query_vector, rows, where, k)
+
+        # 路径 1: 向量语义检索
+        vector_ids = self.vector_store.search(query_vector, k=vector_k, rows=rows, where=where)
+
+        # 路径 2: BM25 关键词检索
+        bm25_ids = self._bm25_search(query, k=vector_k, rows=rows)
+        return vector_ids, bm25_ids
+
+    def _timed_search_paths(self, query, query_vector, rows, where, k):
+        start = time.perf_counter()
+        return self._search_paths(query, query_vector, rows, where, k), elapsed_ms(start)
+
+    # ============================================================
+    # 多查询检索 (问题改写 → 合批编码 → 并发检索 → RRF 融合)
+    # ============================================================
+
+    def _query_variants(self, query, mode):
+        """生成改写问题，返回 (改写列表, LLM 改写是否失败并回退到本地改写)"""
+        if mode == "llm":
+            variants = self._llm_query_variants(query)
+            if variants:
+                return variants, False
+            return local_variants(query), True
+        return local_variants(query), False
+
+    def _llm_query_variants(self, query):
+        """让 LLM 改写问题 (输出 token 数与超时都有严格上限)，失败返回空列表"""
+        data = {
+            "model": "local-model",
+            "messages": expansion_messages(query, MULTI_QUERY_VARIANTS),
+            "temperature": 0.3,
+            "max_tokens": MULTI_QUERY_LLM_TOKENS,
+            "stream": False,
+            **llm_cache_options(LLM_ROUTER_SLOT)
+        }
+        try:
+            response = requests.post(
+                LLM_URL, headers=LLM_HEADERS, json=data,
+                proxies=LLM_PROXIES, timeout=MULTI_QUERY_LLM_TIMEOUT
+            )
+            if response.status_code != 200:
+                print(f"❌ 问题改写 API 报错: {response.status_code}，改用本地改写")
+                return []
+            content = response.json()['choices'][0]['message']['content']
+            return parse_llm_variants(content, query, MULTI_QUERY_VARIANTS)
+        except Exception as e:
+            print(f"❌ 问题改写失败: {e}，改用本地改写")
+            return []
+
+    def _multi_query_search(self, query, k, filters, mode, cache_key):
+        """
+        多查询检索：原问题 + 改写问题的向量一次前向算出，各问题的两路检索在线程池中并发，
+        全部 2 × (1 + 改写数) 路结果一起加权 RRF 融合 (改写问题的权重乘以 MULTI_QUERY_WEIGHT)
+        """
+        start = time.perf_counter()
+        variants, llm_fallback = self._query_variants(query, mode)
+        expand_ms = elapsed_ms(start)
+        queries = [query] + variants
+
+        start = time.perf_counter()
+        query_vectors = self._embed_queries(queries)
+        embed_ms = elapsed_ms(start)
+
+        with self._index_lock:
+            generation = self.index_generation
+            rows, where = self._filter_scope(filters)
+            if rows is not None and not len(rows):
+                return np.array([], dtype=np.int64)
+            # 工作线程只读索引，不取 _index_lock；本线程持锁等待期间增量入库不会改动索引
+            start = time.perf_counter()
+            futures = [search_pool().submit(self._timed_search_paths, q, v, rows, where, k)
+                       for q, v in zip(queries, query_vectors)]
+            results = [future.result() for future in futures]
+            search_ms = elapsed_ms(start)
+
+        ranked, weights = [], []
+        for i, ((vector_ids, bm25_ids), _) in enumerate(results):
+            scale = 1.0 if i == 0 else MULTI_QUERY_WEIGHT
+            ranked += [vector_ids, bm25_ids]
+            weights += [w * scale for w in RRF_WEIGHTS]
+        fused_ids, fused_scores = weighted_rrf(ranked, weights=weights, top_k=k)
+        self.query_cache.put_results((generation,) + cache_key[1:], fused_ids, fused_scores)
+
+        single_ms = results[0][1]
+        added_ms = expand_ms + search_ms - single_ms
+        MULTI_QUERY_STATS.record(len(variants), expand_ms, embed_ms, search_ms, single_ms, llm_fallback)
+
+        # ========== 多查询报告 ==========
+        original_ids = np.union1d(*results[0][0])
+        only_variants = int(np.isin(fused_ids, original_ids, invert=True).sum())
+        print(f"\n   {'='*50}")
+        print(f"   📊 多查询检索报告 ({mode}{'，LLM 改写失败已回退 local' if llm_fallback else ''})")
+        print(f"   {'='*50}")
+        for i, (q, ((vector_ids, bm25_ids), ms)) in enumerate(zip(queries, results)):
+            label = "原问题" if i == 0 else f"改写 #{i}"
+            print(f"   │ {label}: {q[:40]}  |  向量 {len(vector_ids)}条 BM25 {len(bm25_ids)}条 ({ms:.1f}ms)")
+        print(f"   │ 耗时: 改写 {expand_ms:.1f}ms | 合批编码 {len(queries)} 条 {embed_ms:.1f}ms | "
+              f"并发检索 {search_ms:.1f}ms (原问题单路 {single_ms:.1f}ms)")
+        print(f"   │ ⏱ 相对单查询额外耗时 ≈ {added_ms:.1f}ms")
+        print(f"   │ 🎯 融合后 Top-{len(fused_ids)} 中 {only_variants} 条仅由改写问题召回")
+        print(f"   {'='*50}\n")
+
+        return fused_ids
+
+    def _route_to_parents(self, query, query_vector, rows, where, k):
+        """
+        分层检索的第一层：父块层向量 + BM25 路由，返回收窄后的 (rows, where)
+        未开启、子块太少、或与过滤条件的交集不足 k 个时原样返回 (平铺检索)
+        """
+        if self.parent_index is None or self.chunk_store.live_count < HIER_MIN_CHUNKS:
+            return rows, where
+        candidates, codes = self.parent_index.route(query_vector, tokenize(query), HIER_PARENTS)
+        if rows is not None:
+            candidates = np.intersect1d(candidates, rows, assume_unique=True)
+        if len(candidates) < k:
+            return rows, where
+        print(f" -> 分层路由: {len(codes)}/{self.parent_index.parent_count} 个父块，"
+              f"候选子块 {len(candidates)}/{self.chunk_store.live_count} 个")
+        if self.vector_store.name == "chroma":
+            # Chroma 后端不认行号，按父块 id 下推 (没有父块的旧数据不在候选内)
+            parent_clause = {"parent_id": {"$in": [self.chunk_store.parent_keys[c] for c in codes]}}
+            where = parent_clause if where is None else {"$and": [where, parent_clause]}
+        return candidates, where
 
     # ============================================================
     # 意图路由
@@ -216,38 +521,17 @@ class RAGSystem:
         """判断用户意图：SEARCH (检索知识库) 或 CHAT (闲聊)"""
         print(f"🚦 正在进行意图路由分析: {question}")
 
-        # 注入知识库文件名，让模型了解知识库内容
-        indexed_files = self.get_indexed_files()
-        if indexed_files:
-            file_list = ", ".join(sorted(indexed_files))
-            kb_context = f"\nThe knowledge base currently contains: [{file_list}]. "
-        else:
-            kb_context = "\nThe knowledge base is currently empty. "
-
-        system_prompt = (
-            "You are an intent routing AI. Your task is to ONLY output 'SEARCH' or 'CHAT'. Skip thinking process.\n"
-            f"{kb_context}\n"
-            "INSTRUCTIONS:\n"
-            "1. Carefully compare the user's question with the provided filenames to see if they relate.\n"
-            "2. If related to ANY filename, output 'SEARCH'.\n"
-            "3. If question is a greeting, general coding, or unrelated, output 'CHAT'.\n\n"
-            "EXAMPLES:\n"
-            "User: '你好' -> Output: CHAT\n"
-            "User: '帮我写个Python脚本' -> Output: CHAT\n"
-            "User: '根据文档，xxx是什么？' -> Output: SEARCH\n"
-            "Now it's your turn. Output ONLY 'SEARCH' or 'CHAT'."
-        )
+        # 注入知识库文件名，让模型了解知识库内容 (放在 user 消息里，system prompt 保持不变)
+        messages = router_messages(self.get_indexed_files(), question)
 
         try:
             data = {
                 "model": "local-model",
-                "messages": [
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": question}
-                ],
+                "messages": messages,
                 "temperature": 0.0,
                 "max_tokens": 1000,
-                "stream": False
+                "stream": False,
+                **llm_cache_options(LLM_ROUTER_SLOT)
             }
 
             response = requests.post(
@@ -289,7 +573,8 @@ class RAGSystem:
             "model": "local-model",
             "messages": messages,
             "temperature": 0.3,
-            "stream": True
+            "stream": True,
+            **llm_cache_options(LLM_ANSWER_SLOT)
         }
         try:
             response = requests.post(
@@ -305,120 +590,202 @@ class RAGSystem:
             print(f"❌ LLM 调用失败: {e}")
             return None
 
+    def complete(self, messages, timeout=LLM_COMPLETE_TIMEOUT):
+        """
+        非流式调用 LLM，返回完整回答文本 (含 <think> 段，由调用方解析)；批量问答用，失败时抛出异常
+        不指定 KV 缓存槽位：并发的多个请求各自占用空闲槽，不挤在同一个槽上排队
+        """
+        data = {
+            "model": "local-model",
+            "messages": messages,
+            "temperature": 0.3,
+            "stream": False,
+            **llm_cache_options()
+        }
+        response = requests.post(LLM_URL, headers=LLM_HEADERS, json=data, proxies=LLM_PROXIES, timeout=timeout)
+        response.raise_for_status()
+        return response.json()['choices'][0]['message']['content']
+
     # ============================================================
     # 主查询入口
     # ============================================================
 
-    def query(self, question, history=None, mode="flash"):
+    def query(self, question, history=None, mode="flash", filters=None, multi_query=None):
         """
         RAG 主查询入口
         :param question: 用户问题
         :param history: 前端传来的历史对话列表 (list of dict)
         :param mode: 'flash' (极速) 或 'pro' (深度)
+        :param filters: 检索范围过滤 (dict，见 retrieval_filter.py)
+        :param multi_query: 多查询模式 'off' / 'local' / 'llm'，None 表示用实例默认值 (见 query_expansion.py)
         :return: (response 对象, 参考文档列表, 意图)
         """
         if history is None:
             history = []
+        filters = RetrievalFilter.from_dict(filters)
 
-        # 1. 意图路由
-        intent = self.route_query(question)
+        # 1. 意图路由 (显式限定了检索范围时无需路由，直接检索)
+        intent = "SEARCH" if filters is not None else self.route_query(question)
         print(f"👉 路由结果: {intent}")
         print(f"\n🔍 正在检索：{question} | 模式: {mode.upper()}")
 
         # === 分支 A: 闲聊模式 ===
         if intent == "CHAT":
             print("💬 进入闲聊模式，跳过检索...")
-            system_prompt = "你是一个乐于助人的 AI 助手。请直接回答用户的问题。"
-            messages_payload = [{"role": "system", "content": system_prompt}]
-            if history:
-                messages_payload.extend(history[-6:])
-            messages_payload.append({"role": "user", "content": question})
+            messages_payload = answer_messages(CHAT_SYSTEM_PROMPT, self.context_builder.build_history(history), question)
+            self.context_builder.report(messages_payload, baseline=lambda: [
+                messages_payload[0], *history[-LEGACY_HISTORY_MESSAGES:], messages_payload[-1]
+            ])
             response = self._call_llm(messages_payload)
             return response, [], intent
 
         # === 分支 B: 检索模式 ===
         print("🔍 进入检索模式...")
-        final_docs = []
+        final_ids = self.retrieve(question, mode=mode, filters=filters, multi_query=multi_query)
+        if not len(final_ids):
+            print("⚠️ 未找到相关文档。")
+            return None, [], intent
 
+        # 通用逻辑: 构建上下文，调用 LLM
+        messages_payload, final_docs = self.build_answer_messages(question, final_ids, history)
+        response = self._call_llm(messages_payload)
+        return response, final_docs, intent
+
+    # ============================================================
+    # 检索 / Prompt 组装 (单次查询与批量问答共用)
+    # ============================================================
+
+    def retrieve(self, question, mode="flash", filters=None, multi_query=None):
+        """
+        检索阶段 (不含意图路由与 LLM)，返回最终参考子块的 chunk_id 数组
+        Flash: 混合检索 Top-5；Pro: 混合检索 Top-20 → Reranker 精排 → Top-5
+        :param filters: RetrievalFilter 或 None
+        """
         if mode == "pro" and self.reranker:
-            # Pro 模式: 混合检索 Top-20 → Reranker 精排 → Top-5
-            initial_docs = self._hybrid_search(question, k=20)
-
-            if initial_docs:
-                pairs = [[question, doc.page_content] for doc in initial_docs]
-                print(" -> 正在进行 Rerank 重排序...")
-                scores = self.reranker.predict(pairs)
-                scored_docs = sorted(zip(initial_docs, scores), key=lambda x: x[1], reverse=True)
-                top5 = scored_docs[:5]
-                top5_scores = [s for _, s in top5]
-
-                # Reranker 质量指标
-                avg_score = sum(top5_scores) / len(top5_scores) if top5_scores else 0
-                max_score = max(top5_scores) if top5_scores else 0
-                min_score = min(top5_scores) if top5_scores else 0
-
-                print(f"\n   {'='*50}")
-                print(f"   🏆 Reranker 质量报告")
-                print(f"   {'='*50}")
-                print(f"   │ 均分: {avg_score:.4f}  |  最高: {max_score:.4f}  |  最低: {min_score:.4f}")
-                if avg_score > 0.5:
-                    print(f"   │ 🟢 质量优秀，文档与问题高度相关")
-                elif avg_score > 0:
-                    print(f"   │ 🟡 质量中等，部分文档相关")
-                else:
-                    print(f"   │ 🔴 质量较低，知识库可能缺少相关内容")
-                print(f"   │ Top-5 明细:")
-                for doc, score in top5:
-                    print(f"   │   [{score:+.4f}] {doc.page_content[:35]}...")
-                print(f"   {'='*50}\n")
-
-                final_docs = [doc for doc, score in top5]
-            else:
+            initial_ids, texts = self._rerank_candidates(
+                self._hybrid_search_ids(question, k=20, filters=filters, multi_query=multi_query)
+            )
+            if not len(initial_ids):
                 print("⚠️ 混合检索未找到文档。")
+                return initial_ids
+            print(" -> 正在进行 Rerank 重排序...")
+            scores = self.inference.rerank(question, texts)
+            return self._apply_rerank(initial_ids, texts, scores)
+        return self._hybrid_search_ids(question, k=5, filters=filters, multi_query=multi_query)
+
+    def retrieve_many(self, questions, mode="flash", filters=None, multi_query=None):
+        """
+        批量检索 (离线批量问答用)：全部问题的 query 向量一次前向；Pro 模式全部 (问题, 子块) 对合成一个 Rerank 请求
+        :param filters: 与 questions 等长的过滤条件 (dict 或 None) 列表，None 表示都不过滤
+        :return: 与 questions 等长的列表，元素为 (final_ids, 单题检索耗时 ms) 或检索失败时的 Exception
+        """
+        filters = filters or [None] * len(questions)
+        self._embed_queries(questions)  # 写入向量缓存，下面逐题检索时直接命中
+        pro = mode == "pro" and self.reranker
+        results = []
+        for question, spec in zip(questions, filters):
+            start = time.perf_counter()
+            try:
+                ids = self._hybrid_search_ids(question, k=20 if pro else 5, multi_query=multi_query,
+                                              filters=RetrievalFilter.from_dict(spec))
+                results.append((ids, elapsed_ms(start)))
+            except Exception as e:
+                results.append(e)
+        if pro:
+            candidates = {}
+            for i, r in enumerate(results):
+                if not isinstance(r, Exception):
+                    candidates[i] = self._rerank_candidates(r[0])
+                    results[i] = (candidates[i][0], r[1])
+            ready = [i for i, (ids, _) in candidates.items() if len(ids)]
+            print(f" -> 批量 Rerank: {len(ready)} 个问题合并为一次请求...")
+            try:
+                scores = self.inference.rerank_many([(questions[i], candidates[i][1]) for i in ready])
+            except Exception as e:
+                scores = [e] * len(ready)
+            for i, question_scores in zip(ready, scores):
+                if isinstance(question_scores, Exception):
+                    results[i] = question_scores
+                else:
+                    results[i] = (self._apply_rerank(*candidates[i], question_scores), results[i][1])
+        return results
+
+    def _rerank_candidates(self, chunk_ids):
+        """
+        精排候选: 去掉已不在子块仓库中的 chunk_id (检索之后该文件恰好被增量删除 / 重新入库)，
+        返回 (chunk_ids, 对应的子块文本)，不会把别的子块的文本交给 Reranker
+        """
+        rows = self.chunk_store.rows_for(chunk_ids)
+        found = rows >= 0
+        return np.asarray(chunk_ids, dtype=np.int64)[found], [self.chunk_store.texts[r] for r in rows[found]]
+
+    def _apply_rerank(self, initial_ids, texts, scores, top_k=5):
+        """按 Reranker 分数取 Top-K 并打印质量报告 (texts 与 initial_ids 一一对应)"""
+        scores = np.asarray(scores, dtype=np.float64)
+        order = np.argsort(-scores, kind="stable")[:top_k]
+        top5_scores = scores[order]
+
+        # Reranker 质量指标
+        avg_score = float(top5_scores.mean())
+        max_score = float(top5_scores.max())
+        min_score = float(top5_scores.min())
+
+        print(f"\n   {'='*50}")
+        print(f"   🏆 Reranker 质量报告")
+        print(f"   {'='*50}")
+        print(f"   │ 均分: {avg_score:.4f}  |  最高: {max_score:.4f}  |  最低: {min_score:.4f}")
+        if avg_score > 0.5:
+            print(f"   │ 🟢 质量优秀，文档与问题高度相关")
+        elif avg_score > 0:
+            print(f"   │ 🟡 质量中等，部分文档相关")
         else:
-            # Flash 模式: 混合检索 Top-5
-            final_docs = self._hybrid_search(question, k=5)
+            print(f"   │ 🔴 质量较低，知识库可能缺少相关内容")
+        print(f"   │ Top-5 明细:")
+        for idx in order:
+            print(f"   │   [{scores[idx]:+.4f}] {texts[idx][:35]}...")
+        print(f"   {'='*50}\n")
 
-        # 通用逻辑: 构建上下文
-        if not final_docs:
-            print("⚠️ 未找到相关文档。")
-            return None, [], intent
+        return initial_ids[order]
 
+    def build_answer_messages(self, question, final_ids, history=None):
+        """
+        由参考子块组装回答消息 (父块还原 + 去重 + 按 token 预算填充 + 历史)
+        :return: (messages_payload, 参考文档列表)，参考文档只含实际注入 Prompt 的片段 (父块重复 / 超出预算的不算)
+        """
+        history = history or []
         print("\n📚 最终参考资料 (Parent-Child 还原)：")
-        context_text = ""
-        used_parents = set()
-
-        for i, doc in enumerate(final_docs):
-            # 通过 parent_id 还原父文档内容，兼容旧数据
-            parent_id = doc.metadata.get("parent_id", "")
-            if parent_id and parent_id in self.parent_map:
-                content = self.parent_map[parent_id]
-            else:
-                content = doc.metadata.get("parent_content", doc.page_content)
-
-            # 去重: 用内容指纹避免重复父文档
-            fingerprint = f"{len(content)}_{content[:50]}"
-            if fingerprint in used_parents:
-                print(f"   [跳过] 子块 {i+1} 指向已存在的父块...")
-                continue
-            used_parents.add(fingerprint)
-
-            source = os.path.basename(doc.metadata.get("source", "unknown"))
-            preview = content[:50].replace('\n', '')
-            print(f"[{len(used_parents)}] 来源: {source} | 预览: {preview}...")
-            context_text += f"片段{len(used_parents)}: {content}\n\n"
-
-        # 构建 Prompt 与历史注入
-        system_prompt = "你是一个专业助手。请根据【参考资料】回答问题。如果不知道就说不知道。"
-        messages_payload = [{"role": "system", "content": system_prompt}]
-
-        if history:
-            messages_payload.extend(history[-6:])
-            print(f" -> 已注入历史记忆: {len(history[-6:])} 条消息")
-
-        current_user_prompt = f"【参考资料】:\n{context_text}\n\n【问题】:\n{question}"
-        messages_payload.append({"role": "user", "content": current_user_prompt})
-
-        # 调用 LLM
-        response = self._call_llm(messages_payload)
-        return response, final_docs, intent
\ No newline at end of file
+
+        # 父块去重: 按整数父块编码保序去重，多个子块命中同一父块时只保留排名最高的
+        rows = self.chunk_store.rows_for(final_ids)
+        rows = rows[rows >= 0]  # 检索之后该文件恰好被重新入库时，旧子块已不存在
+        keep = first_unique(self.chunk_store.parent_group_keys(rows))
+        if not keep.all():
+            print(f"   [跳过] {int((~keep).sum())} 个子块指向已存在的父块...")
+
+        # 按 token 预算组装参考资料：父块裁剪到命中子块附近的句子，按相关度依次填入
+        kept_rows = rows[keep]
+        passages = [(self.chunk_store.parent_content(row), self.chunk_store.texts[row]) for row in kept_rows]
+        context_text, used = self.context_builder.build_context(passages)
+        for i, row in enumerate(kept_rows[:used]):
+            source = os.path.basename(self.chunk_store.metadatas[row].get("source", "unknown"))
+            preview = passages[i][0][:50].replace('\n', '')
+            print(f"[{i+1}] 来源: {source} | 预览: {preview}...")
+        if used < len(passages):
+            print(f"   [预算] {len(passages) - used} 个片段超出上下文预算，未注入")
+        final_docs = self.chunk_store.documents(self.chunk_store.chunk_ids[kept_rows[:used]])
+
+        # 构建 Prompt: 固定 system → 历史 (按预算截取，早期轮次压缩为摘要) → 本轮参考资料 + 问题
+        history_messages = self.context_builder.build_history(history)
+        if history_messages:
+            print(f" -> 已注入历史记忆: {len(history_messages)} 条消息")
+        messages_payload = answer_messages(ANSWER_SYSTEM_PROMPT, history_messages, question, context_text)
+
+        # 对比基线: 整段父块 + 最近 6 条历史 (改造前的拼接方式)，只在开启对比时拼接并计数
+        def baseline_payload():
+            legacy_context = "".join(f"片段{i+1}: {parent}\n\n" for i, (parent, _) in enumerate(passages))
+            return [
+                messages_payload[0], *history[-LEGACY_HISTORY_MESSAGES:],
+                {"role": "user", "content": f"【参考资料】:\n{legacy_context}\n\n【问题】:\n{question}"},
+            ]
+        self.context_builder.report(messages_payload, baseline=baseline_payload)
+        return messages_payload, final_docs
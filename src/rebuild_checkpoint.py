@@ -0,0 +1,137 @@
+"""
+全量重建断点 (rebuild_checkpoint.py)
+功能: 全量重建分批提交并记录进度，进程崩溃 / 被杀后再次重建从断点继续，不再从零开始
+  - 新索引写入同一个 Chroma 库中的临时集合，父块写入 db_dir/rebuild/parent_map.log，旧索引在重建期间照常服务
+  - db_dir/rebuild/checkpoint.json: 文档清单 + 进度 (第几个文件、该文件已切出几个子块) + 入库时间 + 统计
+    每批子块写入 Chroma、父块追加到日志之后才原子更新，断点之前的内容都已持久化
+  - 文档清单 (相对路径 / 大小 / 修改时间) 或切分配置与断点记录不一致时丢弃断点，从头重建
+  - 全部写完标记 complete，再切换为正式索引；切换开始前先标记 swapping，切换途中中断时
+    下次加载或重建都会先把切换做完 (见 ingest.finish_interrupted_swap)，不会出现没有正式集合的状态
+"""
+
+import os
+import json
+import time
+import shutil
+
+REBUILD_DIR_NAME = "rebuild"
+CHECKPOINT_FILE = "checkpoint.json"
+CHECKPOINT_VERSION = 1
+
+STATUS_RUNNING = "running"
+STATUS_COMPLETE = "complete"
+STATUS_SWAPPING = "swapping"  # 派生索引写出 + 集合改名进行中
+
+
+def staging_dir(db_dir):
+    return os.path.join(db_dir, REBUILD_DIR_NAME)
+
+
+def doc_manifest(docs_dir, files):
+    """文档清单: 相对路径 → [大小, 修改时间 (ns)]"""
+    manifest = {}
+    for rel in files:
+        st = os.stat(os.path.join(docs_dir, rel))
+        manifest[rel] = [st.st_size, st.st_mtime_ns]
+    return manifest
+
+
+def has_interrupted_rebuild(db_dir):
+    return os.path.exists(os.path.join(staging_dir(db_dir), CHECKPOINT_FILE))
+
+
+def has_interrupted_swap(db_dir):
+    """上次重建是否停在切换为正式索引的途中"""
+    checkpoint = RebuildCheckpoint.load(db_dir) if has_interrupted_rebuild(db_dir) else None
+    return checkpoint is not None and checkpoint.swapping
+
+
+class RebuildCheckpoint:
+    def __init__(self, db_dir, state):
+        self.dir = staging_dir(db_dir)
+        self.path = os.path.join(self.dir, CHECKPOINT_FILE)
+        self.state = state
+
+    @classmethod
+    def load(cls, db_dir):
+        """读取上次中断的重建进度，没有 (或无法识别) 时返回 None"""
+        path = os.path.join(staging_dir(db_dir), CHECKPOINT_FILE)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠️ 重建断点无法读取，将从头重建: {e}")
+            return None
+        if state.get("version") != CHECKPOINT_VERSION:
+            return None
+        return cls(db_dir, state)
+
+    @classmethod
+    def start(cls, db_dir, manifest, ingested_at, chunking=None):
+        """开始一次新的重建 (清掉旧的断点目录)"""
+        shutil.rmtree(staging_dir(db_dir), ignore_errors=True)
+        os.makedirs(staging_dir(db_dir))
+        checkpoint = cls(db_dir, {
+            "version": CHECKPOINT_VERSION,
+            "status": STATUS_RUNNING,
+            "manifest": manifest,
+            "files": sorted(manifest),
+            "ingested_at": ingested_at,
+            "chunking": chunking,  # 切分配置签名，配置变化后子块序号对不上
+            "file_index": 0,       # 正在处理的文件下标
+            "children_done": 0,    # 该文件已切出并处理完的子块数
+            "chunks": 0,           # 累计切出的子块
+            "written": 0,          # 累计写入 Chroma 的子块 (去重后)
+            "duplicates": 0,
+            "batches": 0,
+            "started_at": time.time(),
+            "updated_at": time.time(),
+        })
+        checkpoint.save()
+        return checkpoint
+
+    def matches(self, manifest, chunking=None):
+        return self.state["manifest"] == manifest and self.state.get("chunking") == chunking
+
+    @property
+    def resumed(self):
+        return self.state["batches"] > 0
+
+    @property
+    def complete(self):
+        return self.state["status"] in (STATUS_COMPLETE, STATUS_SWAPPING)
+
+    @property
+    def swapping(self):
+        return self.state["status"] == STATUS_SWAPPING
+
+    def advance(self, position, chunks, written, duplicates):
+        """一批已持久写入：记录断点位置与累计统计"""
+        self.state["file_index"], self.state["children_done"] = position
+        self.state["chunks"] += chunks
+        self.state["written"] += written
+        self.state["duplicates"] = duplicates
+        self.state["batches"] += 1
+        self.save()
+
+    def mark_complete(self):
+        self.state["status"] = STATUS_COMPLETE
+        self.save()
+
+    def mark_swapping(self):
+        self.state["status"] = STATUS_SWAPPING
+        self.save()
+
+    def save(self):
+        self.state["updated_at"] = time.time()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def discard(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
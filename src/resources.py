@@ -0,0 +1,176 @@
+"""
+共享资源管理 (resources.py)
+功能: 进程内只加载一次的重资源，检索 (RAGSystem) 与入库 (ingest) 共用
+  - Embedding 模型 / Reranker: 首次使用时加载，之后一直复用 (重建、重置、重新加载知识库都不再重复加载 MiniLM)
+  - Chroma: 每个索引目录一个客户端，集合句柄按 (目录, 集合名) 缓存；删除 / 改名集合统一经过这里，
+    同时丢弃缓存的旧句柄，不会有两个句柄各自持有同一个库 (Windows 下重建 / 重置的文件锁冲突即由此而来)
+  - release(db_dir) 丢弃某个索引目录的全部句柄；close() 在进程退出时释放全部客户端
+用法: 默认使用进程级单例 shared_resources()；测试或多实例场景可以自行构造 ResourceManager 传入
+"""
+
+import os
+import threading
+
+import chromadb
+from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_chroma import Chroma
+from sentence_transformers import CrossEncoder
+
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+RERANK_MODEL_PATH = os.path.join(CURRENT_DIR, "../model_cache/bge-reranker-base")
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+COLLECTION_NAME = "langchain"  # RAGSystem 读取的集合 (langchain_chroma 的默认集合名)
+
+
+def load_embedding_model():
+    """加载向量 Embedding 模型 (检索与入库必须用同一个)"""
+    # 使用 sentence-transformers 的经典模型 'all-MiniLM-L6-v2'，约 80MB，速度快
+    return HuggingFaceEmbeddings(
+        model_name=EMBEDDING_MODEL_NAME,
+        model_kwargs={"device": "cpu"}  # 强制用 CPU，避免和 LM Studio 抢显存
+    )
+
+
+def load_reranker():
+    """加载 Reranker 精排模型 (可选, 加载失败返回 None 自动降级)"""
+    print(f" -> 正在加载 Rerank 模型 ({RERANK_MODEL_PATH})...")
+    try:
+        reranker = CrossEncoder(RERANK_MODEL_PATH, device="cpu")
+        print(" -> Rerank 模型加载成功！")
+        return reranker
+    except Exception as e:
+        print(f"❌ Rerank 模型加载失败: {e}")
+        print("   (将自动降级为仅使用向量检索)")
+        return None
+
+
+class ResourceManager:
+    """Embedding 模型、Reranker 与 Chroma 客户端 / 集合句柄的唯一持有者"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._embedding_model = None
+        self._reranker = None
+        self._reranker_loaded = False
+        self._clients = {}   # 索引目录 (绝对路径) → Chroma 客户端
+        self._stores = {}    # (索引目录, 集合名) → langchain Chroma
+        self._stats = {"embedding_loads": 0, "reranker_loads": 0, "client_opens": 0, "collection_opens": 0}
+
+    # ------------------------------------------------------------
+    # 模型
+    # ------------------------------------------------------------
+
+    def embedding_model(self):
+        with self._lock:
+            if self._embedding_model is None:
+                print(" -> 正在加载 Embedding 模型 (进程内只加载一次)...")
+                self._embedding_model = load_embedding_model()
+                self._stats["embedding_loads"] += 1
+            return self._embedding_model
+
+    def reranker(self):
+        """Reranker 只尝试加载一次，失败时一直返回 None (降级为不精排)"""
+        with self._lock:
+            if not self._reranker_loaded:
+                self._reranker = load_reranker()
+                self._reranker_loaded = True
+                self._stats["reranker_loads"] += 1
+            return self._reranker
+
+    # ------------------------------------------------------------
+    # Chroma 客户端与集合
+    # ------------------------------------------------------------
+
+    @staticmethod
+    def _key(db_dir):
+        return os.path.abspath(db_dir)
+
+    def client(self, db_dir):
+        key = self._key(db_dir)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._clients[key] = chromadb.PersistentClient(path=key)
+                self._stats["client_opens"] += 1
+            return client
+
+    def vector_db(self, db_dir, collection_name=COLLECTION_NAME):
+        """
+        (目录, 集合名) 对应的 langchain Chroma，不存在时创建集合
+        embedding_function 取已加载的共享模型 (只挂上，不因此触发加载；读写都显式传入向量)
+        """
+        key = (self._key(db_dir), collection_name)
+        with self._lock:
+            store = self._stores.get(key)
+            if store is None:
+                store = self._stores[key] = Chroma(
+                    client=self.client(db_dir), collection_name=collection_name,
+                    embedding_function=self._embedding_model
+                )
+                self._stats["collection_opens"] += 1
+            return store
+
+    def collection(self, db_dir, collection_name=COLLECTION_NAME):
+        return self.vector_db(db_dir, collection_name)._collection
+
+    def collection_names(self, db_dir):
+        return {getattr(c, "name", c) for c in self.client(db_dir).list_collections()}
+
+    def delete_collection(self, db_dir, collection_name):
+        """删除集合并丢弃它的句柄，集合不存在时返回 False"""
+        with self._lock:
+            self.forget(db_dir, collection_name)
+            if collection_name not in self.collection_names(db_dir):
+                return False
+            self.client(db_dir).delete_collection(collection_name)
+            return True
+
+    def rename_collection(self, db_dir, old_name, new_name):
+        """集合改名 (新名字的集合需已不存在)，两个名字下缓存的句柄都作废"""
+        with self._lock:
+            collection = self.collection(db_dir, old_name)
+            self.forget(db_dir, old_name, new_name)
+            collection.modify(name=new_name)
+
+    def forget(self, db_dir, *collection_names):
+        """丢弃缓存的集合句柄 (不传集合名时丢弃该目录的全部句柄)，下次使用时重新打开"""
+        key = self._key(db_dir)
+        with self._lock:
+            for store_key in list(self._stores):
+                if store_key[0] == key and (not collection_names or store_key[1] in collection_names):
+                    del self._stores[store_key]
+
+    def release(self, db_dir):
+        """丢弃某个索引目录的客户端与全部集合句柄 (知识库删除 / 不再使用时)"""
+        with self._lock:
+            self.forget(db_dir)
+            self._clients.pop(self._key(db_dir), None)
+
+    def close(self):
+        """进程退出时调用：丢弃全部句柄并停止 Chroma 的后台组件，释放索引文件"""
+        with self._lock:
+            self._stores.clear()
+            self._clients.clear()
+            chromadb.api.client.SharedSystemClient.clear_system_cache()
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["clients"] = len(self._clients)
+            s["collections"] = len(self._stores)
+            s["embedding_loaded"] = self._embedding_model is not None
+            s["reranker_loaded"] = self._reranker is not None
+            return s
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_resources():
+    """进程级共享的 ResourceManager (首次调用时创建，模型仍按需加载)"""
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = ResourceManager()
+        return _shared
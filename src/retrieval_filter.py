@@ -0,0 +1,122 @@
+"""
+检索过滤 (retrieval_filter.py)
+功能: 按来源文件 / 页码范围 / 入库时间限定检索范围，并把过滤条件下推到两路检索
+  - 向量检索: 转为 Chroma where 子句 (matrix 类后端则转为允许的行号)
+  - BM25:     由 chunk_store 预计算的按来源行号表合成行掩码，只对掩码内文档打分
+请求格式 (dict, 所有字段可选):
+  {"sources": ["a.pdf", "b.md"], "page_min": 1, "page_max": 10,
+   "ingested_after": "2026-01-01", "ingested_before": 1767225600}
+页码与前端展示一致，从 1 开始；时间可以是 ISO 日期字符串或 Unix 时间戳。
+"""
+
+import os
+from datetime import datetime
+
+import numpy as np
+
+
+def _to_timestamp(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    return datetime.fromisoformat(str(value)).timestamp()
+
+
+class RetrievalFilter:
+    def __init__(self, sources=None, page_min=None, page_max=None, ingested_after=None, ingested_before=None):
+        if sources is not None and not isinstance(sources, (list, tuple)):
+            raise ValueError("sources 应为文件名列表")
+        self.sources = [os.path.basename(s) for s in sources] if sources else None
+        self.page_min = int(page_min) if page_min is not None else None
+        self.page_max = int(page_max) if page_max is not None else None
+        self.ingested_after = _to_timestamp(ingested_after)
+        self.ingested_before = _to_timestamp(ingested_before)
+
+    @classmethod
+    def from_dict(cls, data):
+        """从请求 dict 构造，空 dict / None 返回 None (表示不过滤)"""
+        if not data:
+            return None
+        if isinstance(data, cls):
+            return data
+        flt = cls(
+            sources=data.get("sources"),
+            page_min=data.get("page_min"),
+            page_max=data.get("page_max"),
+            ingested_after=data.get("ingested_after"),
+            ingested_before=data.get("ingested_before"),
+        )
+        return None if flt.is_empty() else flt
+
+    def is_empty(self):
+        return (self.sources is None and self.page_min is None and self.page_max is None
+                and self.ingested_after is None and self.ingested_before is None)
+
+    def cache_key(self):
+        """可哈希的规范化表示 (用于缓存键)"""
+        return (tuple(sorted(self.sources)) if self.sources else None,
+                self.page_min, self.page_max, self.ingested_after, self.ingested_before)
+
+    # ------------------------------------------------------------
+    # 下推: Chroma where 子句
+    # ------------------------------------------------------------
+
+    def to_chroma_where(self, chunk_store):
+        """
+        生成 Chroma where 子句
+        source 在 metadata 中是完整路径，借助 chunk_store 把文件名展开为实际存储的路径；
+        合并了这些文件重复内容的其它文件的子块按 chunk_id 一并纳入 (与 allowed_rows 的范围一致)
+        """
+        clauses = []
+        if self.sources is not None:
+            paths = chunk_store.source_paths(self.sources)
+            clause = {"source": {"$in": paths or ["__none__"]}}
+            merged = chunk_store.merged_chunk_ids(self.sources)
+            if merged:
+                clause = {"$or": [clause, {"chunk_id": {"$in": merged}}]}
+            clauses.append(clause)
+        # metadata 中的 page 从 0 开始
+        if self.page_min is not None:
+            clauses.append({"page": {"$gte": self.page_min - 1}})
+        if self.page_max is not None:
+            clauses.append({"page": {"$lte": self.page_max - 1}})
+        if self.ingested_after is not None:
+            clauses.append({"ingested_at": {"$gte": self.ingested_after}})
+        if self.ingested_before is not None:
+            clauses.append({"ingested_at": {"$lte": self.ingested_before}})
+
+        if not clauses:
+            return None
+        return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+    # ------------------------------------------------------------
+    # 下推: 行号掩码 (BM25 / matrix 类后端)
+    # ------------------------------------------------------------
+
+    def allowed_rows(self, chunk_store):
+        """返回允许检索的 chunk_store 行号数组 (升序)"""
+        if self.sources is not None:
+            rows = chunk_store.rows_for_sources(self.sources)
+        else:
+            rows = chunk_store.live_rows()
+
+        if self.page_min is not None or self.page_max is not None:
+            pages = chunk_store.pages[rows]
+            keep = pages >= 0
+            if self.page_min is not None:
+                keep &= pages >= self.page_min - 1
+            if self.page_max is not None:
+                keep &= pages <= self.page_max - 1
+            rows = rows[keep]
+
+        if self.ingested_after is not None or self.ingested_before is not None:
+            ts = chunk_store.ingested_at[rows]
+            keep = ~np.isnan(ts)
+            if self.ingested_after is not None:
+                keep &= ts >= self.ingested_after
+            if self.ingested_before is not None:
+                keep &= ts <= self.ingested_before
+            rows = rows[keep]
+
+        return rows
@@ -0,0 +1,221 @@
+"""
+流式输出协议 (stream_parser.py)
+功能: /api/chat 流式回答的解析与分帧
+  - ThinkParser: 增量状态机区分 <think> 思考内容与正文，每个 token 只检查新到的文本 (旧做法每个 token 重扫整段 buffer，O(n²))
+  - FrameCoalescer: 把逐 token 的片段按时间 / 字数合并成帧，同类连续片段合成一帧，减少 json.dumps 与事件循环切换
+  - encode_frame: 三种分帧格式 ndjson (默认) / sse / binary
+帧类型: intent / sources / thought / content / reclassify / error
+  reclassify: 模型省略了开头的 <think>，直到 </think> 出现才知道前面的“正文”其实是思考，客户端应把已收到的正文移入思考
+"""
+
+import os
+import json
+import time
+import struct
+
+STREAM_FLUSH_MS = float(os.environ.get("RAG_STREAM_FLUSH_MS", "50"))      # 一帧最多攒多久
+STREAM_FLUSH_CHARS = int(os.environ.get("RAG_STREAM_FLUSH_CHARS", "256"))  # 一帧最多攒多少字
+
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+
+# 解析器状态
+_START = 0    # 还没有非空白输出，可能以 <think> 开头
+_THINK = 1    # 在 <think> 内
+_ANSWER = 2   # 正文
+
+THOUGHT = "thought"
+CONTENT = "content"
+RECLASSIFY = "reclassify"
+
+
+def _partial_suffix(text, tag):
+    """text 末尾可能是 tag 前缀的最长长度 (需要暂存，等下一段到达再判断)"""
+    for n in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:n]):
+            return n
+    return 0
+
+
+class ThinkParser:
+    """
+    增量解析 <think>...</think>
+    feed(text) 返回 [(kind, text), ...]，kind 为 thought / content / reclassify
+    每次只处理新到的文本加上上次暂存的不完整标签，全程 O(n)
+    """
+
+    def __init__(self):
+        self.state = _START
+        self._pending = ""       # 可能是不完整标签的尾部
+        self._saw_open = False
+        self.thought_parts = []
+        self.content_parts = []
+
+    @property
+    def thought(self):
+        return "".join(self.thought_parts)
+
+    @property
+    def content(self):
+        return "".join(self.content_parts).strip()
+
+    def feed(self, text):
+        out = []
+        text = self._pending + text
+        self._pending = ""
+
+        while text:
+            if self.state == _START:
+                stripped = text.lstrip()
+                if not stripped:
+                    self._pending = text
+                    break
+                if stripped.startswith(THINK_OPEN):
+                    self.state, self._saw_open = _THINK, True
+                    text = stripped[len(THINK_OPEN):]
+                    continue
+                if THINK_OPEN.startswith(stripped):
+                    self._pending = text
+                    break
+                self.state = _ANSWER
+                continue
+
+            if self.state == _THINK:
+                idx = text.find(THINK_CLOSE)
+                if idx >= 0:
+                    self._emit(out, THOUGHT, text[:idx])
+                    self.state = _ANSWER
+                    text = text[idx + len(THINK_CLOSE):]
+                    continue
+                keep = _partial_suffix(text, THINK_CLOSE)
+                self._emit(out, THOUGHT, text[:len(text) - keep])
+                self._pending = text[len(text) - keep:]
+                break
+
+            # _ANSWER: 只有省略了开头 <think> 的模型才会在正文中出现 </think>
+            if not self._saw_open:
+                idx = text.find(THINK_CLOSE)
+                if idx >= 0:
+                    self._emit(out, CONTENT, text[:idx])
+                    self._reclassify(out)
+                    text = text[idx + len(THINK_CLOSE):]
+                    continue
+                keep = _partial_suffix(text, THINK_CLOSE)
+                self._emit(out, CONTENT, text[:len(text) - keep])
+                self._pending = text[len(text) - keep:]
+                break
+            self._emit(out, CONTENT, text)
+            break
+        return out
+
+    def flush(self):
+        """流结束：暂存的尾部按当前状态输出"""
+        out = []
+        if self._pending:
+            pending, self._pending = self._pending, ""
+            self._emit(out, THOUGHT if self.state == _THINK else CONTENT, pending)
+        return out
+
+    def _emit(self, out, kind, text):
+        if not text:
+            return
+        (self.thought_parts if kind == THOUGHT else self.content_parts).append(text)
+        out.append((kind, text))
+
+    def _reclassify(self, out):
+        self.thought_parts += self.content_parts
+        self.content_parts = []
+        self._saw_open = True
+        out.append((RECLASSIFY, ""))
+
+
+class FrameCoalescer:
+    """把片段合并成帧：类型变化、攒够 max_chars 或距首个未发片段超过 flush_ms 时出帧"""
+
+    def __init__(self, flush_ms=STREAM_FLUSH_MS, max_chars=STREAM_FLUSH_CHARS):
+        self.flush_interval = flush_ms / 1000
+        self.max_chars = max_chars
+        self._kind = None
+        self._parts = []
+        self._size = 0
+        self._since = 0.0
+
+    @property
+    def deadline(self):
+        """下一次按时间出帧的时刻 (没有待发片段时为 None)"""
+        return self._since + self.flush_interval if self._parts else None
+
+    def add(self, kind, text, now=None):
+        """加入一个片段，返回需要立即发送的帧列表 [(kind, text), ...]"""
+        now = time.monotonic() if now is None else now
+        frames = []
+        if self._parts and kind != self._kind:
+            frames += self.flush()
+        if kind == RECLASSIFY:
+            return frames + [(RECLASSIFY, "")]
+        if not self._parts:
+            self._kind, self._since = kind, now
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= self.max_chars or now - self._since >= self.flush_interval:
+            frames += self.flush()
+        return frames
+
+    def flush(self):
+        if not self._parts:
+            return []
+        frame = (self._kind, "".join(self._parts))
+        self._kind, self._parts, self._size = None, [], 0
+        return [frame]
+
+
+# ============================================================
+# LLM 原始流解析
+# ============================================================
+
+def parse_llm_line(line):
+    """
+    解析 OpenAI 兼容接口的一行 SSE
+    :return: 增量文本 (可能为空串)；流结束返回 None
+    """
+    if isinstance(line, bytes):
+        line = line.decode("utf-8")
+    if not line.startswith("data: "):
+        return ""
+    payload = line[6:]
+    if payload.strip() == "[DONE]":
+        return None
+    try:
+        return json.loads(payload)["choices"][0]["delta"].get("content", "") or ""
+    except (ValueError, KeyError, IndexError):
+        return ""
+
+
+# ============================================================
+# 分帧格式
+# ============================================================
+STREAM_FORMATS = ("ndjson", "sse", "binary")
+MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "sse": "text/event-stream",
+    "binary": "application/octet-stream",
+}
+# binary 帧: 1 字节类型 + 4 字节大端长度 + UTF-8 载荷 (thought / content / error 为原文，其余为 JSON)
+FRAME_CODES = {"intent": 1, "sources": 2, THOUGHT: 3, CONTENT: 4, RECLASSIFY: 5, "error": 6}
+_RAW_TEXT_FRAMES = (THOUGHT, CONTENT, "error")
+
+
+def encode_frame(fmt, kind, data):
+    """按分帧格式编码一帧，返回 str (ndjson / sse) 或 bytes (binary)"""
+    if fmt == "binary":
+        payload = (data if kind in _RAW_TEXT_FRAMES else json.dumps(data, ensure_ascii=False)).encode("utf-8")
+        return struct.pack(">BI", FRAME_CODES[kind], len(payload)) + payload
+    if fmt == "sse":
+        return f"event: {kind}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+    return json.dumps({"type": kind, "data": data}, ensure_ascii=False) + "\n"
+
+
+def encode_frame_batch(fmt, frames):
+    """同一次产出的多帧拼成一次写出"""
+    encoded = [encode_frame(fmt, kind, data) for kind, data in frames]
+    return b"".join(encoded) if fmt == "binary" else "".join(encoded)
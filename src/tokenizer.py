@@ -0,0 +1,227 @@
+"""
+分词层 (tokenizer.py)
+功能: BM25 路径 (以及聊天记录全文检索) 统一使用的 jieba 分词
+  - jieba 词典缓存固定放在 model_cache/ 下，冷启动不必每次重建前缀词典
+  - 支持领域用户词典 (data/user_dict.txt) 与停用词表 (data/stopwords.txt)
+  - 子块分词结果按内容哈希持久化 (token_cache.json)，重启/重建时命中缓存直接复用
+  - jieba 在首次分词时才初始化 (导入本模块不加载词典)
+  - 大批量文本用共享进程池并行分词：首次需要时才创建 (spawn 方式，不 fork 服务进程)，用完由调用方 close_tokenize_pool() 释放
+"""
+
+import os
+import json
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import jieba
+
+# ============================================================
+# 路径与配置
+# ============================================================
+CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
+JIEBA_CACHE_DIR = os.path.join(CURRENT_DIR, "../model_cache")
+USER_DICT_PATH = os.path.join(CURRENT_DIR, "../data/user_dict.txt")
+STOPWORDS_PATH = os.path.join(CURRENT_DIR, "../data/stopwords.txt")
+TOKEN_CACHE_FILE = "token_cache.json"
+
+PARALLEL_THRESHOLD = 2000                               # 超过这么多条未命中缓存的文本才启用进程池
+TOKENIZE_WORKERS = int(os.environ.get("RAG_TOKENIZE_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+
+# 内置停用词：常见虚词/助词/标点 + 英文高频词，可由 data/stopwords.txt 追加
+DEFAULT_STOPWORDS = set("""
+的 了 是 在 和 与 及 或 也 就 都 而 且 但 并 很 把 被 让 给 对 从 向 于 之 其 这 那 这个 那个 这些 那些
+吗 呢 吧 啊 呀 嘛 哦 么 着 过 得 地 个 一个 有 没有 什么 怎么 如何 哪些 为什么 请问 我 你 他 她 它 我们 你们 他们
+a an the of to in on at for and or is are was were be been it this that with as by from what how why
+""".split()) | set("，。！？、；：“”‘’（）()《》【】[]{}<>—…·,.!?;:'\"-_/\\|~`@#$%^&*+= \t\n")
+
+
+# ============================================================
+# jieba 初始化
+# ============================================================
+
+_jieba_ready = False
+_jieba_lock = threading.Lock()
+
+
+def init_jieba():
+    """配置 jieba 词典缓存目录并加载用户词典 (每个进程只执行一次，首次分词时自动调用；也是分词子进程的 initializer)"""
+    global _jieba_ready
+    if _jieba_ready:
+        return
+    with _jieba_lock:
+        if _jieba_ready:
+            return
+        os.makedirs(JIEBA_CACHE_DIR, exist_ok=True)
+        jieba.dt.tmp_dir = JIEBA_CACHE_DIR
+        jieba.dt.cache_file = "jieba.cache"
+        jieba.initialize()
+        if os.path.exists(USER_DICT_PATH):
+            jieba.load_userdict(USER_DICT_PATH)
+        _jieba_ready = True
+
+
+def _load_stopwords():
+    stopwords = set(DEFAULT_STOPWORDS)
+    if os.path.exists(STOPWORDS_PATH):
+        with open(STOPWORDS_PATH, "r", encoding="utf-8") as f:
+            stopwords.update(line.strip() for line in f if line.strip())
+    return stopwords
+
+
+def _file_digest(path):
+    if not os.path.exists(path):
+        return ""
+    with open(path, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()[:8]
+
+
+STOPWORDS = _load_stopwords()
+# 词典/停用词变化后，旧的分词缓存全部作废
+TOKENIZER_VERSION = f"v1-{_file_digest(USER_DICT_PATH)}-{_file_digest(STOPWORDS_PATH)}"
+
+
+# ============================================================
+# 分词
+# ============================================================
+
+def tokenize(text):
+    """分词 + 停用词过滤 (英文统一小写)"""
+    init_jieba()
+    return [t.lower() for t in jieba.cut(text) if t.strip() and t.lower() not in STOPWORDS]
+
+
+def tokenize_for_search(text):
+    """索引用的细粒度分词 (长词额外切出其中的短词，查询短词也能命中)，用于聊天记录全文检索"""
+    init_jieba()
+    return [t.lower() for t in jieba.cut_for_search(text) if t.strip() and t.lower() not in STOPWORDS]
+
+
+def _tokenize_batch(texts):
+    return [tokenize(t) for t in texts]
+
+
+_pool = None
+_pool_users = 0  # 正在使用进程池的分词调用数 (使用中不关闭)
+_pool_lock = threading.Lock()
+
+
+def _acquire_pool(workers):
+    """
+    取共享分词进程池 (首次调用时创建)：spawn 方式启动，不 fork 多线程的服务进程，子进程由 initializer 各自加载一次 jieba 词典
+    注意: spawn 的子进程会重新导入入口脚本，入口脚本顶层不能建库 / 加载模型 (server.py 在 startup 中初始化)
+    """
+    global _pool, _pool_users
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                        initializer=init_jieba)
+        _pool_users += 1
+        return _pool
+
+
+def _release_pool():
+    global _pool_users
+    with _pool_lock:
+        _pool_users -= 1
+
+
+def close_tokenize_pool():
+    """关闭分词进程池，释放空闲子进程占用的内存 (加载 / 重建结束、进程退出时调用)；其它调用仍在使用时不关闭"""
+    global _pool
+    with _pool_lock:
+        if _pool_users:
+            return
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _discard_broken(pool):
+    """进程池可能已损坏 (子进程异常退出)：不再复用，下次重新创建"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def tokenize_many(texts, workers=TOKENIZE_WORKERS):
+    """批量分词，文本量大时用共享进程池并行"""
+    texts = list(texts)
+    if workers <= 1 or len(texts) < PARALLEL_THRESHOLD:
+        return _tokenize_batch(texts)
+
+    batch_size = max(256, len(texts) // (workers * 4))
+    batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+    results = []
+    pool = _acquire_pool(workers)
+    try:
+        for tokens in pool.map(_tokenize_batch, batches):
+            results.extend(tokens)
+    except Exception as e:
+        print(f"⚠️ 并行分词失败，回退为单进程: {e}")
+        _discard_broken(pool)
+        return _tokenize_batch(texts)
+    finally:
+        _release_pool()
+    return results
+
+
+def text_hash(text):
+    return hashlib.md5(text.encode("utf-8")).hexdigest()[:16]
+
+
+class TokenCache:
+    """按子块内容哈希持久化的分词缓存"""
+
+    def __init__(self, db_dir):
+        self.path = os.path.join(db_dir, TOKEN_CACHE_FILE)
+        self.tokens = {}
+        self.dirty = False
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("version") == TOKENIZER_VERSION:
+                    self.tokens = data.get("tokens", {})
+            except Exception as e:
+                print(f"⚠️ 加载分词缓存失败: {e}")
+
+    def tokenize_corpus(self, texts):
+        """返回与 texts 等长的分词结果，只对未命中缓存的文本分词"""
+        keys = [text_hash(t) for t in texts]
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in self.tokens and key not in missing:
+                missing[key] = text
+
+        if missing:
+            hits = sum(1 for key in keys if key not in missing)
+            print(f" -> 分词缓存命中 {hits}/{len(texts)}，新分词 {len(missing)} 条...")
+            for key, tokens in zip(missing.keys(), tokenize_many(missing.values())):
+                self.tokens[key] = tokens
+            self.dirty = True
+
+        return [self.tokens[key] for key in keys]
+
+    def prune(self, texts):
+        """只保留当前语料对应的缓存条目 (重建后清理已删除的子块)"""
+        self.retain({text_hash(t) for t in texts})
+
+    def retain(self, alive):
+        """只保留给定内容哈希的缓存条目 (流式重建时逐批收集哈希，不必保留全部文本)"""
+        if len(alive) != len(self.tokens):
+            self.tokens = {k: v for k, v in self.tokens.items() if k in alive}
+            self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": TOKENIZER_VERSION, "tokens": self.tokens}, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
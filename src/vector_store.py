@@ -0,0 +1,545 @@
+"""
+向量检索后端 (vector_store.py)
+功能: 可插拔的向量检索实现
+  - chroma: LangChain → Chroma (sqlite + hnsw)，默认
+  - matrix: 进程内 float32/float16 向量矩阵 (np.memmap) + BLAS 矩阵乘暴力检索
+  - hnsw:   进程内 hnswlib 索引 (未安装 hnswlib 时自动降级为 matrix)
+  - int8 / binary: 量化码常驻内存做粗排 (int8 点积 / 汉明距离)，候选再用磁盘上的全精度向量精排
+ingest 阶段会同时写 Chroma 和 matrix 索引文件，检索时通过 RAG_VECTOR_BACKEND 选择。
+
+matrix_index 目录是可追加的裸二进制行存储 (向量 / 量化码 / ids 各一个文件 + meta.json):
+  - 单文件入库时只在末尾追加新行，ids 最后写，ids 的行数即已提交的行数
+  - 删除只把对应行的 id 改写为 -1 (墓碑)，检索时跳过，全量重建时自然压实
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+MATRIX_DIR_NAME = "matrix_index"
+META_FILE = "meta.json"
+VECTORS_FILE = "vectors.bin"
+IDS_FILE = "ids.i64"
+HNSW_FILE = "vectors.hnsw"
+INT8_CODES_FILE = "codes_int8.i8"
+INT8_SCALE_FILE = "codes_int8_scale.npy"
+BINARY_CODES_FILE = "codes_binary.u8"
+
+VECTOR_BACKEND = os.environ.get("RAG_VECTOR_BACKEND", "chroma")      # chroma / matrix / hnsw / int8 / binary
+MATRIX_DTYPE = os.environ.get("RAG_MATRIX_DTYPE", "float32")          # float32 / float16 (磁盘存储精度)
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+# 量化粗排候选数 = k × 倍数 (binary 信息量更少，需要更多候选来保证召回)
+RESCORE_FACTOR = {
+    "int8": int(os.environ.get("RAG_INT8_RESCORE_FACTOR", "4")),
+    "binary": int(os.environ.get("RAG_BINARY_RESCORE_FACTOR", "10")),
+}
+SCAN_BLOCK_ROWS = 65536  # 分块扫描，限制 int8 → float32 转换的临时内存
+VECTOR_FETCH_BATCH = 1000  # 从 Chroma 读取子块向量时每批条数
+
+# 0~255 每个字节中 1 的个数，用于汉明距离 popcount
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def quantize_int8(matrix, scale=None):
+    """按维度对称量化到 int8，返回 (codes, scale)，x ≈ codes * scale (增量追加时沿用已有的 scale)"""
+    if scale is None:
+        scale = np.abs(matrix).max(axis=0) / 127.0
+        scale[scale == 0] = 1.0
+    codes = np.clip(np.rint(matrix / scale), -127, 127).astype(np.int8)
+    return codes, scale.astype(np.float32)
+
+
+def quantize_binary(matrix):
+    """按符号位量化为 1-bit 并打包，384 维 → 48 字节"""
+    return np.packbits(matrix > 0, axis=1)
+
+
+# ============================================================
+# 行文件读写
+# ============================================================
+
+def _read_meta(index_dir):
+    meta_path = os.path.join(index_dir, META_FILE)
+    if not os.path.exists(meta_path):
+        raise FileNotFoundError(f"找不到向量矩阵索引: {index_dir}，请重新构建知识库")
+    with open(meta_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _read_rows(path, dtype, width, n_rows, mmap=True):
+    """读取裸二进制行文件的前 n_rows 行 (多出的未提交半行被忽略)"""
+    if n_rows == 0 or width == 0:
+        return np.zeros((0, width), dtype=dtype)
+    if mmap:
+        data = np.memmap(path, dtype=dtype, mode="r", shape=(n_rows * width,))
+    else:
+        data = np.fromfile(path, dtype=dtype, count=n_rows * width)
+    return data.reshape(n_rows, width)
+
+
+def _append_rows(path, array):
+    with open(path, "ab") as f:
+        f.write(np.ascontiguousarray(array).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _append_to_dir(index_dir, chunk_ids, normalized, dtype, int8_scale):
+    """追加行：先写向量与量化码，最后写 ids (中途崩溃时多出的行不会被读到)"""
+    if not len(normalized):
+        return
+    _append_rows(os.path.join(index_dir, VECTORS_FILE), normalized.astype(dtype))
+    _append_rows(os.path.join(index_dir, INT8_CODES_FILE), quantize_int8(normalized, int8_scale)[0])
+    _append_rows(os.path.join(index_dir, BINARY_CODES_FILE), quantize_binary(normalized))
+    _append_rows(os.path.join(index_dir, IDS_FILE), np.asarray(chunk_ids, dtype=np.int64))
+
+
+# ============================================================
+# 写入 (ingest 调用)
+# ============================================================
+
+class MatrixIndexWriter:
+    """
+    分批全量写出 (流式重建时边 embedding 边写，不在内存中攒全部向量)
+    向量与 ids 逐批追加到临时目录；commit 时按全量的逐维最大值确定 int8 scale，再分块读回生成量化码 / HNSW，
+    最后整体替换 matrix_index 目录；abort 丢弃临时目录
+    """
+
+    def __init__(self, db_dir, dtype=MATRIX_DTYPE):
+        self.index_dir = os.path.join(db_dir, MATRIX_DIR_NAME)
+        self.tmp_dir = self.index_dir + ".tmp"
+        self.dtype = dtype
+        self.dim = None
+        self.count = 0
+        self._abs_max = None
+        if os.path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+        os.makedirs(self.tmp_dir)
+        for name in (VECTORS_FILE, INT8_CODES_FILE, BINARY_CODES_FILE, IDS_FILE):
+            open(os.path.join(self.tmp_dir, name), "wb").close()
+
+    def add(self, chunk_ids, embeddings):
+        """向量按行 L2 归一化，检索时点积即余弦相似度"""
+        if not len(chunk_ids):
+            return
+        normalized = _normalize(np.asarray(embeddings, dtype=np.float32).reshape(len(chunk_ids), -1))
+        if self.dim is None:
+            self.dim = normalized.shape[1]
+            self._abs_max = np.zeros(self.dim, dtype=np.float32)
+        np.maximum(self._abs_max, np.abs(normalized).max(axis=0), out=self._abs_max)
+        _append_rows(os.path.join(self.tmp_dir, VECTORS_FILE), normalized.astype(self.dtype))
+        _append_rows(os.path.join(self.tmp_dir, IDS_FILE), np.asarray(chunk_ids, dtype=np.int64))
+        self.count += len(chunk_ids)
+
+    def commit(self):
+        """整体替换 matrix_index 目录，返回其路径；一行向量都没有时 (空知识库) 删除旧索引并返回 None"""
+        if self.dim is None:
+            # 没有向量就不知道维度，不写空索引: 检索端找不到索引时降级为 Chroma (空集合)，之后的增量入库重新全量写出
+            self.abort()
+            remove_matrix_index(os.path.dirname(self.index_dir))
+            return None
+        with open(os.path.join(self.tmp_dir, META_FILE), "w", encoding="utf-8") as f:
+            json.dump({"dim": self.dim, "dtype": self.dtype}, f)
+
+        # 量化 scale 以全量数据确定，之后的增量追加沿用
+        int8_scale = self._abs_max / 127.0
+        int8_scale[int8_scale == 0] = 1.0
+        np.save(os.path.join(self.tmp_dir, INT8_SCALE_FILE), int8_scale)
+        vectors = _read_rows(os.path.join(self.tmp_dir, VECTORS_FILE), self.dtype, self.dim, self.count)
+        index = None
+        if hnswlib is not None:
+            index = hnswlib.Index(space="ip", dim=self.dim)
+            index.init_index(max_elements=self.count, ef_construction=HNSW_EF_CONSTRUCTION, M=HNSW_M)
+        for start in range(0, self.count, SCAN_BLOCK_ROWS):
+            block = np.asarray(vectors[start:start + SCAN_BLOCK_ROWS], dtype=np.float32)
+            _append_rows(os.path.join(self.tmp_dir, INT8_CODES_FILE), quantize_int8(block, int8_scale)[0])
+            _append_rows(os.path.join(self.tmp_dir, BINARY_CODES_FILE), quantize_binary(block))
+            if index is not None:
+                index.add_items(block, np.arange(start, start + len(block)))
+        del vectors
+        if index is not None:
+            index.save_index(os.path.join(self.tmp_dir, HNSW_FILE))
+
+        # 写完再整体替换，避免检索端读到半成品
+        if os.path.exists(self.index_dir):
+            shutil.rmtree(self.index_dir)
+        os.replace(self.tmp_dir, self.index_dir)
+        return self.index_dir
+
+    def abort(self):
+        if os.path.exists(self.tmp_dir):
+            shutil.rmtree(self.tmp_dir)
+
+
+def write_matrix_index(db_dir, chunk_ids, embeddings, dtype=MATRIX_DTYPE):
+    """全量写出向量矩阵 + 行号 → chunk_id 侧车文件 + 量化码 (没有任何行时不写，返回 None)"""
+    writer = MatrixIndexWriter(db_dir, dtype=dtype)
+    writer.add(chunk_ids, embeddings)
+    return writer.commit()
+
+
+def append_matrix_index(db_dir, chunk_ids, embeddings):
+    """
+    增量追加 (单文件入库)：只写新增的行，开销与新增子块数成正比
+    索引不存在或为空时退化为全量写出
+    """
+    index_dir = os.path.join(db_dir, MATRIX_DIR_NAME)
+    if not len(chunk_ids):
+        return index_dir
+    try:
+        meta = _read_meta(index_dir)
+    except FileNotFoundError:
+        return write_matrix_index(db_dir, chunk_ids, embeddings)
+    ids_path = os.path.join(index_dir, IDS_FILE)
+    n_before = os.path.getsize(ids_path) // 8
+    if n_before == 0:
+        return write_matrix_index(db_dir, chunk_ids, embeddings, dtype=meta["dtype"])
+
+    # 上次追加中途崩溃时，向量 / 量化码文件可能比 ids 多出未提交的行，先截断对齐
+    dim = meta["dim"]
+    row_bytes = {VECTORS_FILE: dim * np.dtype(meta["dtype"]).itemsize,
+                 INT8_CODES_FILE: dim, BINARY_CODES_FILE: (dim + 7) // 8}
+    for name, width in row_bytes.items():
+        path = os.path.join(index_dir, name)
+        if os.path.getsize(path) > n_before * width:
+            os.truncate(path, n_before * width)
+
+    normalized = _normalize(np.asarray(embeddings, dtype=np.float32).reshape(len(chunk_ids), dim))
+    int8_scale = np.load(os.path.join(index_dir, INT8_SCALE_FILE))
+    _append_to_dir(index_dir, chunk_ids, normalized, meta["dtype"], int8_scale)
+
+    hnsw_path = os.path.join(index_dir, HNSW_FILE)
+    if hnswlib is not None and os.path.exists(hnsw_path) and len(normalized):
+        index = hnswlib.Index(space="ip", dim=dim)
+        index.load_index(hnsw_path, max_elements=n_before + len(normalized))
+        index.add_items(normalized, np.arange(n_before, n_before + len(normalized)))
+        index.save_index(hnsw_path)
+    return index_dir
+
+
+def delete_from_matrix_index(db_dir, chunk_ids):
+    """按 chunk_id 打墓碑 (原地把 id 改写为 -1)，返回删除的行数"""
+    index_dir = os.path.join(db_dir, MATRIX_DIR_NAME)
+    ids_path = os.path.join(index_dir, IDS_FILE)
+    if not len(chunk_ids) or not os.path.exists(ids_path) or os.path.getsize(ids_path) == 0:
+        return 0
+
+    ids = np.memmap(ids_path, dtype=np.int64, mode="r+")
+    rows = np.flatnonzero(np.isin(ids, np.asarray(chunk_ids, dtype=np.int64)))
+    if len(rows):
+        ids[rows] = -1
+        ids.flush()
+    n_rows = len(ids)
+    del ids
+
+    hnsw_path = os.path.join(index_dir, HNSW_FILE)
+    if hnswlib is not None and os.path.exists(hnsw_path) and len(rows):
+        index = hnswlib.Index(space="ip", dim=_read_meta(index_dir)["dim"])
+        index.load_index(hnsw_path, max_elements=n_rows)
+        for row in rows:
+            index.mark_deleted(int(row))
+        index.save_index(hnsw_path)
+    return len(rows)
+
+
+def has_matrix_index(db_dir):
+    return os.path.exists(os.path.join(db_dir, MATRIX_DIR_NAME, META_FILE))
+
+
+def remove_matrix_index(db_dir):
+    index_dir = os.path.join(db_dir, MATRIX_DIR_NAME)
+    if os.path.exists(index_dir):
+        shutil.rmtree(index_dir)
+
+
+# ============================================================
+# 检索后端
+# ============================================================
+
+class ChromaVectorStore:
+    """
+    默认后端：直接查询底层 Chroma collection
+    只取 id 与距离，不构造 Document、不解码 metadata
+    """
+    name = "chroma"
+
+    def __init__(self, vector_db, resolve_ids=None):
+        """:param resolve_ids: Chroma 字符串 id 列表 → chunk_id 数组 (兼容旧库的 uuid id)"""
+        self.vector_db = vector_db
+        self._resolve_ids = resolve_ids or (lambda ids: np.asarray([int(i) for i in ids], dtype=np.int64))
+
+    def align(self, chunk_ids):
+        pass  # Chroma 按 where 子句过滤，不需要行号对齐
+
+    def reload(self):
+        pass  # Chroma 写入即可见
+
+    def search(self, query_vector, k, rows=None, where=None):
+        """
+        返回按相似度降序排列的 chunk_id 数组
+        :param where: Chroma where 子句 (元数据过滤下推到 Chroma 内部)
+        """
+        kwargs = {"where": where} if where else {}
+        result = self.vector_db._collection.query(
+            query_embeddings=[list(query_vector)], n_results=k, include=["distances"], **kwargs
+        )
+        return self._resolve_ids(result["ids"][0])
+
+    def vectors(self, chunk_ids):
+        """chunk_id 数组 → 单位向量 (n, dim)，从 Chroma 分批读取；取不到的 (旧库的 uuid id) 为全 0 行"""
+        chunk_ids = [str(int(c)) for c in chunk_ids]
+        found = {}
+        for start in range(0, len(chunk_ids), VECTOR_FETCH_BATCH):
+            rows = self.vector_db._collection.get(ids=chunk_ids[start:start + VECTOR_FETCH_BATCH], include=["embeddings"])
+            found.update(zip(rows["ids"], rows["embeddings"]))
+        if not found:
+            return np.zeros((len(chunk_ids), 0), dtype=np.float32)
+        dim = len(next(iter(found.values())))
+        matrix = np.zeros((len(chunk_ids), dim), dtype=np.float32)
+        for i, cid in enumerate(chunk_ids):
+            if cid in found:
+                matrix[i] = found[cid]
+        return _normalize(matrix)
+
+    def memory_bytes(self):
+        return 0  # 数据在 Chroma 进程内缓存中，不单独统计
+
+
+def _top_k_indices(scores, k):
+    """从分数数组中取 Top-K 下标 (降序)"""
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.array([], dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+def _unit(query_vector):
+    q = np.asarray(query_vector, dtype=np.float32)
+    return q / (np.linalg.norm(q) or 1.0)
+
+
+class MatrixVectorStore:
+    """进程内矩阵后端：一次矩阵乘得到全部相似度，argpartition 取 Top-K"""
+    name = "matrix"
+
+    def __init__(self, db_dir):
+        self.index_dir = os.path.join(db_dir, MATRIX_DIR_NAME)
+        self._aligned_chunk_ids = None
+        self.reload()
+
+    def reload(self):
+        """重新映射索引文件 (增量入库 / 删除之后调用)"""
+        self._load_sidecar()
+        # float32 直接 mmap，按需分页；float16 需转换为 float32 才能走 BLAS
+        matrix = _read_rows(self.vectors_path, self.dtype, self.dim, len(self.chunk_ids))
+        self.matrix = matrix if matrix.dtype == np.float32 else np.asarray(matrix, dtype=np.float32)
+        self._realign()
+
+    def _load_sidecar(self):
+        meta = _read_meta(self.index_dir)
+        self.dim = meta["dim"]
+        self.dtype = np.dtype(meta["dtype"])
+        self.vectors_path = os.path.join(self.index_dir, VECTORS_FILE)
+
+        # id 为 -1 的行是墓碑
+        self.chunk_ids = np.fromfile(os.path.join(self.index_dir, IDS_FILE), dtype=np.int64)
+        self._dead = self.chunk_ids < 0
+        self._aligned_rows = None
+
+    def _realign(self):
+        if self._aligned_chunk_ids is not None:
+            self.align(self._aligned_chunk_ids)
+
+    def align(self, chunk_ids):
+        """建立 chunk_store 行号 → 矩阵行号的映射 (过滤检索时把允许的行换算到本矩阵)"""
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        self._aligned_chunk_ids = chunk_ids
+        order = np.argsort(self.chunk_ids, kind="stable")
+        sorted_ids = self.chunk_ids[order]
+        if len(sorted_ids) == 0:
+            self._aligned_rows = np.full(len(chunk_ids), -1, dtype=np.int64)
+            return
+        pos = np.clip(np.searchsorted(sorted_ids, chunk_ids), 0, len(sorted_ids) - 1)
+        found = (sorted_ids[pos] == chunk_ids) & (chunk_ids >= 0)
+        self._aligned_rows = np.where(found, order[pos], -1)
+
+    def _matrix_rows(self, rows):
+        if rows is None:
+            return None
+        rows = np.asarray(rows, dtype=np.int64)
+        if self._aligned_rows is not None:
+            rows = self._aligned_rows[rows]
+        return np.sort(rows[rows >= 0])
+
+    def _mask_dead(self, scores):
+        """全库检索时把墓碑行的分数压到最低"""
+        if self._dead.any():
+            scores[self._dead] = -np.inf
+        return scores
+
+    def _top_k(self, query_vector, k, rows=None):
+        q = _unit(query_vector)
+        if rows is None:
+            k = min(k, len(self._dead) - int(self._dead.sum()))
+            return _top_k_indices(self._mask_dead(self.matrix @ q), k)
+        # 过滤检索：只对允许的行做矩阵乘，过滤越严格越快
+        return rows[_top_k_indices(np.asarray(self.matrix[rows], dtype=np.float32) @ q, k)]
+
+    def search(self, query_vector, k, rows=None, where=None):
+        """
+        返回按相似度降序排列的 chunk_id 数组
+        :param rows: 允许检索的 chunk_store 行号 (元数据过滤 / 分层路由的结果)，None 表示全库
+        """
+        return self.chunk_ids[self._top_k(query_vector, k, rows=self._matrix_rows(rows))]
+
+    def vectors(self, chunk_ids):
+        """chunk_id 数组 → 单位向量 (n, dim)，不在索引中的为全 0 行"""
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        out = np.zeros((len(chunk_ids), self.dim), dtype=np.float32)
+        live = np.flatnonzero(~self._dead)
+        if not len(chunk_ids) or not len(live):
+            return out
+        order = live[np.argsort(self.chunk_ids[live], kind="stable")]
+        sorted_ids = self.chunk_ids[order]
+        pos = np.minimum(np.searchsorted(sorted_ids, chunk_ids), len(sorted_ids) - 1)
+        found = sorted_ids[pos] == chunk_ids
+        matrix_rows = order[pos[found]]
+        # 按行号排序后读取，顺序访问 mmap
+        read_order = np.argsort(matrix_rows, kind="stable")
+        values = np.empty((len(matrix_rows), self.dim), dtype=np.float32)
+        values[read_order] = np.asarray(self.matrix[matrix_rows[read_order]], dtype=np.float32)
+        out[np.flatnonzero(found)] = values
+        return out
+
+    def memory_bytes(self):
+        return int(self.matrix.nbytes)
+
+
+class HnswVectorStore(MatrixVectorStore):
+    """hnswlib 近似最近邻后端，复用 matrix 的侧车文件 (删除的行在 HNSW 中标记删除)"""
+    name = "hnsw"
+
+    def reload(self):
+        super().reload()
+        hnsw_path = os.path.join(self.index_dir, HNSW_FILE)
+        if not os.path.exists(hnsw_path):
+            raise FileNotFoundError(f"找不到 HNSW 索引文件: {hnsw_path}")
+        self.index = hnswlib.Index(space="ip", dim=self.dim)
+        self.index.load_index(hnsw_path, max_elements=len(self.chunk_ids))
+        self.index.set_ef(HNSW_EF_SEARCH)
+
+    def _top_k(self, query_vector, k, rows=None):
+        if rows is not None:
+            # 过滤后的子集直接精确暴力检索，比带回调的 HNSW 过滤更快
+            return super()._top_k(query_vector, k, rows=rows)
+        k = min(k, len(self.chunk_ids) - int(self._dead.sum()))
+        if k <= 0:
+            return np.array([], dtype=np.int64)
+        labels, _ = self.index.knn_query(_unit(query_vector), k=k)
+        return labels[0]
+
+
+class QuantizedVectorStore(MatrixVectorStore):
+    """
+    量化后端：内存里只放量化码
+      - int8:   每条 384 字节 (float32 的 1/4)，粗排用 int8 点积
+      - binary: 每条 48 字节 (float32 的 1/32)，粗排用汉明距离
+    粗排取 k × RESCORE_FACTOR 个候选，再从 mmap 的全精度向量中读取这些行精排
+    """
+
+    def __init__(self, db_dir, mode="int8"):
+        if mode not in RESCORE_FACTOR:
+            raise ValueError(f"未知的量化模式: {mode}")
+        self.name = mode
+        self.mode = mode
+        super().__init__(db_dir)
+
+    def reload(self):
+        self._load_sidecar()
+        n_rows = len(self.chunk_ids)
+        if self.mode == "int8":
+            codes_path = os.path.join(self.index_dir, INT8_CODES_FILE)
+            width, dtype = self.dim, np.int8
+            self.scale = np.load(os.path.join(self.index_dir, INT8_SCALE_FILE))
+        else:
+            codes_path = os.path.join(self.index_dir, BINARY_CODES_FILE)
+            width, dtype = (self.dim + 7) // 8, np.uint8
+        if not os.path.exists(codes_path):
+            raise FileNotFoundError(f"找不到量化码文件: {codes_path}，请重新构建知识库")
+        self.codes = _read_rows(codes_path, dtype, width, n_rows, mmap=False)
+
+        # 全精度向量只做 mmap，不常驻内存
+        self.matrix = _read_rows(self.vectors_path, self.dtype, self.dim, n_rows)
+        self._realign()
+
+    def _coarse_scores(self, q, codes):
+        """粗排分数 (越大越相似)"""
+        if self.mode == "binary":
+            q_bits = np.packbits(q > 0)
+            # 汉明距离取负，保持“越大越相似”
+            hamming = _POPCOUNT[np.bitwise_xor(codes, q_bits)].sum(axis=1, dtype=np.int32)
+            return -hamming.astype(np.float32)
+
+        # int8: codes · (q * scale)，分块转换避免整表 float32 临时副本
+        q_scaled = q * self.scale
+        scores = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), SCAN_BLOCK_ROWS):
+            block = codes[start:start + SCAN_BLOCK_ROWS]
+            scores[start:start + len(block)] = block.astype(np.float32) @ q_scaled
+        return scores
+
+    def _top_k(self, query_vector, k, rows=None):
+        q = _unit(query_vector)
+        if rows is None:
+            coarse = self._mask_dead(self._coarse_scores(q, self.codes))
+        else:
+            coarse = self._coarse_scores(q, self.codes[rows])
+        candidates = _top_k_indices(coarse, k * RESCORE_FACTOR[self.mode])
+        if rows is not None:
+            candidates = rows[candidates]
+        candidates = candidates[~self._dead[candidates]]
+        if len(candidates) == 0:
+            return candidates
+
+        # 精排: 候选按行号排序后读取，顺序访问 mmap 更友好
+        candidates = np.sort(candidates)
+        exact = np.asarray(self.matrix[candidates], dtype=np.float32) @ q
+        return candidates[_top_k_indices(exact, k)]
+
+    def memory_bytes(self):
+        return int(self.codes.nbytes)
+
+
+def load_vector_store(vector_db, db_dir, backend=VECTOR_BACKEND, resolve_ids=None):
+    """按名称创建检索后端，进程内索引缺失时降级为 Chroma"""
+    if backend == "hnsw" and hnswlib is None:
+        print("⚠️ 未安装 hnswlib，向量后端降级为 matrix")
+        backend = "matrix"
+
+    try:
+        if backend in RESCORE_FACTOR:
+            return QuantizedVectorStore(db_dir, mode=backend)
+        if backend == "hnsw":
+            return HnswVectorStore(db_dir)
+        if backend == "matrix":
+            return MatrixVectorStore(db_dir)
+    except FileNotFoundError as e:
+        print(f"⚠️ {e}，向量后端降级为 chroma")
+
+    return ChromaVectorStore(vector_db, resolve_ids=resolve_ids)
@@ -0,0 +1,46 @@
+"""
+测试共用: 用确定性的字符哈希向量代替 Embedding 模型，不加载 Reranker；Chroma、矩阵索引、BM25 均为真实实现
+"""
+
+import os
+import sys
+import zlib
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '../src'))
+
+from resources import ResourceManager
+
+
+class HashEmbeddings:
+    """按字符哈希计数的归一化向量，同样的文本永远得到同样的向量"""
+    dim = 64
+
+    def embed_documents(self, texts):
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for ch in text:
+                vectors[i, zlib.crc32(ch.encode()) % self.dim] += 1
+        vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors.tolist()
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+class LocalResources(ResourceManager):
+    def embedding_model(self):
+        with self._lock:
+            if self._embedding_model is None:
+                self._embedding_model = HashEmbeddings()
+            return self._embedding_model
+
+    def reranker(self):
+        return None
+
+
+@pytest.fixture
+def resources():
+    return LocalResources()
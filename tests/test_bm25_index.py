@@ -0,0 +1,78 @@
+"""
+BM25Index 与 rank_bm25.BM25Okapi 的打分一致性 (含增量追加 / 删除与空索引)
+运行: python -m pytest -q tests
+"""
+
+import numpy as np
+import pytest
+
+from bm25_index import BM25Index
+
+rank_bm25 = pytest.importorskip("rank_bm25")
+
+# "员工" 出现在超过半数的文档中 (idf 为负，走 epsilon × 平均 idf 的分支)
+CORPUS = [
+    ["员工", "报销", "流程", "发票", "报销"],
+    ["员工", "年假", "工龄", "计算"],
+    ["员工", "出差", "住宿", "标准", "城市"],
+    ["合同", "违约", "责任", "赔偿"],
+    ["员工", "加班", "加班费", "申请", "审批"],
+    ["报销", "审批", "系统", "提交"],
+    ["员工", "报销", "差旅", "住宿", "发票", "审批"],
+]
+QUERIES = [["报销", "发票"], ["员工", "年假"], ["住宿", "标准", "员工"], ["不存在的词"], ["审批", "审批", "系统"]]
+
+
+def reference_scores(corpus, query):
+    return rank_bm25.BM25Okapi(corpus).get_scores(query)
+
+
+@pytest.mark.parametrize("query", QUERIES)
+def test_scores_match_bm25okapi(query):
+    index = BM25Index(CORPUS)
+    np.testing.assert_allclose(index.get_scores(query), reference_scores(CORPUS, query), rtol=1e-5, atol=1e-6)
+
+
+def test_add_matches_full_build():
+    index = BM25Index(CORPUS[:3])
+    rows = index.add(CORPUS[3:])
+    assert rows.tolist() == list(range(3, len(CORPUS)))
+    for query in QUERIES:
+        np.testing.assert_allclose(index.get_scores(query), reference_scores(CORPUS, query), rtol=1e-5, atol=1e-6)
+
+
+def test_remove_matches_rebuild_over_survivors():
+    index = BM25Index(CORPUS)
+    removed = [1, 4]
+    index.remove(removed)
+    index.remove([1])  # 重复删除不再改变统计
+    survivors = [row for row in range(len(CORPUS)) if row not in removed]
+    assert index.corpus_size == len(survivors)
+    assert len(index) == len(CORPUS)
+
+    for query in QUERIES:
+        scores = index.get_scores(query)
+        assert not scores[removed].any()
+        expected = reference_scores([CORPUS[row] for row in survivors], query)
+        np.testing.assert_allclose(scores[survivors], expected, rtol=1e-5, atol=1e-6)
+
+
+def test_batch_scores_match_full_scores():
+    index = BM25Index(CORPUS)
+    index.remove([2])
+    rows = np.array([6, 2, 0, 5, 3])
+    for query in QUERIES:
+        np.testing.assert_allclose(index.get_batch_scores(query, rows), index.get_scores(query)[rows], rtol=1e-6)
+
+
+def test_empty_index():
+    index = BM25Index()
+    assert index.corpus_size == 0
+    assert len(index.get_scores(["报销"])) == 0
+    assert len(index.get_batch_scores(["报销"], [])) == 0
+
+    index.add(CORPUS[:2])
+    index.remove([0, 1])
+    assert index.corpus_size == 0
+    assert not index.get_scores(["员工"]).any()
+    assert not index.get_batch_scores(["员工"], [0, 1]).any()
@@ -0,0 +1,115 @@
+"""
+近似重复子块合并 (MinHash + LSH) 与 dup_refs 记录的维护，不依赖 Embedding 模型
+运行: python -m pytest -q tests
+"""
+
+import json
+
+from langchain_core.documents import Document
+
+from dedup import (
+    DocumentDeduper, find_near_duplicates, merge_dup_metadata, drop_dup_source, load_dup_refs, dup_ref,
+)
+
+FOOTER = "免责声明：本文件内容仅供公司内部参考使用，未经书面许可不得对外传播、复制或者引用，违者将依法追究相关责任。" * 3
+OTHER = "年假按照员工累计工作年限计算，满一年不满十年的每年五天，满十年不满二十年的每年十天，满二十年的每年十五天。" * 3
+
+
+def doc(text, source, chunk_id):
+    return Document(page_content=text, metadata={"source": source, "page": 0, "chunk_id": chunk_id})
+
+
+# ============================================================
+# find_near_duplicates
+# ============================================================
+
+def test_near_duplicate_is_merged():
+    text = "".join(f"第{i}条：员工应当按照流程提交第{i}类申请材料，并在{i + 2}个工作日内等待审批结果。" for i in range(20))
+    near = text.replace("第3类", "第三类", 1)  # 改动一处
+    spaced = "\n  " + text + "  \n"          # 只差首尾空白
+    rep = find_near_duplicates([text, OTHER, near, spaced])
+    assert rep.tolist() == [0, 1, 0, 0]
+
+
+def test_different_texts_are_kept():
+    rep = find_near_duplicates([FOOTER, OTHER, FOOTER[:40]])
+    assert rep.tolist() == [0, 1, 2]
+
+
+def test_threshold_zero_disables_dedup():
+    rep = find_near_duplicates([FOOTER, FOOTER, FOOTER], threshold=0)
+    assert rep.tolist() == [0, 1, 2]
+
+
+# ============================================================
+# DocumentDeduper: 批内合并与跨批次的 late_updates
+# ============================================================
+
+def test_filter_merges_within_batch():
+    deduper = DocumentDeduper()
+    docs = [doc(FOOTER, "docs/a.txt", 1), doc(FOOTER, "docs/a.txt", 2), doc(FOOTER, "docs/sub/b.txt", 3)]
+    kept, ids = deduper.filter(docs, ["1", "2", "3"])
+    assert ids == ["1"]
+    meta = kept[0].metadata
+    assert meta["dup_count"] == 2
+    assert meta["dup_sources"] == "b.txt"
+    assert meta["dup_files"] == 1
+    assert [ref["chunk_id"] for ref in load_dup_refs(meta)] == [3]
+    assert deduper.duplicates == 2 and not deduper.late_updates
+
+
+def test_late_updates_across_batches():
+    deduper = DocumentDeduper()
+    kept, ids = deduper.filter([doc(FOOTER, "docs/a.txt", 1), doc(OTHER, "docs/a.txt", 2)], ["1", "2"])
+    assert ids == ["1", "2"]
+
+    # 第二批的重复合并到第一批已写入的代表子块: 记入 late_updates，不改本批的 metadata
+    second = [doc(OTHER, "docs/b.txt", 3), doc(FOOTER, "docs/c.txt", 4), doc(FOOTER, "docs/b.txt", 5)]
+    kept, ids = deduper.filter(second, ["3", "4", "5"])
+    assert ids == []
+    assert deduper.duplicates == 3
+    assert set(deduper.late_updates) == {"1", "2"}
+    count, sources, refs = deduper.late_updates["1"]
+    assert count == 2 and sources == {"b.txt", "c.txt"}
+    assert sorted(ref["chunk_id"] for ref in refs) == [4, 5]
+
+    # 调用方最后补写: 与批内合并的结果一致
+    meta = dict(doc(FOOTER, "docs/a.txt", 1).metadata)
+    merge_dup_metadata(meta, count, sources, refs)
+    assert meta["dup_count"] == 2 and meta["dup_files"] == 2
+    assert meta["dup_sources"] == "b.txt|c.txt"
+
+
+# ============================================================
+# drop_dup_source: dup_count / dup_files / dup_sources 保持一致
+# ============================================================
+
+def representative():
+    meta = {"source": "docs/a.txt", "page": 0, "chunk_id": 1}
+    refs = [dup_ref({"source": "docs/财务/报销.txt", "chunk_id": 10}),
+            dup_ref({"source": "docs/财务/报销.txt", "chunk_id": 11}),
+            dup_ref({"source": "docs/人事/报销.txt", "chunk_id": 12}),
+            dup_ref({"source": "docs/c.txt", "chunk_id": 13})]
+    merge_dup_metadata(meta, 5, {"报销.txt", "c.txt"}, refs)  # 另有一条来自 a.txt 自己的重复
+    return meta
+
+
+def test_drop_dup_source_keeps_counts_consistent():
+    meta = representative()
+    assert (meta["dup_count"], meta["dup_files"], meta["dup_sources"]) == (5, 3, "c.txt|报销.txt")
+
+    assert drop_dup_source(meta, "docs/财务/报销.txt") == 2
+    assert meta["dup_count"] == 3
+    assert meta["dup_files"] == 2
+    # 另一个目录下的同名文件仍有记录，文件名保留
+    assert meta["dup_sources"] == "c.txt|报销.txt"
+    assert [ref["chunk_id"] for ref in json.loads(meta["dup_refs"])] == [12, 13]
+
+    assert drop_dup_source(meta, "docs/人事/报销.txt") == 1
+    assert (meta["dup_count"], meta["dup_files"], meta["dup_sources"]) == (2, 1, "c.txt")
+
+    assert drop_dup_source(meta, "docs/missing.txt") == 0
+    assert drop_dup_source(meta, "docs/c.txt") == 1
+    assert meta["dup_count"] == 1  # a.txt 自己的那条重复
+    assert meta["dup_files"] == 0
+    assert "dup_sources" not in meta and "dup_refs" not in meta
@@ -0,0 +1,85 @@
+"""
+单文件维护 (重新入库 / 删除) 与全量重建时跨文件去重合并的交互
+运行: python -m pytest -q tests
+"""
+
+import os
+
+import pytest
+
+import kb_manager
+from kb_manager import KnowledgeBaseManager, DEFAULT_KB
+from retrieval_filter import RetrievalFilter
+
+FOOTER = "免责声明：本文件内容仅供公司内部参考使用，未经书面许可不得对外传播、复制或者引用，违者将依法追究相关责任。" * 4
+
+
+def body(tag):
+    return "".join(f"{tag}部门第{i}条规定：员工应当按照{tag}流程提交申请材料并等待审批结果。" for i in range(12))
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch, resources):
+    monkeypatch.setattr(kb_manager, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(kb_manager, "KB_ROOT", str(tmp_path / "kbs"))
+    docs_dir = tmp_path / "docs"
+    for name in ("财务/报销.txt", "人事/报销.txt"):
+        path = docs_dir / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(body(name[:2]) + "\n\n" + FOOTER + "\n\n" + body(name[:2] * 2), encoding="utf-8")
+    manager = KnowledgeBaseManager(resources=resources)
+    success, msg = manager.rebuild_kb(DEFAULT_KB)
+    assert success, msg
+    yield manager
+    manager.close()
+
+
+def relative(manager, source):
+    return os.path.relpath(source, manager.paths(DEFAULT_KB)[0]).replace(os.sep, "/")
+
+
+def footer_sources(manager, rag):
+    """检索免责声明时命中的子块所属文件 (相对文档目录)"""
+    ids = rag._hybrid_search_ids("免责声明 对外传播", k=10, filters=RetrievalFilter())
+    return {relative(manager, d.metadata["source"])
+            for d in rag.chunk_store.documents(ids) if "免责声明" in d.page_content}
+
+
+def merged_owner(manager, rag):
+    """全量重建时合并了另一个文件重复内容的那个文件"""
+    owners = [d.metadata["source"] for d in rag.chunk_store.documents(rag.chunk_store.chunk_ids[rag.chunk_store.alive])
+              if d.metadata.get("dup_files")]
+    assert len(owners) == 1
+    return relative(manager, owners[0])
+
+
+def test_rebuild_merges_cross_file_duplicate(manager):
+    rag = manager.get(DEFAULT_KB)
+    owner = merged_owner(manager, rag)
+    assert footer_sources(manager, rag) == {owner}
+
+
+def test_reindex_owner_keeps_duplicate_retrievable(manager):
+    rag = manager.get(DEFAULT_KB)
+    owner = merged_owner(manager, rag)
+    other = ({"财务/报销.txt", "人事/报销.txt"} - {owner}).pop()
+
+    success, msg = manager.reindex_file(DEFAULT_KB, owner)
+    assert success, msg
+    assert footer_sources(manager, rag) == {owner, other}
+
+    manager.invalidate(DEFAULT_KB)
+    reloaded = manager.get(DEFAULT_KB)
+    assert footer_sources(manager, reloaded) == {owner, other}
+    assert reloaded.chunk_store.live_count == rag.chunk_store.live_count
+
+
+def test_delete_owner_rehomes_duplicate(manager):
+    rag = manager.get(DEFAULT_KB)
+    owner = merged_owner(manager, rag)
+    other = ({"财务/报销.txt", "人事/报销.txt"} - {owner}).pop()
+
+    success, msg = manager.delete_file(DEFAULT_KB, owner)
+    assert success, msg
+    assert footer_sources(manager, rag) == {other}
+    assert not rag.chunk_store.has_path(os.path.join(manager.paths(DEFAULT_KB)[0], os.path.normpath(owner)))
@@ -0,0 +1,43 @@
+"""
+向量化 RRF 融合与去重 (对照逐条累加的朴素实现)
+运行: python -m pytest -q tests
+"""
+
+import numpy as np
+
+from fusion import weighted_rrf, first_unique, RRF_K
+
+
+def naive_rrf(ranked_ids, weights, rrf_k=RRF_K):
+    scores, first_seen, position = {}, {}, 0
+    for ids, w in zip(ranked_ids, weights):
+        for rank, doc_id in enumerate(ids):
+            scores[doc_id] = scores.get(doc_id, 0.0) + w / (rrf_k + rank + 1)
+            first_seen.setdefault(doc_id, position)
+            position += 1
+    return sorted(scores.items(), key=lambda item: (-item[1], first_seen[item[0]]))
+
+
+def test_weighted_rrf_matches_naive():
+    ranked = [[5, 3, 9, 1], [3, 7, 5], [], [9, 2]]
+    weights = [1.0, 0.8, 2.0, 0.5]
+    ids, scores = weighted_rrf(ranked, weights=weights)
+    expected = naive_rrf(ranked, weights)
+    assert ids.tolist() == [doc_id for doc_id, _ in expected]
+    np.testing.assert_allclose(scores, [score for _, score in expected])
+
+
+def test_ties_keep_first_seen_order_and_top_k():
+    ids, scores = weighted_rrf([[10, 20], [20, 10]], top_k=1)
+    assert ids.tolist() == [10]
+    assert len(scores) == 1
+
+
+def test_empty_inputs():
+    ids, scores = weighted_rrf([[], []])
+    assert ids.dtype == np.int64 and not len(ids) and not len(scores)
+
+
+def test_first_unique_keeps_first_occurrence():
+    assert first_unique([4, 1, 4, 2, 1]).tolist() == [True, True, False, True, False]
+    assert not len(first_unique([]))
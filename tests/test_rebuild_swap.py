@@ -0,0 +1,86 @@
+"""
+全量重建切换为正式索引的中断恢复: 两次集合改名之间进程崩溃时，下次加载先补做切换
+运行: python -m pytest -q tests
+"""
+
+import pytest
+
+import ingest
+from ingest import create_vector_db, OLD_COLLECTION, STAGING_COLLECTION
+from resources import COLLECTION_NAME
+from rag_core02 import RAGSystem
+from inference_service import InferenceService
+from retrieval_filter import RetrievalFilter
+from rebuild_checkpoint import has_interrupted_rebuild, has_interrupted_swap
+
+
+class Crash(Exception):
+    pass
+
+
+def write_docs(docs_dir, tag):
+    docs_dir.mkdir(exist_ok=True)
+    for i in range(3):
+        (docs_dir / f"{i}.txt").write_text(
+            "".join(f"{tag}制度第{i}-{j}条：员工应当按照{tag}流程提交申请材料。" for j in range(20)), encoding="utf-8")
+
+
+@pytest.fixture
+def kb(tmp_path, resources):
+    docs_dir, db_dir = tmp_path / "docs", tmp_path / "db"
+    write_docs(docs_dir, "报销")
+    success, msg = create_vector_db(docs_dir=str(docs_dir), db_dir=str(db_dir), resources=resources)
+    assert success, msg
+    yield docs_dir, db_dir
+    resources.close()
+
+
+def crash_between_renames(monkeypatch, resources):
+    """正式集合改名为旧集合之后、临时集合改名为正式集合之前崩溃"""
+    rename = resources.rename_collection
+
+    def flaky(db_dir, old_name, new_name):
+        if old_name == STAGING_COLLECTION:
+            raise Crash()
+        return rename(db_dir, old_name, new_name)
+
+    monkeypatch.setattr(resources, "rename_collection", flaky)
+
+
+def load(db_dir, resources):
+    return RAGSystem(db_dir=str(db_dir), vector_backend="matrix", embedding_model=resources.embedding_model(),
+                     inference=InferenceService(resources.embedding_model(), None), resources=resources)
+
+
+def test_load_finishes_interrupted_swap(kb, resources, monkeypatch):
+    docs_dir, db_dir = kb
+    write_docs(docs_dir, "差旅")
+    with monkeypatch.context() as m:
+        crash_between_renames(m, resources)
+        success, _ = create_vector_db(docs_dir=str(docs_dir), db_dir=str(db_dir), resources=resources)
+        assert not success
+    assert resources.collection_names(str(db_dir)) == {OLD_COLLECTION, STAGING_COLLECTION}
+    assert has_interrupted_swap(str(db_dir))
+
+    rag = load(db_dir, resources)
+    assert resources.collection_names(str(db_dir)) == {COLLECTION_NAME}
+    assert not has_interrupted_rebuild(str(db_dir))
+    texts = rag.chunk_store.texts
+    assert texts and all("差旅" in t for t in texts)
+    ids = rag._hybrid_search_ids("差旅 申请材料", k=3, filters=RetrievalFilter())
+    assert len(ids) and all("差旅" in d.page_content for d in rag.chunk_store.documents(ids))
+    rag.inference.close()
+
+
+def test_rebuild_finishes_interrupted_swap(kb, resources, monkeypatch):
+    docs_dir, db_dir = kb
+    write_docs(docs_dir, "差旅")
+    with monkeypatch.context() as m:
+        crash_between_renames(m, resources)
+        success, _ = create_vector_db(docs_dir=str(docs_dir), db_dir=str(db_dir), resources=resources)
+        assert not success
+
+    success, msg = create_vector_db(docs_dir=str(docs_dir), db_dir=str(db_dir), resources=resources)
+    assert success, msg
+    assert resources.collection_names(str(db_dir)) == {COLLECTION_NAME}
+    assert not ingest.finish_interrupted_swap(str(db_dir), resources)
@@ -0,0 +1,66 @@
+"""
+按来源文件过滤检索: 向量 (Chroma where) 与 BM25 (行号掩码) 两路的范围一致，
+包括入库时合并进其它文件代表子块的重复内容
+运行: python -m pytest -q tests
+"""
+
+import os
+
+import pytest
+
+import kb_manager
+from kb_manager import KnowledgeBaseManager, DEFAULT_KB
+from retrieval_filter import RetrievalFilter
+
+FOOTER = "免责声明：本文件内容仅供公司内部参考使用，未经书面许可不得对外传播、复制或者引用，违者将依法追究相关责任。" * 4
+NAMES = ("财务制度.txt", "人事制度.txt")
+
+
+def body(tag):
+    return "".join(f"{tag}第{i}条规定：员工应当按照{tag}流程提交申请材料并等待审批结果。" for i in range(12))
+
+
+@pytest.fixture
+def rag(tmp_path, monkeypatch, resources):
+    monkeypatch.setattr(kb_manager, "DATA_DIR", str(tmp_path))
+    monkeypatch.setattr(kb_manager, "KB_ROOT", str(tmp_path / "kbs"))
+    docs_dir = tmp_path / "docs"
+    docs_dir.mkdir()
+    for name in NAMES:
+        (docs_dir / name).write_text(body(name[:2]) + "\n\n" + FOOTER + "\n\n" + body(name[:2] * 2), encoding="utf-8")
+    manager = KnowledgeBaseManager(resources=resources)
+    success, msg = manager.rebuild_kb(DEFAULT_KB)
+    assert success, msg
+    yield manager.get(DEFAULT_KB)
+    manager.close()
+
+
+def merged_rows(rag):
+    """合并了另一个文件重复内容的代表子块行号，及被合并的那个文件名"""
+    store = rag.chunk_store
+    rows = [r for r in store.live_rows() if store.documents(store.chunk_ids[[r]])[0].metadata.get("dup_files")]
+    assert rows
+    owner = os.path.basename(store.documents(store.chunk_ids[rows[:1]])[0].metadata["source"])
+    return rows, ({*NAMES} - {owner}).pop()
+
+
+def test_chroma_where_matches_allowed_rows(rag):
+    rows, merged_name = merged_rows(rag)
+    flt = RetrievalFilter(sources=[merged_name])
+    allowed = set(flt.allowed_rows(rag.chunk_store).tolist())
+    assert set(rows) <= allowed
+
+    hits = rag.vector_db._collection.get(where=flt.to_chroma_where(rag.chunk_store), include=[])
+    assert {int(i) for i in hits["ids"]} == set(rag.chunk_store.chunk_ids[sorted(allowed)].tolist())
+
+
+def test_filtered_vector_search_finds_merged_duplicate(rag):
+    rows, merged_name = merged_rows(rag)
+    flt = RetrievalFilter(sources=[merged_name])
+    query_vector = rag.inference.embed_query(FOOTER)
+    with rag._index_lock:
+        scope, where = rag._filter_scope(flt)
+        vector_ids, bm25_ids = rag._search_paths("免责声明 对外传播", query_vector, scope, where, k=5)
+    merged_ids = set(rag.chunk_store.chunk_ids[rows].tolist())
+    assert merged_ids & set(vector_ids.tolist())
+    assert merged_ids & set(bm25_ids.tolist())
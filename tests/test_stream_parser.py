@@ -0,0 +1,144 @@
+"""
+流式输出协议: <think> 增量解析、分帧合并与三种分帧格式
+运行: python -m pytest -q tests
+"""
+
+import json
+import struct
+
+from stream_parser import (
+    ThinkParser, FrameCoalescer, encode_frame, encode_frame_batch, parse_llm_line,
+    THOUGHT, CONTENT, RECLASSIFY, FRAME_CODES,
+)
+
+
+def run(chunks):
+    """逐段喂给解析器 (含 flush)，相邻同类片段合并后返回"""
+    parser = ThinkParser()
+    segments = []
+    for chunk in chunks:
+        segments += parser.feed(chunk)
+    segments += parser.flush()
+    merged = []
+    for kind, text in segments:
+        if merged and merged[-1][0] == kind and kind != RECLASSIFY:
+            merged[-1] = (kind, merged[-1][1] + text)
+        else:
+            merged.append((kind, text))
+    return parser, merged
+
+
+# ============================================================
+# ThinkParser
+# ============================================================
+
+def test_tags_split_across_chunks():
+    parser, segments = run(["  <thi", "nk>先看", "制度</th", "ink>", "答案是三天"])
+    assert segments == [(THOUGHT, "先看制度"), (CONTENT, "答案是三天")]
+    assert parser.thought == "先看制度"
+    assert parser.content == "答案是三天"
+
+
+def test_tag_split_into_single_characters():
+    parser, segments = run(list("<think>想</think>答"))
+    assert segments == [(THOUGHT, "想"), (CONTENT, "答")]
+
+
+def test_missing_open_tag_reclassifies_earlier_content():
+    parser, segments = run(["先想一下", "规定</th", "ink>", "正文"])
+    assert segments == [(CONTENT, "先想一下规定"), (RECLASSIFY, ""), (CONTENT, "正文")]
+    assert parser.thought == "先想一下规定"
+    assert parser.content == "正文"
+
+
+def test_unclosed_think_block_stays_thought():
+    parser, segments = run(["<think>还在想", "</thi"])
+    assert segments == [(THOUGHT, "还在想</thi")]
+    assert parser.thought == "还在想</thi"
+    assert parser.content == ""
+
+
+def test_plain_answer_keeps_angle_brackets():
+    parser, segments = run(["a <", "b> 与 <", "/t"])
+    assert segments == [(CONTENT, "a <b> 与 </t")]
+    assert parser.thought == ""
+
+
+def test_close_tag_after_think_block_is_content():
+    parser, segments = run(["<think>想</think>答", "案 </think> 结束"])
+    assert segments == [(THOUGHT, "想"), (CONTENT, "答案 </think> 结束")]
+    assert RECLASSIFY not in [kind for kind, _ in segments]
+
+
+# ============================================================
+# FrameCoalescer
+# ============================================================
+
+def test_coalescer_merges_same_kind_and_flushes_on_kind_change():
+    coalescer = FrameCoalescer(flush_ms=1000, max_chars=100)
+    assert coalescer.add(THOUGHT, "a", now=0.0) == []
+    assert coalescer.add(THOUGHT, "b", now=0.1) == []
+    assert coalescer.deadline == 1.0
+    assert coalescer.add(CONTENT, "c", now=0.2) == [(THOUGHT, "ab")]
+    assert coalescer.flush() == [(CONTENT, "c")]
+    assert coalescer.deadline is None
+    assert coalescer.flush() == []
+
+
+def test_coalescer_flushes_on_size_and_time():
+    coalescer = FrameCoalescer(flush_ms=50, max_chars=4)
+    assert coalescer.add(CONTENT, "ab", now=0.0) == []
+    assert coalescer.add(CONTENT, "cd", now=0.01) == [(CONTENT, "abcd")]
+    assert coalescer.add(CONTENT, "e", now=1.0) == []
+    assert coalescer.add(CONTENT, "f", now=1.06) == [(CONTENT, "ef")]
+
+
+def test_coalescer_passes_reclassify_through():
+    coalescer = FrameCoalescer(flush_ms=1000, max_chars=100)
+    coalescer.add(CONTENT, "x", now=0.0)
+    assert coalescer.add(RECLASSIFY, "", now=0.1) == [(CONTENT, "x"), (RECLASSIFY, "")]
+    assert coalescer.flush() == []
+
+
+# ============================================================
+# LLM 原始流与分帧格式
+# ============================================================
+
+def test_parse_llm_line():
+    assert parse_llm_line(b'data: {"choices": [{"delta": {"content": "\xe4\xbd\xa0"}}]}') == "你"
+    assert parse_llm_line("data: [DONE]") is None
+    assert parse_llm_line(": keep-alive") == ""
+    assert parse_llm_line('data: {"choices": []}') == ""
+
+
+def test_encode_frame_ndjson():
+    line = encode_frame("ndjson", "sources", [{"source": "报销.md"}])
+    assert line.endswith("\n")
+    assert json.loads(line) == {"type": "sources", "data": [{"source": "报销.md"}]}
+
+
+def test_encode_frame_sse():
+    frame = encode_frame("sse", CONTENT, "你好\n世界")
+    assert frame.startswith("event: content\ndata: ") and frame.endswith("\n\n")
+    assert json.loads(frame[len("event: content\ndata: "):-2]) == "你好\n世界"
+
+
+def decode_binary(data):
+    frames = []
+    while data:
+        code, length = struct.unpack(">BI", data[:5])
+        frames.append((code, data[5:5 + length].decode("utf-8")))
+        data = data[5 + length:]
+    return frames
+
+
+def test_encode_frame_binary():
+    assert decode_binary(encode_frame("binary", CONTENT, "正文")) == [(FRAME_CODES[CONTENT], "正文")]
+    intent = decode_binary(encode_frame("binary", "intent", "KB"))
+    assert intent == [(FRAME_CODES["intent"], json.dumps("KB"))]
+
+    batch = encode_frame_batch("binary", [(THOUGHT, "想"), (RECLASSIFY, ""), (CONTENT, "答")])
+    assert isinstance(batch, bytes)
+    assert decode_binary(batch) == [(FRAME_CODES[THOUGHT], "想"), (FRAME_CODES[RECLASSIFY], '""'),
+                                    (FRAME_CODES[CONTENT], "答")]
+    assert encode_frame_batch("ndjson", [(THOUGHT, "想"), (CONTENT, "答")]).count("\n") == 2